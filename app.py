@@ -9,7 +9,7 @@ import random
 import os
 import threading
 #from flask_cors import CORS
-from remote_server import RemoteServer
+from remote_server import RemoteServer, parse_wait
 import config
 import logging
 from database import database
@@ -47,13 +47,32 @@ class HTTPServer (object):
         @app.route('/api/open_tunnel', methods=['POST'])
         def open_tunnel():
             options = request.json
+            if options.get("wait") is not None:
+                try:
+                    parse_wait(options["wait"])
+                except ValueError:
+                    return '{"status": "error", "reason": "bad wait"}', 400
             return rem_server.open_tunnel(options)
 
+        @app.route('/api/tunnel_status')
+        def get_tunnel_status():
+            tunnel_id = int(request.args.get('tunnel_id'))
+            try:
+                wait = parse_wait(request.args.get('wait') or 0)
+            except ValueError:
+                return '{"status": "error", "reason": "bad wait"}', 400
+            return rem_server.get_tunnel_status(tunnel_id, wait)
+
         @app.route('/api/close_tunnel')
         def close_tunnel():
             tunnel_id = int(request.args.get('tunnel_id'))
             return rem_server.close_tunnel(tunnel_id)
         
+        @app.route('/api/tunnel_stats')
+        def get_tunnel_stats():
+            tunnel_id = request.args.get('tunnel_id')
+            return rem_server.get_tunnel_stats(int(tunnel_id) if tunnel_id else None)
+
         @app.route('/api/get_client_status')
         def get_slaver_status():
             id = int(request.args.get('id'))
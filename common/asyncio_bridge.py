@@ -0,0 +1,294 @@
+"""
+An asyncio implementation of the SocketBridge. The pairs are relayed by asyncio transports,
+which do the write buffering themselves, and the flow control is done with
+transport pause_reading() / resume_reading() driven by the peer's write buffer limits.
+Rate limits pause reading the same way, till the token buckets are refilled. The transports
+read whatever is ready, so the weights of the fair scheduling and the adaptive read size
+of the profiles are not applied here, the profile socket options are.
+The timeouts, the closed pairs counters and the stats are kept by the same code as in SocketBridge.
+asyncio refuses sockets already wrapped with ssl, so the SSL pairs of a bridge fall back to a SocketBridge.
+"""
+import logging
+import socket
+import ssl
+import threading
+import time
+import traceback
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from .socket_bridge import *
+from .socket_bridge import _BridgeBase, _PairBase, _ReactorBase
+from .timer_wheel import *
+
+_Protocol = asyncio.Protocol if asyncio else object
+
+
+class _RelayProtocol(_Protocol):
+    """ One socket of a pair. Writes everything it receives into the peer's transport
+    """
+
+    def __init__(self, bridge, pair):
+        self.bridge = bridge  # type: AsyncioBridge
+        self.pair = pair  # type: _AsyncioPair
+        self.transport = None
+        self.peer = None  # type: _RelayProtocol
+        self.closed = False
+        self.paused = False  # the peer is too slow to accept the data
+        self.throttled = False  # the rate limits of the bridge are reached
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # the peer's transport may be not ready yet, so nothing is read till the pair is linked
+        transport.pause_reading()
+        transport.set_write_buffer_limits(self.bridge.high_watermark, self.bridge.low_watermark)
+        self.bridge.protocols.add(self)
+
+    def data_received(self, data):
+        pair = self.pair
+        pair.last_active = monotonic() # Reset the idle timer
+        pair.bytes_in += len(data)
+        pair.recv_calls += 1
+        # the transport sends what it can right away and buffers the rest
+        self.peer.transport.write(data)
+        pair.bytes_out += len(data)
+        pair.send_calls += 1
+        buckets = self.bridge.buckets
+        if buckets:
+            now = monotonic()
+            for b in buckets:
+                b.consume(len(data))
+            if min(b.available(now) for b in buckets) < THROTTLE_RESUME_BYTES:
+                self.throttled = True
+                self.transport.pause_reading()
+                delay = max(max(b.resume_at(now) for b in buckets) - now, 0)
+                self.bridge.reactor.loop.call_later(delay, self._unthrottle)
+
+    def _unthrottle(self):
+        self.throttled = False
+        self._update_reading()
+
+    def _update_reading(self):
+        if self.closed:
+            return
+        if self.paused or self.throttled:
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        # the peer is closed once it gets all the data already written into it
+        self.peer.transport.close()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.bridge.protocols.discard(self)
+        if self.peer and self.peer.transport:
+            self.peer.transport.close()
+        if self.peer.closed:
+            self.bridge.reactor._pair_closed(self.pair)
+
+    # the peer is too slow to accept the data, stop reading till it catches up
+    def pause_writing(self):
+        self.peer.paused = True
+        self.peer._update_reading()
+
+    def resume_writing(self):
+        self.peer.paused = False
+        self.peer._update_reading()
+
+
+class _AsyncioPair(_PairBase):
+    """ Traffic counters and a timer wheel entry of a pair.
+        The transports buffer the data themselves, so bytes_out counts the data given to them,
+        and the latency histogram is not collected
+    """
+    __slots__ = ("p1", "p2")
+
+    def __init__(self, bridge):
+        _PairBase.__init__(self, bridge, monotonic())
+        self.p1 = self.p2 = None  # type: _RelayProtocol
+
+
+class AsyncioReactor(_ReactorBase):
+    """ A process-wide asyncio event loop running in its own thread, which relays all AsyncioBridges
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        if asyncio is None:
+            raise Exception("asyncio is not available")
+        _ReactorBase.__init__(self)
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="asyncioBridge")
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info("AsyncioReactor daemon started")
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._tick)
+        while True:
+            try:
+                self.loop.run_forever()
+            except:
+                logging.error("FATAL ERROR! AsyncioReactor failed {}".format(
+                    traceback.format_exc()
+                ))
+
+    def call_soon(self, fn, *args):
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def _buffered(self, pair):
+        return sum(p.transport.get_write_buffer_size() for p in (pair.p1, pair.p2) if not p.closed)
+
+    def _tick(self):
+        self._expire(monotonic())
+        self.loop.call_later(self.timers.tick, self._tick)
+
+    def _close_pair(self, pair):
+        pair.p1.transport.abort()
+
+    def _fire(self, callback):
+        # the callback may block, so it is fired out of the loop thread
+        self.loop.run_in_executor(None, callback)
+
+    def _add_pair(self, bridge, conn1, conn2):
+        if not bridge.work:
+            try_close(conn1)
+            try_close(conn2)
+            return
+        pair = _AsyncioPair(bridge)
+        p1 = pair.p1 = _RelayProtocol(bridge, pair)
+        p2 = pair.p2 = _RelayProtocol(bridge, pair)
+        p1.peer = p2
+        p2.peer = p1
+        futures = [self.loop.create_task(self.loop.create_connection(lambda: p1, sock = conn1)),
+                   self.loop.create_task(self.loop.create_connection(lambda: p2, sock = conn2))]
+        for f in futures:
+            f.add_done_callback(lambda f: self._link_pair(bridge, p1, p2, conn1, conn2, futures))
+
+    def _link_pair(self, bridge, p1, p2, conn1, conn2, futures):
+        """ Let the pair go, when both its transports are made
+        """
+        if not all(f.done() for f in futures):
+            return
+        errors = [f.exception() for f in futures if f.exception()]
+        if errors or not bridge.work:
+            if errors:
+                logging.warning("unable to add a pair to the asyncio bridge: {}".format(errors[0]))
+            for p, conn in ((p1, conn1), (p2, conn2)):
+                if p.transport:
+                    p.transport.close()
+                else:
+                    try_close(conn)
+            return
+        self._pair_added(p1.pair)
+        p1._update_reading()
+        p2._update_reading()
+        logging.debug("New pair added. Total {} pairs in bridge".format(len(bridge.pairs)))
+
+    def _close_bridge(self, bridge):
+        self.timers.cancel(bridge)
+        for p in list(bridge.protocols):
+            p.transport.abort()
+
+
+class AsyncioBridge (_BridgeBase):
+    """ The same contract as SocketBridge: add_pair, start_as_daemon, close and terminate callback.
+        asyncio refuses sockets already wrapped with ssl, so SSL pairs are relayed by a local SocketBridge
+        of the selector engine, the bridge stats sum both
+    """
+
+    def __init__ (self, terminate_callback = None, timeout = 60,
+                  high_watermark = HIGH_WATERMARK, low_watermark = LOW_WATERMARK, reactor = None,
+                  max_lifetime = None, rate_limit = None, device_id = None, device_rate_limit = None, weight = 1,
+                  profile = None):
+        _BridgeBase.__init__(self, terminate_callback, timeout, high_watermark, low_watermark, max_lifetime,
+                             rate_limit, device_id, device_rate_limit, weight, profile)
+        self.protocols = set()  # holds protocols of the bridge sockets, touched by the loop thread only
+        self.reactor = reactor or AsyncioReactor.instance()
+        self._local = None  # type: SocketBridge
+        self._started = False
+        self._uses_loop = False  # a plain pair has been added, so the loop watches the bridge timeout
+
+    def add_pair (self, conn1, conn2):
+        """
+        transfer anything between two sockets
+        :type conn1: socket.socket
+        :type conn2: socket.socket
+        """
+        if isinstance(conn1, ssl.SSLSocket) or isinstance(conn2, ssl.SSLSocket):
+            self._get_local().add_pair(conn1, conn2)
+            return
+        conn1.setblocking(False)
+        conn2.setblocking(False)
+        if self.profile:
+            tune_socket(conn1, self.profile)
+            tune_socket(conn2, self.profile)
+        if not self._uses_loop:
+            self._uses_loop = True
+            if self._started:
+                self.reactor.call_soon(self.reactor._watch_timeout, self)
+        self.reactor.call_soon(self.reactor._add_pair, self, conn1, conn2)
+
+    def start_as_daemon(self):
+        self.start()
+
+    def start(self):
+        self._started = True
+        if self._uses_loop:
+            self.reactor.call_soon(self.reactor._watch_timeout, self)
+        if self._local:
+            self._local.start()
+
+    def get_stats(self):
+        """ Returns the traffic counters of the bridge, see SocketBridge.get_stats()
+            rtype: dict
+        """
+        stats = {}
+        if self._uses_loop:
+            stats = self.reactor.run_in_loop(self.reactor._bridge_stats, self) or {}
+        if self._local:
+            stats = merge_stats(stats, self._local.get_stats())
+        return stats
+
+    def close (self, from_outside = False):
+        """close the bridge
+        """
+        self.work = False
+        self.reactor.call_soon(self.reactor._close_bridge, self)
+        if self._local:
+            self._local.close(True)
+
+        # ------ callback --------
+        if not from_outside: # If bridge closed from outside - there is no use in callback
+            if self.callback:
+                self.callback()
+
+    def _get_local(self):
+        if self._local is None:
+            logging.info("asyncio can not relay SSL sockets, SSL pairs of the bridge are relayed by the selector engine")
+            self._local = SocketBridge(self._on_local_timeout, self.timeout_sec,
+                                       self.high_watermark, self.low_watermark, max_lifetime = self.max_lifetime,
+                                       rate_limit = self.rate_limit, device_id = self.device_id,
+                                       device_rate_limit = self.device_rate_limit, weight = self.weight,
+                                       profile = self.profile_name)
+            if self._started:
+                self._local.start()
+        return self._local
+
+    def _on_local_timeout(self):
+        if self.work:
+            self.close()
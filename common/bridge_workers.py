@@ -0,0 +1,415 @@
+"""
+Relay worker processes. The relay is CPU bound, so with a single BridgeReactor the
+server is limited by one core. A BridgeWorkerPool starts several processes each running
+its own reactor, and hands accepted socket pairs over to them with SCM_RIGHTS.
+Tunnels control stays in the main process.
+"""
+import array
+import json
+import logging
+import multiprocessing
+import select
+import socket
+import ssl
+import struct
+import threading
+import time
+import traceback
+
+from .socket_bridge import *
+
+# channel commands: main process -> worker
+CMD_OPEN = 1  # a new bridge: bridge_id, timeout, high watermark, low watermark, max lifetime; and the options json
+CMD_ADD_PAIR = 2  # a new pair of the bridge, two descriptors are attached
+CMD_START = 3  # start watching the bridge for the timeout
+CMD_CLOSE = 4  # close the bridge from outside
+# worker -> main process
+CMD_TIMEOUT = 5  # the bridge is closed due a timeout: bridge_id
+CMD_LOAD = 6  # a worker load report: number of relayed pairs
+CMD_STATS = 7  # a bridge stats request: bridge_id, 0 - of the worker reactor; and the reply with the stats json appended
+
+# command, bridge_id, timeout, high watermark, low watermark, max lifetime (0 - unlimited)
+CMD_FORMAT = struct.Struct("<BIdIId")
+
+# how often workers report their load, seconds
+LOAD_REPORT_PERIOD = 1
+
+# the biggest message a worker sends
+MAX_MESSAGE_SIZE = 2 ** 16
+
+
+def _pack(cmd, bridge_id = 0, timeout = 0, high = 0, low = 0, max_lifetime = 0):
+    return CMD_FORMAT.pack(cmd, bridge_id, timeout, high, low, max_lifetime or 0)
+
+
+class WorkerBridge ():
+    """ A SocketBridge which relays its pairs in one of the worker processes.
+        Has the same contract as SocketBridge: add_pair, start_as_daemon, close and terminate callback.
+        SSL sockets can not be handed over to another process (the TLS state lives in this one),
+        so SSL pairs are relayed by a local SocketBridge. So are all the pairs, when no worker is left
+    """
+
+    def __init__ (self, pool, bridge_id, terminate_callback = None, timeout = 60,
+                  high_watermark = HIGH_WATERMARK, low_watermark = LOW_WATERMARK, max_lifetime = None,
+                  rate_limit = None, device_id = None, device_rate_limit = None, weight = 1, profile = None):
+        self.work = True
+        self.callback = terminate_callback
+        self.timeout_sec = timeout
+        self.max_lifetime = max_lifetime
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        # the rest of SocketBridge options, passed to the worker as json.
+        # Every worker keeps its own device buckets, so a device limit is enforced per worker
+        self.options = {"rate_limit": rate_limit, "device_id": device_id,
+                        "device_rate_limit": device_rate_limit, "weight": weight, "profile": profile}
+        self._pool = pool
+        self._id = bridge_id
+        self._worker = None  # type: _WorkerHandle
+        self._local = None  # type: SocketBridge
+        self._started = False
+
+    def add_pair (self, conn1, conn2):
+        """
+        transfer anything between two sockets
+        :type conn1: socket.socket
+        :type conn2: socket.socket
+        """
+        if isinstance(conn1, ssl.SSLSocket) or isinstance(conn2, ssl.SSLSocket):
+            self._get_local().add_pair(conn1, conn2)
+            return
+
+        worker = self._worker
+        if worker is None:
+            # all the pairs of a bridge live in one worker, so its timeout keeps working
+            worker = self._open(self._pool.choose_worker())
+        if worker is not None:
+            try:
+                worker.send(_pack(CMD_ADD_PAIR, self._id), [conn1.fileno(), conn2.fileno()])
+            except Exception as e:
+                # the worker is gone, the pool listener reassigns the bridge
+                logging.warning("Unable to hand a pair over to bridge worker {}: {}".format(worker.process.name, e))
+                worker = None
+        if worker is None:
+            # no worker is left, the pair is relayed in this process
+            self._get_local().add_pair(conn1, conn2)
+            return
+        worker.pending += 1
+        # the worker has its own copies of the descriptors now
+        try_close(conn1)
+        try_close(conn2)
+
+    def start_as_daemon(self):
+        self.start()
+
+    def start(self):
+        self._started = True
+        if self._worker:
+            self._command(self._worker, _pack(CMD_START, self._id))
+        if self._local:
+            self._local.start()
+
+    def get_stats(self):
+        """ Returns the traffic counters of the bridge, see SocketBridge.get_stats()
+            rtype: dict
+        """
+        stats = {}
+        if self._worker:
+            stats = self._pool.request_stats(self._worker, self._id)
+        if self._local:
+            stats = merge_stats(stats, self._local.get_stats())
+        return stats
+
+    def close (self, from_outside = False):
+        """close the bridge
+        """
+        self.work = False
+        self._pool.forget(self._id)
+        if self._worker:
+            self._command(self._worker, _pack(CMD_CLOSE, self._id))
+        if self._local:
+            self._local.close(True)
+
+        # ------ callback --------
+        if not from_outside: # If bridge closed from outside - there is no use in callback
+            if self.callback:
+                self.callback()
+
+    def _open(self, worker):
+        """ Open the bridge in the worker
+            type worker: _WorkerHandle or None
+            rtype: _WorkerHandle - the worker, None if it is not given or gone
+        """
+        if worker is None:
+            return None
+        if not self._command(worker, _pack(CMD_OPEN, self._id, self.timeout_sec, self.high_watermark,
+                                           self.low_watermark, self.max_lifetime) + json.dumps(self.options).encode()):
+            return None
+        if self._started:
+            self._command(worker, _pack(CMD_START, self._id))
+        self._worker = worker
+        return worker
+
+    def _command(self, worker, data):
+        """ rtype: bool - False if the worker is gone
+        """
+        try:
+            worker.send(data)
+            return True
+        except Exception as e:
+            logging.debug("Unable to send a command to bridge worker {}: {}".format(worker.process.name, e))
+            return False
+
+    def _on_worker_gone(self, worker):
+        """ The worker of the bridge died. Its pairs are closed with it (the worker held the only descriptors),
+            the bridge is opened in another worker, or in this process if none is left, so its timeout keeps working
+            type worker: _WorkerHandle - the next worker, or None
+        """
+        self._worker = None
+        if not self.work:
+            return
+        if self._open(worker) is None:
+            self._get_local()
+
+    def _get_local(self):
+        if self._local is None:
+            self._local = SocketBridge(self._on_local_timeout, self.timeout_sec,
+                                       self.high_watermark, self.low_watermark, max_lifetime = self.max_lifetime,
+                                       **self.options)
+            if self._started:
+                self._local.start()
+        return self._local
+
+    def _on_local_timeout(self):
+        self._on_worker_timeout()
+
+    def _on_worker_timeout(self):
+        """ Fired when the worker (or the local bridge) closes the bridge due a timeout
+        """
+        if not self.work:
+            return
+        self.close()
+
+
+class _WorkerHandle(object):
+    """ The main process side of a worker: its channel and the last reported load
+    """
+    __slots__ = ("process", "channel", "load", "pending", "lock")
+
+    def __init__(self, process, channel):
+        self.process = process
+        self.channel = channel
+        self.load = 0  # pairs the worker relays, as it reported last time
+        self.pending = 0  # pairs handed over since the last report
+        self.lock = threading.Lock()
+
+    def send(self, data, fds = None):
+        ancdata = []
+        if fds:
+            ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+        with self.lock:
+            self.channel.sendmsg([data], ancdata)
+
+
+class BridgeWorkerPool ():
+    """ Starts relay worker processes and creates WorkerBridges, which hand their pairs over to the workers
+    """
+
+    def __init__(self, workers_count):
+        self._workers = []
+        self._bridges = {}  # bridge_id -> WorkerBridge, to fire callbacks of bridges closed by workers
+        self._stats_requests = {}  # (worker, bridge_id) -> (threading.Event, list for the reply)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        try:
+            ctx = multiprocessing.get_context("fork")
+        except (AttributeError, ValueError):
+            ctx = multiprocessing
+
+        for n in range(workers_count):
+            parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            process = ctx.Process(target=_worker_main, args=(child, parent), name="bridgeWorker-{}".format(n))
+            process.daemon = True
+            process.start()
+            child.close()
+            self._workers.append(_WorkerHandle(process, parent))
+
+        t = threading.Thread(target=self._listen_workers, name="bridgeWorkers")
+        t.daemon = True
+        t.start()
+        logging.info("{} bridge workers started".format(workers_count))
+
+    @staticmethod
+    def is_supported():
+        return hasattr(socket, "AF_UNIX") and hasattr(socket, "SOCK_SEQPACKET") and hasattr(socket, "SCM_RIGHTS")
+
+    def create_bridge(self, terminate_callback = None, timeout = 60, **kwargs):
+        """ A drop-in replacement of the SocketBridge constructor
+            rtype: WorkerBridge
+        """
+        with self._lock:
+            self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+            bridge = WorkerBridge(self, self._next_id, terminate_callback, timeout, **kwargs)
+            self._bridges[bridge._id] = bridge
+        return bridge
+
+    def forget(self, bridge_id):
+        with self._lock:
+            self._bridges.pop(bridge_id, None)
+
+    def choose_worker(self):
+        """ Returns the least loaded worker
+            rtype: _WorkerHandle or None if all the workers are gone
+        """
+        with self._lock:
+            if not self._workers:
+                return None
+            return min(self._workers, key=lambda w: w.load + w.pending)
+
+    def request_stats(self, worker, bridge_id):
+        """ Ask the worker for the bridge stats and wait for the reply
+            rtype: dict
+        """
+        done = threading.Event()
+        reply = []
+        with self._lock:
+            self._stats_requests[(worker, bridge_id)] = (done, reply)
+        try:
+            worker.send(_pack(CMD_STATS, bridge_id))
+            done.wait(CALL_TIMEOUT)
+        except Exception as e:
+            logging.debug("Unable to request stats of bridge worker {}: {}".format(worker.process.name, e))
+        with self._lock:
+            self._stats_requests.pop((worker, bridge_id), None)
+        return reply[0] if reply else {}
+
+    def get_stats(self):
+        """ Returns the reactor state of every worker, see BridgeReactor.get_stats()
+            rtype: list
+        """
+        with self._lock:
+            workers = list(self._workers)
+        return [dict(self.request_stats(w, 0), worker = w.process.name, load = w.load + w.pending) for w in workers]
+
+    def _listen_workers(self):
+        channels = dict((w.channel, w) for w in self._workers)
+        while channels:
+            readable, _, _ = select.select(list(channels), [], [])
+            for channel in readable:
+                worker = channels[channel]
+                try:
+                    data = channel.recv(MAX_MESSAGE_SIZE)
+                except Exception:
+                    data = None
+                if not data:
+                    logging.error("Bridge worker {} is gone".format(worker.process.name))
+                    channels.pop(channel)
+                    self._on_worker_gone(worker)
+                    continue
+                (cmd, bridge_id, _, load, _, _) = CMD_FORMAT.unpack_from(data)
+                if cmd == CMD_LOAD:
+                    worker.load = load
+                    worker.pending = 0
+                elif cmd == CMD_TIMEOUT:
+                    with self._lock:
+                        bridge = self._bridges.get(bridge_id)
+                    if bridge:
+                        bridge._on_worker_timeout()
+                elif cmd == CMD_STATS:
+                    with self._lock:
+                        request = self._stats_requests.get((worker, bridge_id))
+                    if request:
+                        request[1].append(json.loads(data[CMD_FORMAT.size:].decode()))
+                        request[0].set()
+
+    def _on_worker_gone(self, worker):
+        """ Move the bridges of a dead worker to the rest of them
+        """
+        with self._lock:
+            self._workers.remove(worker)
+            orphans = [bridge for bridge in self._bridges.values() if bridge._worker is worker]
+            # the stats requests to the dead worker are not answered
+            for key, request in self._stats_requests.items():
+                if key[0] is worker:
+                    request[0].set()
+        try_close(worker.channel)
+        if orphans:
+            logging.warning("{} bridges of the dead worker are reassigned".format(len(orphans)))
+        for bridge in orphans:
+            bridge._on_worker_gone(self.choose_worker())
+
+
+def _worker_main(channel, parent_channel):
+    """ A worker process entry point: runs its own reactor and takes pairs from the channel
+    """
+    try_close(parent_channel)
+    # the reactor of the parent process (if any) is not running here
+    BridgeReactor._instance = None
+    reactor = BridgeReactor.instance()
+    bridges = {}
+    bridges_lock = threading.Lock()  # the bridges closed by timeouts are forgotten in the reactor callbacks thread
+    lock = threading.Lock()
+
+    def send(data):
+        with lock:
+            channel.send(data)
+
+    def get_bridge(bridge_id, forget = False):
+        with bridges_lock:
+            return bridges.pop(bridge_id, None) if forget else bridges.get(bridge_id)
+
+    def timeout_callback(bridge_id):
+        return lambda: (get_bridge(bridge_id, True), send(_pack(CMD_TIMEOUT, bridge_id)))
+
+    channel.settimeout(LOAD_REPORT_PERIOD)
+    next_report = 0
+    while True:
+        now = time.time()
+        if now >= next_report:
+            # the load is passed in the "high watermark" field
+            send(_pack(CMD_LOAD, high = len(reactor.endpoints) // 2))
+            next_report = now + LOAD_REPORT_PERIOD
+        try:
+            data, ancdata, _, _ = channel.recvmsg(MAX_MESSAGE_SIZE, socket.CMSG_LEN(2 * array.array("i").itemsize))
+        except socket.timeout:
+            continue
+        except Exception:
+            logging.error("Bridge worker channel failed {}".format(traceback.format_exc()))
+            return
+        if not data:
+            return  # the main process is gone
+
+        (cmd, bridge_id, timeout, high, low, max_lifetime) = CMD_FORMAT.unpack_from(data)
+        if cmd == CMD_OPEN:
+            options = json.loads(data[CMD_FORMAT.size:].decode() or "{}")
+            bridge = SocketBridge(timeout_callback(bridge_id), timeout, high, low, reactor,
+                                  max_lifetime = max_lifetime or None, **options)
+            with bridges_lock:
+                bridges[bridge_id] = bridge
+        elif cmd == CMD_ADD_PAIR:
+            fds = array.array("i")
+            for level, type, payload in ancdata:
+                if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                    fds.frombytes(payload[:len(payload) - (len(payload) % fds.itemsize)])
+            socks = [socket.socket(fileno = fd) for fd in fds]
+            bridge = get_bridge(bridge_id)
+            if bridge and len(socks) == 2:
+                bridge.add_pair(socks[0], socks[1])
+            else:
+                for s in socks:
+                    try_close(s)
+        elif cmd == CMD_START:
+            bridge = get_bridge(bridge_id)
+            if bridge:
+                bridge.start()
+        elif cmd == CMD_CLOSE:
+            bridge = get_bridge(bridge_id, True)
+            if bridge:
+                bridge.close(True)
+        elif cmd == CMD_STATS:
+            if bridge_id:
+                bridge = get_bridge(bridge_id)
+                stats = bridge.get_stats() if bridge else {}
+            else:
+                stats = reactor.get_stats()
+            send(_pack(CMD_STATS, bridge_id) + json.dumps(stats).encode())
@@ -0,0 +1,299 @@
+"""
+Datagram (UDP) tunnels. The server and the slaver exchange the datagrams of the customers over a UDP socket
+of the tunnel, each one prefixed with the id of its flow. A flow is like a NAT mapping: a customer address
+on the server, and a socket connected to the tunnel target on the slaver, so the answers find their way back.
+Flows idle for flow_timeout seconds are expired, and the relay is closed when it relays nothing for timeout seconds.
+"""
+import logging
+import select
+import socket
+import struct
+import threading
+import traceback
+
+from .socket_bridge import *
+
+# flow id (uint_32), followed by the datagram
+DATAGRAM_HEADER = struct.Struct("<I")
+MAX_DATAGRAM = 2 ** 16
+# seconds a flow lives without datagrams
+UDP_FLOW_TIMEOUT = 60
+# the slaver sends an empty datagram of the flow 0 every DATAGRAM_KEEPALIVE_PERIOD seconds: the server learns
+# the slaver address from it, and the NAT mappings between them are kept alive
+KEEPALIVE_FLOW = 0
+DATAGRAM_KEEPALIVE_PERIOD = 15
+# how often the flows are checked for the expiry, seconds
+EXPIRE_PERIOD = 1
+
+
+class DatagramFlow(TrafficStats):
+    """ A flow of datagrams: a customer address on the server, or a socket connected to the target on the slaver
+    """
+    __slots__ = ("id", "addr", "sock", "last_active")
+
+    def __init__(self, flow_id, addr = None, sock = None):
+        TrafficStats.__init__(self)
+        self.id = flow_id
+        self.addr = addr
+        self.sock = sock # type: socket.socket
+        self.last_active = monotonic()
+
+
+class DatagramRelay ():
+    """ A relay thread of one datagram tunnel. Its subclasses are the server and the slaver ends of the tunnel:
+        they find the flow of a customer or target datagram with _find_flow(), send into the tunnel with _send_tunnel(),
+        and take the datagrams of the tunnel with _from_tunnel()
+    """
+
+    def __init__(self, tunnel_sock, terminate_callback = None, timeout = 60, flow_timeout = UDP_FLOW_TIMEOUT):
+        """ type tunnel_sock: socket.socket - the UDP socket between the server and the slaver
+            type terminate_callback: callable() - the relay closed itself on the timeout
+        """
+        self.work = True
+        self.callback = terminate_callback
+        self.timeout_sec = timeout
+        self.flow_timeout = flow_timeout
+        self.last_active = monotonic()
+        self.closed_stats = TrafficStats() # summed counters of the flows already expired
+        self.closed_flows_count = 0
+        self._tunnel_sock = tunnel_sock
+        self._flows = {} # flow id -> DatagramFlow
+        self._lock = threading.Lock() # the flows are changed by the relay thread, and read by get_stats()
+
+    def start(self):
+        thread = threading.Thread(target = self._run, name = "datagram relay")
+        thread.daemon = True
+        thread.start()
+
+    def get_stats(self):
+        """ Returns the traffic counters of the relay: summed ones of its flows, both alive and expired.
+            bytes_in - received from the customers or the target, bytes_out - sent into them
+            rtype: dict
+        """
+        with self._lock:
+            stats = TrafficStats()
+            stats.add(self.closed_stats)
+            for flow in self._flows.values():
+                stats.add(flow)
+            ret = stats.as_dict()
+            ret["flows"] = len(self._flows)
+            ret["flows_total"] = len(self._flows) + self.closed_flows_count
+        return ret
+
+    def close(self, from_outside = False):
+        self.work = False
+        if not from_outside and self.callback:
+            self.callback()
+
+    def _sockets(self):
+        """ rtype: list - the sockets to read
+        """
+        return [self._tunnel_sock]
+
+    def _on_readable(self, sock, now):
+        """ Pass a datagram of a customer or of the target into the tunnel, prefixed with its flow id,
+            or a datagram of the tunnel to its flow
+        """
+        try:
+            data, addr = sock.recvfrom(MAX_DATAGRAM)
+        except (OSError, socket.error):
+            return
+        if sock is self._tunnel_sock:
+            if len(data) >= DATAGRAM_HEADER.size:
+                self._from_tunnel(DATAGRAM_HEADER.unpack_from(data)[0], data[DATAGRAM_HEADER.size:], addr)
+            return
+        flow = self._find_flow(sock, addr)
+        if flow is None:
+            return
+        flow.recv_calls += 1
+        flow.bytes_in += len(data)
+        flow.last_active = self.last_active = now
+        try:
+            self._send_tunnel(DATAGRAM_HEADER.pack(flow.id) + data)
+        except (OSError, socket.error) as e:
+            logging.debug("datagram of flow {} dropped: {}".format(flow.id, e))
+
+    def _on_tick(self, now):
+        """ Called every loop pass
+        """
+        pass
+
+    def _add_flow(self, flow):
+        with self._lock:
+            self._flows[flow.id] = flow
+
+    def _remove_flow(self, flow):
+        with self._lock:
+            if self._flows.pop(flow.id, None) is None:
+                return
+            self.closed_stats.add(flow)
+            self.closed_flows_count += 1
+        if flow.sock:
+            try_close(flow.sock)
+
+    def _relay(self, flow, data, sock, addr = None):
+        """ Send a datagram of the flow into the customer or the target socket
+        """
+        flow.last_active = self.last_active = monotonic()
+        flow.send_calls += 1
+        try:
+            if addr:
+                sock.sendto(data, addr)
+            else:
+                sock.send(data)
+        except (OSError, socket.error) as e:
+            # a datagram is lost, as it may be on the way anyway
+            logging.debug("datagram of flow {} dropped: {}".format(flow.id, e))
+            return
+        flow.bytes_out += len(data)
+
+    def _run(self):
+        expired = monotonic()
+        try:
+            while self.work:
+                readable, _, _ = select.select(self._sockets(), [], [], EXPIRE_PERIOD)
+                now = monotonic()
+                for sock in readable:
+                    self._on_readable(sock, now)
+                self._on_tick(now)
+                if now - expired >= EXPIRE_PERIOD:
+                    expired = now
+                    for flow in list(self._flows.values()):
+                        if now - flow.last_active >= self.flow_timeout:
+                            self._remove_flow(flow)
+                    if now - self.last_active >= self.timeout_sec:
+                        logging.info("datagram relay timeout reached")
+                        self.close()
+        except Exception as e:
+            if self.work:
+                logging.error("Datagram relay failed {}".format(e))
+                logging.debug(traceback.format_exc())
+                self.close()
+        for flow in list(self._flows.values()):
+            self._remove_flow(flow)
+
+
+class DatagramServerRelay (DatagramRelay):
+    """ The server end: the customers send to the customer socket, a flow per customer address
+    """
+
+    def __init__(self, tunnel_sock, terminate_callback = None, timeout = 60, flow_timeout = UDP_FLOW_TIMEOUT):
+        DatagramRelay.__init__(self, tunnel_sock, terminate_callback, timeout, flow_timeout)
+        self.peer = None # the slaver address
+        self._customer_sock = None # type: socket.socket
+        self._by_addr = {} # customer address -> DatagramFlow
+        self._next_id = KEEPALIVE_FLOW
+
+    def wait_peer(self, host, timeout):
+        """ Wait for the first keepalive of the slaver. The tunnel port is open to anyone,
+            so only a keepalive from the host of the slaver control connection is taken
+            type host: str - the IP address of the slaver control connection
+            rtype: bool - the slaver is known
+        """
+        deadline = monotonic() + timeout
+        try:
+            while self.peer is None:
+                left = deadline - monotonic()
+                if left <= 0:
+                    return False
+                self._tunnel_sock.settimeout(left)
+                data, addr = self._tunnel_sock.recvfrom(MAX_DATAGRAM)
+                if len(data) < DATAGRAM_HEADER.size or DATAGRAM_HEADER.unpack_from(data)[0] != KEEPALIVE_FLOW:
+                    continue
+                if addr[0] != host:
+                    logging.warning("datagram tunnel keepalive from a stranger {} is dropped".format(addr[0]))
+                    continue
+                self.peer = addr
+        except (OSError, socket.error):
+            return False
+        finally:
+            self._tunnel_sock.settimeout(None)
+        return True
+
+    def start(self, customer_sock):
+        """ type customer_sock: socket.socket - a bound UDP socket the customers send to
+        """
+        self._customer_sock = customer_sock
+        DatagramRelay.start(self)
+
+    def _sockets(self):
+        return [self._tunnel_sock, self._customer_sock]
+
+    def _remove_flow(self, flow):
+        self._by_addr.pop(flow.addr, None)
+        DatagramRelay._remove_flow(self, flow)
+
+    def _find_flow(self, sock, addr):
+        """ A new customer address opens a flow
+        """
+        flow = self._by_addr.get(addr)
+        if flow is None:
+            self._next_id = self._next_id % 0xFFFFFFFF + 1
+            flow = DatagramFlow(self._next_id, addr)
+            self._by_addr[addr] = flow
+            self._add_flow(flow)
+        return flow
+
+    def _send_tunnel(self, data):
+        self._tunnel_sock.sendto(data, self.peer)
+
+    def _from_tunnel(self, flow_id, data, addr):
+        # only the slaver host sends into the tunnel socket, its port may be changed by a NAT
+        if addr[0] != self.peer[0]:
+            return
+        self.peer = addr
+        flow = self._flows.get(flow_id)
+        if flow is not None:
+            self._relay(flow, data, self._customer_sock, flow.addr)
+
+
+class DatagramClientRelay (DatagramRelay):
+    """ The slaver end: a socket connected to the target per flow
+    """
+
+    def __init__(self, tunnel_sock, target, terminate_callback = None, timeout = 60, flow_timeout = UDP_FLOW_TIMEOUT):
+        """ type tunnel_sock: socket.socket - connected to the server tunnel port
+            type target: tuple - (host, port) of the tunnel target
+        """
+        DatagramRelay.__init__(self, tunnel_sock, terminate_callback, timeout, flow_timeout)
+        self.target = socket.getaddrinfo(target[0], target[1], 0, socket.SOCK_DGRAM)[0]
+        self._by_sock = {} # target socket -> DatagramFlow
+        self._keepalive = -DATAGRAM_KEEPALIVE_PERIOD # the first one goes right away
+
+    def _sockets(self):
+        return [self._tunnel_sock] + list(self._by_sock)
+
+    def _remove_flow(self, flow):
+        self._by_sock.pop(flow.sock, None)
+        DatagramRelay._remove_flow(self, flow)
+
+    def _on_tick(self, now):
+        if now - self._keepalive >= DATAGRAM_KEEPALIVE_PERIOD:
+            self._keepalive = now
+            try:
+                self._tunnel_sock.send(DATAGRAM_HEADER.pack(KEEPALIVE_FLOW))
+            except (OSError, socket.error) as e:
+                logging.debug("datagram tunnel keepalive failed: {}".format(e))
+
+    def _find_flow(self, sock, addr):
+        return self._by_sock.get(sock)
+
+    def _send_tunnel(self, data):
+        self._tunnel_sock.send(data)
+
+    def _from_tunnel(self, flow_id, data, addr):
+        flow = self._flows.get(flow_id)
+        if flow is None:
+            # a new customer of the tunnel
+            family, type, proto, _, target_addr = self.target
+            target_sock = socket.socket(family, type, proto)
+            try:
+                target_sock.connect(target_addr)
+            except (OSError, socket.error) as e:
+                try_close(target_sock)
+                logging.debug("unable to open datagram flow {}: {}".format(flow_id, e))
+                return
+            flow = DatagramFlow(flow_id, target_addr, target_sock)
+            self._by_sock[target_sock] = flow
+            self._add_flow(flow)
+        self._relay(flow, data, flow.sock)
@@ -0,0 +1,278 @@
+"""
+One port for the customers of all the tunnels. A customer names its tunnel with the first bytes it sends:
+an HTTP CONNECT request, the server name (SNI) of a TLS client hello, or a preamble line "TUNNEL <route>\\n".
+Host names are routed by their first label, so "3017.tunnels.example.com" names the route "3017".
+The CONNECT request and the preamble are taken off the connection, a client hello goes to the tunnel target as is.
+"""
+import errno
+import logging
+import selectors
+import socket
+import struct
+import threading
+import time
+import traceback
+
+from .socket_bridge import *
+
+INGRESS_PREAMBLE = b"TUNNEL "
+# the most bytes a customer may send before its route is known
+MAX_ROUTE_HEADER = 2 ** 14
+# seconds a customer has to name its route
+INGRESS_TIMEOUT = 5
+# a customer that sent a part of its route header is read again after it, seconds
+INGRESS_RETRY = 0.01
+
+CONNECT_ESTABLISHED = b"HTTP/1.1 200 Connection established\r\n\r\n"
+CONNECT_NOT_FOUND = b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n"
+
+# the kinds of route headers
+ROUTE_CONNECT = "connect"
+ROUTE_SNI = "sni"
+ROUTE_PREAMBLE = "preamble"
+
+
+def _host_route(host):
+    return host.split(".", 1)[0].lower()
+
+
+def _parse_preamble(data):
+    end = data.find(b"\n")
+    if end < 0:
+        return None
+    route = bytes(data[len(INGRESS_PREAMBLE):end]).strip().decode().lower()
+    if not route:
+        raise ValueError("no route in the preamble")
+    return (ROUTE_PREAMBLE, route, end + 1)
+
+
+def _parse_connect(data):
+    end = data.find(b"\r\n\r\n")
+    if end < 0:
+        return None
+    request_line = bytes(data[:data.find(b"\r\n")]).decode("latin-1").split()
+    if len(request_line) != 3:
+        raise ValueError("bad CONNECT request")
+    host = request_line[1].rsplit(":", 1)[0].strip("[]")
+    return (ROUTE_CONNECT, _host_route(host), end + 4)
+
+
+def _parse_sni(data):
+    if len(data) < 5:
+        return None
+    (record_size,) = struct.unpack_from(">H", data, 3)
+    if len(data) < 5 + record_size:
+        return None
+    # the handshake message: type (client hello is 1), length (uint_24)
+    if data[5] != 1:
+        raise ValueError("not a client hello")
+    # version, random, then the session id, the cipher suites and the compression methods
+    pos = 5 + 4 + 2 + 32
+    pos += 1 + data[pos]
+    pos += 2 + struct.unpack_from(">H", data, pos)[0]
+    pos += 1 + data[pos]
+    (extensions_size,) = struct.unpack_from(">H", data, pos)
+    pos += 2
+    end = min(pos + extensions_size, 5 + record_size)
+    while pos + 4 <= end:
+        (extension, size) = struct.unpack_from(">HH", data, pos)
+        pos += 4
+        if extension == 0:
+            # server_name: list length, then entries of name type (host_name is 0), length, name
+            item = pos + 2
+            while item + 3 <= pos + size:
+                (name_type, name_size) = struct.unpack_from(">BH", data, item)
+                if name_type == 0:
+                    return (ROUTE_SNI, _host_route(bytes(data[item + 3:item + 3 + name_size]).decode()), 0)
+                item += 3 + name_size
+        pos += size
+    raise ValueError("no server name in the client hello")
+
+
+def parse_route(data):
+    """ Find the route in the first bytes of a customer
+        type data: bytes
+        rtype: tuple - (kind, route, the size of the route header to take off the connection)
+            or None - more bytes are needed
+        raises ValueError - the bytes name no route
+    """
+    try:
+        if data[:1] == b"\x16":
+            return _parse_sni(data)
+        for prefix, parse in ((INGRESS_PREAMBLE, _parse_preamble), (b"CONNECT ", _parse_connect)):
+            if data.startswith(prefix):
+                return parse(data)
+            if prefix.startswith(data):
+                return None
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError("bad route header: {}".format(e))
+    raise ValueError("unknown route header")
+
+
+class IngressServer ():
+    """ The shared customers port. One thread accepts the customers, reads their routes, and gives them to the tunnels.
+        The bytes of a customer are peeked, not read, till its route header is complete. The thread never blocks:
+        the sockets are non-blocking, and a tunnel add_customer() only queues the customer
+    """
+
+    def __init__(self, port, host = "0.0.0.0", backlog = 1024):
+        self.port = port
+        self.routed = 0
+        self.rejected = 0
+        self._host = host
+        self._backlog = backlog
+        self._routes = {} # route -> the tunnel, it has add_customer(socket), not blocking
+        self._routes_lock = threading.Lock()
+        self._pending = {} # customer socket -> [deadline, the next read time, None - it is read when readable]
+        self._selector = selectors.DefaultSelector()
+
+    def start(self):
+        """ Bind the port and start the ingress thread. A port that can not be bound raises the socket error here,
+            not in the thread
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self._host, self.port))
+            sock.listen(self._backlog)
+            sock.setblocking(False)
+        except Exception:
+            try_close(sock)
+            raise
+        self._selector.register(sock, selectors.EVENT_READ)
+        thread = threading.Thread(target = self._run, args = [sock], name = "ingress")
+        thread.daemon = True
+        thread.start()
+
+    def add_route(self, route, tunnel):
+        """ rtype: bool - False, if the route is taken by another tunnel
+        """
+        route = route.lower()
+        with self._routes_lock:
+            if self._routes.get(route, tunnel) is not tunnel:
+                return False
+            self._routes[route] = tunnel
+        return True
+
+    def remove_route(self, route, tunnel):
+        route = route.lower()
+        with self._routes_lock:
+            if self._routes.get(route) is tunnel:
+                del self._routes[route]
+
+    def get_stats(self):
+        """ rtype: dict
+        """
+        return {"routes": len(self._routes), "routed": self.routed, "rejected": self.rejected, "pending": len(self._pending)}
+
+    def _run(self, sock):
+        while True:
+            try:
+                self._step(sock)
+            except Exception:
+                # one customer or tunnel gone wrong does not stop the routing of the others
+                logging.error("Ingress routing failed {}".format(traceback.format_exc()))
+                time.sleep(INGRESS_RETRY)
+
+    def _step(self, sock):
+        now = monotonic()
+        waits = [1]
+        for conn, state in self._pending.items():
+            if state[1] is not None and state[1] <= now:
+                state[1] = None
+                self._selector.register(conn, selectors.EVENT_READ)
+            elif state[1] is not None:
+                waits.append(state[1] - now)
+        events = self._selector.select(min(waits))
+        now = monotonic()
+        for key, _ in events:
+            if key.fileobj is sock:
+                self._accept(sock, now)
+            else:
+                self._read_customer(key.fileobj, now)
+        for conn, (deadline, _) in list(self._pending.items()):
+            if deadline <= now:
+                self._reject(conn, "timeout")
+
+    def _read_customer(self, conn, now):
+        try:
+            self._read_route(conn, now)
+        except Exception:
+            logging.error("Ingress customer failed {}".format(traceback.format_exc()))
+            if conn in self._pending:
+                self._reject(conn, "error")
+            else:
+                try_close(conn)
+
+    def _accept(self, sock, now):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except (OSError, socket.error):
+                return
+            conn.setblocking(False)
+            self._pending[conn] = [now + INGRESS_TIMEOUT, None]
+            self._selector.register(conn, selectors.EVENT_READ)
+
+    def _forget(self, conn):
+        state = self._pending.pop(conn)
+        if state[1] is None:
+            self._selector.unregister(conn)
+
+    def _reject(self, conn, reason, reply = None):
+        self._forget(conn)
+        self.rejected += 1
+        logging.debug("ingress customer rejected: {}".format(reason))
+        if reply:
+            try:
+                conn.send(reply)
+            except (OSError, socket.error):
+                pass
+        try_close(conn)
+
+    def _read_route(self, conn, now):
+        try:
+            data = conn.recv(MAX_ROUTE_HEADER, socket.MSG_PEEK)
+        except (OSError, socket.error) as e:
+            if getattr(e, "errno", None) in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b""
+        if not data:
+            self._reject(conn, "closed")
+            return
+        try:
+            found = parse_route(data)
+        except ValueError as e:
+            self._reject(conn, e)
+            return
+        if found is None:
+            if len(data) >= MAX_ROUTE_HEADER:
+                self._reject(conn, "the route header is too long")
+            else:
+                # the rest is on the way, the peeked bytes keep the socket readable till then
+                self._selector.unregister(conn)
+                self._pending[conn][1] = now + INGRESS_RETRY
+            return
+        kind, route, size = found
+        with self._routes_lock:
+            tunnel = self._routes.get(route)
+        if tunnel is None:
+            self._reject(conn, "no route {}".format(route), CONNECT_NOT_FOUND if kind == ROUTE_CONNECT else None)
+            return
+        self._forget(conn)
+        try:
+            # the header is peeked already, and the reply fits the send buffer of a new connection,
+            # so neither of them blocks the ingress thread
+            if size and conn.recv(size) != data[:size]:
+                raise socket.error("the route header is not read at once")
+            if kind == ROUTE_CONNECT and conn.send(CONNECT_ESTABLISHED) != len(CONNECT_ESTABLISHED):
+                raise socket.error("the CONNECT reply is not sent at once")
+        except (OSError, socket.error) as e:
+            self.rejected += 1
+            logging.debug("ingress customer lost: {}".format(e))
+            try_close(conn)
+            return
+        self.routed += 1
+        # the tunnel gets it as the ones accepted on its own port, and queues it for its thread
+        conn.setblocking(True)
+        tunnel.add_customer(conn)
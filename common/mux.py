@@ -0,0 +1,390 @@
+"""
+Tunnel streams multiplexed over the control connection. A new customer of a tunnel costs
+a stream open message instead of a new connection from the device back to the server.
+Every stream has a credit based flow control: a side sends no more than the other side
+has granted with window updates, so a slow stream never blocks the others, and no side
+buffers more than its window. Streams with a higher priority are read first.
+The messages are queued for a writer thread, so a slow control connection never stalls the stream sockets;
+the streams are not read while too much data is queued.
+"""
+import collections
+import logging
+import socket
+import threading
+import traceback
+
+from .control_message import *
+from .socket_bridge import *
+
+# bytes a side is ready to receive on a stream, before the data is delivered to its socket
+MUX_WINDOW = 2 ** 18
+# the biggest data message, so streams take turns on the control connection
+MUX_MAX_DATA = 2 ** 14
+# stream data queued for the control connection, the streams are not read above it till a half of it is sent
+MUX_MAX_QUEUED = 2 ** 20
+
+
+class MuxStream(TrafficStats):
+    """ A stream and the socket it is relayed to: a socket pair end bridged to a customer on the server,
+        or the connection to the tunnel target on the slaver
+    """
+    __slots__ = ("id", "tunnel_id", "priority", "sock", "credit", "pending", "pending_size",
+                 "consumed", "granted", "events", "eof")
+
+    def __init__(self, stream_id, tunnel_id, priority = 0, credit = 0):
+        TrafficStats.__init__(self)
+        self.id = stream_id
+        self.tunnel_id = tunnel_id
+        self.priority = priority  # higher is read first
+        self.sock = None  # type: socket.socket
+        self.credit = credit  # bytes the other side is ready to receive
+        self.pending = collections.deque()  # data received from the other side, not written into the socket yet
+        self.pending_size = 0
+        self.consumed = 0  # bytes written into the socket, not granted back to the other side yet
+        self.granted = 0  # bytes the other side may send, it never gets more than the window
+        self.events = 0
+        self.eof = False  # the other side has closed the stream, it is closed once the pending data is written
+
+
+class Multiplexer ():
+    """ Relays the streams of one control connection. The socket I/O is done by the multiplexer thread,
+        the connection reader passes the stream messages with feed(), and the writer thread sends the messages
+        into the control connection
+    """
+
+    def __init__(self, send, on_open = None, window = MUX_WINDOW):
+        """ type send: callable(ControlMessage) - sends into the control connection, atomically for a message.
+                            It is called by the writer thread only, and may block
+            type on_open: callable(Multiplexer, MuxStream) - the other side opened a stream,
+                            attach() a socket to it, or close_stream() it
+        """
+        self.work = True
+        self.window = window
+        self._send = send
+        self._on_open = on_open
+        self._streams = {}  # stream_id -> MuxStream, touched by the multiplexer thread only
+        self._next_id = 0
+        self._id_lock = threading.Lock()
+        self._outgoing = collections.deque()  # (message, data size) not sent yet
+        self._outgoing_size = 0
+        self._outgoing_ready = threading.Condition()  # guards the outgoing queue
+        self._blocked = False  # too much data is queued, the streams are not read
+        self._calls = collections.deque()
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_r.setblocking(False)
+        self._waker_w.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._waker_r, EVENT_READ)
+        self._thread = threading.Thread(target=self._run, name="mux")
+        self._thread.daemon = True
+        self._thread.start()
+        self._writer = threading.Thread(target=self._write, name="mux writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def open_stream(self, tunnel_id, sock, priority = 0):
+        """ Open a stream of the tunnel and relay the socket to it. The data is sent once the other side accepts
+            rtype: int - the stream id
+        """
+        with self._id_lock:
+            self._next_id = self._next_id % 0xFFFFFFFF + 1
+            stream_id = self._next_id
+        stream = MuxStream(stream_id, tunnel_id, priority)
+        stream.granted = self.window
+        sock.setblocking(False)
+        stream.sock = sock
+        # registered before the message is sent, so the accepting window update always finds the stream
+        self._call_soon(self._add_stream, stream)
+        self._post(StreamOpenMessage(stream_id, tunnel_id, priority, self.window))
+        return stream_id
+
+    def attach(self, stream_id, sock):
+        """ Relay the socket to a stream opened by the other side, and accept the stream
+        """
+        sock.setblocking(False)
+        self._call_soon(self._attach, stream_id, sock)
+
+    def close_stream(self, stream_id):
+        self._call_soon(self._close_stream, stream_id, True)
+
+    def feed(self, message):
+        """ Pass a stream message read from the control connection
+            rtype: bool - the message is a stream one
+        """
+        if type(message) not in STREAM_MESSAGES.values():
+            return False
+        self._call_soon(self._on_message, message)
+        return True
+
+    def get_stats(self, tunnel_id = None):
+        """ Returns the traffic counters of the streams of the tunnel (or of all the streams):
+            bytes_in - received from the sockets, bytes_out - written into them
+            rtype: dict
+        """
+        result = []
+        def collect():
+            stats = TrafficStats()
+            count = 0
+            for stream in self._streams.values():
+                if tunnel_id in (None, stream.tunnel_id):
+                    stats.add(stream)
+                    count += 1
+            ret = stats.as_dict()
+            ret["streams"] = count
+            return ret
+        if not self.work:
+            return {}  # the streams are gone with the control connection
+        done = threading.Event()
+        self._call_soon(lambda: (result.append(collect()), done.set()))
+        deadline = monotonic() + CALL_TIMEOUT
+        # a multiplexer closed meanwhile never runs the call, so it is not waited for
+        while not done.wait(0.1) and self.work and monotonic() < deadline:
+            pass
+        return result[0] if result else {}
+
+    def has_streams(self, tunnel_id):
+        """ rtype: bool - the tunnel has streams, False at once for a closed multiplexer
+        """
+        return bool(self.get_stats(tunnel_id).get("streams"))
+
+    def close(self):
+        """ Close all the streams, the control connection is gone
+        """
+        self.work = False
+        self._wakeup()
+        with self._outgoing_ready:
+            self._outgoing_ready.notify()
+
+    def _post(self, message, size = 0):
+        """ Queue the message for the writer thread
+            type size: int - the stream data bytes of the message
+        """
+        with self._outgoing_ready:
+            self._outgoing.append((message, size))
+            self._outgoing_size += size
+            if self._outgoing_size >= MUX_MAX_QUEUED:
+                self._blocked = True
+            self._outgoing_ready.notify()
+
+    def _write(self):
+        """ The writer thread: sends the queued messages in order, and resumes reading the streams
+            once the control connection has taken enough of them
+        """
+        while self.work:
+            with self._outgoing_ready:
+                while self.work and not self._outgoing:
+                    self._outgoing_ready.wait()
+                messages, self._outgoing = self._outgoing, collections.deque()
+            sent = 0
+            try:
+                for message, size in messages:
+                    self._send(message)
+                    sent += size
+            except Exception as e:
+                # in most cases, the control connection is broken
+                if self.work:
+                    logging.warning("Multiplexer stopped: {}".format(e))
+                self.close()
+                return
+            with self._outgoing_ready:
+                self._outgoing_size -= sent
+                resume = self._blocked and self._outgoing_size < MUX_MAX_QUEUED // 2
+                if resume:
+                    self._blocked = False
+            if resume:
+                self._call_soon(self._update_streams)
+
+    def _call_soon(self, fn, *args):
+        self._calls.append((fn, args))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._waker_w.send(b"\0")
+        except Exception:
+            pass # the waker is already full or closed, the loop will be woken anyway
+
+    def _run(self):
+        try:
+            while self.work:
+                while self._calls:
+                    fn, args = self._calls.popleft()
+                    fn(*args)
+                events = self._selector.select()
+                readable = []
+                for key, mask in events:
+                    stream = key.data
+                    if stream is None:
+                        try:
+                            while self._waker_r.recv(1024):
+                                pass
+                        except Exception:
+                            pass
+                        continue
+                    if mask & EVENT_WRITE and stream.id in self._streams:
+                        self._flush(stream)
+                    if mask & EVENT_READ:
+                        readable.append(stream)
+                # the higher priority streams take the control connection first
+                readable.sort(key = lambda stream: -stream.priority)
+                for stream in readable:
+                    if stream.id in self._streams and not self._blocked:
+                        self._read(stream)
+        except Exception as e:
+            # in most cases, the control connection is broken
+            logging.warning("Multiplexer stopped: {}".format(e))
+            logging.debug(traceback.format_exc())
+        # the writer thread and the callers waiting on the loop see it stopped
+        self.close()
+        for stream in list(self._streams.values()):
+            self._close_stream(stream.id, False)
+        try_close(self._waker_r)
+        try_close(self._waker_w)
+        self._selector.close()
+
+    def _add_stream(self, stream):
+        self._streams[stream.id] = stream
+        self._update_events(stream)
+
+    def _update_streams(self):
+        for stream in self._streams.values():
+            self._update_events(stream)
+
+    def _on_message(self, message):
+        stream = self._streams.get(message.stream_id)
+        if isinstance(message, StreamOpenMessage):
+            if stream is not None:
+                # the live stream is kept, its socket and data are not given to another one
+                logging.warning("Mux protocol error: stream {} is opened again, rejected".format(message.stream_id))
+                self._post(StreamCloseMessage(message.stream_id))
+                return
+            stream = MuxStream(message.stream_id, message.tunnel_id, message.priority, message.window)
+            self._streams[stream.id] = stream
+            if self._on_open:
+                self._on_open(self, stream)
+            else:
+                self._close_stream(stream.id, True)
+        elif stream is None:
+            return # the stream is closed already
+        elif isinstance(message, StreamDataMessage):
+            if stream.eof:
+                return
+            stream.granted -= len(message.data)
+            if stream.granted < 0:
+                # the other side ignores the credits, it is not buffered without a limit
+                logging.warning("Mux protocol error: stream {} exceeds its window, closed".format(stream.id))
+                self._close_stream(stream.id, True)
+                return
+            stream.pending.append(message.data)
+            stream.pending_size += len(message.data)
+            if stream.sock:
+                self._flush(stream)
+        elif isinstance(message, StreamWindowUpdateMessage):
+            stream.credit += message.increment
+            self._update_events(stream)
+        elif isinstance(message, StreamCloseMessage):
+            stream.eof = True
+            if not stream.pending_size or stream.sock is None:
+                self._close_stream(stream.id, False)
+
+    def _attach(self, stream_id, sock):
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            try_close(sock)
+            return
+        stream.sock = sock
+        stream.granted = self.window
+        self._post(StreamWindowUpdateMessage(stream_id, self.window))
+        self._flush(stream)
+
+    def _read(self, stream):
+        """ Send the socket data to the other side, as much as it is ready to receive
+        """
+        try:
+            data = stream.sock.recv(min(stream.credit, MUX_MAX_DATA))
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            logging.debug("mux stream {} read error: {}".format(stream.id, e))
+            data = b""
+        if not data:
+            # the other side delivers what it got and closes the stream
+            self._close_stream(stream.id, True)
+            return
+        stream.credit -= len(data)
+        stream.bytes_in += len(data)
+        stream.recv_calls += 1
+        self._post(StreamDataMessage(stream.id, data), len(data))
+        if self._blocked:
+            # the control connection is too slow, stop reading all the streams
+            self._update_streams()
+        else:
+            self._update_events(stream)
+
+    def _flush(self, stream):
+        """ Write the data of the other side into the socket, and grant the written bytes back
+        """
+        while stream.pending:
+            data = stream.pending[0]
+            stream.send_calls += 1
+            try:
+                sent = stream.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                break
+            except Exception as e:
+                logging.debug("mux stream {} write error: {}".format(stream.id, e))
+                self._close_stream(stream.id, True)
+                return
+            stream.bytes_out += sent
+            stream.pending_size -= sent
+            stream.consumed += sent
+            if sent < len(data):
+                stream.pending[0] = data[sent:]
+                break
+            stream.pending.popleft()
+        if stream.eof and not stream.pending:
+            self._close_stream(stream.id, False)
+            return
+        # grant the window back in big enough pieces, not to send an update for every message
+        if stream.consumed >= self.window // 2:
+            self._post(StreamWindowUpdateMessage(stream.id, stream.consumed))
+            stream.granted += stream.consumed
+            stream.consumed = 0
+        self._update_events(stream)
+
+    def _update_events(self, stream):
+        if stream.sock is None:
+            return
+        events = 0
+        if stream.credit > 0 and not self._blocked:
+            events |= EVENT_READ
+        if stream.pending:
+            events |= EVENT_WRITE
+        if events == stream.events:
+            return
+        try:
+            if not stream.events:
+                self._selector.register(stream.sock, events, stream)
+            elif events:
+                self._selector.modify(stream.sock, events, stream)
+            else:
+                self._selector.unregister(stream.sock)
+        except (KeyError, ValueError, OSError):
+            pass
+        stream.events = events
+
+    def _close_stream(self, stream_id, notify):
+        """ notify - let the other side know, the stream is closed on this side
+        """
+        stream = self._streams.pop(stream_id, None)
+        if stream is None:
+            return
+        if stream.sock:
+            if stream.events:
+                try:
+                    self._selector.unregister(stream.sock)
+                except (KeyError, ValueError, OSError):
+                    pass
+            try_close(stream.sock)
+        if notify and self.work:
+            self._post(StreamCloseMessage(stream_id))
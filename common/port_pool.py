@@ -0,0 +1,144 @@
+"""
+The ports of the tunnels. The free ports of the range are kept in a queue, taken from its head and returned to
+its tail, so a port is found without bind retries, and a closed port is reused as late as possible.
+A port another program (or a lingering connection) holds is set aside for a while, instead of being tried again at once.
+A few stream sockets are bound ahead by a thread, so opening a tunnel does not bind at all.
+"""
+import collections
+import errno
+import logging
+import random
+import socket
+import threading
+
+from .socket_bridge import try_close
+from .timer_wheel import monotonic
+
+# a port found busy is tried again after it, seconds
+BUSY_PORT_RETRY = 30
+
+
+class PortPool ():
+    """ Allocates the ports of a range. The sockets are bound, not listening: the tunnel listens with its own backlog,
+        so no connection is queued to a port no tunnel has
+    """
+
+    def __init__(self, first, last, prebound = 0, host = "0.0.0.0"):
+        """ type first: int - the first port of the range
+            type last: int - the port after the last one
+            type prebound: int - stream sockets kept bound ahead
+        """
+        ports = list(range(first, last))
+        # the ports are handed out in a random order, as before, so the tunnel ids are not guessed
+        random.shuffle(ports)
+        self.size = len(ports)
+        self._host = host
+        self._prebound_size = prebound
+        self._free = collections.deque(ports)
+        self._busy = collections.deque() # (retry time, port)
+        self._used = {} # socket -> port
+        self._prebound = collections.deque() # (socket, port)
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self.allocations = 0
+        self.exhausted = 0 # allocations failed for no free port
+        self.busy_found = 0 # binds failed for a port held by another socket
+
+    def start(self):
+        """ Start binding the sockets ahead
+        """
+        if self._prebound_size:
+            thread = threading.Thread(target = self._run, name = "port pool")
+            thread.daemon = True
+            thread.start()
+            self._refill.set()
+
+    def allocate(self, kind = socket.SOCK_STREAM):
+        """ Returns a socket bound to a free port of the range
+            type kind: int - socket.SOCK_STREAM or socket.SOCK_DGRAM
+            rtype: tuple - (socket.socket, port), or (None, None) if the range is exhausted
+        """
+        with self._lock:
+            self.allocations += 1
+            if kind == socket.SOCK_STREAM and self._prebound:
+                sock, port = self._prebound.popleft()
+                self._used[sock] = port
+                self._refill.set()
+                return sock, port
+        sock, port = self._bind(kind)
+        with self._lock:
+            if sock is None:
+                self.exhausted += 1
+                logging.warning("No free port in the range, {} ports are used".format(len(self._used)))
+            else:
+                self._used[sock] = port
+        return sock, port
+
+    def release(self, sock):
+        """ Close the socket of an allocated port, and return the port to the range. A socket released already is just closed
+            type sock: socket.socket
+        """
+        if sock is None:
+            return
+        with self._lock:
+            port = self._used.pop(sock, None)
+        try_close(sock)
+        if port is not None:
+            with self._lock:
+                self._free.append(port)
+            self._refill.set()
+
+    def get_stats(self):
+        """ rtype: dict
+        """
+        with self._lock:
+            used = len(self._used)
+            return {"ports": self.size, "ports_used": used, "ports_free": len(self._free), "ports_busy": len(self._busy),
+                    "ports_prebound": len(self._prebound),
+                    "ports_utilisation": round((used + len(self._busy)) / float(self.size), 3) if self.size else 0,
+                    "port_allocations": self.allocations, "ports_exhausted": self.exhausted, "ports_found_busy": self.busy_found}
+
+    def _next_port(self, now):
+        """ rtype: int or None
+        """
+        with self._lock:
+            while self._busy and self._busy[0][0] <= now:
+                self._free.append(self._busy.popleft()[1])
+            return self._free.popleft() if self._free else None
+
+    def _bind(self, kind):
+        """ Bind a socket to the next free port. The ports held by others are set aside, so it tries each of them once
+            rtype: tuple - (socket.socket, port) or (None, None)
+        """
+        now = monotonic()
+        while True:
+            port = self._next_port(now)
+            if port is None:
+                return None, None
+            sock = socket.socket(socket.AF_INET, kind)
+            try:
+                sock.bind((self._host, port))
+                return sock, port
+            except socket.error as e:
+                try_close(sock)
+                with self._lock:
+                    if e.errno == errno.EADDRINUSE:
+                        self.busy_found += 1
+                        self._busy.append((now + BUSY_PORT_RETRY, port))
+                    else:
+                        self._free.append(port)
+                if e.errno != errno.EADDRINUSE:
+                    logging.error("Failed to bind the port {}: {}".format(port, e))
+                    return None, None
+
+    def _run(self):
+        while True:
+            self._refill.wait()
+            self._refill.clear()
+            while len(self._prebound) < self._prebound_size:
+                sock, port = self._bind(socket.SOCK_STREAM)
+                if sock is None:
+                    # the range is exhausted, the next release or allocation tries again
+                    break
+                with self._lock:
+                    self._prebound.append((sock, port))
@@ -8,10 +8,26 @@ I just little simplified it.
 import collections
 import warnings
 import traceback
-import datetime
 import logging
 import threading
 import time
+import socket
+import select
+import os
+import heapq
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .timer_wheel import *
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 try:
     import selectors
@@ -19,13 +35,62 @@ try:
 
     EVENT_READ_WRITE = EVENT_READ | EVENT_WRITE
 except ImportError:
-    import select
-
     warnings.warn('selectors module not available, fallback to select')
     selectors = None
+    EVENT_READ, EVENT_WRITE = 1, 2
+    EVENT_READ_WRITE = EVENT_READ | EVENT_WRITE
 
 # socket recv buffer, 16384 bytes
 RECV_BUFFER_SIZE = 2 ** 14
+# a reader is paused when its pair has more than HIGH_WATERMARK bytes not sent yet,
+# and resumed when the pair's buffer drains down to LOW_WATERMARK
+HIGH_WATERMARK = 2 ** 18
+LOW_WATERMARK = 2 ** 16
+
+# how long a thread waits for the reactor to answer, seconds
+CALL_TIMEOUT = 5
+
+# free slabs kept by the bridge buffer pool, 4 MiB
+POOL_MAX_FREE_SLABS = 2 ** 8
+
+# relay plain sockets with splice() through a pipe, so the data never comes to userspace (Linux only)
+SPLICE_ENABLED = hasattr(os, "splice")
+
+
+# recv to send latency histogram buckets: bucket i counts latencies below 2**i microseconds
+LATENCY_BUCKETS = 32
+
+# a rate limited bridge may send this many seconds of its rate at once
+RATE_BURST_SEC = 0.1
+# a throttled reader is resumed when its token buckets have this many bytes to spend,
+# but not sooner than in THROTTLE_MIN_DELAY seconds, not to wake up the loop for every few bytes
+THROTTLE_RESUME_BYTES = 2 ** 10
+THROTTLE_MIN_DELAY = 0.01
+# a pair which received nothing for that long, seconds, is idle and takes the current virtual time
+# of the fair scheduling, instead of its own one left behind
+FAIR_IDLE_SEC = 0.1
+
+# socket options of the tunnel profiles, None - the OS default
+PROFILES = {
+    # shells and consoles: small writes go out right away
+    "interactive": {"nodelay": True, "sndbuf": None, "rcvbuf": None, "keepalive": True, "adaptive": False},
+    # file transfers: big kernel buffers, and reads growing to the bandwidth-delay product
+    "bulk": {"nodelay": False, "sndbuf": 2 ** 22, "rcvbuf": 2 ** 22, "keepalive": True, "adaptive": True},
+}
+# TCP keepalive of the profiles: idle seconds before the first probe, seconds between probes, probes count
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+
+# an adaptive pair reads the data its path holds: throughput * round trip time, measured every ADAPT_PERIOD seconds
+ADAPT_PERIOD = 1
+ADAPTIVE_MIN_READ = 2 ** 12
+ADAPTIVE_MAX_READ = 2 ** 20
+# the round trip time used when the OS does not report one, seconds
+ASSUMED_RTT = 0.01
+# tcpi_rtt, microseconds, follows 8 one byte fields and 15 four byte ones of the Linux struct tcp_info
+TCP_INFO_RTT = struct.Struct("=I")
+TCP_INFO_RTT_OFFSET = 68
 
 
 def fmt_addr(socket):
@@ -39,188 +104,949 @@ def try_close(connection):
         pass
 
 
-class SocketBridge ():
+def tune_socket(sock, profile):
+    """ Apply the socket options of a tunnel profile. An option the socket does not support is skipped
+        type profile: dict - one of PROFILES
+    """
+    is_tcp = sock.family in (socket.AF_INET, getattr(socket, "AF_INET6", None)) and sock.type == socket.SOCK_STREAM
+    options = []
+    if profile.get("sndbuf"):
+        options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, profile["sndbuf"]))
+    if profile.get("rcvbuf"):
+        options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, profile["rcvbuf"]))
+    if is_tcp:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, int(bool(profile.get("nodelay")))))
+        if profile.get("keepalive"):
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            for name, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                                ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+                if hasattr(socket, name):
+                    options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    for level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except (OSError, socket.error) as e:
+            logging.debug("unable to set a socket option {}: {}".format(option, e))
 
-    def __init__ (self, terminate_callback = None, timeout = 60):
-        self.work = True
-        self.connections = set()  # holds all sockets
-        self.map = {}  # holds sockets pairs
-        self.callback =  terminate_callback # holds callback
-        self.send_buff = {}  # buff one packet for those sending too-fast socket
-        self.timeout_sec = timeout
-        self.timeout_counter = 0
-        self.delay = 0.1
-        if selectors:
-            self.selector = selectors.DefaultSelector()
+
+def get_profile(name):
+    """ Returns the socket options of a tunnel profile, None for the OS defaults
+        rtype: dict
+    """
+    if not name:
+        return None
+    if name not in PROFILES:
+        logging.warning("unknown tunnel profile {}, the OS defaults are used".format(name))
+    return PROFILES.get(name)
+
+
+def tcp_rtt(sock):
+    """ The smoothed round trip time of a TCP socket, as the OS measured it
+        rtype: float - seconds, or None if it is unknown
+    """
+    if not hasattr(socket, "TCP_INFO") or sock.family not in (socket.AF_INET, getattr(socket, "AF_INET6", None)):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size)
+        return TCP_INFO_RTT.unpack_from(info, TCP_INFO_RTT_OFFSET)[0] / 1000000.0 or None
+    except (OSError, socket.error, struct.error):
+        return None
+
+
+class TrafficStats(object):
+    """ Traffic counters of a pair, or summed ones of a bridge
+    """
+    __slots__ = ("bytes_in", "bytes_out", "recv_calls", "send_calls", "latency")
+
+    def __init__(self):
+        self.bytes_in = 0  # bytes received from the sockets
+        self.bytes_out = 0  # bytes sent into the sockets
+        self.recv_calls = 0
+        self.send_calls = 0
+        self.latency = [0] * LATENCY_BUCKETS  # how long the data stays in the bridge, log2 of microseconds
+
+    def record_latency(self, seconds):
+        self.latency[min(int(seconds * 1000000).bit_length(), LATENCY_BUCKETS - 1)] += 1
+
+    def add(self, other):
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.recv_calls += other.recv_calls
+        self.send_calls += other.send_calls
+        self.latency = [a + b for a, b in zip(self.latency, other.latency)]
+
+    def as_dict(self):
+        return {"bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                "recv_calls": self.recv_calls, "send_calls": self.send_calls,
+                "latency_us_log2": list(self.latency)}
+
+
+def merge_stats(a, b):
+    """ Sum two stats dicts, as returned by get_stats() of the bridges
+        rtype: dict
+    """
+    ret = dict(a)
+    for key, value in b.items():
+        if key not in ret:
+            ret[key] = value
+        elif isinstance(value, list):
+            ret[key] = [x + y for x, y in zip(ret[key], value)]
+        elif isinstance(value, (int, float)):
+            ret[key] = ret[key] + value
+    return ret
+
+
+class TokenBucket(object):
+    """ Limits the traffic rate. Tokens (bytes) come with the rate, up to the burst size,
+        and every byte received spends one. Touched by the reactor thread only
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated", "round")
+
+    def __init__(self, rate, burst = None):
+        self.rate = float(rate)  # bytes per second
+        self.burst = burst or max(self.rate * RATE_BURST_SEC, RECV_BUFFER_SIZE)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.round = 0  # when the readers throttled by the bucket are resumed
+
+    def available(self, now):
+        """ Bytes which may be received right now
+            rtype: float
+        """
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens
+
+    def consume(self, count):
+        self.tokens -= count
+
+    def delay(self, count, now):
+        """ Seconds till the bucket has count bytes to spend
+        """
+        return max(0, (min(count, self.burst) - self.available(now)) / self.rate)
+
+    def resume_at(self, now):
+        """ Returns when the readers throttled by the bucket are resumed. They are all resumed at once,
+            so the fair order decides who takes the tokens
+        """
+        if self.round <= now:
+            self.round = now + max(THROTTLE_MIN_DELAY, self.delay(THROTTLE_RESUME_BYTES, now))
+        return self.round
+
+
+_device_buckets = {}
+_device_buckets_lock = threading.Lock()
+
+
+def device_bucket(device_id, rate):
+    """ Returns the token bucket shared by all the bridges of a device in this process.
+        The rate of an existing bucket is updated, so the last opened tunnel sets it
+        rtype: TokenBucket
+    """
+    with _device_buckets_lock:
+        bucket = _device_buckets.get(device_id)
+        if bucket is None:
+            bucket = _device_buckets[device_id] = TokenBucket(rate)
+        elif bucket.rate != rate:
+            bucket.rate = float(rate)
+            bucket.burst = max(bucket.rate * RATE_BURST_SEC, RECV_BUFFER_SIZE)
+        return bucket
+
+
+class BufferPool(object):
+    """ Preallocated bytearray slabs the bridge receives the data into with recv_into().
+        Slabs come back to the pool once their data is sent, so the hot loop does not allocate
+    """
+    __slots__ = ("slab_size", "max_free", "free", "allocated", "misses")
+
+    def __init__(self, slab_size = RECV_BUFFER_SIZE, max_free = POOL_MAX_FREE_SLABS):
+        self.slab_size = slab_size
+        self.max_free = max_free  # slabs above this number are given back to the allocator
+        self.free = []
+        self.allocated = 0
+        self.misses = 0  # slabs allocated for no free one in the pool
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        self.allocated += 1
+        self.misses += 1
+        return bytearray(self.slab_size)
+
+    def release(self, slab):
+        if len(self.free) < self.max_free:
+            self.free.append(slab)
         else:
-            self.selector = None
-        
-        
+            self.allocated -= 1
 
-    def add_pair (self, conn1, conn2):
+    def stats(self):
+        """ Returns the pool occupancy
+            rtype: dict
         """
-        transfer anything between two sockets
-        :type conn1: socket.socket
-        :type conn2: socket.socket
-        :param callback: callback in connection finish
-        :type callback: Callable
+        return {"slab_size": self.slab_size, "allocated": self.allocated,
+                "in_use": self.allocated - len(self.free), "free": len(self.free), "misses": self.misses}
+
+
+class SendBuffer(object):
+    """ Data received from one socket of a pair and not sent into another one yet.
+        Each chunk is a [slab, start, end, received at] region of a pool slab, so a partial send just moves the start,
+        and the next recv continues to fill the last slab while it has room.
+        The latency of a chunk is measured from its first recv till its last byte is sent
+    """
+    __slots__ = ("pool", "chunks", "size")
+
+    capacity = float("inf")
+
+    # do not receive into the rest of the last slab if it is smaller than that
+    MIN_SLAB_ROOM = 2 ** 10
+
+    def __init__(self, pool):
+        self.pool = pool  # type: BufferPool
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def fill_from(self, sock, limit = RECV_BUFFER_SIZE):
+        """ Receive up to limit bytes of the socket
+            rtype: int - bytes received, 0 if the socket is closed by remote
         """
-        # change to non-blocking
-        # we use select or epoll to notice when data is ready
-        conn1.setblocking(False)
-        conn2.setblocking(False)
+        chunks = self.chunks
+        total = 0
+        now = None
+        while total < limit:
+            chunk = chunks[-1] if chunks else None
+            if chunk is None or len(chunk[0]) - chunk[2] < self.MIN_SLAB_ROOM:
+                chunk = None
+                slab = self.pool.acquire()
+                start = 0
+            else:
+                slab = chunk[0]
+                start = chunk[2]
+            requested = min(len(slab) - start, limit - total)
+            try:
+                received = sock.recv_into(memoryview(slab)[start:start + requested])
+            except Exception:
+                if chunk is None:
+                    self.pool.release(slab)
+                if total:
+                    break
+                raise
+            if not received:
+                if chunk is None:
+                    self.pool.release(slab)
+                break
+            if chunk is None:
+                if now is None:
+                    now = monotonic()
+                chunks.append([slab, 0, received, now])
+            else:
+                chunk[2] += received
+            total += received
+            # a short read means the socket is drained. But an SSL socket may hold already decrypted data,
+            # which select() will never report
+            if received < requested and not (getattr(sock, "pending", None) and sock.pending()):
+                break
+        self.size += total
+        return total
 
-        # mark as readable+writable
-        self.connections.add(conn1)
-        self.connections.add(conn2)
+    def send_to(self, sock, stats):
+        """ Send as much as the socket accepts without blocking
+            type stats: TrafficStats
+            rtype: int - bytes sent
+        """
+        total = 0
+        chunks = self.chunks
+        while chunks:
+            chunk = chunks[0]
+            slab, start, end, received_at = chunk
+            stats.send_calls += 1
+            try:
+                sent = sock.send(memoryview(slab)[start:end])
+            except (BlockingIOError, InterruptedError):
+                break
+            except Exception as e:
+                if _is_want_io(e):
+                    break
+                raise
+            total += sent
+            if start + sent < end:
+                chunk[1] = start + sent
+                break
+            chunks.popleft()
+            self.pool.release(slab)
+            stats.record_latency(monotonic() - received_at)
+        self.size -= total
+        stats.bytes_out += total
+        return total
 
-        # record sockets pairs
-        self.map[conn1] = conn2
-        self.map[conn2] = conn1
-            
-        if self.selector:
-            self.selector.register(conn1, EVENT_READ_WRITE)
-            self.selector.register(conn2, EVENT_READ_WRITE)
+    def clear(self):
+        while self.chunks:
+            self.pool.release(self.chunks.popleft()[0])
+        self.size = 0
+
+
+class PipeBuffer(object):
+    """ The same as SendBuffer, but the data is moved socket -> pipe -> socket with splice(),
+        so it is never copied to userspace. Works only for plain (not SSL) sockets on Linux
+    """
+    __slots__ = ("r", "w", "size", "capacity", "since")
+
+    FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+
+    def __init__(self, capacity = HIGH_WATERMARK):
+        self.r, self.w = os.pipe()
+        self.size = 0
+        self.since = 0  # when the pipe became non empty, the latency is measured till it is drained
+        self.capacity = 2 ** 16  # the default pipe size
+        try:
+            os.set_blocking(self.r, False)
+            os.set_blocking(self.w, False)
+            if fcntl and hasattr(fcntl, "F_SETPIPE_SZ"):
+                self.capacity = fcntl.fcntl(self.w, fcntl.F_SETPIPE_SZ, capacity)
+        except OSError:
+            pass # keep the default size
+
+    @staticmethod
+    def supports(sock):
+        return SPLICE_ENABLED and type(sock) is socket.socket and sock.type == socket.SOCK_STREAM
+
+    def fill_from(self, sock, limit = RECV_BUFFER_SIZE):
+        if self.size >= self.capacity:
+            raise BlockingIOError()
+        received = os.splice(sock.fileno(), self.w, min(self.capacity - self.size, limit), flags = self.FLAGS)
+        if not self.size:
+            self.since = monotonic()
+        self.size += received
+        return received
+
+    def send_to(self, sock, stats):
+        total = 0
+        while self.size:
+            stats.send_calls += 1
+            try:
+                sent = os.splice(self.r, sock.fileno(), self.size, flags = self.FLAGS)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not sent:
+                break
+            self.size -= sent
+            total += sent
+        if total and not self.size:
+            stats.record_latency(monotonic() - self.since)
+        stats.bytes_out += total
+        return total
+
+    def clear(self):
+        self.size = 0
+        for fd in (self.r, self.w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.r = self.w = -1
+
+
+class _Endpoint(object):
+    """ One socket of a pair together with the data waiting to be sent into it
+    """
+    __slots__ = ("sock", "bridge", "pair", "peer", "buff", "events", "paused", "throttled", "eof", "read_size")
+
+    def __init__(self, sock, bridge, buff):
+        self.sock = sock
+        self.bridge = bridge  # type: SocketBridge
+        self.pair = None  # type: _Pair
+        self.peer = None  # type: _Endpoint
+        self.buff = buff  # type: SendBuffer or PipeBuffer
+        self.events = 0  # events the socket is currently watched for
+        self.paused = False  # reading is paused because the peer has too much data not sent yet
+        self.throttled = False  # reading is paused till the rate limits of the bridge let it go
+        self.eof = False  # the socket is closed by remote, the pair lives till the peer gets all the data
+        self.read_size = RECV_BUFFER_SIZE  # bytes read per loop pass, before the bridge weight
+
+
+class _PairBase(TrafficStats):
+    """ The traffic counters of a pair of any engine.
+        The pair is a timer wheel entry, expiring when it is idle or too old
+    """
+    __slots__ = ("bridge", "created", "last_active", "deadline", "wheel_slot")
+
+    def __init__(self, bridge, now):
+        TrafficStats.__init__(self)
+        self.bridge = bridge
+        self.created = now
+        self.last_active = now  # the last time something was received, monotonic
+        self.deadline = None
+        self.wheel_slot = None
+
+    def get_deadline(self):
+        deadline = self.last_active + self.bridge.timeout_sec
+        if self.bridge.max_lifetime:
+            deadline = min(deadline, self.created + self.bridge.max_lifetime)
+        return deadline
+
+
+class _Pair(_PairBase):
+    """ Two linked endpoints and their traffic counters
+    """
+    __slots__ = ("ep1", "ep2", "vtime", "sampled", "sampled_bytes")
+
+    def __init__(self, ep1, ep2, now):
+        _PairBase.__init__(self, ep1.bridge, now)
+        self.ep1 = ep1
+        self.ep2 = ep2
+        self.vtime = 0  # bytes received divided by the bridge weight, the fair scheduling virtual time
+        self.sampled = now  # when the throughput of an adaptive pair was measured last time
+        self.sampled_bytes = 0
+
+
+class _ReactorBase(object):
+    """ What the engines keep the same way: the deadlines of the pairs and of the empty bridges on a timer wheel,
+        the counters of the closed pairs, and the bridge stats. All of it is touched by the loop thread only.
+        An engine provides call_soon(), and _buffered(), _close_pair(), _close_bridge() and _fire() for its pairs
+    """
+
+    def __init__(self):
+        self.timers = TimerWheel()  # idle deadlines of pairs, and of started bridges having no pairs
+        self._thread = None
+
+    def run_in_loop(self, fn, *args):
+        """ Run the function in the loop thread and wait for its result
+        """
+        if threading.current_thread() is self._thread:
+            return fn(*args)
+        done = threading.Event()
+        result = []
+        def call():
+            try:
+                result.append(fn(*args))
+            finally:
+                done.set()
+        self.call_soon(call)
+        done.wait(CALL_TIMEOUT)
+        return result[0] if result else None
+
+    def _bridge_stats(self, bridge):
+        stats = TrafficStats()
+        stats.add(bridge.closed_stats)
+        buffered = 0
+        for pair in bridge.pairs:
+            stats.add(pair)
+            buffered += self._buffered(pair)
+        ret = stats.as_dict()
+        ret["pairs"] = len(bridge.pairs)
+        ret["pairs_total"] = len(bridge.pairs) + bridge.closed_pairs_count
+        ret["buffered"] = buffered
+        return ret
 
-        logging.debug("New pair added. Total {} sockets in bridge".format(len(self.connections)))
+    def _expire(self, now):
+        """ Close the pairs and the bridges which deadlines are reached. Activity does not touch the wheel,
+            so the deadline of a pair is checked again here and the timer is moved if the pair was active meanwhile
+        """
+        for timer in self.timers.advance(now):
+            if isinstance(timer, _PairBase):
+                deadline = timer.get_deadline()
+                if deadline > now:
+                    self.timers.schedule(timer, deadline)
+                    continue
+                logging.debug("pair timeout reached")
+                self._close_pair(timer)
+            elif timer.work and not timer.pairs:
+                logging.info("bridge timeout reached")
+                timer.work = False
+                self._close_bridge(timer)
+                if timer.callback:
+                    self._fire(timer.callback)
+
+    def _pair_added(self, pair):
+        bridge = pair.bridge
+        bridge.pairs.add(pair)
+        self.timers.schedule(pair, pair.get_deadline())
+        self.timers.cancel(bridge)
+
+    def _pair_closed(self, pair):
+        bridge = pair.bridge
+        if pair in bridge.pairs:
+            bridge.pairs.discard(pair)
+            bridge.closed_stats.add(pair)
+            bridge.closed_pairs_count += 1
+            self.timers.cancel(pair)
+            if bridge.work and bridge.watched and not bridge.pairs:
+                self.timers.schedule(bridge, monotonic() + bridge.timeout_sec)
+
+    def _watch_timeout(self, bridge):
+        """ Close the bridge when it has no pairs for its timeout
+        """
+        bridge.watched = True
+        if bridge.work and not bridge.pairs:
+            self.timers.schedule(bridge, monotonic() + bridge.timeout_sec)
 
 
+class BridgeReactor(_ReactorBase):
+    """ A single event loop relaying data of all SocketBridges of the process.
+        SocketBridges only group pairs of a tunnel, so the thread count does not grow with the tunnels count.
+        All the state is touched by the loop thread only, other threads pass their requests via call_soon()
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """ Returns the process-wide reactor, starts it on first use
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start_as_daemon()
+            return cls._instance
+
+    def __init__(self):
+        _ReactorBase.__init__(self)
+        self.endpoints = {}  # holds an endpoint of every socket in the reactor
+        self.pool = BufferPool()  # slabs the data is received into
+        self.now = monotonic()  # the time of the current loop pass
+        self.vclock = 0  # the virtual time of the last served pair, new and idle pairs start from it
+        self._throttled = []  # a heap of (resume time, sequence, endpoint) of the rate limited readers
+        self._throttle_seq = 0
+        self._calls = collections.deque()  # requests from other threads
+        self._callbacks = queue.Queue()  # terminate callbacks, they are fired out of the loop thread
+        # a socket pair to wake up the loop when other threads put requests
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_r.setblocking(False)
+        self._waker_w.setblocking(False)
+        if selectors:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self._waker_r, EVENT_READ)
+        else:
+            self.selector = None
+
     def start_as_daemon(self):
-        t = threading.Thread(target=self.start, name="socketBridge")
-        t.daemon = True
-        t.start()
-        logging.info("SocketBridge daemon started")
-        return t
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.start, name="socketBridge")
+            self._thread.daemon = True
+            self._thread.start()
+            t = threading.Thread(target=self._fire_callbacks, name="socketBridge callbacks")
+            t.daemon = True
+            t.start()
+            logging.info("BridgeReactor daemon started")
+        return self._thread
 
     def start(self):
-        while self.work:
+        while True:
             try:
                 self._start()
             except:
-                logging.error("FATAL ERROR! SocketBridge failed {}".format(
+                logging.error("FATAL ERROR! BridgeReactor failed {}".format(
                     traceback.format_exc()
                 ))
 
+    def call_soon(self, fn, *args):
+        """ Run the function in the loop thread
+        """
+        self._calls.append((fn, args))
+        self._wakeup()
 
-    def _start(self): 
-        self._last_success_read = datetime.datetime.now() 
-        while self.work:
-            # Check if timeout reached
-            if (datetime.datetime.now() - self._last_success_read).total_seconds() >= self.timeout_sec:
-                logging.info("bridge timeout reached")
-                self.close() # Close the bridge due a timeout
-                break
+    def get_stats(self):
+        """ Returns the reactor state: sockets count and the buffer pool occupancy
+            rtype: dict
+        """
+        return self.run_in_loop(self._reactor_stats) or {}
+
+    def _reactor_stats(self):
+        return {"sockets": len(self.endpoints), "pool": self.pool.stats()}
+
+    def _buffered(self, pair):
+        return pair.ep1.buff.size + pair.ep2.buff.size
 
-            if not self.connections:
-                # sleep if there is no connections
-                time.sleep(self.delay)
-                continue
-            # blocks until there is socket(s) ready for .recv
+    def _start(self):
+        while True:
+            while self._calls:
+                fn, args = self._calls.popleft()
+                fn(*args)
+
+            self.now = monotonic()
+            self._expire(self.now)
+            wait = self.timers.next_tick(self.now)
+            if self._throttled:
+                self._resume_throttled()
+                if self._throttled:
+                    resume_in = max(0, self._throttled[0][0] - self.now)
+                    wait = resume_in if wait is None else min(wait, resume_in)
+
+            # blocks until there is socket(s) ready for .recv or a socket with pending data is ready for .send,
+            # or until the next timer tick
             # notice: sockets which were closed by remote,
             #   are also regarded as read-ready by select()
             if self.selector:
-                events = self.selector.select(self.timeout_sec)
-                socks_rd = tuple(key.fileobj for key, mask in events if mask & EVENT_READ)
-                socks_wr = tuple(key.fileobj for key, mask in events if mask & EVENT_WRITE)
+                events = self.selector.select(wait)
+                eps_rd = tuple(key.data for key, mask in events if mask & EVENT_READ)
+                eps_wr = tuple(key.data for key, mask in events if mask & EVENT_WRITE)
             else:
-                r, w, e = select.select(self.connections, self.connections, [], self.timeout_sec)
-                socks_rd = tuple(r)
-                socks_wr = tuple(w)
-                # logging.debug('socks_rd: %s, socks_wr:%s', len(socks_rd), len(socks_wr))
+                r, w, e = select.select(
+                    [self._waker_r] + [ep.sock for ep in self.endpoints.values() if ep.events & EVENT_READ],
+                    [ep.sock for ep in self.endpoints.values() if ep.events & EVENT_WRITE], [], wait)
+                eps_rd = tuple(self.endpoints.get(s) for s in r)
+                eps_wr = tuple(self.endpoints.get(s) for s in w)
+            self.now = monotonic()
 
-            if not socks_rd and not socks_wr: # If select timeout reached (for both read and write ready sockets)
-                logging.info("bridge timeout reached")
-                self.close() # Close the bridge due a timeout
+            # ----------------- SENDING ----------------
+            # flush pending data first, so the readers paused by it may be resumed
+            for ep in eps_wr:
+                if ep and ep.sock in self.endpoints:
+                    self._flush(ep)
 
-            if not socks_rd and not self.send_buff:  # reduce CPU in low traffic if there is no read-ready sockets
-                time.sleep(self.delay)
-                continue
-            
-            # logging.debug('got rd:%s wr:%s', socks_rd, socks_wr) 
             # ----------------- RECEIVING ----------------
-            for s in socks_rd:  # type: socket.socket
-                
-                # if this socket has non-sent data, stop recving more, to prevent buff blowing up.
-                if self.map[s] in self.send_buff:
-                    # logging.debug('delay recv because another too slow %s', self.map.get(s))
+            # pairs which received less (for their weight) go first, so a bulk transfer
+            # can not take the rate limits of its tunnel or device from the interactive ones
+            if len(eps_rd) > 1:
+                eps_rd = sorted(eps_rd, key = _fair_order)
+            # the waker (None) is not a pair
+            first = next((ep for ep in eps_rd if ep is not None), None)
+            if first:
+                # the virtual time follows the least served of the busy pairs
+                self.vclock = max(self.vclock, first.pair.vtime)
+            for ep in eps_rd:
+                if ep is None:
+                    self._drain_waker()
                     continue
-
-                try:
-                    received = s.recv(RECV_BUFFER_SIZE)
-                    self._last_success_read = datetime.datetime.now() # Reset timeout timer
-                    # logging.debug('recved %s from %s', len(received), s)
-                except Exception as e:
-                    # unable to read, in most cases, it's due to socket close
-                    logging.warning('error reading socket %s, %s closing', repr(e), s)
-                    self._terminate(s)
+                # the socket (or its pair) may be terminated or paused while handling previous events
+                if ep.sock not in self.endpoints or ep.paused or ep.throttled:
                     continue
+                self._forward(ep)
 
-                if not received:
-                    self._terminate(s)
-                    continue
-                else:
-                    self.send_buff[self.map[s]] = received
+    def _resume_throttled(self):
+        """ Readers throttled by the same bucket are resumed together, and are read right away in the fair order,
+            so the one which received less for its weight takes the tokens first
+        """
+        throttled = self._throttled
+        resumed = []
+        while throttled and throttled[0][0] <= self.now:
+            ep = heapq.heappop(throttled)[2]
+            ep.throttled = False
+            if ep.sock in self.endpoints:
+                resumed.append(ep)
+        for ep in sorted(resumed, key = _fair_order):
+            if ep.sock in self.endpoints and not ep.paused and not ep.throttled:
+                self._update_events(ep)
+                self._forward(ep)
 
-            # ----------------- SENDING ----------------
-            for s in socks_wr:
-                if s not in self.send_buff:
-                    continue
-                data = self.send_buff.pop(s)
-                try:
-                    s.send(data)
-                    # logging.debug('sent %s to %s', len(data), s)
-                except Exception as e:
-                    # unable to send, close connection
-                    logging.warning('error sending socket %s, %s closing', repr(e), s)
-                    print("eror write")
-                    print(s)
-                    self._terminate(s)
-                    continue
-    
+    def _throttle(self, ep, resume_at):
+        """ Stop reading the socket till the resume_at time, its bridge or device rate limit is reached
+        """
+        ep.throttled = True
+        self._throttle_seq += 1
+        heapq.heappush(self._throttled, (resume_at, self._throttle_seq, ep))
+        self._update_events(ep)
+
+    def _close_pair(self, pair):
+        self._terminate(pair.ep1)
+
+    def _fire(self, callback):
+        self._callbacks.put(callback)
+
+    def _fire_callbacks(self):
+        """ Terminate callbacks may block (e.g. they notify the other side), so they are called
+            from a dedicated thread, not to stall the loop
+        """
+        while True:
+            callback = self._callbacks.get()
+            try:
+                callback()
+            except:
+                logging.error("SocketBridge callback failed {}".format(traceback.format_exc()))
+
+    def _add_pair(self, bridge, conn1, conn2):
+        if not bridge.work:
+            # the bridge has been closed before the pair came to the loop
+            try_close(conn1)
+            try_close(conn2)
+            return
+
+        # record sockets pairs
+        ep1 = _Endpoint(conn1, bridge, self._create_buffer(bridge, conn1, conn2))
+        ep2 = _Endpoint(conn2, bridge, self._create_buffer(bridge, conn2, conn1))
+        ep1.peer = ep2
+        ep2.peer = ep1
+        pair = _Pair(ep1, ep2, monotonic())
+        ep1.pair = ep2.pair = pair
+        self.endpoints[conn1] = ep1
+        self.endpoints[conn2] = ep2
+        self._pair_added(pair)
+
+        # mark as readable only, a write interest is added just when there is something to send
+        self._update_events(ep1)
+        self._update_events(ep2)
+
+        logging.debug("New pair added. Total {} pairs in bridge".format(len(bridge.pairs)))
+
+    def _create_buffer(self, bridge, sock, peer_sock):
+        """ Splice the pair when both of its sockets allow it, or copy the data through userspace
+        """
+        if bridge.zero_copy and PipeBuffer.supports(sock) and PipeBuffer.supports(peer_sock):
+            try:
+                return PipeBuffer(bridge.high_watermark)
+            except OSError as e:
+                logging.warning("unable to create a pipe for splice: {}".format(e))
+        return SendBuffer(self.pool)
+
+    def _close_bridge(self, bridge):
+        self.timers.cancel(bridge)
+        for pair in list(bridge.pairs):
+            self._terminate(pair.ep1)
+
+    def _forward(self, ep):
+        """ Read from a socket and pass the data to its pair right away
+        """
+        s = ep.sock
+        bridge = ep.bridge
+        limit = max(int(ep.read_size * bridge.weight), 1)
+        if bridge.buckets:
+            allowed = int(min(b.available(self.now) for b in bridge.buckets))
+            # do not read a few bytes every loop pass, wait till the tokens come in bulk
+            if allowed < min(THROTTLE_RESUME_BYTES, limit):
+                self._throttle(ep, max(b.resume_at(self.now) for b in bridge.buckets))
+                return
+            limit = min(limit, allowed)
+        try:
+            received = ep.peer.buff.fill_from(s, limit)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            if _is_want_io(e):
+                return
+            # unable to read, in most cases, it's due to socket close
+            logging.warning('error reading socket %s, %s closing', repr(e), s)
+            self._terminate(ep)
+            return
+
+        if not received:
+            if ep.peer.buff.size:
+                # deliver what is left before closing the pair
+                ep.eof = ep.paused = True
+                self._update_events(ep)
+            else:
+                self._terminate(ep)
+            return
+
+        pair = ep.pair
+        # a pair idle for a while does not get credit for the time it did not use
+        if self.now - pair.last_active > FAIR_IDLE_SEC:
+            pair.vtime = max(pair.vtime, self.vclock)
+        pair.vtime += received / bridge.weight
+        pair.last_active = self.now # Reset the idle timer
+        pair.bytes_in += received
+        pair.recv_calls += 1
+        for b in bridge.buckets:
+            b.consume(received)
+        if bridge.adaptive and self.now - pair.sampled >= ADAPT_PERIOD:
+            self._adapt_read_size(pair, bridge)
+        self._flush(ep.peer)
+
+    def _adapt_read_size(self, pair, bridge):
+        """ Read as much per loop pass, as the pair path holds: the bandwidth-delay product
+        """
+        throughput = (pair.bytes_in - pair.sampled_bytes) / (self.now - pair.sampled)
+        rtt = max(tcp_rtt(pair.ep1.sock) or 0, tcp_rtt(pair.ep2.sock) or 0) or ASSUMED_RTT
+        size = min(max(int(throughput * rtt), ADAPTIVE_MIN_READ), ADAPTIVE_MAX_READ, bridge.high_watermark)
+        pair.ep1.read_size = pair.ep2.read_size = size
+        pair.sampled = self.now
+        pair.sampled_bytes = pair.bytes_in
+
+    def _flush(self, ep):
+        """ Send pending data of the socket. What could not be sent is kept till the socket becomes writable
+        """
+        try:
+            ep.buff.send_to(ep.sock, ep.pair)
+        except Exception as e:
+            # unable to send, close connection
+            logging.warning('error sending socket %s, %s closing', repr(e), ep.sock)
+            self._terminate(ep)
+            return
+
+        # stop reading from the pair while this socket is too slow to accept its data
+        reader = ep.peer
+        if reader.eof:
+            if not ep.buff.size:
+                self._terminate(reader)
+                return
+        else:
+            high = min(ep.bridge.high_watermark, ep.buff.capacity)
+            if reader.paused:
+                reader.paused = ep.buff.size > min(ep.bridge.low_watermark, high // 2)
+            else:
+                reader.paused = ep.buff.size >= high
+        self._update_events(ep)
+        self._update_events(reader)
+
+    def _update_events(self, ep):
+        """ Watch the socket for reading unless it is paused,
+            and for writing only while it has non-sent data
+        """
+        events = 0
+        if not ep.paused and not ep.throttled:
+            events |= EVENT_READ
+        if ep.buff.size:
+            events |= EVENT_WRITE
+        self._watch(ep, events)
+
+    def _watch(self, ep, events):
+        """ Change the events the socket is watched for. Zero means the socket is not watched at all
+        """
+        current = ep.events
+        if current == events:
+            return
+        ep.events = events
+        if not self.selector:
+            return
+        try:
+            if not current:
+                self.selector.register(ep.sock, events, ep)
+            elif events:
+                self.selector.modify(ep.sock, events, ep)
+            else:
+                self.selector.unregister(ep.sock)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def _wakeup(self):
+        try:
+            self._waker_w.send(b"\0")
+        except Exception:
+            pass # the waker is already full or closed, the loop will be woken anyway
+
+    def _drain_waker(self):
+        try:
+            while self._waker_r.recv(1024):
+                pass
+        except Exception:
+            pass
+
+    def _terminate(self, ep, once=False):
+        """terminate a sockets pair (two socket)
+        :type ep: _Endpoint
+        :param ep: any one of the sockets pair
+        """
+        logging.debug('terminate %s', ep.sock)
+        self._watch(ep, 0)
+        ep.throttled = False  # the throttled heap entry is dropped when due
+        try_close(ep.sock)  # close the first socket
+        ep.buff.clear()
+        self.endpoints.pop(ep.sock, None)
+
+        # terminate another
+        if not once and ep.peer.sock in self.endpoints:
+            self._terminate(ep.peer, True)
+
+        self._pair_closed(ep.pair)
+
+
+class _BridgeBase ():
+    """ The options and the pairs of a bridge, the same for the engines. See SocketBridge
+    """
+
+    def __init__ (self, terminate_callback, timeout, high_watermark, low_watermark, max_lifetime,
+                  rate_limit, device_id, device_rate_limit, weight, profile):
+        self.work = True
+        self.pairs = set()  # holds pairs of the bridge, touched by the reactor thread only
+        self.closed_stats = TrafficStats()  # summed counters of the pairs already closed
+        self.closed_pairs_count = 0
+        self.callback =  terminate_callback # holds callback
+        self.timeout_sec = timeout
+        self.max_lifetime = max_lifetime  # seconds, None - unlimited
+        self.watched = False  # the bridge is started, so it is closed when empty for timeout
+        self.deadline = None  # the bridge is a timer wheel entry too
+        self.wheel_slot = None
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.rate_limit = rate_limit  # bytes per second, None - unlimited
+        self.device_id = device_id
+        self.device_rate_limit = device_rate_limit  # bytes per second, shared by the bridges of the device
+        self.weight = max(float(weight or 1), 0.01)  # scales the bytes a pair may read per loop pass
+        self.profile_name = profile
+        self.profile = get_profile(profile)
+        self.adaptive = bool(self.profile and self.profile.get("adaptive"))  # adapt the read size to the throughput
+        self.buckets = []  # type: list[TokenBucket]
+        if rate_limit:
+            self.buckets.append(TokenBucket(rate_limit))
+        if device_rate_limit and device_id is not None:
+            self.buckets.append(device_bucket(device_id, device_rate_limit))
+
+
+class SocketBridge (_BridgeBase):
+    """ A group of socket pairs of one tunnel. The data is relayed by the shared BridgeReactor,
+        the bridge just holds the tunnel`s timeouts, watermarks and terminate callback.
+        A pair is closed when it has nothing to read for timeout seconds or lives longer than max_lifetime.
+        Once started, the bridge itself is closed (and the callback fired) when it has no pairs for timeout seconds.
+        The received traffic may be limited by rate_limit bytes per second for the bridge, and by device_rate_limit
+        shared by all the bridges having the same device_id. The weight sets the bridge share of a busy reactor.
+        The profile, one of PROFILES names, tunes the sockets of the pairs
+    """
+
+    def __init__ (self, terminate_callback = None, timeout = 60,
+                  high_watermark = HIGH_WATERMARK, low_watermark = LOW_WATERMARK, reactor = None,
+                  zero_copy = SPLICE_ENABLED, max_lifetime = None,
+                  rate_limit = None, device_id = None, device_rate_limit = None, weight = 1, profile = None):
+        _BridgeBase.__init__(self, terminate_callback, timeout, high_watermark, low_watermark, max_lifetime,
+                             rate_limit, device_id, device_rate_limit, weight, profile)
+        self.zero_copy = zero_copy  # splice the pairs of plain sockets
+        self.reactor = reactor or BridgeReactor.instance()
+
+    def add_pair (self, conn1, conn2):
+        """
+        transfer anything between two sockets
+        :type conn1: socket.socket
+        :type conn2: socket.socket
+        """
+        # change to non-blocking
+        # we use select or epoll to notice when data is ready
+        conn1.setblocking(False)
+        conn2.setblocking(False)
+        if self.profile:
+            tune_socket(conn1, self.profile)
+            tune_socket(conn2, self.profile)
+        self.reactor.call_soon(self.reactor._add_pair, self, conn1, conn2)
+
+    def start_as_daemon(self):
+        """ Start watching the bridge for the timeout. Kept for compatibility:
+            there is no thread per bridge anymore, the shared reactor thread is returned
+        """
+        self.start()
+        return self.reactor.start_as_daemon()
+
+    def start(self):
+        self.reactor.call_soon(self.reactor._watch_timeout, self)
+
+    def get_stats(self):
+        """ Returns the traffic counters of the bridge: summed ones of its pairs, both alive and closed
+            rtype: dict
+        """
+        return self.reactor.run_in_loop(self.reactor._bridge_stats, self) or {}
 
     def close (self, from_outside = False):
         """close the SocketBridge
         """
         self.work = False
-        
-        for s in self.connections:
-            try_close(s)  # close the first socket
-            self.send_buff.pop(s, None)
-            if self.selector:
-                try:
-                    self.selector.unregister(s)
-                except:
-                    pass
-        
-        self.map.clear()
+        self.reactor.call_soon(self.reactor._close_bridge, self)
 
         # ------ callback --------
         if not from_outside: # If bridge closed from outside - there is no use in callback
             if self.callback: 
                 self.callback()
 
-        
-    def _terminate(self, conn, once=False):
-        """terminate a sockets pair (two socket)
-        :type conn: socket.socket
-        :param conn: any one of the sockets pair
-        """
-        logging.debug('terminate %s',conn)
-        try_close(conn)  # close the first socket
 
-        # ------ close and clean the mapped socket, if exist ------
-        _another_conn = self.map.pop(conn, None)
+def reactor_stats():
+    """ Returns the state of the process reactor, see BridgeReactor.get_stats()
+        rtype: dict or None if no bridge has started it
+    """
+    reactor = BridgeReactor._instance
+    return reactor.get_stats() if reactor else None
 
-        if conn in self.connections:
-            self.connections.remove(conn)
 
-        self.send_buff.pop(conn, None)
-        if self.selector:
-            try:
-                self.selector.unregister(conn)
-            except:
-                pass
+def _fair_order(ep):
+    # the waker has no endpoint, it goes first
+    return ep.pair.vtime if ep else -1
 
-        # terminate another
-        if not once and _another_conn in self.map:
-            self._terminate(_another_conn, True)
\ No newline at end of file
+
+def _is_want_io(e):
+    """ Non-blocking SSL sockets raise SSLWantReadError/SSLWantWriteError when a record is incomplete
+    """
+    return type(e).__name__ in ("SSLWantReadError", "SSLWantWriteError")
@@ -0,0 +1,71 @@
+"""
+A hashed timer wheel. The bridges keep an idle deadline for every socket pair,
+and a wheel makes both scheduling and expiring O(1), however many pairs there are.
+"""
+import math
+import time
+
+# a monotonic clock, not affected by the system time changes
+monotonic = getattr(time, "monotonic", time.time)
+
+
+class TimerWheel(object):
+    """ Timers are any objects with "deadline" and "wheel_slot" attributes.
+        A timer is put into the slot of its deadline tick, advance() walks the slots passed since the last call
+        and returns the timers which are due. Timers which are more than a wheel revolution ahead
+        just stay in their slot till the right revolution comes.
+    """
+    __slots__ = ("tick", "slots", "current", "count")
+
+    def __init__(self, tick = 1.0, slots_count = 512):
+        self.tick = tick  # seconds
+        self.slots = [set() for _ in range(slots_count)]
+        self.current = int(monotonic() / tick)  # the tick processed last
+        self.count = 0
+
+    def schedule(self, timer, deadline):
+        """ Put (or move) the timer to the given monotonic time
+        """
+        self.cancel(timer)
+        # the slot is processed when its tick begins, so the deadline tick is rounded up.
+        # A due timer goes to the next slot to be processed
+        tick = max(int(math.ceil(deadline / self.tick)), self.current + 1)
+        timer.deadline = deadline
+        timer.wheel_slot = self.slots[tick % len(self.slots)]
+        timer.wheel_slot.add(timer)
+        self.count += 1
+
+    def cancel(self, timer):
+        slot = getattr(timer, "wheel_slot", None)
+        if slot is not None:
+            slot.discard(timer)
+            timer.wheel_slot = None
+            self.count -= 1
+
+    def advance(self, now = None):
+        """ Returns a list of timers which are due. They are removed from the wheel
+        """
+        now = monotonic() if now is None else now
+        tick = int(now / self.tick)
+        expired = []
+        # do not walk the same slots more than once, if the wheel was not advanced for long
+        first = max(self.current + 1, tick - len(self.slots) + 1)
+        for t in range(first, tick + 1):
+            slot = self.slots[t % len(self.slots)]
+            if not slot:
+                continue
+            for timer in [timer for timer in slot if timer.deadline <= now]:
+                slot.discard(timer)
+                timer.wheel_slot = None
+                self.count -= 1
+                expired.append(timer)
+        self.current = max(self.current, tick)
+        return expired
+
+    def next_tick(self, now = None):
+        """ Seconds till the next slot is due, or None if the wheel is empty
+        """
+        if not self.count:
+            return None
+        now = monotonic() if now is None else now
+        return max(0, (self.current + 1) * self.tick - now)
@@ -0,0 +1,194 @@
+"""
+TLS of the control and data connections. A context is made once per role, so the certificate is not
+reloaded for every connection, and the slaver offers the TLS session of its previous connection to the same
+server, so follow-up connections take an abbreviated handshake instead of a full one. The server shares its
+context between the control and the tunnel ports, so a session of one port is resumed on another.
+On Linux the record encryption can be handed to the kernel (kTLS): OpenSSL moves the keys into the socket after
+the handshake, and the sockets are read and written as before, with no encryption done in the process.
+"""
+import logging
+import socket
+import ssl
+import sys
+import threading
+
+from .timer_wheel import *
+
+# seconds a peer has to complete the handshake
+TLS_HANDSHAKE_TIMEOUT = 10
+
+# SSL_OP_ENABLE_KTLS of OpenSSL 3, the ssl module has it since python 3.12
+OP_ENABLE_KTLS = getattr(ssl, "OP_ENABLE_KTLS", 1 << 3)
+KTLS_SUPPORTED = sys.platform.startswith("linux") and (hasattr(ssl, "OP_ENABLE_KTLS") or ssl.OPENSSL_VERSION_INFO >= (3, 0))
+# getsockopt() of a kernel TLS socket, from linux/tls.h
+SOL_TLS = 282
+TLS_TX = 1
+TLS_RX = 2
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def _enable_ktls(context):
+    """ Ask OpenSSL for the kernel TLS. Without the kernel or the OpenSSL support, or for a cipher the kernel
+        does not have, the connections just stay in the userspace TLS
+    """
+    if KTLS_SUPPORTED:
+        context.options |= OP_ENABLE_KTLS
+
+
+def server_context(certfile, keyfile, ktls = False):
+    """ Returns the shared server context of the certificate. Its session cache and ticket keys
+        are shared by all the connections, which lets the clients resume their sessions
+        type ktls: bool - try the kernel TLS
+        rtype: ssl.SSLContext
+    """
+    with _contexts_lock:
+        context = _contexts.get((certfile, keyfile, ktls))
+        if context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            if ktls:
+                _enable_ktls(context)
+            _contexts[(certfile, keyfile, ktls)] = context
+        return context
+
+
+def client_context(ktls = False):
+    """ Returns the shared client context. As before, the server certificate is not verified
+        type ktls: bool - try the kernel TLS
+        rtype: ssl.SSLContext
+    """
+    with _contexts_lock:
+        context = _contexts.get(("client", ktls))
+        if context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            if ktls:
+                _enable_ktls(context)
+            _contexts[("client", ktls)] = context
+        return context
+
+
+def ktls_offload(sock):
+    """ Returns the directions the kernel encrypts (TLS_TX) and decrypts (TLS_RX) the records of the socket in.
+        OpenSSL 3.0 offloads both for TLS 1.2, and only the sending for TLS 1.3
+        rtype: tuple - (bool, bool)
+    """
+    ret = []
+    for direction in (TLS_TX, TLS_RX):
+        try:
+            sock.getsockopt(SOL_TLS, direction, 64)
+            ret.append(True)
+        except (OSError, socket.error):
+            ret.append(False)
+    return tuple(ret)
+
+
+class TlsStats(object):
+    """ Handshake counters of a tunnel, added by the threads of its connections
+    """
+    __slots__ = ("handshakes", "resumed", "handshake_time", "offloaded", "_lock")
+
+    def __init__(self):
+        self.handshakes = 0
+        self.resumed = 0 # abbreviated handshakes, the session was reused
+        self.handshake_time = 0.0 # seconds, summed
+        self.offloaded = 0 # connections sent by the kernel TLS
+        self._lock = threading.Lock()
+
+    def add(self, seconds, resumed, offloaded = False):
+        with self._lock:
+            self.handshakes += 1
+            self.resumed += int(bool(resumed))
+            self.handshake_time += seconds
+            self.offloaded += int(bool(offloaded))
+
+    def as_dict(self):
+        with self._lock:
+            return {"tls_handshakes": self.handshakes, "tls_resumed": self.resumed, "tls_offloaded": self.offloaded,
+                    "tls_handshake_ms": round(self.handshake_time * 1000 / self.handshakes, 3) if self.handshakes else 0}
+
+
+class TlsSessionCache ():
+    """ The last TLS session of every server host. With TLS 1.3 the session ticket comes after the handshake,
+        with the first data read, so the session is taken from the latest connection when the next one is made
+    """
+
+    def __init__(self):
+        self._sessions = {} # host -> ssl.SSLSession
+        self._sockets = {} # host -> the latest ssl.SSLSocket
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        """ rtype: ssl.SSLSession or None
+        """
+        with self._lock:
+            sock = self._sockets.get(host)
+            try:
+                session = sock.session if sock is not None else None
+            except (ValueError, OSError):
+                session = None # the connection is closed already
+            if session is not None and (session.has_ticket or session.id):
+                self._sessions[host] = session
+            return self._sessions.get(host)
+
+    def put(self, host, sock):
+        with self._lock:
+            self._sockets[host] = sock
+
+    def forget(self, host):
+        with self._lock:
+            self._sessions.pop(host, None)
+            self._sockets.pop(host, None)
+
+
+# the sessions of the slaver connections
+SESSIONS = TlsSessionCache()
+
+
+def _handshake(wrap, sock, stats, ktls):
+    timeout = sock.gettimeout()
+    sock.settimeout(TLS_HANDSHAKE_TIMEOUT)
+    started = monotonic()
+    tls_sock = wrap()
+    duration = monotonic() - started
+    tls_sock.settimeout(timeout)
+    offloaded = ktls and ktls_offload(tls_sock)[0]
+    if stats is not None:
+        stats.add(duration, tls_sock.session_reused, offloaded)
+    return tls_sock, duration, offloaded
+
+
+def wrap_server(sock, certfile, keyfile, stats = None, ktls = False):
+    """ Make the TLS handshake of an accepted connection
+        type stats: TlsStats - of the tunnel
+        type ktls: bool - try the kernel TLS
+        rtype: ssl.SSLSocket
+    """
+    context = server_context(certfile, keyfile, ktls)
+    tls_sock, _, _ = _handshake(lambda: context.wrap_socket(sock, server_side = True), sock, stats, ktls)
+    return tls_sock
+
+
+def wrap_client(sock, address, stats = None, sessions = SESSIONS, ktls = False):
+    """ Make the TLS handshake of a connection to the server, resuming the session of the previous connection
+        to the same host
+        type sock: socket.socket - connected to the address
+        type ktls: bool - try the kernel TLS
+        rtype: ssl.SSLSocket
+    """
+    context = client_context(ktls)
+    session = sessions.get(address[0])
+    try:
+        tls_sock, duration, offloaded = _handshake(lambda: context.wrap_socket(sock, session = session), sock, stats, ktls)
+    except ssl.SSLError:
+        # a session the server does not know anymore is just not reused, so the error is not about it
+        sessions.forget(address[0])
+        raise
+    sessions.put(address[0], tls_sock)
+    logging.debug("TLS handshake with {}:{} took {:.1f} ms{}{}".format(
+        address[0], address[1], duration * 1000, ", the session is resumed" if tls_sock.session_reused else "",
+        ", records are sent by the kernel" if offloaded else ""))
+    return tls_sock
@@ -3,4 +3,15 @@ TUNNEL_SERVER_PORT = 444
 DATABASE_NAME = 'app_base.db'
 
 HOST_ALIVE_TIMEOUT = 100 # seconds
-TUNNEL_IDLE_TIMEOUT = 100 # seconds
\ No newline at end of file
+ALIVE_PING_PERIOD = 5 # seconds. Asked from the slavers negotiating it in the handshake, it must be well below HOST_ALIVE_TIMEOUT
+TUNNEL_IDLE_TIMEOUT = 100 # seconds
+
+BRIDGE_ENGINE = "selector" # "selector" or "asyncio". Workers, and SSL pairs of the asyncio engine, use the selector engine
+BRIDGE_WORKERS = 0 # relay worker processes (Unix only). 0 - relay in the server process
+RESUME_GRACE_PERIOD = 120 # seconds. The tunnels of a disconnected slaver wait for it to reconnect and resume the session
+MUX_ENABLED = True # relay new customers of tunnels over the slaver control connection, if the slaver supports it
+CONTROL_BATCH_WINDOW = 0.005 # seconds. Connection requests and tunnel closed messages of a slaver are sent together within it
+KTLS_ENABLED = False # ssl tunnels hand the TLS record encryption to the kernel (Linux, OpenSSL 3 built with kTLS), or stay in the userspace TLS
+CONNECTION_POOL_SIZE = 2 # idle slaver connections parked per tunnel, the customers take them without waiting for the slaver. 0 - no pool
+INGRESS_PORT = 0 # one port for the customers of the tunnels opened with the "ingress" option, routed by HTTP CONNECT, TLS SNI or a preamble. 0 - off
+PREBOUND_PORTS = 4 # tunnel ports kept bound ahead, so opening a tunnel does not look for a free port. 0 - bound on demand
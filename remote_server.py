@@ -9,13 +9,23 @@ import time
 import json
 import select
 import random
-import errno
 import sys
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from database import database
 import config
 import ssl
 from common.control_message import *
 from common.socket_bridge import *
+from common.bridge_workers import *
+from common.asyncio_bridge import *
+from common.mux import *
+from common.datagram_relay import *
+from common.tls import *
+from common.ingress import *
+from common.port_pool import *
 
 # A tunnel status codes
 ERROR = -1
@@ -32,63 +42,107 @@ OFFLINE = 0
 
 PY3_OR_LATER = sys.version_info[0] >= 3
 SSL_ENABLED = False
-
-# < Utillits >
-def get_random_port():
-    return random.randrange(PORTS_RANGE[0], PORTS_RANGE[1], 1)
-
-
-def bind_unused_port(sock):
-    # Lets find an unused port and bind it to given socket
-    port = get_random_port()
-    attempts_left = 100
-    while True:
-        try:
-            server_address = ('0.0.0.0', port)
-            sock.bind(server_address)
-            break
-        except socket.error as e:
-            if e.errno == errno.EADDRINUSE:  # if port is used -> try another
-                port = get_random_port()
-                attempts_left -= 1
-                if attempts_left < 1:
-                    return None
-            else:
-                return None
-    return port
-# </ Utillits >
+SSL_KEY_FILE = 'ssl/server.key'
+SSL_CERT_FILE = 'ssl/server.crt'
+
+# a slaver last update time is written to database not more often, seconds
+LAST_UPDATE_WRITE_PERIOD = 5
+
+# customers of a tunnel (and slaver connections for them) waiting to be accepted, for a burst of customers
+CUSTOMERS_BACKLOG = 128
+# seconds a customer waits for the slaver connection requested for it
+CONNECTION_SETUP_TIMEOUT = 5
+# seconds a new tunnel waits for the slaver to connect, or tunnel will be closed by reason of timeout
+SLAVER_CONNECT_TIMEOUT = 15
+# seconds open_tunnel waits for the tunnel to be ready, unless the request gives its own "wait":
+# the slaver connection, its TLS handshake, and a few seconds for the control message and the customer port
+TUNNEL_OPEN_TIMEOUT = SLAVER_CONNECT_TIMEOUT + TLS_HANDSHAKE_TIMEOUT + 5
+# the longest wait for a tunnel status, seconds. A tunnel is ready or failed by then
+MAX_STATUS_WAIT = TUNNEL_OPEN_TIMEOUT
+
+
+def parse_wait(value):
+    """ The seconds a request waits for a tunnel status
+        rtype: float
+        raises ValueError - the value is not a number of seconds
+    """
+    try:
+        wait = float(value)
+    except (TypeError, ValueError):
+        wait = None
+    # NaN is not a wait either
+    if wait is None or not wait >= 0:
+        raise ValueError("bad wait: {}".format(value))
+    return min(wait, MAX_STATUS_WAIT)
 
 
 class TCP_tunnel_server():
 
-    def __init__(self, slaver, options, close_callback):
+    def __init__(self, slaver, options, close_callback, ports, bridge_factory = SocketBridge, ingress = None):
+        """ type ports: PortPool - the communicate and customer ports of the tunnels
+        """
 
         self._status = STARTED  # Holds a status code (online or not)
+        self._status_changed = threading.Condition()
+        self.communicate_port = None
+        self.customer_port = None
+        self._ports = ports
         self._slaver = slaver
         self._work = True
         self._options = options
-        self._socket_bridge = SocketBridge(self._terminate)
+        # Pairs idle for idle_timeout seconds, or living longer than max_lifetime seconds are closed.
+        # The tunnel is closed when it has no pairs for idle_timeout
+        max_lifetime = options.get("max_lifetime")
+        # The received traffic is limited by rate_limit bytes per second for the tunnel, and by device_rate_limit
+        # for all the tunnels of the device. The weight sets the tunnel share when the relay is busy.
+        # The profile ("interactive" or "bulk") tunes the sockets of both legs for latency or throughput
+        rate_limit = options.get("rate_limit")
+        device_rate_limit = options.get("device_rate_limit")
+        self._socket_bridge = bridge_factory(self._terminate,
+            timeout = int(options.get("idle_timeout") or config.TUNNEL_IDLE_TIMEOUT),
+            max_lifetime = int(max_lifetime) if max_lifetime else None,
+            rate_limit = int(rate_limit) if rate_limit else None,
+            device_id = slaver.hwId,
+            device_rate_limit = int(device_rate_limit) if device_rate_limit else None,
+            weight = float(options.get("weight") or 1),
+            profile = options.get("profile") or None)
         self._customer_socket = None
         self._communicate_socket = None
+        self._relay = None # type: DatagramServerRelay - relays the datagrams of a udp tunnel
         self._close_callback = close_callback
         self._ssl = options["ssl"] and SSL_ENABLED
+        self._tls_stats = TlsStats() # handshakes of the slaver connections
+        self._setups = {} # setup token -> (customer socket, deadline), the customers waiting for their slaver connections
+        self._setups_lock = threading.Lock()
+        self._setup_acceptor = False # the slaver connections are accepted by a thread, pairing them by the token
+        # Idle slaver connections parked for the customers, so a customer does not wait for the slaver to connect
+        pool = options.get("pool")
+        self._pool_size = int(pool) if pool is not None else config.CONNECTION_POOL_SIZE
+        self._pool = [] # parked connections
+        self._parking = 0 # connections asked to be parked, not come yet
+        self._pool_hits = 0
+        self._pool_misses = 0
+        # The customers come routed by the shared ingress port, if the tunnel asks for it and the server has the port
+        self._ingress = ingress if options.get("ingress") else None # type: IngressServer
+        self._route = None
+        self._ingress_customers = queue.Queue() # routed by the ingress thread, served by the tunnel thread. None - the tunnel is closed
+        self._request_lock = threading.Lock() # old slavers are asked for a connection at a time
 
     def start(self):
-        threading.Thread(target=self._run, args=[], name="tunnel").start()
+        """ Take the communicate port, it is the tunnel id, and bring the tunnel up in its own thread.
+            The port comes from the bound ahead ones, so the id is known at once
+            rtype: bool - False, if there is no free port
+        """
+        udp = self._options["proto"] == "udp"
+        self._communicate_socket, self.communicate_port = self._ports.allocate(socket.SOCK_DGRAM if udp else socket.SOCK_STREAM)
+        if not self.communicate_port:
+            self.set_status(ERROR)
+            return False
+        threading.Thread(target=self._run_udp if udp else self._run, args=[], name="tunnel").start()
+        return True
 
     def _run(self):
         try:
-            if self._ssl:
-                self._communicate_socket = ssl.wrap_socket(socket.socket(), 'ssl/server.key', 'ssl/server.crt',
-                ssl_version=ssl.PROTOCOL_SSLv23, server_side = True)
-            else:
-                self._communicate_socket = socket.socket()
-
-            self.communicate_port = bind_unused_port(self._communicate_socket)
-            print(self.communicate_port)
-            if not self.communicate_port:
-                return
-
             self.set_status(OPENED)
 
             try:
@@ -102,83 +156,392 @@ class TCP_tunnel_server():
                     message = TunnelReqMessage(communicate_port = self.communicate_port, ssl = self._ssl,
                     ser_name = str(self._options["ser_name"]), baudrate = int(self._options['rate']))
 
-                self._slaver.socket.sendall(message.encode())
+                self._slaver.send(message)
 
             except:
                 self.set_status(ERROR)
+                self._terminate()
                 return
 
-            self._communicate_socket.listen(1)
-            # 15 sec for waiting remote device to connect, or tunnel will be closed by reason of timeout
-            self._communicate_socket.settimeout(15)
+            self._communicate_socket.listen(CUSTOMERS_BACKLOG)
+            self._communicate_socket.settimeout(SLAVER_CONNECT_TIMEOUT)
 
-            slaver_conn, _ = self._communicate_socket.accept()
+            slaver_conn = self._accept_slaver_connection()
             # Remote device connected to the server, and it client`s time to connect
 
-            self._customer_socket = socket.socket(
-                socket.AF_INET, socket.SOCK_STREAM)
-            self.customer_port = bind_unused_port(self._customer_socket)
-            if not self._customer_socket:
-                self.set_status(ERROR)
-                return
+            if self._ingress:
+                self._serve_ingress(slaver_conn)
+            else:
+                self._customer_socket, self.customer_port = self._ports.allocate()
+                if not self.customer_port:
+                    self.set_status(ERROR)
+                    try_close(slaver_conn)
+                    self._terminate()
+                    return
 
-            self.set_status(READY)
-            #self._slaver.status = self.customer_port
+                self._customer_socket.listen(CUSTOMERS_BACKLOG)
+                # 60 sec for waiting customer to connect, or tunnel will be closed by reason of timeout
+                self._customer_socket.settimeout(60)
 
-            self._customer_socket.listen(1)
-            # 60 sec for waiting customer to connect, or tunnel will be closed by reason of timeout
-            self._customer_socket.settimeout(60)
+                # the customers are told the port the moment it is ready, so it is listening already
+                self.set_status(READY)
+                #self._slaver.status = self.customer_port
 
-            customer_conn, _ = self._customer_socket.accept()
+                customer_conn, _ = self._customer_socket.accept()
 
-            self._socket_bridge.start_as_daemon()
+                self._socket_bridge.start_as_daemon()
 
-            self._socket_bridge.add_pair(
-                customer_conn, slaver_conn
-            )
+                self._socket_bridge.add_pair(
+                    customer_conn, slaver_conn
+                )
 
-            threading.Thread(target=self._listen_for_customers,
-                             args=[], name="customer listen").start()
+                threading.Thread(target=self._listen_for_customers,
+                                 args=[], name="customer listen").start()
 
             while self._work:
                 time.sleep(5)
         except Exception as e:
-            self._status = ERROR
+            self.set_status(ERROR)
+            self._terminate()
+
+    def _run_udp(self):
+        """ A datagram tunnel. The slaver sends the datagrams of the customers flows from a UDP socket,
+            to the communicate port of the tunnel, no connection is made per customer
+        """
+        try:
+            if not self._slaver.has_capability(Capability.UDP):
+                raise Exception("the slaver does not support UDP tunnels")
+            if self._ssl:
+                raise Exception("UDP tunnels have no SSL")
+            self.set_status(OPENED)
+
+            flow_timeout = self._options.get("flow_timeout")
+            self._relay = DatagramServerRelay(self._communicate_socket, self._terminate,
+                timeout = int(self._options.get("idle_timeout") or config.TUNNEL_IDLE_TIMEOUT),
+                flow_timeout = int(flow_timeout) if flow_timeout else UDP_FLOW_TIMEOUT)
+            # the slaver end expires the flows and the tunnel the same way
+            self._slaver.send(TunnelReqMessage(communicate_port = self.communicate_port,
+                hostname = str(self._options["host"]), port = int(self._options["port"]), udp = True,
+                idle_timeout = self._relay.timeout_sec, flow_timeout = self._relay.flow_timeout))
+            if not self._relay.wait_peer(self._slaver.socket.getpeername()[0], SLAVER_CONNECT_TIMEOUT):
+                raise Exception("the slaver has not connected")
+
+            self._customer_socket, self.customer_port = self._ports.allocate(socket.SOCK_DGRAM)
+            if not self.customer_port:
+                raise Exception("no free port")
+            self._relay.start(self._customer_socket)
+            self.set_status(READY)
+        except Exception as e:
+            logging.error("UDP tunnel failed: {}".format(e))
+            self.set_status(ERROR)
             self._terminate()
 
     def _listen_for_customers(self):
         """ Non - blocking customers accept routine 
             It accepts new a customers and requests a new connection from slaver
-            Then adds both conections to the socket bridge
+            Then adds both conections to the socket bridge.
+            A burst of customers is accepted at once, and their connections are requested together
         """
+        if self._pooling():
+            self._fill_pool()
         while self._work:
             readable, _, _ = select.select([self._customer_socket], [], [], 5)
-            if readable:
-                try:
-                    customer_conn, _ = self._customer_socket.accept()  # New customer accepted
-                except:
-                    continue
-                try:
-                    # Say to slaver, that we need one more connection
-                    self._slaver.socket.sendall(ConnectionReqMessage(self.communicate_port).encode())
-                except:
-                    break
-            else:
+            if not readable:
                 continue
-            # 5 sec for waiting remote device to connect, or tunnel will be closed by reason of timeout
-            self._communicate_socket.settimeout(5)
+            # the customers taking parked connections are not held for a batch of requests
+            customers = self._accept_customers(0 if self._pool else config.CONTROL_BATCH_WINDOW)
+            if customers:
+                self._serve_customers(customers)
+
+    def _serve_customers(self, customers):
+        """ Relay the customers over the streams of the control connection, or over the slaver connections.
+            The customers are closed, if the slaver is unreachable. The tunnel keeps serving:
+            the slaver may reconnect and resume the session
+        """
+        mux = self._slaver.get_mux()
+        if mux:
+            self._open_streams(mux, customers)
+        elif self._slaver.has_capability(Capability.SETUP_TOKEN):
+            self._request_tagged_connections(customers)
+        else:
+            with self._request_lock:
+                self._request_connections(customers)
 
-            slaver_conn, _ = self._communicate_socket.accept()
-            # As we now have two new connections (from customer and slaver), lets add it to bridge
+    def _serve_ingress(self, slaver_conn):
+        """ Take the customers routed by the ingress port, instead of listening for them. The ingress thread queues them,
+            and the tunnel thread serves them, a burst at once.
+            The first one is paired with the slaver connection made with the tunnel
+        """
+        self._route = str(self._options.get("route") or self.communicate_port).lower()
+        self._socket_bridge.start_as_daemon()
+        if not self._ingress.add_route(self._route, self):
+            try_close(slaver_conn)
+            raise Exception("The route {} is taken".format(self._route))
+        self.customer_port = self._ingress.port
+        self.set_status(READY)
+        try:
+            # 60 sec for waiting customer to connect, or tunnel will be closed by reason of timeout
+            customer_conn = self._ingress_customers.get(timeout = 60)
+        except queue.Empty:
+            customer_conn = None
+        if customer_conn is None:
+            try_close(slaver_conn)
+            if self._work:
+                raise Exception("No customer came")
+            return
+        self._socket_bridge.add_pair(customer_conn, slaver_conn)
+        if self._pooling():
+            self._fill_pool()
+        customers = []
+        while self._work:
+            customers = self._take_ingress_customers(5)
+            if customers and self._work:
+                self._serve_customers(customers)
+                customers = []
+        # the customers routed before the route was removed
+        for customer_conn in customers + self._take_ingress_customers(0):
+            try_close(customer_conn)
+
+    def _take_ingress_customers(self, timeout):
+        """ Take the queued customers, waiting for the first one up to the timeout
+            rtype: list of socket.socket
+        """
+        customers = []
+        try:
+            customers.append(self._ingress_customers.get(timeout = timeout) if timeout else self._ingress_customers.get_nowait())
+            while len(customers) < BatchMessage.MAX_ITEMS:
+                customers.append(self._ingress_customers.get_nowait())
+        except queue.Empty:
+            pass
+        return [conn for conn in customers if conn is not None]
+
+    def add_customer(self, customer_conn):
+        """ A customer routed by the ingress port. It is called by the ingress thread, and only queues the customer
+            type customer_conn: socket.socket
+        """
+        self._ingress_customers.put(customer_conn)
+
+    def _request_connections(self, customers):
+        """ Ask the slaver for a connection per customer, and pair them in the bridge.
+            Slavers supporting batches get the requests of the burst in one message. Old ones decode a message per read,
+            so they are asked for the next connection, when the previous one came
+            rtype: bool - False, if the slaver failed to connect
+        """
+        batch = self._slaver.has_capability(Capability.BATCH)
+        # 5 sec for waiting remote device to connect, or tunnel will be closed by reason of timeout
+        self._communicate_socket.settimeout(5)
+        for n, customer_conn in enumerate(customers):
+            try:
+                # Say to slaver, that we need one more connection
+                if batch and n == 0:
+                    for _ in customers:
+                        self._slaver.post(ConnectionReqMessage(self.communicate_port))
+                elif not batch:
+                    self._slaver.send(ConnectionReqMessage(self.communicate_port))
+                slaver_conn = self._accept_slaver_connection()
+            except:
+                for conn in customers[n:]:
+                    try_close(conn)
+                return False
+            # As we now have two new connections (from customer and slaver), lets add it to bridge.
+            # The slaver connections are all alike, so a customer takes any of them
             self._socket_bridge.add_pair(
                 customer_conn, slaver_conn
             )
+        return True
+
+    def _request_tagged_connections(self, customers):
+        """ Ask the slaver for a connection per customer, each with its setup token, and do not wait for them.
+            The connections are set up in parallel, and paired with their customers by the token in any order
+        """
+        pooling = self._pooling()
+        deadline = monotonic() + CONNECTION_SETUP_TIMEOUT
+        for customer_conn in customers:
+            slaver_conn = self._take_parked() if pooling else None
+            if slaver_conn:
+                self._pool_hits += 1
+                self._socket_bridge.add_pair(customer_conn, slaver_conn)
+                continue
+            self._pool_misses += int(pooling)
+            with self._setups_lock:
+                token = self._add_setup(customer_conn, deadline)
+            self._slaver.post(ConnectionReqMessage(self.communicate_port, token))
+        if pooling:
+            self._fill_pool()
+
+    def _add_setup(self, customer_conn, deadline):
+        """ Make a setup token for the customer. It is called with the _setups_lock held
+            type customer_conn: socket.socket - None for a connection of the pool
+            rtype: int
+        """
+        if not self._setup_acceptor:
+            self._setup_acceptor = True
+            threading.Thread(target=self._accept_tagged_connections, name="slaver connections accept").start()
+        token = 0
+        while not token or token in self._setups:
+            token = random.SystemRandom().getrandbits(32)
+        self._setups[token] = (customer_conn, deadline)
+        return token
+
+    def _pooling(self):
+        """ rtype: bool - the slaver parks connections for the customers of the tunnel
+        """
+        return self._pool_size > 0 and self._slaver.has_capability(Capability.POOL) and not self._slaver.get_mux()
+
+    def _fill_pool(self):
+        """ Ask the slaver to park the connections the pool lacks. They are made in the background
+        """
+        deadline = monotonic() + CONNECTION_SETUP_TIMEOUT
+        with self._setups_lock:
+            tokens = [self._add_setup(None, deadline) for _ in range(self._pool_size - len(self._pool) - self._parking)]
+            self._parking += len(tokens)
+        for token in tokens:
+            self._slaver.post(ParkReqMessage(self.communicate_port, token))
+
+    def _take_parked(self):
+        """ Take a connection of the pool, and tell the slaver to connect it to the tunnel target
+            rtype: socket.socket or None - if the pool is empty
+        """
+        while True:
+            with self._setups_lock:
+                if not self._pool:
+                    return None
+                slaver_conn = self._pool.pop()
+            try:
+                # a parked connection is silent, a readable one is closed by the slaver
+                readable, _, _ = select.select([slaver_conn], [], [], 0)
+                if readable:
+                    raise Exception("Connection broken")
+                slaver_conn.sendall(PARKED_TAKEN)
+                return slaver_conn
+            except:
+                try_close(slaver_conn)
+
+    def _accept_tagged_connections(self):
+        """ Accept the slaver connections, each one is set up by its own thread.
+            The customers not getting their connection in CONNECTION_SETUP_TIMEOUT are closed
+        """
+        self._communicate_socket.settimeout(1)
+        while self._work:
+            try:
+                slaver_conn, _ = self._communicate_socket.accept()
+                threading.Thread(target=self._pair_tagged_connection, args=[slaver_conn],
+                                 name="slaver connection setup").start()
+            except socket.timeout:
+                pass
+            except:
+                break # the tunnel is closed
+            self._expire_setups(monotonic())
+
+    def _pair_tagged_connection(self, slaver_conn):
+        """ Read the setup token of a slaver connection, and pair it with the customer it was requested for
+        """
+        try:
+            if self._ssl:
+                slaver_conn = wrap_server(slaver_conn, SSL_CERT_FILE, SSL_KEY_FILE, self._tls_stats, config.KTLS_ENABLED)
+            slaver_conn.settimeout(CONNECTION_SETUP_TIMEOUT)
+            data = b""
+            while len(data) < SETUP_TOKEN.size:
+                chunk = slaver_conn.recv(SETUP_TOKEN.size - len(data))
+                if not chunk:
+                    raise Exception("Connection broken")
+                data += chunk
+            slaver_conn.settimeout(None)
+        except Exception as e:
+            logging.debug("slaver connection setup failed: {}".format(e))
+            try_close(slaver_conn)
+            return
+        with self._setups_lock:
+            setup = self._setups.pop(SETUP_TOKEN.unpack(data)[0], None)
+            if setup is not None and setup[0] is None:
+                self._parking -= 1
+                self._pool.append(slaver_conn)
+                return
+        if setup is None:
+            # too late, or not requested at all
+            try_close(slaver_conn)
+            return
+        self._socket_bridge.add_pair(setup[0], slaver_conn)
+
+    def _expire_setups(self, now = None):
+        """ Close the customers waiting for their slaver connections too long. Or all of them, if now is None
+        """
+        with self._setups_lock:
+            expired = [token for token, (_, deadline) in self._setups.items() if now is None or deadline <= now]
+            customers = [self._setups.pop(token)[0] for token in expired]
+            customers = [conn for conn in customers if conn is not None]
+            self._parking -= len(expired) - len(customers)
+        for customer_conn in customers:
+            try_close(customer_conn)
+        if customers:
+            logging.debug("{} customers of tunnel {} got no slaver connection".format(len(customers), self.communicate_port))
+
+    def _accept_slaver_connection(self):
+        """ Accept a connection of the slaver to the communicate port, and make its TLS handshake for ssl tunnels.
+            The handshakes share the server context, so the slaver connections resume its TLS session
+            rtype: socket.socket
+        """
+        conn, _ = self._communicate_socket.accept()
+        if not self._ssl:
+            return conn
+        try:
+            return wrap_server(conn, SSL_CERT_FILE, SSL_KEY_FILE, self._tls_stats, config.KTLS_ENABLED)
+        except:
+            try_close(conn)
+            raise
+
+    def _open_streams(self, mux, customers):
+        """ Relay the customers over the streams of the slaver control connection.
+            The bridge gets one end of a local socket pair, and the multiplexer the other one
+            rtype: bool - False, if the control connection is broken
+        """
+        for n, customer_conn in enumerate(customers):
+            local_conn, stream_conn = socket.socketpair()
+            try:
+                mux.open_stream(self.communicate_port, stream_conn, int(self._options.get("priority") or 0))
+            except:
+                try_close(local_conn)
+                try_close(stream_conn)
+                for conn in customers[n:]:
+                    try_close(conn)
+                return False
+            self._socket_bridge.add_pair(customer_conn, local_conn)
+        return True
+
+    def _accept_customers(self, window):
+        """ Accept the customers waiting in the listen backlog, and the ones coming within the window
+            type window: float - seconds
+            rtype: list of socket.socket
+        """
+        customers = []
+        self._customer_socket.settimeout(window)
+        while len(customers) < BatchMessage.MAX_ITEMS:
+            try:
+                customer_conn, _ = self._customer_socket.accept()  # New customer accepted
+            except:
+                break
+            customers.append(customer_conn)
+        return customers
     
 
     def _stop (self):
         self._work = False
-        try_close(self._communicate_socket)
-        try_close(self._customer_socket)
+        # the tunnel closed before it was ready has failed, for those waiting for it
+        with self._status_changed:
+            if self._status != READY:
+                self._status = ERROR
+                self._status_changed.notify_all()
+        self._ports.release(self._communicate_socket)
+        self._ports.release(self._customer_socket)
+        self._expire_setups()
+        with self._setups_lock:
+            pool, self._pool = self._pool, []
+        for slaver_conn in pool:
+            try_close(slaver_conn)
+        if self._route:
+            self._ingress.remove_route(self._route, self)
+            # wake up the tunnel thread, the customers queued meanwhile are closed by it
+            self._ingress_customers.put(None)
         # Assuming that slaver have been online when tunnel was started. So lets restore this status again
         if self._slaver.status != OFFLINE:
             self._slaver.status = ONLINE
@@ -199,12 +562,25 @@ class TCP_tunnel_server():
         self._stop()
         # A "True" parameter - says to SocketBridge that it closed forcibly and not need to fire "on closed" callback
         self._socket_bridge.close(True) 
+        if self._relay:
+            self._relay.close(True)
         
     def get_status(self):
         return self._status
 
     def set_status(self, status):
-        self._status = status
+        with self._status_changed:
+            self._status = status
+            self._status_changed.notify_all()
+
+    def wait_status(self, timeout):
+        """ Wait for the tunnel to be ready, or to fail
+            type timeout: float - seconds
+            rtype: int - the status, READY or ERROR, or the current one, if the time is out
+        """
+        with self._status_changed:
+            self._status_changed.wait_for(lambda: self._status in (READY, ERROR), timeout)
+            return self._status
 
     def get_customer_port(self):
         return self.customer_port
@@ -218,6 +594,32 @@ class TCP_tunnel_server():
     def get_slaver(self):
         return self._slaver
 
+    def get_route(self):
+        """ rtype: str - the name customers give the ingress port, None if the tunnel has a port of its own
+        """
+        return self._route
+
+    def get_stats(self):
+        """ Returns the tunnel traffic counters, summed over its pairs
+            rtype: dict
+        """
+        stats = self._relay.get_stats() if self._relay else self._socket_bridge.get_stats()
+        stats["id"] = self.communicate_port
+        stats["port"] = self.customer_port
+        if self._route:
+            stats["route"] = self._route
+        stats["hwId"] = self._slaver.hwId
+        mux = self._slaver.get_mux()
+        if mux:
+            stats["streams"] = mux.get_stats(self.communicate_port).get("streams", 0)
+        if self._ssl:
+            stats.update(self._tls_stats.as_dict())
+        if self._pooling():
+            stats["pooled"] = len(self._pool)
+            stats["pool_hits"] = self._pool_hits
+            stats["pool_misses"] = self._pool_misses
+        return stats
+
     
 
 
@@ -232,20 +634,133 @@ class Slaver ():
         self.last_update = time.time()
         self.name = name
         self.status = OFFLINE # {0: offline, 1: online; from 2 to 65535 : a port number of already opened tunnel}
+        self._version = VERSION_1 # the protocol version the slaver is answered in
+        self._terms = None # type: HandshakeMessage - agreed with the slaver, None for old slavers
+        self._token = 0 # the slaver presents it to resume the session on a new connection, 0 - not resumable
+        self._disconnected = None # when the control connection was lost
+        self._mux = None # type: Multiplexer - streams over the control connection, if the slaver supports it
+        self._send_lock = threading.Lock()
+        self._queue = [] # messages posted, not sent yet
+        self._queue_lock = threading.Lock()
+
+    def send(self, message):
+        """ Send a message into the control connection, in the protocol version of the slaver.
+            Tunnels and the multiplexer send from different threads, so a message is never interleaved with another one.
+            The posted messages are sent before it, in one write
+            type message: ControlMessage
+        """
+        with self._queue_lock:
+            messages, self._queue = self._queue, []
+        messages.append(message)
+        self._send_messages(messages)
+
+    def post(self, message):
+        """ Queue a message to be sent together with the ones posted within CONTROL_BATCH_WINDOW:
+            one write for all of them, and one BatchMessage for a run of connection requests or tunnel closed messages
+            type message: ControlMessage
+        """
+        with self._queue_lock:
+            self._queue.append(message)
+            if len(self._queue) > 1:
+                return # the flush is scheduled already
+        timer = threading.Timer(config.CONTROL_BATCH_WINDOW, self.flush)
+        timer.daemon = True
+        timer.start()
+
+    def flush(self):
+        """ Send the posted messages
+        """
+        with self._queue_lock:
+            messages, self._queue = self._queue, []
+        if not messages:
+            return
+        try:
+            self._send_messages(messages)
+        except Exception as e:
+            # the slaver reader notices the broken connection
+            logging.debug("unable to send control messages to {}: {}".format(self.name, e))
+
+    def _send_messages(self, messages):
+        if not self.has_capability(Capability.BATCH):
+            # Old slavers decode one message per read, so they get a write per message
+            with self._send_lock:
+                for message in messages:
+                    self.socket.sendall(message.encode(self._version))
+            return
+        messages = BatchMessage.coalesce(messages, self._terms.max_frame_size)
+        data = b"".join([message.encode(self._version) for message in messages])
+        with self._send_lock:
+            self.socket.sendall(data)
+
+    def get_mux(self):
+        return self._mux
+
+    def can_resume(self, token):
+        """ The session may be taken by a new connection presenting the token: the slaver is still connected
+            (the old connection is not known to be broken yet), or it has been disconnected for less than RESUME_GRACE_PERIOD
+            rtype: bool
+        """
+        if not self._token or token != self._token:
+            return False
+        return self.status != OFFLINE or time.time() - self._disconnected <= config.RESUME_GRACE_PERIOD
+
+    def resume(self, connection):
+        """ Take the new control connection of the slaver. The tunnels and their bridge pairs are kept,
+            the streams of the multiplexer are gone with the old connection
+        """
+        if self._mux:
+            self._mux.close()
+            self._mux = None
+        with self._send_lock:
+            old, self.socket = self.socket, connection
+        try:
+            # wake up the reader of the old connection
+            old.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try_close(old)
+
+    def has_capability(self, capability):
+        """ type capability: Capability bit
+            rtype: bool
+        """
+        return bool(self._terms and self._terms.has(capability))
 
     def serialize(self):
         if PY3_OR_LATER:
-            return dict((k, v) for (k, v) in self.__dict__.items() if v != self.socket)
+            return dict((k, v) for (k, v) in self.__dict__.items() if v != self.socket and not k.startswith("_"))
         else:
-            return dict((k, v) for (k, v) in self.__dict__.iteritems() if v != self.socket)
+            return dict((k, v) for (k, v) in self.__dict__.iteritems() if v != self.socket and not k.startswith("_"))
 
 
 class RemoteServer ():
     def __init__(self, port):
         self._port = port
+        # Workers are forked before any other thread is started
+        self._bridge_factory = AsyncioBridge if config.BRIDGE_ENGINE == "asyncio" else SocketBridge
+        self._bridge_workers = None
+        if config.BRIDGE_WORKERS:
+            if BridgeWorkerPool.is_supported():
+                self._bridge_workers = BridgeWorkerPool(config.BRIDGE_WORKERS)
+                self._bridge_factory = self._bridge_workers.create_bridge
+            else:
+                logging.warning("Bridge workers are not supported on this platform, relaying in the server process")
         self._slavers = {}
         self._load_known_slavers()
         self._opened_tunnels = {}
+        self._sessions_lock = threading.Lock() # a slaver session is resumed by one connection, or lost by another one
+        self._ingress = None
+        if config.INGRESS_PORT:
+            try:
+                self._ingress = IngressServer(config.INGRESS_PORT)
+                self._ingress.start()
+            except (OSError, socket.error) as e:
+                # the tunnels asking for the ingress port listen on ports of their own
+                logging.error("Ingress port {} is not available, it is not used: {}".format(config.INGRESS_PORT, e))
+                self._ingress = None
+        # The communicate and customer ports of the tunnels. The communicate port is the tunnel id
+        self._ports = PortPool(PORTS_RANGE[0], PORTS_RANGE[1], config.PREBOUND_PORTS)
+        self._ports.start()
         threading.Thread(target=self._run, args=[]).start()
 
     def _load_known_slavers(self):
@@ -261,10 +776,7 @@ class RemoteServer ():
             asks it for its name and id, then if all ok - appends it to the list
             and creates a new thread for each connection.
         """
-        if SSL_ENABLED:
-            sock = ssl.wrap_socket(socket.socket(),  'ssl/server.key', 'ssl/server.crt', server_side = True)
-        else:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         server_address = ('0.0.0.0', self._port)
         sock.bind(server_address)
@@ -275,10 +787,9 @@ class RemoteServer ():
                 slaver_socket, _ = sock.accept()
                 logging.debug("new connection {}".format(slaver_socket.getsockname()))
                 
+                # the TLS handshake is made by the connection thread, a slow slaver does not hold the others
                 threading.Thread(target=self._handle_slaver,
                                     args=[slaver_socket]).start()
-            except ssl.SSLError:
-                logging.error("Slaver connection SSL error")
             except:
                 pass
 
@@ -289,12 +800,42 @@ class RemoteServer ():
             Runs in dedicated thread for each active slaver connection
             type slaver: Slaver ()
         """
+        reader = MessageReader(MAX_FRAME_SIZE)
+        messages = []
         try:
+            if SSL_ENABLED:
+                try:
+                    connection = wrap_server(connection, SSL_CERT_FILE, SSL_KEY_FILE, ktls = config.KTLS_ENABLED)
+                except ssl.SSLError:
+                    logging.error("Slaver connection SSL error")
+                    try_close(connection)
+                    return
             connection.settimeout(5)  # Wait 5 sec for handshake
-            hs = ControlMessage.from_bytes(connection.recv(128))
-            if (None ==  hs and not isinstance(hs,HandshakeMessage)):
+            while not messages:
+                data = connection.recv(128)
+                if not data:
+                    raise Exception("Connection broken")
+                messages = reader.feed(data)
+            hs = messages.pop(0)
+            if not isinstance(hs,HandshakeMessage):
+                try_close(connection)
                 return
-            slaver = Slaver(connection, hs.hwId, hs.name)
+            slaver = self._resume_session(hs, connection)
+            if slaver is None:
+                slaver = Slaver(connection, hs.hwId, hs.name)
+            # Old slavers speak version 1, and are answered the same way. A newer slaver is answered in the server version
+            slaver._version = min(hs.frame_version, ControlMessage.get_version())
+            if hs.capabilities is not None:
+                # The slaver negotiates: it gets the server terms, and both sides use what they agree on.
+                # It is sent before the slaver is listed, so no other message can be sent before
+                terms = self._create_handshake(random.SystemRandom().getrandbits(64) or 1)
+                slaver.send(terms)
+                slaver._terms = terms.agree(hs)
+                # A new token for every connection
+                slaver._token = terms.token if slaver.has_capability(Capability.RESUME) else 0
+                if slaver.has_capability(Capability.MUX):
+                    slaver._mux = Multiplexer(slaver.send, window = slaver._terms.window)
+                    logging.debug("slaver {} tunnel streams are multiplexed".format(slaver.name))
             slaver.status = ONLINE # Mark it as online
             database.log(slaver.hwId, slaver.status, time.time()) # Wite log to database: slaver ID and connection time
             database.write(slaver) # Add to base of know slavers. Or update, if slaver with such it already exists
@@ -304,33 +845,89 @@ class RemoteServer ():
             try_close(connection)
             return
 
-        slaver.socket.settimeout(config.HOST_ALIVE_TIMEOUT)
+        connection.settimeout(config.HOST_ALIVE_TIMEOUT)
+        written = 0
         while True:
             try:
-                data = slaver.socket.recv(256)
+                for message in messages:
+                    self._process_message(message, slaver)
+                data = connection.recv(RECV_BUFFER_SIZE)
                 if not data:
                     raise Exception("Connection broken")
 
                 slaver.last_update = time.time()
-                database.write(slaver)
-                if len(data) > 2:  # If not just alive ping
-                    message = ControlMessage.from_bytes(data)
-                    self._process_message(message)
+                if slaver.last_update - written >= LAST_UPDATE_WRITE_PERIOD:
+                    database.write(slaver)
+                    written = slaver.last_update
+                # Alive pings are skipped by the reader
+                messages = reader.feed(data)
 
             except Exception as e:
                 logging.debug("Exception occures while listening to slaver socket: {}".format(e))
-                try_close(slaver.socket)
-                slaver.status = OFFLINE
+                try_close(connection)
+                with self._sessions_lock:
+                    if slaver.socket is not connection:
+                        break # The session is resumed on a new connection
+                    if slaver.get_mux():
+                        slaver.get_mux().close()
+                    slaver.status = OFFLINE
+                    slaver._disconnected = time.time()
                 database.log(slaver.hwId, slaver.status, time.time())
+                if slaver._token:
+                    # The tunnels wait for the slaver to resume the session
+                    timer = threading.Timer(config.RESUME_GRACE_PERIOD, self._expire_session, [slaver, connection])
+                    timer.daemon = True
+                    timer.start()
                 break  # Exit from the loop and shutdown the thread
 
-    def _process_message(self, message):
+    def _resume_session(self, hs, connection):
+        """ Give the slaver session back to a new connection presenting the resume token
+            type hs: HandshakeMessage - of the new connection
+            rtype: Slaver or None, if there is no session to resume
+        """
+        old = self._slavers.get(hs.hwId)
+        if old is None or not old._token:
+            return None
+        with self._sessions_lock:
+            if old.can_resume(hs.token):
+                old.resume(connection)
+                old.status = ONLINE
+                logging.debug("slaver {} session resumed".format(old.name))
+                return old
+        # The slaver has lost the session (restarted), so the tunnels of it are closed on the server too
+        self._expire_session(old, old.socket)
+        return None
+
+    def _expire_session(self, slaver, connection):
+        """ Close the tunnels of a session not resumed
+        """
+        with self._sessions_lock:
+            if slaver.socket is not connection or not slaver._token:
+                return # resumed, or expired already
+            slaver._token = 0
+        for tunnel_id, tunnel in list(self._opened_tunnels.items()):
+            if tunnel.get_slaver() is slaver:
+                self._opened_tunnels.pop(tunnel_id, None)
+                tunnel.close()
+        logging.debug("slaver {} session expired".format(slaver.name))
+
+    def _process_message(self, message, slaver):
         """
         type message: ControlMessage
+        type slaver: Slaver
         """
         if None == message:
             return
 
+        if isinstance(message, BatchMessage):
+            for item in message.messages():
+                self._process_message(item, slaver)
+            return
+
+        mux = slaver.get_mux()
+        if mux and mux.feed(message):
+            return
+
         if isinstance(message, TunnelClosedMessage): 
             """ Message when tunnel with given id has closed by slaver.
                 So we need to close it on the server side too.
@@ -342,6 +939,17 @@ class RemoteServer ():
             except:
                 pass
     
+    @staticmethod
+    def _create_handshake(token):
+        """ The server capabilities and limits, sent to the slavers negotiating them
+            type token: int - the slaver session resume token
+            rtype: HandshakeMessage
+        """
+        capabilities = Capability.BATCH | Capability.UDP | Capability.RESUME | Capability.SETUP_TOKEN | Capability.POOL
+        if config.MUX_ENABLED:
+            capabilities |= Capability.MUX
+        return HandshakeMessage(0, "server", capabilities, MAX_FRAME_SIZE, config.ALIVE_PING_PERIOD, MUX_WINDOW, token)
+
     def _on_tunnel_closed (self, tunnel_id):
         """ Callback when tunnel with given id has closed by server.
             So we need to remove it from list of opened tunnels
@@ -358,34 +966,92 @@ class RemoteServer ():
         return json.dumps([json.dumps(self._slavers[key].serialize()) for key in self._slavers])
 
     def open_tunnel(self, options):
+        """ Open a tunnel, or take the one opened with the same options. The tunnel is brought up by its thread,
+            and the reply comes the moment it is ready, or fails. A request may give the seconds to wait for it in "wait":
+            with 0 the reply is {"status": "opening", "id": ...} at once, and the tunnel is waited by get_tunnel_status()
+            type options: dict
+            rtype: json string
+            raises ValueError - the "wait" is not a number of seconds
+        """
+        options = dict(options)
+        wait = options.pop("wait", None)
+        wait = parse_wait(wait) if wait is not None else TUNNEL_OPEN_TIMEOUT
         id = int(options["id"])
         # If there is no client with such ID or the client exists but it is offline -> return error
         if id not in self._slavers or self._slavers[id].status == OFFLINE:
             return "ERROR Client not found or offline"
 
-        # First lets check if a tunnel with a requested options already opened
-        for _, tunnel in self._opened_tunnels.items():
+        # First lets check if a tunnel with a requested options already opened, or being opened
+        for _, tunnel in list(self._opened_tunnels.items()):
             if tunnel.get_options() == options: # If does -> just return a coonection parameters
                 logging.debug("Requested tunnel already opened")
-                return '{{"status": "ok", "port": {0},"id": {1} }}'.format(str(tunnel.get_customer_port()),str(tunnel.get_communicate_port()))
+                return self._tunnel_status_reply(tunnel, wait)
+
+        tunnel = TCP_tunnel_server(self._slavers[id], options, self._on_tunnel_closed, self._ports, self._bridge_factory,
+                                   self._ingress)
+        if not tunnel.start():
+            return '{"status": "error"}'
+        # Tunnel`s communicate port uses also as its ID
+        tunnel_id = tunnel.get_communicate_port()
+        self._opened_tunnels[tunnel_id] = tunnel
+        if tunnel.get_status() == ERROR and self._opened_tunnels.get(tunnel_id) is tunnel:
+            # it failed before it was listed, so its close callback has found nothing to forget
+            self._opened_tunnels.pop(tunnel_id, None)
+        return self._tunnel_status_reply(tunnel, wait)
+
+    def get_tunnel_status(self, tunnel_id, wait = 0):
+        """ Returns the connection parameters of a tunnel, once it is ready. A long poll: the reply comes the moment
+            the tunnel is ready or fails, or in "wait" seconds with {"status": "opening", "id": ...}
+            type tunnel_id: int
+            type wait: float - seconds, up to MAX_STATUS_WAIT
+            rtype: json string
+        """
+        tunnel = self._opened_tunnels.get(tunnel_id)
+        if tunnel is None:
+            return '{"status": "error"}'
+        return self._tunnel_status_reply(tunnel, min(wait, MAX_STATUS_WAIT))
 
-        tunnel = TCP_tunnel_server(self._slavers[id], options, self._on_tunnel_closed)
-        tunnel.start()
-        while True:
-            time.sleep(0.5)
-            status = tunnel.get_status()
-            if status == READY:
-                # Tunnel`s communicate port uses also as its ID
-                self._opened_tunnels[tunnel.get_communicate_port()] = tunnel
-                return '{{"status": "ok", "port": {0},"id": {1} }}'.format(str(tunnel.get_customer_port()),str(tunnel.get_communicate_port()))
-            elif status == ERROR:
-                return '{"status": "error"}'
+    def _tunnel_status_reply(self, tunnel, wait):
+        """ rtype: json string
+        """
+        status = tunnel.wait_status(wait)
+        if status == READY:
+            return self._tunnel_reply(tunnel)
+        elif status == ERROR:
+            return '{"status": "error"}'
+        return '{{"status": "opening", "id": {0} }}'.format(str(tunnel.get_communicate_port()))
+
+    @staticmethod
+    def _tunnel_reply(tunnel):
+        """ The connection parameters of an opened tunnel. The customers of a routed tunnel name its route to the port
+            rtype: json string
+        """
+        if tunnel.get_route():
+            return '{{"status": "ok", "port": {0},"id": {1}, "route": {2} }}'.format(str(tunnel.get_customer_port()),
+                str(tunnel.get_communicate_port()), json.dumps(tunnel.get_route()))
+        return '{{"status": "ok", "port": {0},"id": {1} }}'.format(str(tunnel.get_customer_port()),str(tunnel.get_communicate_port()))
+
+    def get_tunnel_stats(self, tunnel_id = None):
+        """ Returns traffic counters of all the opened tunnels, or of the given one, via json string.
+            The use of the tunnel ports, of the ingress port, and of the relay buffers come along
+            type tunnel_id: int
+            rtype: json string
+        """
+        tunnels = [tunnel for id, tunnel in list(self._opened_tunnels.items()) if tunnel_id in (None, id)]
+        stats = {"tunnels": [tunnel.get_stats() for tunnel in tunnels], "ports": self._ports.get_stats()}
+        if self._ingress:
+            stats["ingress"] = self._ingress.get_stats()
+        # the reactor of this process relays the pairs not handed over to the workers, e.g. SSL ones
+        stats["bridge"] = {"reactor": reactor_stats()}
+        if self._bridge_workers:
+            stats["bridge"]["workers"] = self._bridge_workers.get_stats()
+        return json.dumps(stats)
 
     def close_tunnel (self, tunnel_id):
         tunnel = self._opened_tunnels.pop(tunnel_id, None)
         if None != tunnel:
             try:
-                tunnel.get_slaver().socket.sendall(TunnelClosedMessage(tunnel_id).encode())
+                tunnel.get_slaver().post(TunnelClosedMessage(tunnel_id))
             except:
                 pass
             tunnel.close()
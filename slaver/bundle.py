@@ -12,6 +12,11 @@ MASTER_PORT = 444
 DEVICE_NAME = "Test windows device"
 
 SSL_ENABLED = False
+KTLS_ENABLED = False # hand the TLS record encryption to the kernel (Linux, OpenSSL 3 built with kTLS)
+
+BRIDGE_ENGINE = "selector" # "selector" or "asyncio". SSL pairs use the selector engine anyway
+
+MUX_ENABLED = True # accept the server offer to relay new tunnel connections over the control connection
 #
 
 import socket
@@ -21,7 +26,6 @@ import time
 import os
 import select
 import serial
-import ssl
 from uuid import getnode as get_mac
 """ Created on 10.06.2020.
 @author: Pavel Saenko
@@ -35,126 +39,318 @@ class MessageType:
     TUNNEL_REQUEST = 1
     CONNECTION_REQUEST = 2
     TUNNEL_CLOSED = 3
+    STREAM_OPEN = 4
+    STREAM_DATA = 5
+    STREAM_WINDOW_UPDATE = 6
+    STREAM_CLOSE = 7
+    BATCH = 8
+    PARK_REQUEST = 9
 
 class Proto:
     TCP = 0
     SERIAL = 1
+    UDP = 2
+
+class Capability:
+    """ Bits of the handshake capabilities bitmap: what a side supports besides the version 1 messages.
+        A capability is used, if both sides have it
+    """
+    BATCH = 1 # BatchMessage
+    MUX = 2 # tunnel streams over the control connection
+    UDP = 4 # Proto.UDP tunnels
+    RESUME = 8 # a reconnected slaver takes its tunnels back with the resume token
+    SETUP_TOKEN = 16 # connection requests carry a token, the slaver sends it first on the data connection
+    POOL = 32 # ParkReqMessage, the slaver keeps idle data connections parked on the server
+
+
+try:
+    _Struct = struct.Struct
+except AttributeError:
+    class _Struct(object):
+        """ MicroPython has no struct.Struct, the same interface over the module functions
+        """
+        def __init__(self, format):
+            self.format = format
+            self.size = struct.calcsize(format)
+
+        def pack(self, *args):
+            return struct.pack(self.format, *args)
+
+        def unpack_from(self, buffer, offset = 0):
+            return struct.unpack_from(self.format, buffer, offset)
+
+
+# protocol versions, as they are put in the message header
+VERSION_1 = 10 # message = header (version, type) + payload. The payload size is known from its fields only
+VERSION_2 = 20 # message = header (version, type, payload length) + payload
+# later versions keep the version 2 header, and only append fields to the payloads,
+# so the messages of a newer peer are still split and decoded as far as the fields are known
+
+# the biggest frame payload accepted, a bigger length means the stream is broken
+MAX_FRAME_SIZE = 2 ** 20
+
+# the formats are compiled once
+_HEADER = _Struct("<BB")
+_FRAME_HEADER = _Struct("<BBI")
+_BYTE = _Struct("<B")
+# the setup token of a requested data connection (uint_32), the slaver sends it first on the connection
+SETUP_TOKEN = _Struct("<I")
+# the server sends it on a parked data connection, when the connection is given to a customer
+PARKED_TAKEN = b"\x01"
+
 
+def _read_string(buffer, start, length):
+    return bytes(buffer[start:start + length]).decode()
 
-class ControlMessage ():
+
+class ControlMessage (object):
     """
         A base class of control messages to communicate between slaves and master.
-        message = header (version: uint_8, message type: uint_8) + payload
+        version 2 frame = header (version: uint_8, message type: uint_8, payload length: uint_32) + payload
+        version 1 message = header (version: uint_8, message type: uint_8) + payload
+        A message is decoded in the version it came, and encoded in the version the peer speaks
     """
+    __slots__ = ("frame_version",)
     #static fields
     header_format = "<BB"
-    version = 1.0
-    HEADER_SIZE = 2
+    frame_header_format = "<BBI"
+    version = 2.0
+    HEADER_SIZE = _HEADER.size
+    FRAME_HEADER_SIZE = _FRAME_HEADER.size
+
+    def __init__(self):
+        self.frame_version = None # the version a decoded message came in
+
     @classmethod
     def from_bytes (cls,payload):
-        (version,message_type)  = struct.unpack(cls.get_header_format(),payload[:cls.HEADER_SIZE])
-        #if version != cls.get_version():
-            #logging.error("message protocol versions is not match: {} and {}".format(float(version)/10, cls.version))
-        if message_type == MessageType.HANDSHAKE:
-            return HandshakeMessage.from_bytes(payload[cls.HEADER_SIZE:])
-        elif message_type == MessageType.TUNNEL_REQUEST:
-            return TunnelReqMessage.from_bytes(payload[cls.HEADER_SIZE:])
-        elif message_type == MessageType.CONNECTION_REQUEST:
-            return ConnectionReqMessage.from_bytes(payload[cls.HEADER_SIZE:])
-        elif message_type == MessageType.TUNNEL_CLOSED:
-            return TunnelClosedMessage.from_bytes(payload[cls.HEADER_SIZE:])
+        """ Decode a message
+            type payload: bytes - exactly one message
+            rtype: ControlMessage or None, if it is broken or of an unknown type
+        """
+        return ControlMessage.decode(payload, 0, len(payload))
+
+    @staticmethod
+    def decode(buffer, offset, end):
+        """ Decode the message at buffer[offset:end] without copying it.
+            end - the end of the frame, or of the buffer for a version 1 message
+            type buffer: memoryview or bytes
+            rtype: ControlMessage or None
+        """
+        try:
+            (version,message_type)  = _HEADER.unpack_from(buffer, offset)
+            message_class = MESSAGE_CLASSES.get(message_type)
+            if message_class is None:
+                return None
+            start = offset + (_FRAME_HEADER.size if version >= VERSION_2 else _HEADER.size)
+            message = message_class.decode_payload(buffer, start, end)
+        except Exception:
+            return None
+        if message is not None:
+            message.frame_version = version
+        return message
+
+    @staticmethod
+    def message_size(buffer, offset = 0, end = None, max_frame_size = MAX_FRAME_SIZE):
+        """ Returns the size of the message at buffer[offset:end], or None if there is too little data to tell.
+            A version 1 message has no length field, so it is worked out from the message type and its fields
+            rtype: int
+        """
+        end = len(buffer) if end is None else end
+        if end - offset < _HEADER.size:
+            return None
+        (version, message_type) = _HEADER.unpack_from(buffer, offset)
+        if version >= VERSION_2:
+            if end - offset < _FRAME_HEADER.size:
+                return None
+            length = _FRAME_HEADER.unpack_from(buffer, offset)[2]
+            if length > max_frame_size:
+                raise Exception("Frame is too long: {}".format(length))
+            return _FRAME_HEADER.size + length
+        if version != VERSION_1:
+            raise Exception("Unknown protocol version {}".format(version))
+        message_class = MESSAGE_CLASSES.get(message_type)
+        if message_class is None:
+            raise Exception("Unknown message type {}".format(message_type))
+        size = message_class.payload_size(buffer, offset + _HEADER.size, end)
+        return None if size is None else _HEADER.size + size
 
-        return None
     @staticmethod
     def get_header_format():
         return ControlMessage.header_format
-    
+
     @staticmethod
     def get_version():
         return int(ControlMessage.version*10)
 
     @classmethod
-    def _add_header(cls,message_type, payload):
-        return struct.pack(cls.get_header_format(),cls.get_version(),message_type) + payload
+    def _add_header(cls,message_type, payload, version = None):
+        """ version - the peer protocol version, the current one by default
+        """
+        version = version or cls.get_version()
+        if version == VERSION_1:
+            return _HEADER.pack(version,message_type) + payload
+        return _FRAME_HEADER.pack(version,message_type,len(payload)) + payload
 
 class HandshakeMessage(ControlMessage):
-    def __init__(self, hwId, name):
+    """ The slaver introduces itself with it. A slaver sending the capabilities gets the server handshake back,
+        and both sides use what they agree on: see agree()
+    hwId (uint_64), len_of name (uint_8), name (n*s)
+        version 2 frames, optional: capabilities (uint_32), max_frame_size (uint_32), alive_period (uint_16), window (uint_32)
+            then optional: resume token (uint_64)
+    """
+    __slots__ = ("hwId", "name", "capabilities", "max_frame_size", "alive_period", "window", "token")
+    message_type = MessageType.HANDSHAKE
+    _struct = _Struct("<QB")
+    _limits_struct = _Struct("<IIHI")
+    _token_struct = _Struct("<Q")
+
+    def __init__(self, hwId, name, capabilities = None, max_frame_size = MAX_FRAME_SIZE, alive_period = 0, window = 0,
+                 token = 0):
+        """ type capabilities: int - Capability bits, None - the sender does not negotiate (an old slaver)
+            type max_frame_size: int - the biggest frame payload the sender accepts
+            type alive_period: int - seconds between alive pings, 0 - no preference
+            type window: int - the stream window of the multiplexing, 0 - no preference
+            type token: int - the server gives it to the slaver, the slaver presents it to resume the session. 0 - none
+        """
+        ControlMessage.__init__(self)
         self.hwId = hwId
         if (len(name) > 255):
             raise Exception ("Device name is too long")
         self.name = name
+        self.capabilities = capabilities
+        self.max_frame_size = max_frame_size
+        self.alive_period = alive_period
+        self.window = window
+        self.token = token
+
+    def has(self, capability):
+        """ rtype: bool
+        """
+        return bool((self.capabilities or 0) & capability)
+
+    def agree(self, other):
+        """ Returns the terms both sides support: the common capabilities, and the smallest limits
+            type other: HandshakeMessage - the handshake of the other side
+            rtype: HandshakeMessage
+        """
+        def smallest(a, b):
+            return min(a, b) if a and b else a or b
+        return HandshakeMessage(other.hwId, other.name, (self.capabilities or 0) & (other.capabilities or 0),
+                                min(self.max_frame_size, other.max_frame_size),
+                                smallest(self.alive_period, other.alive_period), smallest(self.window, other.window))
 
     @classmethod
-    def from_bytes(cls, payload):
-        try:
-            (hwid,name_len) = struct.unpack("<QB",payload[0:9])
-            return (cls(hwid,payload[-name_len:].decode()))
-        except:
+    def decode_payload(cls, buffer, start, end):
+        (hwid,name_len) = cls._struct.unpack_from(buffer, start)
+        start += cls._struct.size
+        message = cls(hwid, _read_string(buffer, start, name_len))
+        start += name_len
+        # old slavers send no capabilities
+        if end - start >= cls._limits_struct.size:
+            (message.capabilities, message.max_frame_size, message.alive_period,
+                message.window) = cls._limits_struct.unpack_from(buffer, start)
+            start += cls._limits_struct.size
+            if end - start >= cls._token_struct.size:
+                message.token = cls._token_struct.unpack_from(buffer, start)[0]
+        return message
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        if end - start < cls._struct.size:
             return None
+        return cls._struct.size + _BYTE.unpack_from(buffer, start + 8)[0]
+
+    def encode (self, version = None):
+        name = self.name.encode()
+        payload = self._struct.pack(self.hwId, len(name)) + name
+        if self.capabilities is not None and (version or self.get_version()) != VERSION_1:
+            # a version 1 message has no length, so nothing may follow the name
+            payload += self._limits_struct.pack(self.capabilities, self.max_frame_size, self.alive_period, self.window)
+            payload += self._token_struct.pack(self.token)
+        return self._add_header(MessageType.HANDSHAKE, payload, version)
+
+
+class _TunnelMessage(ControlMessage):
+    """ A message about a tunnel. The messages of different types are not subclasses of each other,
+        so an isinstance() check does not take one type for another
+    tunnel_id (uint_16)
+    """
+    __slots__ = ("tunnel_id", "token")
+    _struct = _Struct("<H")
 
-    def encode (self):
-        payload = struct.pack(self._get_format(),self.hwId,len(self.name), self.name.encode())
-        return self._add_header(MessageType.HANDSHAKE, payload)
-    
-    def _get_format(self):
+    def __init__(self, tunnel_id, token = 0):
+        """ type token: int - sent first on the requested connection, so the server knows its customer. 0 - no token
         """
-        hwId (uint_64), len_of name (uint_8), name (n*s)
-        """
-        return "<QB{}s".format(len(self.name)) 
-
-
-class ConnectionReqMessage(ControlMessage):
-    def __init__(self, tunnel_id):
+        ControlMessage.__init__(self)
         self.tunnel_id = tunnel_id
+        self.token = token
 
     @classmethod
-    def from_bytes(cls, payload):
-        try:
-            (tunnel_id,) = struct.unpack("<H",payload)
-            return (cls(tunnel_id))
-        except:
-            return None
+    def decode_payload(cls, buffer, start, end):
+        message = cls(*cls._struct.unpack_from(buffer, start))
+        start += cls._struct.size
+        if end - start >= SETUP_TOKEN.size:
+            message.token = SETUP_TOKEN.unpack_from(buffer, start)[0]
+        return message
 
-    def encode (self):
-        payload = struct.pack(self._get_format(),self.tunnel_id)
-        return self._add_header(MessageType.CONNECTION_REQUEST, payload)
-    
-    def _get_format(self):
-        """
-        tunnel_id (uint_16)
-        """
-        return "<H"
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        return cls._struct.size
 
-class TunnelClosedMessage(ControlMessage):
-    """ A tunnel closed callback message. 
+    def encode (self, version = None):
+        payload = self._struct.pack(self.tunnel_id)
+        if self.token:
+            payload += SETUP_TOKEN.pack(self.token)
+        return self._add_header(self.message_type, payload, version)
+
+class ConnectionReqMessage(_TunnelMessage):
     """
-    def __init__(self, tunnel_id):
-        self.tunnel_id = tunnel_id
+    tunnel_id (uint_16)
+        -> setup token (uint_32) - in version 2 frames to slavers agreed on the Capability.SETUP_TOKEN
+    """
+    __slots__ = ()
+    message_type = MessageType.CONNECTION_REQUEST
 
-    @classmethod
-    def from_bytes(cls, payload):
-        try:
-            (tunnel_id,) = struct.unpack("<H",payload)
-            return (cls(tunnel_id))
-        except:
-            return None
+class TunnelClosedMessage(_TunnelMessage):
+    """ A tunnel closed callback message.
+    tunnel_id (uint_16)
+    """
+    __slots__ = ()
+    message_type = MessageType.TUNNEL_CLOSED
 
-    def encode (self):
-        payload = struct.pack(self._get_format(),self.tunnel_id)
-        return self._add_header(MessageType.TUNNEL_CLOSED, payload)
-    
-    def _get_format(self):
-        """
-        tunnel_id (uint_16)
-        """
-        return "<H"
+class ParkReqMessage(_TunnelMessage):
+    """ A connection request for the pool of the tunnel: the slaver connects to the server and sends the token,
+        then waits for PARKED_TAKEN to connect to the tunnel target. It is sent to slavers agreed on the Capability.POOL
+    tunnel_id (uint_16), setup token (uint_32)
+    """
+    __slots__ = ()
+    message_type = MessageType.PARK_REQUEST
 
 class TunnelReqMessage(ControlMessage):
-    """ A new tunnel request message. 
+    """ A new tunnel request message.
+    communicate_port (uint_16), proto (uint_8), ssl(uint_8)
+        -> port (uint_16), len_of hostname (uint_8), hostname (n*s) - TCP and UDP
+            then for UDP, optional: idle_timeout (uint_32), flow_timeout (uint_32)
+        or
+        -> baudrate (uint_32), len_of ser_name (uint_8), ser_name (n*s)
     """
-    def __init__(self, communicate_port, ssl = False, hostname = None, port = None, ser_name = None, baudrate = None):
+    __slots__ = ("proto", "hostname", "port", "ser_name", "baudrate", "communicate_port", "ssl",
+                 "idle_timeout", "flow_timeout")
+    message_type = MessageType.TUNNEL_REQUEST
+    _struct = _Struct("<HBB")
+    _tcp_struct = _Struct("<HB")
+    _serial_struct = _Struct("<IB")
+    _udp_struct = _Struct("<II")
+
+    def __init__(self, communicate_port, ssl = False, hostname = None, port = None, ser_name = None, baudrate = None,
+                 udp = False, idle_timeout = 0, flow_timeout = 0):
+        """ udp - forward the datagrams to the host and port, instead of the connections
+            type idle_timeout: int - seconds a UDP tunnel lives without datagrams, 0 - the slaver default
+            type flow_timeout: int - seconds a flow of a UDP tunnel lives without datagrams, 0 - the slaver default
+        """
+        ControlMessage.__init__(self)
         if hostname and port:
-            self.proto = Proto.TCP
+            self.proto = Proto.UDP if udp else Proto.TCP
             self.hostname = hostname
             self.port = port
         elif ser_name and baudrate:
@@ -165,265 +361,2578 @@ class TunnelReqMessage(ControlMessage):
             raise Exception("Wrong parameters given")
         self.communicate_port = communicate_port
         self.ssl = ssl
+        self.idle_timeout = idle_timeout
+        self.flow_timeout = flow_timeout
+
+    @classmethod
+    def decode_payload(cls, buffer, start, end):
+        (communicate_port,proto, ssl) = cls._struct.unpack_from(buffer, start)
+        start += cls._struct.size
+        if proto in (Proto.TCP, Proto.UDP):
+            (port, host_len ) = cls._tcp_struct.unpack_from(buffer, start)
+            start += cls._tcp_struct.size
+            hostname = _read_string(buffer, start, host_len)
+            message = cls(communicate_port = communicate_port, ssl = ssl, hostname = hostname, port = port,
+                          udp = proto == Proto.UDP)
+            start += host_len
+            # UDP tunnels are version 2 only, so the end is the frame end
+            if proto == Proto.UDP and end - start >= cls._udp_struct.size:
+                (message.idle_timeout, message.flow_timeout) = cls._udp_struct.unpack_from(buffer, start)
+            return message
+        elif proto == Proto.SERIAL:
+            (baudrate, ser_name_len ) = cls._serial_struct.unpack_from(buffer, start)
+            ser_name = _read_string(buffer, start + cls._serial_struct.size, ser_name_len)
+            return cls(communicate_port = communicate_port, ssl = ssl, ser_name = ser_name, baudrate= baudrate)
+        return None
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        if end - start < cls._struct.size:
+            return None
+        proto = _BYTE.unpack_from(buffer, start + 2)[0]
+        # the name length follows the port (uint_16) or the baudrate (uint_32)
+        len_offset = 8 if proto == Proto.SERIAL else 6
+        if end - start <= len_offset:
+            return None
+        return len_offset + 1 + _BYTE.unpack_from(buffer, start + len_offset)[0]
+
+    def encode (self, version = None):
+        header = self._struct.pack(self.communicate_port, self.proto, self.ssl)
+        if self.proto != Proto.SERIAL:
+            name = self.hostname.encode()
+            payload = header + self._tcp_struct.pack(self.port, len(name)) + name
+            if self.proto == Proto.UDP and (version or self.get_version()) != VERSION_1:
+                payload += self._udp_struct.pack(self.idle_timeout, self.flow_timeout)
+        else:
+            name = self.ser_name.encode()
+            payload = header + self._serial_struct.pack(self.baudrate, len(name)) + name
+        return self._add_header(MessageType.TUNNEL_REQUEST, payload, version)
+
+
+class StreamOpenMessage(ControlMessage):
+    """ Open a stream of the tunnel multiplexed over the control connection.
+        window - bytes the sender is ready to receive on the stream
+    stream_id (uint_32), tunnel_id (uint_16), priority (uint_8), window (uint_32)
+    """
+    __slots__ = ("stream_id", "tunnel_id", "priority", "window")
+    message_type = MessageType.STREAM_OPEN
+    _struct = _Struct("<IHBI")
+
+    def __init__(self, stream_id, tunnel_id, priority = 0, window = 0):
+        ControlMessage.__init__(self)
+        self.stream_id = stream_id
+        self.tunnel_id = tunnel_id
+        self.priority = priority
+        self.window = window
+
+    @classmethod
+    def decode_payload(cls, buffer, start, end):
+        return cls(*cls._struct.unpack_from(buffer, start))
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        return cls._struct.size
+
+    def encode (self, version = None):
+        payload = self._struct.pack(self.stream_id, self.tunnel_id, self.priority, self.window)
+        return self._add_header(MessageType.STREAM_OPEN, payload, version)
+
+
+class StreamDataMessage(ControlMessage):
+    """ Data of a multiplexed stream
+    stream_id (uint_32), len_of data (uint_16), data (n*s)
+    """
+    __slots__ = ("stream_id", "data")
+    message_type = MessageType.STREAM_DATA
+    _struct = _Struct("<IH")
+
+    def __init__(self, stream_id, data):
+        ControlMessage.__init__(self)
+        if len(data) > 0xFFFF:
+            raise Exception("Stream data is too long")
+        self.stream_id = stream_id
+        self.data = data
+
+    @classmethod
+    def decode_payload(cls, buffer, start, end):
+        (stream_id, length) = cls._struct.unpack_from(buffer, start)
+        start += cls._struct.size
+        if end - start < length:
+            return None
+        # the only copy of the data, the buffer is reused by the reader
+        return cls(stream_id, bytes(buffer[start:start + length]))
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        if end - start < cls._struct.size:
+            return None
+        return cls._struct.size + cls._struct.unpack_from(buffer, start)[1]
+
+    def encode (self, version = None):
+        return self._add_header(MessageType.STREAM_DATA,
+                                self._struct.pack(self.stream_id, len(self.data)) + bytes(self.data), version)
+
+
+class StreamWindowUpdateMessage(ControlMessage):
+    """ The receiver of a stream has delivered increment bytes, so the sender may send that much more.
+        The first update of a stream opened by the other side acknowledges it
+    stream_id (uint_32), increment (uint_32)
+    """
+    __slots__ = ("stream_id", "increment")
+    message_type = MessageType.STREAM_WINDOW_UPDATE
+    _struct = _Struct("<II")
+
+    def __init__(self, stream_id, increment):
+        ControlMessage.__init__(self)
+        self.stream_id = stream_id
+        self.increment = increment
+
+    @classmethod
+    def decode_payload(cls, buffer, start, end):
+        return cls(*cls._struct.unpack_from(buffer, start))
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        return cls._struct.size
+
+    def encode (self, version = None):
+        return self._add_header(MessageType.STREAM_WINDOW_UPDATE,
+                                self._struct.pack(self.stream_id, self.increment), version)
+
+
+class StreamCloseMessage(ControlMessage):
+    """ The sender has closed the stream. The receiver delivers what it already got and closes the stream too
+    stream_id (uint_32)
+    """
+    __slots__ = ("stream_id",)
+    message_type = MessageType.STREAM_CLOSE
+    _struct = _Struct("<I")
+
+    def __init__(self, stream_id):
+        ControlMessage.__init__(self)
+        self.stream_id = stream_id
+
+    @classmethod
+    def decode_payload(cls, buffer, start, end):
+        return cls(*cls._struct.unpack_from(buffer, start))
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        return cls._struct.size
+
+    def encode (self, version = None):
+        return self._add_header(MessageType.STREAM_CLOSE, self._struct.pack(self.stream_id), version)
+
+
+class BatchMessage(ControlMessage):
+    """ Several connection requests or tunnel closed messages in one frame, for a burst of customers
+        or of closed tunnels. It is sent to slavers agreed on the Capability.BATCH only
+    message type of the items (uint_8), count (uint_16), tunnel_id (count*uint_16)
+        -> setup token (count*uint_32) - connection requests to slavers agreed on the Capability.SETUP_TOKEN
+    """
+    __slots__ = ("item_type", "tunnel_ids", "tokens")
+    message_type = MessageType.BATCH
+    _struct = _Struct("<BH")
+    MAX_ITEMS = 0xFFFF
+
+    def __init__(self, item_type, tunnel_ids, tokens = None):
+        ControlMessage.__init__(self)
+        if item_type not in BATCH_ITEMS:
+            raise Exception("Messages of type {} are not batched".format(item_type))
+        if len(tunnel_ids) > self.MAX_ITEMS:
+            raise Exception("Too many messages in a batch")
+        if tokens and len(tokens) != len(tunnel_ids):
+            raise Exception("A token per message is needed")
+        self.item_type = item_type
+        self.tunnel_ids = tunnel_ids
+        self.tokens = tokens
+
+    def messages(self):
+        """ rtype: list - the batched messages
+        """
+        item_class = BATCH_ITEMS[self.item_type]
+        if self.tokens:
+            return [item_class(tunnel_id, token) for tunnel_id, token in zip(self.tunnel_ids, self.tokens)]
+        return [item_class(tunnel_id) for tunnel_id in self.tunnel_ids]
+
+    @classmethod
+    def decode_payload(cls, buffer, start, end):
+        (item_type, count) = cls._struct.unpack_from(buffer, start)
+        start += cls._struct.size
+        if end - start < 2 * count:
+            return None
+        message = cls(item_type, list(struct.unpack_from("<{}H".format(count), buffer, start)))
+        start += 2 * count
+        if count and end - start >= SETUP_TOKEN.size * count:
+            message.tokens = list(struct.unpack_from("<{}I".format(count), buffer, start))
+        return message
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        if end - start < cls._struct.size:
+            return None
+        return cls._struct.size + 2 * cls._struct.unpack_from(buffer, start)[1]
+
+    def encode (self, version = None):
+        count = len(self.tunnel_ids)
+        payload = self._struct.pack(self.item_type, count) + struct.pack("<{}H".format(count), *self.tunnel_ids)
+        if self.tokens:
+            payload += struct.pack("<{}I".format(count), *self.tokens)
+        return self._add_header(MessageType.BATCH, payload, version)
+
+    @classmethod
+    def coalesce(cls, messages, max_frame_size = MAX_FRAME_SIZE):
+        """ Put the runs of batchable messages into batches, keeping the order of the messages
+            type messages: list of ControlMessage
+            type max_frame_size: int - the biggest frame the other side accepts
+            rtype: list of ControlMessage
+        """
+        ret = []
+        run = []
+        for message in messages + [None]:
+            # the messages with tokens and without them are not mixed in a batch
+            if run and (type(message) is not type(run[0]) or bool(message.token) != bool(run[0].token) or
+                        len(run) == min(cls.MAX_ITEMS, (max_frame_size - cls._struct.size) // (6 if run[0].token else 2))):
+                if len(run) > 1:
+                    tokens = [m.token for m in run] if run[0].token else None
+                    ret.append(cls(run[0].message_type, [m.tunnel_id for m in run], tokens))
+                else:
+                    ret.extend(run)
+                run = []
+            if type(message) in BATCH_ITEMS.values():
+                run.append(message)
+            elif message is not None:
+                ret.append(message)
+        return ret
+
+
+# message type -> class of the messages a BatchMessage carries
+BATCH_ITEMS = dict((c.message_type, c) for c in (ConnectionReqMessage, TunnelClosedMessage, ParkReqMessage))
+
+STREAM_MESSAGES = dict((c.message_type, c) for c in (
+    StreamOpenMessage, StreamDataMessage, StreamWindowUpdateMessage, StreamCloseMessage))
+
+# the message type -> class dispatch table of the decoder
+MESSAGE_CLASSES = dict((c.message_type, c) for c in (
+    HandshakeMessage, TunnelReqMessage, ConnectionReqMessage, TunnelClosedMessage, BatchMessage, ParkReqMessage))
+MESSAGE_CLASSES.update(STREAM_MESSAGES)
+
+# the slaver alive ping, sent as is
+ALIVE_PING = b"0\n"
+
+
+class MessageReader ():
+    """ An incremental decoder of a control connection. A message may come in several reads,
+        and one read may hold several messages. Partial ones are buffered till they are complete.
+        Version 2 frames are split by their length, version 1 messages by their fields
+    """
+
+    def __init__(self, max_frame_size = MAX_FRAME_SIZE):
+        """ max_frame_size - the biggest frame this side accepts, as told to the other side in the handshake
+        """
+        self._buffer = bytearray() # the start of a partial message, it is grown in place by the next reads
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        """ Returns the messages completed by the data. Alive pings are skipped
+            rtype: list
+        """
+        if self._buffer:
+            self._buffer += data
+            buff = self._buffer
+        else:
+            buff = data # nothing is buffered, the messages are decoded from the data as is
+        end = len(buff)
+        messages = []
+        pos = 0
+        # the view is released before the buffer is resized, the messages copy what they keep
+        with memoryview(buff) as view:
+            while pos < end:
+                if buff.startswith(ALIVE_PING, pos):
+                    pos += len(ALIVE_PING)
+                    continue
+                try:
+                    size = ControlMessage.message_size(view, pos, end, self.max_frame_size)
+                except Exception as e:
+                    # there is no way to find where the next message starts
+                    logging.error("Control message decode error: {}. {} bytes dropped".format(e, end - pos))
+                    pos = end
+                    break
+                if size is None or end - pos < size:
+                    break
+                message = ControlMessage.decode(view, pos, pos + size)
+                if message is not None:
+                    messages.append(message)
+                pos += size
+            if buff is not self._buffer and pos < end:
+                self._buffer += view[pos:]
+        if buff is self._buffer:
+            del self._buffer[:pos]
+        return messages
+
+"""
+A socket bridge implementation was borrowed from this repository https://github.com/aploium/shootback
+I just little simplified it.
+"""  
+#!/usr/bin/env python
+# coding=utf-8
+import collections
+import warnings
+import traceback
+import heapq
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+"""
+A hashed timer wheel. The bridges keep an idle deadline for every socket pair,
+and a wheel makes both scheduling and expiring O(1), however many pairs there are.
+"""
+import math
+
+# a monotonic clock, not affected by the system time changes
+monotonic = getattr(time, "monotonic", time.time)
+
+
+class TimerWheel(object):
+    """ Timers are any objects with "deadline" and "wheel_slot" attributes.
+        A timer is put into the slot of its deadline tick, advance() walks the slots passed since the last call
+        and returns the timers which are due. Timers which are more than a wheel revolution ahead
+        just stay in their slot till the right revolution comes.
+    """
+    __slots__ = ("tick", "slots", "current", "count")
+
+    def __init__(self, tick = 1.0, slots_count = 512):
+        self.tick = tick  # seconds
+        self.slots = [set() for _ in range(slots_count)]
+        self.current = int(monotonic() / tick)  # the tick processed last
+        self.count = 0
+
+    def schedule(self, timer, deadline):
+        """ Put (or move) the timer to the given monotonic time
+        """
+        self.cancel(timer)
+        # the slot is processed when its tick begins, so the deadline tick is rounded up.
+        # A due timer goes to the next slot to be processed
+        tick = max(int(math.ceil(deadline / self.tick)), self.current + 1)
+        timer.deadline = deadline
+        timer.wheel_slot = self.slots[tick % len(self.slots)]
+        timer.wheel_slot.add(timer)
+        self.count += 1
+
+    def cancel(self, timer):
+        slot = getattr(timer, "wheel_slot", None)
+        if slot is not None:
+            slot.discard(timer)
+            timer.wheel_slot = None
+            self.count -= 1
+
+    def advance(self, now = None):
+        """ Returns a list of timers which are due. They are removed from the wheel
+        """
+        now = monotonic() if now is None else now
+        tick = int(now / self.tick)
+        expired = []
+        # do not walk the same slots more than once, if the wheel was not advanced for long
+        first = max(self.current + 1, tick - len(self.slots) + 1)
+        for t in range(first, tick + 1):
+            slot = self.slots[t % len(self.slots)]
+            if not slot:
+                continue
+            for timer in [timer for timer in slot if timer.deadline <= now]:
+                slot.discard(timer)
+                timer.wheel_slot = None
+                self.count -= 1
+                expired.append(timer)
+        self.current = max(self.current, tick)
+        return expired
+
+    def next_tick(self, now = None):
+        """ Seconds till the next slot is due, or None if the wheel is empty
+        """
+        if not self.count:
+            return None
+        now = monotonic() if now is None else now
+        return max(0, (self.current + 1) * self.tick - now)
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import selectors
+    from selectors import EVENT_READ, EVENT_WRITE
+
+    EVENT_READ_WRITE = EVENT_READ | EVENT_WRITE
+except ImportError:
+    warnings.warn('selectors module not available, fallback to select')
+    selectors = None
+    EVENT_READ, EVENT_WRITE = 1, 2
+    EVENT_READ_WRITE = EVENT_READ | EVENT_WRITE
+
+# socket recv buffer, 16384 bytes
+RECV_BUFFER_SIZE = 2 ** 14
+# a reader is paused when its pair has more than HIGH_WATERMARK bytes not sent yet,
+# and resumed when the pair's buffer drains down to LOW_WATERMARK
+HIGH_WATERMARK = 2 ** 18
+LOW_WATERMARK = 2 ** 16
+
+# how long a thread waits for the reactor to answer, seconds
+CALL_TIMEOUT = 5
+
+# free slabs kept by the bridge buffer pool, 4 MiB
+POOL_MAX_FREE_SLABS = 2 ** 8
+
+# relay plain sockets with splice() through a pipe, so the data never comes to userspace (Linux only)
+SPLICE_ENABLED = hasattr(os, "splice")
+
+
+# recv to send latency histogram buckets: bucket i counts latencies below 2**i microseconds
+LATENCY_BUCKETS = 32
+
+# a rate limited bridge may send this many seconds of its rate at once
+RATE_BURST_SEC = 0.1
+# a throttled reader is resumed when its token buckets have this many bytes to spend,
+# but not sooner than in THROTTLE_MIN_DELAY seconds, not to wake up the loop for every few bytes
+THROTTLE_RESUME_BYTES = 2 ** 10
+THROTTLE_MIN_DELAY = 0.01
+# a pair which received nothing for that long, seconds, is idle and takes the current virtual time
+# of the fair scheduling, instead of its own one left behind
+FAIR_IDLE_SEC = 0.1
+
+# socket options of the tunnel profiles, None - the OS default
+PROFILES = {
+    # shells and consoles: small writes go out right away
+    "interactive": {"nodelay": True, "sndbuf": None, "rcvbuf": None, "keepalive": True, "adaptive": False},
+    # file transfers: big kernel buffers, and reads growing to the bandwidth-delay product
+    "bulk": {"nodelay": False, "sndbuf": 2 ** 22, "rcvbuf": 2 ** 22, "keepalive": True, "adaptive": True},
+}
+# TCP keepalive of the profiles: idle seconds before the first probe, seconds between probes, probes count
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+
+# an adaptive pair reads the data its path holds: throughput * round trip time, measured every ADAPT_PERIOD seconds
+ADAPT_PERIOD = 1
+ADAPTIVE_MIN_READ = 2 ** 12
+ADAPTIVE_MAX_READ = 2 ** 20
+# the round trip time used when the OS does not report one, seconds
+ASSUMED_RTT = 0.01
+# tcpi_rtt, microseconds, follows 8 one byte fields and 15 four byte ones of the Linux struct tcp_info
+TCP_INFO_RTT = struct.Struct("=I")
+TCP_INFO_RTT_OFFSET = 68
+
+
+def fmt_addr(socket):
+    """(host, int(port)) --> "host:port" """
+    return "{}:{}".format(*socket)
+
+def try_close(connection):
+    try:
+        connection.close()
+    except:
+        pass
+
+
+def tune_socket(sock, profile):
+    """ Apply the socket options of a tunnel profile. An option the socket does not support is skipped
+        type profile: dict - one of PROFILES
+    """
+    is_tcp = sock.family in (socket.AF_INET, getattr(socket, "AF_INET6", None)) and sock.type == socket.SOCK_STREAM
+    options = []
+    if profile.get("sndbuf"):
+        options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, profile["sndbuf"]))
+    if profile.get("rcvbuf"):
+        options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, profile["rcvbuf"]))
+    if is_tcp:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, int(bool(profile.get("nodelay")))))
+        if profile.get("keepalive"):
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            for name, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                                ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+                if hasattr(socket, name):
+                    options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    for level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except (OSError, socket.error) as e:
+            logging.debug("unable to set a socket option {}: {}".format(option, e))
+
+
+def get_profile(name):
+    """ Returns the socket options of a tunnel profile, None for the OS defaults
+        rtype: dict
+    """
+    if not name:
+        return None
+    if name not in PROFILES:
+        logging.warning("unknown tunnel profile {}, the OS defaults are used".format(name))
+    return PROFILES.get(name)
+
+
+def tcp_rtt(sock):
+    """ The smoothed round trip time of a TCP socket, as the OS measured it
+        rtype: float - seconds, or None if it is unknown
+    """
+    if not hasattr(socket, "TCP_INFO") or sock.family not in (socket.AF_INET, getattr(socket, "AF_INET6", None)):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size)
+        return TCP_INFO_RTT.unpack_from(info, TCP_INFO_RTT_OFFSET)[0] / 1000000.0 or None
+    except (OSError, socket.error, struct.error):
+        return None
+
+
+class TrafficStats(object):
+    """ Traffic counters of a pair, or summed ones of a bridge
+    """
+    __slots__ = ("bytes_in", "bytes_out", "recv_calls", "send_calls", "latency")
+
+    def __init__(self):
+        self.bytes_in = 0  # bytes received from the sockets
+        self.bytes_out = 0  # bytes sent into the sockets
+        self.recv_calls = 0
+        self.send_calls = 0
+        self.latency = [0] * LATENCY_BUCKETS  # how long the data stays in the bridge, log2 of microseconds
+
+    def record_latency(self, seconds):
+        self.latency[min(int(seconds * 1000000).bit_length(), LATENCY_BUCKETS - 1)] += 1
+
+    def add(self, other):
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.recv_calls += other.recv_calls
+        self.send_calls += other.send_calls
+        self.latency = [a + b for a, b in zip(self.latency, other.latency)]
+
+    def as_dict(self):
+        return {"bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                "recv_calls": self.recv_calls, "send_calls": self.send_calls,
+                "latency_us_log2": list(self.latency)}
+
+
+def merge_stats(a, b):
+    """ Sum two stats dicts, as returned by get_stats() of the bridges
+        rtype: dict
+    """
+    ret = dict(a)
+    for key, value in b.items():
+        if key not in ret:
+            ret[key] = value
+        elif isinstance(value, list):
+            ret[key] = [x + y for x, y in zip(ret[key], value)]
+        elif isinstance(value, (int, float)):
+            ret[key] = ret[key] + value
+    return ret
+
+
+class TokenBucket(object):
+    """ Limits the traffic rate. Tokens (bytes) come with the rate, up to the burst size,
+        and every byte received spends one. Touched by the reactor thread only
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated", "round")
+
+    def __init__(self, rate, burst = None):
+        self.rate = float(rate)  # bytes per second
+        self.burst = burst or max(self.rate * RATE_BURST_SEC, RECV_BUFFER_SIZE)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.round = 0  # when the readers throttled by the bucket are resumed
+
+    def available(self, now):
+        """ Bytes which may be received right now
+            rtype: float
+        """
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens
+
+    def consume(self, count):
+        self.tokens -= count
+
+    def delay(self, count, now):
+        """ Seconds till the bucket has count bytes to spend
+        """
+        return max(0, (min(count, self.burst) - self.available(now)) / self.rate)
+
+    def resume_at(self, now):
+        """ Returns when the readers throttled by the bucket are resumed. They are all resumed at once,
+            so the fair order decides who takes the tokens
+        """
+        if self.round <= now:
+            self.round = now + max(THROTTLE_MIN_DELAY, self.delay(THROTTLE_RESUME_BYTES, now))
+        return self.round
+
+
+_device_buckets = {}
+_device_buckets_lock = threading.Lock()
+
+
+def device_bucket(device_id, rate):
+    """ Returns the token bucket shared by all the bridges of a device in this process.
+        The rate of an existing bucket is updated, so the last opened tunnel sets it
+        rtype: TokenBucket
+    """
+    with _device_buckets_lock:
+        bucket = _device_buckets.get(device_id)
+        if bucket is None:
+            bucket = _device_buckets[device_id] = TokenBucket(rate)
+        elif bucket.rate != rate:
+            bucket.rate = float(rate)
+            bucket.burst = max(bucket.rate * RATE_BURST_SEC, RECV_BUFFER_SIZE)
+        return bucket
+
+
+class BufferPool(object):
+    """ Preallocated bytearray slabs the bridge receives the data into with recv_into().
+        Slabs come back to the pool once their data is sent, so the hot loop does not allocate
+    """
+    __slots__ = ("slab_size", "max_free", "free", "allocated", "misses")
+
+    def __init__(self, slab_size = RECV_BUFFER_SIZE, max_free = POOL_MAX_FREE_SLABS):
+        self.slab_size = slab_size
+        self.max_free = max_free  # slabs above this number are given back to the allocator
+        self.free = []
+        self.allocated = 0
+        self.misses = 0  # slabs allocated for no free one in the pool
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        self.allocated += 1
+        self.misses += 1
+        return bytearray(self.slab_size)
+
+    def release(self, slab):
+        if len(self.free) < self.max_free:
+            self.free.append(slab)
+        else:
+            self.allocated -= 1
+
+    def stats(self):
+        """ Returns the pool occupancy
+            rtype: dict
+        """
+        return {"slab_size": self.slab_size, "allocated": self.allocated,
+                "in_use": self.allocated - len(self.free), "free": len(self.free), "misses": self.misses}
+
+
+class SendBuffer(object):
+    """ Data received from one socket of a pair and not sent into another one yet.
+        Each chunk is a [slab, start, end, received at] region of a pool slab, so a partial send just moves the start,
+        and the next recv continues to fill the last slab while it has room.
+        The latency of a chunk is measured from its first recv till its last byte is sent
+    """
+    __slots__ = ("pool", "chunks", "size")
+
+    capacity = float("inf")
+
+    # do not receive into the rest of the last slab if it is smaller than that
+    MIN_SLAB_ROOM = 2 ** 10
+
+    def __init__(self, pool):
+        self.pool = pool  # type: BufferPool
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def fill_from(self, sock, limit = RECV_BUFFER_SIZE):
+        """ Receive up to limit bytes of the socket
+            rtype: int - bytes received, 0 if the socket is closed by remote
+        """
+        chunks = self.chunks
+        total = 0
+        now = None
+        while total < limit:
+            chunk = chunks[-1] if chunks else None
+            if chunk is None or len(chunk[0]) - chunk[2] < self.MIN_SLAB_ROOM:
+                chunk = None
+                slab = self.pool.acquire()
+                start = 0
+            else:
+                slab = chunk[0]
+                start = chunk[2]
+            requested = min(len(slab) - start, limit - total)
+            try:
+                received = sock.recv_into(memoryview(slab)[start:start + requested])
+            except Exception:
+                if chunk is None:
+                    self.pool.release(slab)
+                if total:
+                    break
+                raise
+            if not received:
+                if chunk is None:
+                    self.pool.release(slab)
+                break
+            if chunk is None:
+                if now is None:
+                    now = monotonic()
+                chunks.append([slab, 0, received, now])
+            else:
+                chunk[2] += received
+            total += received
+            # a short read means the socket is drained. But an SSL socket may hold already decrypted data,
+            # which select() will never report
+            if received < requested and not (getattr(sock, "pending", None) and sock.pending()):
+                break
+        self.size += total
+        return total
+
+    def send_to(self, sock, stats):
+        """ Send as much as the socket accepts without blocking
+            type stats: TrafficStats
+            rtype: int - bytes sent
+        """
+        total = 0
+        chunks = self.chunks
+        while chunks:
+            chunk = chunks[0]
+            slab, start, end, received_at = chunk
+            stats.send_calls += 1
+            try:
+                sent = sock.send(memoryview(slab)[start:end])
+            except (BlockingIOError, InterruptedError):
+                break
+            except Exception as e:
+                if _is_want_io(e):
+                    break
+                raise
+            total += sent
+            if start + sent < end:
+                chunk[1] = start + sent
+                break
+            chunks.popleft()
+            self.pool.release(slab)
+            stats.record_latency(monotonic() - received_at)
+        self.size -= total
+        stats.bytes_out += total
+        return total
+
+    def clear(self):
+        while self.chunks:
+            self.pool.release(self.chunks.popleft()[0])
+        self.size = 0
+
+
+class PipeBuffer(object):
+    """ The same as SendBuffer, but the data is moved socket -> pipe -> socket with splice(),
+        so it is never copied to userspace. Works only for plain (not SSL) sockets on Linux
+    """
+    __slots__ = ("r", "w", "size", "capacity", "since")
+
+    FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+
+    def __init__(self, capacity = HIGH_WATERMARK):
+        self.r, self.w = os.pipe()
+        self.size = 0
+        self.since = 0  # when the pipe became non empty, the latency is measured till it is drained
+        self.capacity = 2 ** 16  # the default pipe size
+        try:
+            os.set_blocking(self.r, False)
+            os.set_blocking(self.w, False)
+            if fcntl and hasattr(fcntl, "F_SETPIPE_SZ"):
+                self.capacity = fcntl.fcntl(self.w, fcntl.F_SETPIPE_SZ, capacity)
+        except OSError:
+            pass # keep the default size
+
+    @staticmethod
+    def supports(sock):
+        return SPLICE_ENABLED and type(sock) is socket.socket and sock.type == socket.SOCK_STREAM
+
+    def fill_from(self, sock, limit = RECV_BUFFER_SIZE):
+        if self.size >= self.capacity:
+            raise BlockingIOError()
+        received = os.splice(sock.fileno(), self.w, min(self.capacity - self.size, limit), flags = self.FLAGS)
+        if not self.size:
+            self.since = monotonic()
+        self.size += received
+        return received
+
+    def send_to(self, sock, stats):
+        total = 0
+        while self.size:
+            stats.send_calls += 1
+            try:
+                sent = os.splice(self.r, sock.fileno(), self.size, flags = self.FLAGS)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not sent:
+                break
+            self.size -= sent
+            total += sent
+        if total and not self.size:
+            stats.record_latency(monotonic() - self.since)
+        stats.bytes_out += total
+        return total
+
+    def clear(self):
+        self.size = 0
+        for fd in (self.r, self.w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.r = self.w = -1
+
+
+class _Endpoint(object):
+    """ One socket of a pair together with the data waiting to be sent into it
+    """
+    __slots__ = ("sock", "bridge", "pair", "peer", "buff", "events", "paused", "throttled", "eof", "read_size")
+
+    def __init__(self, sock, bridge, buff):
+        self.sock = sock
+        self.bridge = bridge  # type: SocketBridge
+        self.pair = None  # type: _Pair
+        self.peer = None  # type: _Endpoint
+        self.buff = buff  # type: SendBuffer or PipeBuffer
+        self.events = 0  # events the socket is currently watched for
+        self.paused = False  # reading is paused because the peer has too much data not sent yet
+        self.throttled = False  # reading is paused till the rate limits of the bridge let it go
+        self.eof = False  # the socket is closed by remote, the pair lives till the peer gets all the data
+        self.read_size = RECV_BUFFER_SIZE  # bytes read per loop pass, before the bridge weight
+
+
+class _PairBase(TrafficStats):
+    """ The traffic counters of a pair of any engine.
+        The pair is a timer wheel entry, expiring when it is idle or too old
+    """
+    __slots__ = ("bridge", "created", "last_active", "deadline", "wheel_slot")
+
+    def __init__(self, bridge, now):
+        TrafficStats.__init__(self)
+        self.bridge = bridge
+        self.created = now
+        self.last_active = now  # the last time something was received, monotonic
+        self.deadline = None
+        self.wheel_slot = None
+
+    def get_deadline(self):
+        deadline = self.last_active + self.bridge.timeout_sec
+        if self.bridge.max_lifetime:
+            deadline = min(deadline, self.created + self.bridge.max_lifetime)
+        return deadline
+
+
+class _Pair(_PairBase):
+    """ Two linked endpoints and their traffic counters
+    """
+    __slots__ = ("ep1", "ep2", "vtime", "sampled", "sampled_bytes")
+
+    def __init__(self, ep1, ep2, now):
+        _PairBase.__init__(self, ep1.bridge, now)
+        self.ep1 = ep1
+        self.ep2 = ep2
+        self.vtime = 0  # bytes received divided by the bridge weight, the fair scheduling virtual time
+        self.sampled = now  # when the throughput of an adaptive pair was measured last time
+        self.sampled_bytes = 0
+
+
+class _ReactorBase(object):
+    """ What the engines keep the same way: the deadlines of the pairs and of the empty bridges on a timer wheel,
+        the counters of the closed pairs, and the bridge stats. All of it is touched by the loop thread only.
+        An engine provides call_soon(), and _buffered(), _close_pair(), _close_bridge() and _fire() for its pairs
+    """
+
+    def __init__(self):
+        self.timers = TimerWheel()  # idle deadlines of pairs, and of started bridges having no pairs
+        self._thread = None
+
+    def run_in_loop(self, fn, *args):
+        """ Run the function in the loop thread and wait for its result
+        """
+        if threading.current_thread() is self._thread:
+            return fn(*args)
+        done = threading.Event()
+        result = []
+        def call():
+            try:
+                result.append(fn(*args))
+            finally:
+                done.set()
+        self.call_soon(call)
+        done.wait(CALL_TIMEOUT)
+        return result[0] if result else None
+
+    def _bridge_stats(self, bridge):
+        stats = TrafficStats()
+        stats.add(bridge.closed_stats)
+        buffered = 0
+        for pair in bridge.pairs:
+            stats.add(pair)
+            buffered += self._buffered(pair)
+        ret = stats.as_dict()
+        ret["pairs"] = len(bridge.pairs)
+        ret["pairs_total"] = len(bridge.pairs) + bridge.closed_pairs_count
+        ret["buffered"] = buffered
+        return ret
+
+    def _expire(self, now):
+        """ Close the pairs and the bridges which deadlines are reached. Activity does not touch the wheel,
+            so the deadline of a pair is checked again here and the timer is moved if the pair was active meanwhile
+        """
+        for timer in self.timers.advance(now):
+            if isinstance(timer, _PairBase):
+                deadline = timer.get_deadline()
+                if deadline > now:
+                    self.timers.schedule(timer, deadline)
+                    continue
+                logging.debug("pair timeout reached")
+                self._close_pair(timer)
+            elif timer.work and not timer.pairs:
+                logging.info("bridge timeout reached")
+                timer.work = False
+                self._close_bridge(timer)
+                if timer.callback:
+                    self._fire(timer.callback)
+
+    def _pair_added(self, pair):
+        bridge = pair.bridge
+        bridge.pairs.add(pair)
+        self.timers.schedule(pair, pair.get_deadline())
+        self.timers.cancel(bridge)
+
+    def _pair_closed(self, pair):
+        bridge = pair.bridge
+        if pair in bridge.pairs:
+            bridge.pairs.discard(pair)
+            bridge.closed_stats.add(pair)
+            bridge.closed_pairs_count += 1
+            self.timers.cancel(pair)
+            if bridge.work and bridge.watched and not bridge.pairs:
+                self.timers.schedule(bridge, monotonic() + bridge.timeout_sec)
+
+    def _watch_timeout(self, bridge):
+        """ Close the bridge when it has no pairs for its timeout
+        """
+        bridge.watched = True
+        if bridge.work and not bridge.pairs:
+            self.timers.schedule(bridge, monotonic() + bridge.timeout_sec)
+
+
+class BridgeReactor(_ReactorBase):
+    """ A single event loop relaying data of all SocketBridges of the process.
+        SocketBridges only group pairs of a tunnel, so the thread count does not grow with the tunnels count.
+        All the state is touched by the loop thread only, other threads pass their requests via call_soon()
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """ Returns the process-wide reactor, starts it on first use
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start_as_daemon()
+            return cls._instance
+
+    def __init__(self):
+        _ReactorBase.__init__(self)
+        self.endpoints = {}  # holds an endpoint of every socket in the reactor
+        self.pool = BufferPool()  # slabs the data is received into
+        self.now = monotonic()  # the time of the current loop pass
+        self.vclock = 0  # the virtual time of the last served pair, new and idle pairs start from it
+        self._throttled = []  # a heap of (resume time, sequence, endpoint) of the rate limited readers
+        self._throttle_seq = 0
+        self._calls = collections.deque()  # requests from other threads
+        self._callbacks = queue.Queue()  # terminate callbacks, they are fired out of the loop thread
+        # a socket pair to wake up the loop when other threads put requests
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_r.setblocking(False)
+        self._waker_w.setblocking(False)
+        if selectors:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self._waker_r, EVENT_READ)
+        else:
+            self.selector = None
+
+    def start_as_daemon(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.start, name="socketBridge")
+            self._thread.daemon = True
+            self._thread.start()
+            t = threading.Thread(target=self._fire_callbacks, name="socketBridge callbacks")
+            t.daemon = True
+            t.start()
+            logging.info("BridgeReactor daemon started")
+        return self._thread
+
+    def start(self):
+        while True:
+            try:
+                self._start()
+            except:
+                logging.error("FATAL ERROR! BridgeReactor failed {}".format(
+                    traceback.format_exc()
+                ))
+
+    def call_soon(self, fn, *args):
+        """ Run the function in the loop thread
+        """
+        self._calls.append((fn, args))
+        self._wakeup()
+
+    def get_stats(self):
+        """ Returns the reactor state: sockets count and the buffer pool occupancy
+            rtype: dict
+        """
+        return self.run_in_loop(self._reactor_stats) or {}
+
+    def _reactor_stats(self):
+        return {"sockets": len(self.endpoints), "pool": self.pool.stats()}
+
+    def _buffered(self, pair):
+        return pair.ep1.buff.size + pair.ep2.buff.size
+
+    def _start(self):
+        while True:
+            while self._calls:
+                fn, args = self._calls.popleft()
+                fn(*args)
+
+            self.now = monotonic()
+            self._expire(self.now)
+            wait = self.timers.next_tick(self.now)
+            if self._throttled:
+                self._resume_throttled()
+                if self._throttled:
+                    resume_in = max(0, self._throttled[0][0] - self.now)
+                    wait = resume_in if wait is None else min(wait, resume_in)
+
+            # blocks until there is socket(s) ready for .recv or a socket with pending data is ready for .send,
+            # or until the next timer tick
+            # notice: sockets which were closed by remote,
+            #   are also regarded as read-ready by select()
+            if self.selector:
+                events = self.selector.select(wait)
+                eps_rd = tuple(key.data for key, mask in events if mask & EVENT_READ)
+                eps_wr = tuple(key.data for key, mask in events if mask & EVENT_WRITE)
+            else:
+                r, w, e = select.select(
+                    [self._waker_r] + [ep.sock for ep in self.endpoints.values() if ep.events & EVENT_READ],
+                    [ep.sock for ep in self.endpoints.values() if ep.events & EVENT_WRITE], [], wait)
+                eps_rd = tuple(self.endpoints.get(s) for s in r)
+                eps_wr = tuple(self.endpoints.get(s) for s in w)
+            self.now = monotonic()
+
+            # ----------------- SENDING ----------------
+            # flush pending data first, so the readers paused by it may be resumed
+            for ep in eps_wr:
+                if ep and ep.sock in self.endpoints:
+                    self._flush(ep)
+
+            # ----------------- RECEIVING ----------------
+            # pairs which received less (for their weight) go first, so a bulk transfer
+            # can not take the rate limits of its tunnel or device from the interactive ones
+            if len(eps_rd) > 1:
+                eps_rd = sorted(eps_rd, key = _fair_order)
+            # the waker (None) is not a pair
+            first = next((ep for ep in eps_rd if ep is not None), None)
+            if first:
+                # the virtual time follows the least served of the busy pairs
+                self.vclock = max(self.vclock, first.pair.vtime)
+            for ep in eps_rd:
+                if ep is None:
+                    self._drain_waker()
+                    continue
+                # the socket (or its pair) may be terminated or paused while handling previous events
+                if ep.sock not in self.endpoints or ep.paused or ep.throttled:
+                    continue
+                self._forward(ep)
+
+    def _resume_throttled(self):
+        """ Readers throttled by the same bucket are resumed together, and are read right away in the fair order,
+            so the one which received less for its weight takes the tokens first
+        """
+        throttled = self._throttled
+        resumed = []
+        while throttled and throttled[0][0] <= self.now:
+            ep = heapq.heappop(throttled)[2]
+            ep.throttled = False
+            if ep.sock in self.endpoints:
+                resumed.append(ep)
+        for ep in sorted(resumed, key = _fair_order):
+            if ep.sock in self.endpoints and not ep.paused and not ep.throttled:
+                self._update_events(ep)
+                self._forward(ep)
+
+    def _throttle(self, ep, resume_at):
+        """ Stop reading the socket till the resume_at time, its bridge or device rate limit is reached
+        """
+        ep.throttled = True
+        self._throttle_seq += 1
+        heapq.heappush(self._throttled, (resume_at, self._throttle_seq, ep))
+        self._update_events(ep)
+
+    def _close_pair(self, pair):
+        self._terminate(pair.ep1)
+
+    def _fire(self, callback):
+        self._callbacks.put(callback)
+
+    def _fire_callbacks(self):
+        """ Terminate callbacks may block (e.g. they notify the other side), so they are called
+            from a dedicated thread, not to stall the loop
+        """
+        while True:
+            callback = self._callbacks.get()
+            try:
+                callback()
+            except:
+                logging.error("SocketBridge callback failed {}".format(traceback.format_exc()))
+
+    def _add_pair(self, bridge, conn1, conn2):
+        if not bridge.work:
+            # the bridge has been closed before the pair came to the loop
+            try_close(conn1)
+            try_close(conn2)
+            return
+
+        # record sockets pairs
+        ep1 = _Endpoint(conn1, bridge, self._create_buffer(bridge, conn1, conn2))
+        ep2 = _Endpoint(conn2, bridge, self._create_buffer(bridge, conn2, conn1))
+        ep1.peer = ep2
+        ep2.peer = ep1
+        pair = _Pair(ep1, ep2, monotonic())
+        ep1.pair = ep2.pair = pair
+        self.endpoints[conn1] = ep1
+        self.endpoints[conn2] = ep2
+        self._pair_added(pair)
+
+        # mark as readable only, a write interest is added just when there is something to send
+        self._update_events(ep1)
+        self._update_events(ep2)
+
+        logging.debug("New pair added. Total {} pairs in bridge".format(len(bridge.pairs)))
+
+    def _create_buffer(self, bridge, sock, peer_sock):
+        """ Splice the pair when both of its sockets allow it, or copy the data through userspace
+        """
+        if bridge.zero_copy and PipeBuffer.supports(sock) and PipeBuffer.supports(peer_sock):
+            try:
+                return PipeBuffer(bridge.high_watermark)
+            except OSError as e:
+                logging.warning("unable to create a pipe for splice: {}".format(e))
+        return SendBuffer(self.pool)
+
+    def _close_bridge(self, bridge):
+        self.timers.cancel(bridge)
+        for pair in list(bridge.pairs):
+            self._terminate(pair.ep1)
+
+    def _forward(self, ep):
+        """ Read from a socket and pass the data to its pair right away
+        """
+        s = ep.sock
+        bridge = ep.bridge
+        limit = max(int(ep.read_size * bridge.weight), 1)
+        if bridge.buckets:
+            allowed = int(min(b.available(self.now) for b in bridge.buckets))
+            # do not read a few bytes every loop pass, wait till the tokens come in bulk
+            if allowed < min(THROTTLE_RESUME_BYTES, limit):
+                self._throttle(ep, max(b.resume_at(self.now) for b in bridge.buckets))
+                return
+            limit = min(limit, allowed)
+        try:
+            received = ep.peer.buff.fill_from(s, limit)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            if _is_want_io(e):
+                return
+            # unable to read, in most cases, it's due to socket close
+            logging.warning('error reading socket %s, %s closing', repr(e), s)
+            self._terminate(ep)
+            return
+
+        if not received:
+            if ep.peer.buff.size:
+                # deliver what is left before closing the pair
+                ep.eof = ep.paused = True
+                self._update_events(ep)
+            else:
+                self._terminate(ep)
+            return
+
+        pair = ep.pair
+        # a pair idle for a while does not get credit for the time it did not use
+        if self.now - pair.last_active > FAIR_IDLE_SEC:
+            pair.vtime = max(pair.vtime, self.vclock)
+        pair.vtime += received / bridge.weight
+        pair.last_active = self.now # Reset the idle timer
+        pair.bytes_in += received
+        pair.recv_calls += 1
+        for b in bridge.buckets:
+            b.consume(received)
+        if bridge.adaptive and self.now - pair.sampled >= ADAPT_PERIOD:
+            self._adapt_read_size(pair, bridge)
+        self._flush(ep.peer)
+
+    def _adapt_read_size(self, pair, bridge):
+        """ Read as much per loop pass, as the pair path holds: the bandwidth-delay product
+        """
+        throughput = (pair.bytes_in - pair.sampled_bytes) / (self.now - pair.sampled)
+        rtt = max(tcp_rtt(pair.ep1.sock) or 0, tcp_rtt(pair.ep2.sock) or 0) or ASSUMED_RTT
+        size = min(max(int(throughput * rtt), ADAPTIVE_MIN_READ), ADAPTIVE_MAX_READ, bridge.high_watermark)
+        pair.ep1.read_size = pair.ep2.read_size = size
+        pair.sampled = self.now
+        pair.sampled_bytes = pair.bytes_in
+
+    def _flush(self, ep):
+        """ Send pending data of the socket. What could not be sent is kept till the socket becomes writable
+        """
+        try:
+            ep.buff.send_to(ep.sock, ep.pair)
+        except Exception as e:
+            # unable to send, close connection
+            logging.warning('error sending socket %s, %s closing', repr(e), ep.sock)
+            self._terminate(ep)
+            return
+
+        # stop reading from the pair while this socket is too slow to accept its data
+        reader = ep.peer
+        if reader.eof:
+            if not ep.buff.size:
+                self._terminate(reader)
+                return
+        else:
+            high = min(ep.bridge.high_watermark, ep.buff.capacity)
+            if reader.paused:
+                reader.paused = ep.buff.size > min(ep.bridge.low_watermark, high // 2)
+            else:
+                reader.paused = ep.buff.size >= high
+        self._update_events(ep)
+        self._update_events(reader)
+
+    def _update_events(self, ep):
+        """ Watch the socket for reading unless it is paused,
+            and for writing only while it has non-sent data
+        """
+        events = 0
+        if not ep.paused and not ep.throttled:
+            events |= EVENT_READ
+        if ep.buff.size:
+            events |= EVENT_WRITE
+        self._watch(ep, events)
+
+    def _watch(self, ep, events):
+        """ Change the events the socket is watched for. Zero means the socket is not watched at all
+        """
+        current = ep.events
+        if current == events:
+            return
+        ep.events = events
+        if not self.selector:
+            return
+        try:
+            if not current:
+                self.selector.register(ep.sock, events, ep)
+            elif events:
+                self.selector.modify(ep.sock, events, ep)
+            else:
+                self.selector.unregister(ep.sock)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def _wakeup(self):
+        try:
+            self._waker_w.send(b"\0")
+        except Exception:
+            pass # the waker is already full or closed, the loop will be woken anyway
+
+    def _drain_waker(self):
+        try:
+            while self._waker_r.recv(1024):
+                pass
+        except Exception:
+            pass
+
+    def _terminate(self, ep, once=False):
+        """terminate a sockets pair (two socket)
+        :type ep: _Endpoint
+        :param ep: any one of the sockets pair
+        """
+        logging.debug('terminate %s', ep.sock)
+        self._watch(ep, 0)
+        ep.throttled = False  # the throttled heap entry is dropped when due
+        try_close(ep.sock)  # close the first socket
+        ep.buff.clear()
+        self.endpoints.pop(ep.sock, None)
+
+        # terminate another
+        if not once and ep.peer.sock in self.endpoints:
+            self._terminate(ep.peer, True)
+
+        self._pair_closed(ep.pair)
+
+
+class _BridgeBase ():
+    """ The options and the pairs of a bridge, the same for the engines. See SocketBridge
+    """
+
+    def __init__ (self, terminate_callback, timeout, high_watermark, low_watermark, max_lifetime,
+                  rate_limit, device_id, device_rate_limit, weight, profile):
+        self.work = True
+        self.pairs = set()  # holds pairs of the bridge, touched by the reactor thread only
+        self.closed_stats = TrafficStats()  # summed counters of the pairs already closed
+        self.closed_pairs_count = 0
+        self.callback =  terminate_callback # holds callback
+        self.timeout_sec = timeout
+        self.max_lifetime = max_lifetime  # seconds, None - unlimited
+        self.watched = False  # the bridge is started, so it is closed when empty for timeout
+        self.deadline = None  # the bridge is a timer wheel entry too
+        self.wheel_slot = None
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.rate_limit = rate_limit  # bytes per second, None - unlimited
+        self.device_id = device_id
+        self.device_rate_limit = device_rate_limit  # bytes per second, shared by the bridges of the device
+        self.weight = max(float(weight or 1), 0.01)  # scales the bytes a pair may read per loop pass
+        self.profile_name = profile
+        self.profile = get_profile(profile)
+        self.adaptive = bool(self.profile and self.profile.get("adaptive"))  # adapt the read size to the throughput
+        self.buckets = []  # type: list[TokenBucket]
+        if rate_limit:
+            self.buckets.append(TokenBucket(rate_limit))
+        if device_rate_limit and device_id is not None:
+            self.buckets.append(device_bucket(device_id, device_rate_limit))
+
+
+class SocketBridge (_BridgeBase):
+    """ A group of socket pairs of one tunnel. The data is relayed by the shared BridgeReactor,
+        the bridge just holds the tunnel`s timeouts, watermarks and terminate callback.
+        A pair is closed when it has nothing to read for timeout seconds or lives longer than max_lifetime.
+        Once started, the bridge itself is closed (and the callback fired) when it has no pairs for timeout seconds.
+        The received traffic may be limited by rate_limit bytes per second for the bridge, and by device_rate_limit
+        shared by all the bridges having the same device_id. The weight sets the bridge share of a busy reactor.
+        The profile, one of PROFILES names, tunes the sockets of the pairs
+    """
+
+    def __init__ (self, terminate_callback = None, timeout = 60,
+                  high_watermark = HIGH_WATERMARK, low_watermark = LOW_WATERMARK, reactor = None,
+                  zero_copy = SPLICE_ENABLED, max_lifetime = None,
+                  rate_limit = None, device_id = None, device_rate_limit = None, weight = 1, profile = None):
+        _BridgeBase.__init__(self, terminate_callback, timeout, high_watermark, low_watermark, max_lifetime,
+                             rate_limit, device_id, device_rate_limit, weight, profile)
+        self.zero_copy = zero_copy  # splice the pairs of plain sockets
+        self.reactor = reactor or BridgeReactor.instance()
+
+    def add_pair (self, conn1, conn2):
+        """
+        transfer anything between two sockets
+        :type conn1: socket.socket
+        :type conn2: socket.socket
+        """
+        # change to non-blocking
+        # we use select or epoll to notice when data is ready
+        conn1.setblocking(False)
+        conn2.setblocking(False)
+        if self.profile:
+            tune_socket(conn1, self.profile)
+            tune_socket(conn2, self.profile)
+        self.reactor.call_soon(self.reactor._add_pair, self, conn1, conn2)
+
+    def start_as_daemon(self):
+        """ Start watching the bridge for the timeout. Kept for compatibility:
+            there is no thread per bridge anymore, the shared reactor thread is returned
+        """
+        self.start()
+        return self.reactor.start_as_daemon()
+
+    def start(self):
+        self.reactor.call_soon(self.reactor._watch_timeout, self)
+
+    def get_stats(self):
+        """ Returns the traffic counters of the bridge: summed ones of its pairs, both alive and closed
+            rtype: dict
+        """
+        return self.reactor.run_in_loop(self.reactor._bridge_stats, self) or {}
+
+    def close (self, from_outside = False):
+        """close the SocketBridge
+        """
+        self.work = False
+        self.reactor.call_soon(self.reactor._close_bridge, self)
+
+        # ------ callback --------
+        if not from_outside: # If bridge closed from outside - there is no use in callback
+            if self.callback: 
+                self.callback()
+
+
+def reactor_stats():
+    """ Returns the state of the process reactor, see BridgeReactor.get_stats()
+        rtype: dict or None if no bridge has started it
+    """
+    reactor = BridgeReactor._instance
+    return reactor.get_stats() if reactor else None
+
+
+def _fair_order(ep):
+    # the waker has no endpoint, it goes first
+    return ep.pair.vtime if ep else -1
+
+
+def _is_want_io(e):
+    """ Non-blocking SSL sockets raise SSLWantReadError/SSLWantWriteError when a record is incomplete
+    """
+    return type(e).__name__ in ("SSLWantReadError", "SSLWantWriteError")
+"""
+An asyncio implementation of the SocketBridge. The pairs are relayed by asyncio transports,
+which do the write buffering themselves, and the flow control is done with
+transport pause_reading() / resume_reading() driven by the peer's write buffer limits.
+Rate limits pause reading the same way, till the token buckets are refilled. The transports
+read whatever is ready, so the weights of the fair scheduling and the adaptive read size
+of the profiles are not applied here, the profile socket options are.
+The timeouts, the closed pairs counters and the stats are kept by the same code as in SocketBridge.
+asyncio refuses sockets already wrapped with ssl, so the SSL pairs of a bridge fall back to a SocketBridge.
+"""
+import ssl
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+
+_Protocol = asyncio.Protocol if asyncio else object
+
+
+class _RelayProtocol(_Protocol):
+    """ One socket of a pair. Writes everything it receives into the peer's transport
+    """
+
+    def __init__(self, bridge, pair):
+        self.bridge = bridge  # type: AsyncioBridge
+        self.pair = pair  # type: _AsyncioPair
+        self.transport = None
+        self.peer = None  # type: _RelayProtocol
+        self.closed = False
+        self.paused = False  # the peer is too slow to accept the data
+        self.throttled = False  # the rate limits of the bridge are reached
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # the peer's transport may be not ready yet, so nothing is read till the pair is linked
+        transport.pause_reading()
+        transport.set_write_buffer_limits(self.bridge.high_watermark, self.bridge.low_watermark)
+        self.bridge.protocols.add(self)
+
+    def data_received(self, data):
+        pair = self.pair
+        pair.last_active = monotonic() # Reset the idle timer
+        pair.bytes_in += len(data)
+        pair.recv_calls += 1
+        # the transport sends what it can right away and buffers the rest
+        self.peer.transport.write(data)
+        pair.bytes_out += len(data)
+        pair.send_calls += 1
+        buckets = self.bridge.buckets
+        if buckets:
+            now = monotonic()
+            for b in buckets:
+                b.consume(len(data))
+            if min(b.available(now) for b in buckets) < THROTTLE_RESUME_BYTES:
+                self.throttled = True
+                self.transport.pause_reading()
+                delay = max(max(b.resume_at(now) for b in buckets) - now, 0)
+                self.bridge.reactor.loop.call_later(delay, self._unthrottle)
+
+    def _unthrottle(self):
+        self.throttled = False
+        self._update_reading()
+
+    def _update_reading(self):
+        if self.closed:
+            return
+        if self.paused or self.throttled:
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        # the peer is closed once it gets all the data already written into it
+        self.peer.transport.close()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.bridge.protocols.discard(self)
+        if self.peer and self.peer.transport:
+            self.peer.transport.close()
+        if self.peer.closed:
+            self.bridge.reactor._pair_closed(self.pair)
+
+    # the peer is too slow to accept the data, stop reading till it catches up
+    def pause_writing(self):
+        self.peer.paused = True
+        self.peer._update_reading()
+
+    def resume_writing(self):
+        self.peer.paused = False
+        self.peer._update_reading()
+
+
+class _AsyncioPair(_PairBase):
+    """ Traffic counters and a timer wheel entry of a pair.
+        The transports buffer the data themselves, so bytes_out counts the data given to them,
+        and the latency histogram is not collected
+    """
+    __slots__ = ("p1", "p2")
+
+    def __init__(self, bridge):
+        _PairBase.__init__(self, bridge, monotonic())
+        self.p1 = self.p2 = None  # type: _RelayProtocol
+
+
+class AsyncioReactor(_ReactorBase):
+    """ A process-wide asyncio event loop running in its own thread, which relays all AsyncioBridges
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        if asyncio is None:
+            raise Exception("asyncio is not available")
+        _ReactorBase.__init__(self)
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="asyncioBridge")
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info("AsyncioReactor daemon started")
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._tick)
+        while True:
+            try:
+                self.loop.run_forever()
+            except:
+                logging.error("FATAL ERROR! AsyncioReactor failed {}".format(
+                    traceback.format_exc()
+                ))
+
+    def call_soon(self, fn, *args):
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def _buffered(self, pair):
+        return sum(p.transport.get_write_buffer_size() for p in (pair.p1, pair.p2) if not p.closed)
+
+    def _tick(self):
+        self._expire(monotonic())
+        self.loop.call_later(self.timers.tick, self._tick)
+
+    def _close_pair(self, pair):
+        pair.p1.transport.abort()
+
+    def _fire(self, callback):
+        # the callback may block, so it is fired out of the loop thread
+        self.loop.run_in_executor(None, callback)
+
+    def _add_pair(self, bridge, conn1, conn2):
+        if not bridge.work:
+            try_close(conn1)
+            try_close(conn2)
+            return
+        pair = _AsyncioPair(bridge)
+        p1 = pair.p1 = _RelayProtocol(bridge, pair)
+        p2 = pair.p2 = _RelayProtocol(bridge, pair)
+        p1.peer = p2
+        p2.peer = p1
+        futures = [self.loop.create_task(self.loop.create_connection(lambda: p1, sock = conn1)),
+                   self.loop.create_task(self.loop.create_connection(lambda: p2, sock = conn2))]
+        for f in futures:
+            f.add_done_callback(lambda f: self._link_pair(bridge, p1, p2, conn1, conn2, futures))
+
+    def _link_pair(self, bridge, p1, p2, conn1, conn2, futures):
+        """ Let the pair go, when both its transports are made
+        """
+        if not all(f.done() for f in futures):
+            return
+        errors = [f.exception() for f in futures if f.exception()]
+        if errors or not bridge.work:
+            if errors:
+                logging.warning("unable to add a pair to the asyncio bridge: {}".format(errors[0]))
+            for p, conn in ((p1, conn1), (p2, conn2)):
+                if p.transport:
+                    p.transport.close()
+                else:
+                    try_close(conn)
+            return
+        self._pair_added(p1.pair)
+        p1._update_reading()
+        p2._update_reading()
+        logging.debug("New pair added. Total {} pairs in bridge".format(len(bridge.pairs)))
+
+    def _close_bridge(self, bridge):
+        self.timers.cancel(bridge)
+        for p in list(bridge.protocols):
+            p.transport.abort()
+
+
+class AsyncioBridge (_BridgeBase):
+    """ The same contract as SocketBridge: add_pair, start_as_daemon, close and terminate callback.
+        asyncio refuses sockets already wrapped with ssl, so SSL pairs are relayed by a local SocketBridge
+        of the selector engine, the bridge stats sum both
+    """
+
+    def __init__ (self, terminate_callback = None, timeout = 60,
+                  high_watermark = HIGH_WATERMARK, low_watermark = LOW_WATERMARK, reactor = None,
+                  max_lifetime = None, rate_limit = None, device_id = None, device_rate_limit = None, weight = 1,
+                  profile = None):
+        _BridgeBase.__init__(self, terminate_callback, timeout, high_watermark, low_watermark, max_lifetime,
+                             rate_limit, device_id, device_rate_limit, weight, profile)
+        self.protocols = set()  # holds protocols of the bridge sockets, touched by the loop thread only
+        self.reactor = reactor or AsyncioReactor.instance()
+        self._local = None  # type: SocketBridge
+        self._started = False
+        self._uses_loop = False  # a plain pair has been added, so the loop watches the bridge timeout
+
+    def add_pair (self, conn1, conn2):
+        """
+        transfer anything between two sockets
+        :type conn1: socket.socket
+        :type conn2: socket.socket
+        """
+        if isinstance(conn1, ssl.SSLSocket) or isinstance(conn2, ssl.SSLSocket):
+            self._get_local().add_pair(conn1, conn2)
+            return
+        conn1.setblocking(False)
+        conn2.setblocking(False)
+        if self.profile:
+            tune_socket(conn1, self.profile)
+            tune_socket(conn2, self.profile)
+        if not self._uses_loop:
+            self._uses_loop = True
+            if self._started:
+                self.reactor.call_soon(self.reactor._watch_timeout, self)
+        self.reactor.call_soon(self.reactor._add_pair, self, conn1, conn2)
+
+    def start_as_daemon(self):
+        self.start()
+
+    def start(self):
+        self._started = True
+        if self._uses_loop:
+            self.reactor.call_soon(self.reactor._watch_timeout, self)
+        if self._local:
+            self._local.start()
+
+    def get_stats(self):
+        """ Returns the traffic counters of the bridge, see SocketBridge.get_stats()
+            rtype: dict
+        """
+        stats = {}
+        if self._uses_loop:
+            stats = self.reactor.run_in_loop(self.reactor._bridge_stats, self) or {}
+        if self._local:
+            stats = merge_stats(stats, self._local.get_stats())
+        return stats
+
+    def close (self, from_outside = False):
+        """close the bridge
+        """
+        self.work = False
+        self.reactor.call_soon(self.reactor._close_bridge, self)
+        if self._local:
+            self._local.close(True)
+
+        # ------ callback --------
+        if not from_outside: # If bridge closed from outside - there is no use in callback
+            if self.callback:
+                self.callback()
+
+    def _get_local(self):
+        if self._local is None:
+            logging.info("asyncio can not relay SSL sockets, SSL pairs of the bridge are relayed by the selector engine")
+            self._local = SocketBridge(self._on_local_timeout, self.timeout_sec,
+                                       self.high_watermark, self.low_watermark, max_lifetime = self.max_lifetime,
+                                       rate_limit = self.rate_limit, device_id = self.device_id,
+                                       device_rate_limit = self.device_rate_limit, weight = self.weight,
+                                       profile = self.profile_name)
+            if self._started:
+                self._local.start()
+        return self._local
+
+    def _on_local_timeout(self):
+        if self.work:
+            self.close()
+"""
+Tunnel streams multiplexed over the control connection. A new customer of a tunnel costs
+a stream open message instead of a new connection from the device back to the server.
+Every stream has a credit based flow control: a side sends no more than the other side
+has granted with window updates, so a slow stream never blocks the others, and no side
+buffers more than its window. Streams with a higher priority are read first.
+The messages are queued for a writer thread, so a slow control connection never stalls the stream sockets;
+the streams are not read while too much data is queued.
+"""
+
+
+# bytes a side is ready to receive on a stream, before the data is delivered to its socket
+MUX_WINDOW = 2 ** 18
+# the biggest data message, so streams take turns on the control connection
+MUX_MAX_DATA = 2 ** 14
+# stream data queued for the control connection, the streams are not read above it till a half of it is sent
+MUX_MAX_QUEUED = 2 ** 20
+
+
+class MuxStream(TrafficStats):
+    """ A stream and the socket it is relayed to: a socket pair end bridged to a customer on the server,
+        or the connection to the tunnel target on the slaver
+    """
+    __slots__ = ("id", "tunnel_id", "priority", "sock", "credit", "pending", "pending_size",
+                 "consumed", "granted", "events", "eof")
+
+    def __init__(self, stream_id, tunnel_id, priority = 0, credit = 0):
+        TrafficStats.__init__(self)
+        self.id = stream_id
+        self.tunnel_id = tunnel_id
+        self.priority = priority  # higher is read first
+        self.sock = None  # type: socket.socket
+        self.credit = credit  # bytes the other side is ready to receive
+        self.pending = collections.deque()  # data received from the other side, not written into the socket yet
+        self.pending_size = 0
+        self.consumed = 0  # bytes written into the socket, not granted back to the other side yet
+        self.granted = 0  # bytes the other side may send, it never gets more than the window
+        self.events = 0
+        self.eof = False  # the other side has closed the stream, it is closed once the pending data is written
+
+
+class Multiplexer ():
+    """ Relays the streams of one control connection. The socket I/O is done by the multiplexer thread,
+        the connection reader passes the stream messages with feed(), and the writer thread sends the messages
+        into the control connection
+    """
+
+    def __init__(self, send, on_open = None, window = MUX_WINDOW):
+        """ type send: callable(ControlMessage) - sends into the control connection, atomically for a message.
+                            It is called by the writer thread only, and may block
+            type on_open: callable(Multiplexer, MuxStream) - the other side opened a stream,
+                            attach() a socket to it, or close_stream() it
+        """
+        self.work = True
+        self.window = window
+        self._send = send
+        self._on_open = on_open
+        self._streams = {}  # stream_id -> MuxStream, touched by the multiplexer thread only
+        self._next_id = 0
+        self._id_lock = threading.Lock()
+        self._outgoing = collections.deque()  # (message, data size) not sent yet
+        self._outgoing_size = 0
+        self._outgoing_ready = threading.Condition()  # guards the outgoing queue
+        self._blocked = False  # too much data is queued, the streams are not read
+        self._calls = collections.deque()
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_r.setblocking(False)
+        self._waker_w.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._waker_r, EVENT_READ)
+        self._thread = threading.Thread(target=self._run, name="mux")
+        self._thread.daemon = True
+        self._thread.start()
+        self._writer = threading.Thread(target=self._write, name="mux writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def open_stream(self, tunnel_id, sock, priority = 0):
+        """ Open a stream of the tunnel and relay the socket to it. The data is sent once the other side accepts
+            rtype: int - the stream id
+        """
+        with self._id_lock:
+            self._next_id = self._next_id % 0xFFFFFFFF + 1
+            stream_id = self._next_id
+        stream = MuxStream(stream_id, tunnel_id, priority)
+        stream.granted = self.window
+        sock.setblocking(False)
+        stream.sock = sock
+        # registered before the message is sent, so the accepting window update always finds the stream
+        self._call_soon(self._add_stream, stream)
+        self._post(StreamOpenMessage(stream_id, tunnel_id, priority, self.window))
+        return stream_id
+
+    def attach(self, stream_id, sock):
+        """ Relay the socket to a stream opened by the other side, and accept the stream
+        """
+        sock.setblocking(False)
+        self._call_soon(self._attach, stream_id, sock)
+
+    def close_stream(self, stream_id):
+        self._call_soon(self._close_stream, stream_id, True)
+
+    def feed(self, message):
+        """ Pass a stream message read from the control connection
+            rtype: bool - the message is a stream one
+        """
+        if type(message) not in STREAM_MESSAGES.values():
+            return False
+        self._call_soon(self._on_message, message)
+        return True
+
+    def get_stats(self, tunnel_id = None):
+        """ Returns the traffic counters of the streams of the tunnel (or of all the streams):
+            bytes_in - received from the sockets, bytes_out - written into them
+            rtype: dict
+        """
+        result = []
+        def collect():
+            stats = TrafficStats()
+            count = 0
+            for stream in self._streams.values():
+                if tunnel_id in (None, stream.tunnel_id):
+                    stats.add(stream)
+                    count += 1
+            ret = stats.as_dict()
+            ret["streams"] = count
+            return ret
+        if not self.work:
+            return {}  # the streams are gone with the control connection
+        done = threading.Event()
+        self._call_soon(lambda: (result.append(collect()), done.set()))
+        deadline = monotonic() + CALL_TIMEOUT
+        # a multiplexer closed meanwhile never runs the call, so it is not waited for
+        while not done.wait(0.1) and self.work and monotonic() < deadline:
+            pass
+        return result[0] if result else {}
+
+    def has_streams(self, tunnel_id):
+        """ rtype: bool - the tunnel has streams, False at once for a closed multiplexer
+        """
+        return bool(self.get_stats(tunnel_id).get("streams"))
+
+    def close(self):
+        """ Close all the streams, the control connection is gone
+        """
+        self.work = False
+        self._wakeup()
+        with self._outgoing_ready:
+            self._outgoing_ready.notify()
+
+    def _post(self, message, size = 0):
+        """ Queue the message for the writer thread
+            type size: int - the stream data bytes of the message
+        """
+        with self._outgoing_ready:
+            self._outgoing.append((message, size))
+            self._outgoing_size += size
+            if self._outgoing_size >= MUX_MAX_QUEUED:
+                self._blocked = True
+            self._outgoing_ready.notify()
+
+    def _write(self):
+        """ The writer thread: sends the queued messages in order, and resumes reading the streams
+            once the control connection has taken enough of them
+        """
+        while self.work:
+            with self._outgoing_ready:
+                while self.work and not self._outgoing:
+                    self._outgoing_ready.wait()
+                messages, self._outgoing = self._outgoing, collections.deque()
+            sent = 0
+            try:
+                for message, size in messages:
+                    self._send(message)
+                    sent += size
+            except Exception as e:
+                # in most cases, the control connection is broken
+                if self.work:
+                    logging.warning("Multiplexer stopped: {}".format(e))
+                self.close()
+                return
+            with self._outgoing_ready:
+                self._outgoing_size -= sent
+                resume = self._blocked and self._outgoing_size < MUX_MAX_QUEUED // 2
+                if resume:
+                    self._blocked = False
+            if resume:
+                self._call_soon(self._update_streams)
+
+    def _call_soon(self, fn, *args):
+        self._calls.append((fn, args))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._waker_w.send(b"\0")
+        except Exception:
+            pass # the waker is already full or closed, the loop will be woken anyway
+
+    def _run(self):
+        try:
+            while self.work:
+                while self._calls:
+                    fn, args = self._calls.popleft()
+                    fn(*args)
+                events = self._selector.select()
+                readable = []
+                for key, mask in events:
+                    stream = key.data
+                    if stream is None:
+                        try:
+                            while self._waker_r.recv(1024):
+                                pass
+                        except Exception:
+                            pass
+                        continue
+                    if mask & EVENT_WRITE and stream.id in self._streams:
+                        self._flush(stream)
+                    if mask & EVENT_READ:
+                        readable.append(stream)
+                # the higher priority streams take the control connection first
+                readable.sort(key = lambda stream: -stream.priority)
+                for stream in readable:
+                    if stream.id in self._streams and not self._blocked:
+                        self._read(stream)
+        except Exception as e:
+            # in most cases, the control connection is broken
+            logging.warning("Multiplexer stopped: {}".format(e))
+            logging.debug(traceback.format_exc())
+        # the writer thread and the callers waiting on the loop see it stopped
+        self.close()
+        for stream in list(self._streams.values()):
+            self._close_stream(stream.id, False)
+        try_close(self._waker_r)
+        try_close(self._waker_w)
+        self._selector.close()
+
+    def _add_stream(self, stream):
+        self._streams[stream.id] = stream
+        self._update_events(stream)
+
+    def _update_streams(self):
+        for stream in self._streams.values():
+            self._update_events(stream)
+
+    def _on_message(self, message):
+        stream = self._streams.get(message.stream_id)
+        if isinstance(message, StreamOpenMessage):
+            if stream is not None:
+                # the live stream is kept, its socket and data are not given to another one
+                logging.warning("Mux protocol error: stream {} is opened again, rejected".format(message.stream_id))
+                self._post(StreamCloseMessage(message.stream_id))
+                return
+            stream = MuxStream(message.stream_id, message.tunnel_id, message.priority, message.window)
+            self._streams[stream.id] = stream
+            if self._on_open:
+                self._on_open(self, stream)
+            else:
+                self._close_stream(stream.id, True)
+        elif stream is None:
+            return # the stream is closed already
+        elif isinstance(message, StreamDataMessage):
+            if stream.eof:
+                return
+            stream.granted -= len(message.data)
+            if stream.granted < 0:
+                # the other side ignores the credits, it is not buffered without a limit
+                logging.warning("Mux protocol error: stream {} exceeds its window, closed".format(stream.id))
+                self._close_stream(stream.id, True)
+                return
+            stream.pending.append(message.data)
+            stream.pending_size += len(message.data)
+            if stream.sock:
+                self._flush(stream)
+        elif isinstance(message, StreamWindowUpdateMessage):
+            stream.credit += message.increment
+            self._update_events(stream)
+        elif isinstance(message, StreamCloseMessage):
+            stream.eof = True
+            if not stream.pending_size or stream.sock is None:
+                self._close_stream(stream.id, False)
+
+    def _attach(self, stream_id, sock):
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            try_close(sock)
+            return
+        stream.sock = sock
+        stream.granted = self.window
+        self._post(StreamWindowUpdateMessage(stream_id, self.window))
+        self._flush(stream)
 
-    @classmethod
-    def from_bytes(cls, payload):
+    def _read(self, stream):
+        """ Send the socket data to the other side, as much as it is ready to receive
+        """
         try:
-            (communicate_port,proto, ssl) = struct.unpack("<HBB",payload[0:4])
-            if proto == Proto.TCP:
-                (port, host_len ) = struct.unpack("<HB",payload[4:7])
-                return cls(communicate_port = communicate_port, ssl = ssl, hostname = payload[-host_len:].decode(),port = port)
-            elif proto == Proto.SERIAL:
-                (baudrate, ser_name_len ) = struct.unpack("<IB",payload[4:9])
-                return cls(communicate_port = communicate_port, ssl = ssl, ser_name = payload[-ser_name_len:].decode(), baudrate= baudrate)
-            return None
+            data = stream.sock.recv(min(stream.credit, MUX_MAX_DATA))
+        except (BlockingIOError, InterruptedError):
+            return
         except Exception as e:
-            print(e)
-            return None
-             
-    def encode (self):
-        payload = None
-        if self.proto == Proto.TCP:
-            payload =  struct.pack(self._get_format(), self.communicate_port, 
-            self.proto, self.ssl, self.port, len(self.hostname), self.hostname.encode() )
+            logging.debug("mux stream {} read error: {}".format(stream.id, e))
+            data = b""
+        if not data:
+            # the other side delivers what it got and closes the stream
+            self._close_stream(stream.id, True)
+            return
+        stream.credit -= len(data)
+        stream.bytes_in += len(data)
+        stream.recv_calls += 1
+        self._post(StreamDataMessage(stream.id, data), len(data))
+        if self._blocked:
+            # the control connection is too slow, stop reading all the streams
+            self._update_streams()
         else:
-            payload =  struct.pack(self._get_format(), self.communicate_port, 
-            self.proto, self.ssl, self.baudrate, len(self.ser_name), self.ser_name.encode())
-        return self._add_header(MessageType.TUNNEL_REQUEST, payload)
+            self._update_events(stream)
 
-    def _get_format(self):
+    def _flush(self, stream):
+        """ Write the data of the other side into the socket, and grant the written bytes back
         """
-        communicate_port (uint_16), proto (uint_8), ssl(uint_8)
-            -> port (uint_16), len_of hostname (uint_8), hostname (n*s)
-            or
-            -> baudrate (uint_32), len_of ser_name (uint_8), ser_name (n*s)
+        while stream.pending:
+            data = stream.pending[0]
+            stream.send_calls += 1
+            try:
+                sent = stream.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                break
+            except Exception as e:
+                logging.debug("mux stream {} write error: {}".format(stream.id, e))
+                self._close_stream(stream.id, True)
+                return
+            stream.bytes_out += sent
+            stream.pending_size -= sent
+            stream.consumed += sent
+            if sent < len(data):
+                stream.pending[0] = data[sent:]
+                break
+            stream.pending.popleft()
+        if stream.eof and not stream.pending:
+            self._close_stream(stream.id, False)
+            return
+        # grant the window back in big enough pieces, not to send an update for every message
+        if stream.consumed >= self.window // 2:
+            self._post(StreamWindowUpdateMessage(stream.id, stream.consumed))
+            stream.granted += stream.consumed
+            stream.consumed = 0
+        self._update_events(stream)
+
+    def _update_events(self, stream):
+        if stream.sock is None:
+            return
+        events = 0
+        if stream.credit > 0 and not self._blocked:
+            events |= EVENT_READ
+        if stream.pending:
+            events |= EVENT_WRITE
+        if events == stream.events:
+            return
+        try:
+            if not stream.events:
+                self._selector.register(stream.sock, events, stream)
+            elif events:
+                self._selector.modify(stream.sock, events, stream)
+            else:
+                self._selector.unregister(stream.sock)
+        except (KeyError, ValueError, OSError):
+            pass
+        stream.events = events
+
+    def _close_stream(self, stream_id, notify):
+        """ notify - let the other side know, the stream is closed on this side
         """
-        if self.proto == Proto.TCP:
-            return "<HBBHB{}s".format(len(self.hostname)) 
-        else:
-            return "<HBBIB{}s".format(len(self.ser_name))
+        stream = self._streams.pop(stream_id, None)
+        if stream is None:
+            return
+        if stream.sock:
+            if stream.events:
+                try:
+                    self._selector.unregister(stream.sock)
+                except (KeyError, ValueError, OSError):
+                    pass
+            try_close(stream.sock)
+        if notify and self.work:
+            self._post(StreamCloseMessage(stream_id))
+"""
+Datagram (UDP) tunnels. The server and the slaver exchange the datagrams of the customers over a UDP socket
+of the tunnel, each one prefixed with the id of its flow. A flow is like a NAT mapping: a customer address
+on the server, and a socket connected to the tunnel target on the slaver, so the answers find their way back.
+Flows idle for flow_timeout seconds are expired, and the relay is closed when it relays nothing for timeout seconds.
 """
-A socket bridge implementation was borrowed from this repository https://github.com/aploium/shootback
-I just little simplified it.
-"""  
-#!/usr/bin/env python
-# coding=utf-8
-import collections
-import warnings
-import traceback
-import datetime
 
-try:
-    import selectors
-    from selectors import EVENT_READ, EVENT_WRITE
 
-    EVENT_READ_WRITE = EVENT_READ | EVENT_WRITE
-except ImportError:
-    import select
+# flow id (uint_32), followed by the datagram
+DATAGRAM_HEADER = struct.Struct("<I")
+MAX_DATAGRAM = 2 ** 16
+# seconds a flow lives without datagrams
+UDP_FLOW_TIMEOUT = 60
+# the slaver sends an empty datagram of the flow 0 every DATAGRAM_KEEPALIVE_PERIOD seconds: the server learns
+# the slaver address from it, and the NAT mappings between them are kept alive
+KEEPALIVE_FLOW = 0
+DATAGRAM_KEEPALIVE_PERIOD = 15
+# how often the flows are checked for the expiry, seconds
+EXPIRE_PERIOD = 1
 
-    warnings.warn('selectors module not available, fallback to select')
-    selectors = None
 
-# socket recv buffer, 16384 bytes
-RECV_BUFFER_SIZE = 2 ** 14
+class DatagramFlow(TrafficStats):
+    """ A flow of datagrams: a customer address on the server, or a socket connected to the target on the slaver
+    """
+    __slots__ = ("id", "addr", "sock", "last_active")
 
+    def __init__(self, flow_id, addr = None, sock = None):
+        TrafficStats.__init__(self)
+        self.id = flow_id
+        self.addr = addr
+        self.sock = sock # type: socket.socket
+        self.last_active = monotonic()
 
-def fmt_addr(socket):
-    """(host, int(port)) --> "host:port" """
-    return "{}:{}".format(*socket)
 
-def try_close(connection):
-    try:
-        connection.close()
-    except:
+class DatagramRelay ():
+    """ A relay thread of one datagram tunnel. Its subclasses are the server and the slaver ends of the tunnel:
+        they find the flow of a customer or target datagram with _find_flow(), send into the tunnel with _send_tunnel(),
+        and take the datagrams of the tunnel with _from_tunnel()
+    """
+
+    def __init__(self, tunnel_sock, terminate_callback = None, timeout = 60, flow_timeout = UDP_FLOW_TIMEOUT):
+        """ type tunnel_sock: socket.socket - the UDP socket between the server and the slaver
+            type terminate_callback: callable() - the relay closed itself on the timeout
+        """
+        self.work = True
+        self.callback = terminate_callback
+        self.timeout_sec = timeout
+        self.flow_timeout = flow_timeout
+        self.last_active = monotonic()
+        self.closed_stats = TrafficStats() # summed counters of the flows already expired
+        self.closed_flows_count = 0
+        self._tunnel_sock = tunnel_sock
+        self._flows = {} # flow id -> DatagramFlow
+        self._lock = threading.Lock() # the flows are changed by the relay thread, and read by get_stats()
+
+    def start(self):
+        thread = threading.Thread(target = self._run, name = "datagram relay")
+        thread.daemon = True
+        thread.start()
+
+    def get_stats(self):
+        """ Returns the traffic counters of the relay: summed ones of its flows, both alive and expired.
+            bytes_in - received from the customers or the target, bytes_out - sent into them
+            rtype: dict
+        """
+        with self._lock:
+            stats = TrafficStats()
+            stats.add(self.closed_stats)
+            for flow in self._flows.values():
+                stats.add(flow)
+            ret = stats.as_dict()
+            ret["flows"] = len(self._flows)
+            ret["flows_total"] = len(self._flows) + self.closed_flows_count
+        return ret
+
+    def close(self, from_outside = False):
+        self.work = False
+        if not from_outside and self.callback:
+            self.callback()
+
+    def _sockets(self):
+        """ rtype: list - the sockets to read
+        """
+        return [self._tunnel_sock]
+
+    def _on_readable(self, sock, now):
+        """ Pass a datagram of a customer or of the target into the tunnel, prefixed with its flow id,
+            or a datagram of the tunnel to its flow
+        """
+        try:
+            data, addr = sock.recvfrom(MAX_DATAGRAM)
+        except (OSError, socket.error):
+            return
+        if sock is self._tunnel_sock:
+            if len(data) >= DATAGRAM_HEADER.size:
+                self._from_tunnel(DATAGRAM_HEADER.unpack_from(data)[0], data[DATAGRAM_HEADER.size:], addr)
+            return
+        flow = self._find_flow(sock, addr)
+        if flow is None:
+            return
+        flow.recv_calls += 1
+        flow.bytes_in += len(data)
+        flow.last_active = self.last_active = now
+        try:
+            self._send_tunnel(DATAGRAM_HEADER.pack(flow.id) + data)
+        except (OSError, socket.error) as e:
+            logging.debug("datagram of flow {} dropped: {}".format(flow.id, e))
+
+    def _on_tick(self, now):
+        """ Called every loop pass
+        """
         pass
 
+    def _add_flow(self, flow):
+        with self._lock:
+            self._flows[flow.id] = flow
+
+    def _remove_flow(self, flow):
+        with self._lock:
+            if self._flows.pop(flow.id, None) is None:
+                return
+            self.closed_stats.add(flow)
+            self.closed_flows_count += 1
+        if flow.sock:
+            try_close(flow.sock)
+
+    def _relay(self, flow, data, sock, addr = None):
+        """ Send a datagram of the flow into the customer or the target socket
+        """
+        flow.last_active = self.last_active = monotonic()
+        flow.send_calls += 1
+        try:
+            if addr:
+                sock.sendto(data, addr)
+            else:
+                sock.send(data)
+        except (OSError, socket.error) as e:
+            # a datagram is lost, as it may be on the way anyway
+            logging.debug("datagram of flow {} dropped: {}".format(flow.id, e))
+            return
+        flow.bytes_out += len(data)
 
-class SocketBridge ():
+    def _run(self):
+        expired = monotonic()
+        try:
+            while self.work:
+                readable, _, _ = select.select(self._sockets(), [], [], EXPIRE_PERIOD)
+                now = monotonic()
+                for sock in readable:
+                    self._on_readable(sock, now)
+                self._on_tick(now)
+                if now - expired >= EXPIRE_PERIOD:
+                    expired = now
+                    for flow in list(self._flows.values()):
+                        if now - flow.last_active >= self.flow_timeout:
+                            self._remove_flow(flow)
+                    if now - self.last_active >= self.timeout_sec:
+                        logging.info("datagram relay timeout reached")
+                        self.close()
+        except Exception as e:
+            if self.work:
+                logging.error("Datagram relay failed {}".format(e))
+                logging.debug(traceback.format_exc())
+                self.close()
+        for flow in list(self._flows.values()):
+            self._remove_flow(flow)
 
-    def __init__ (self, terminate_callback = None, timeout = 60):
-        self.work = True
-        self.connections = set()  # holds all sockets
-        self.map = {}  # holds sockets pairs
-        self.callback =  terminate_callback # holds callback
-        self.send_buff = {}  # buff one packet for those sending too-fast socket
-        self.timeout_sec = timeout
-        self.timeout_counter = 0
-        self.delay = 0.1
-        if selectors:
-            self.selector = selectors.DefaultSelector()
-        else:
-            self.selector = None
-        
-        
 
-    def add_pair (self, conn1, conn2):
+class DatagramServerRelay (DatagramRelay):
+    """ The server end: the customers send to the customer socket, a flow per customer address
+    """
+
+    def __init__(self, tunnel_sock, terminate_callback = None, timeout = 60, flow_timeout = UDP_FLOW_TIMEOUT):
+        DatagramRelay.__init__(self, tunnel_sock, terminate_callback, timeout, flow_timeout)
+        self.peer = None # the slaver address
+        self._customer_sock = None # type: socket.socket
+        self._by_addr = {} # customer address -> DatagramFlow
+        self._next_id = KEEPALIVE_FLOW
+
+    def wait_peer(self, host, timeout):
+        """ Wait for the first keepalive of the slaver. The tunnel port is open to anyone,
+            so only a keepalive from the host of the slaver control connection is taken
+            type host: str - the IP address of the slaver control connection
+            rtype: bool - the slaver is known
         """
-        transfer anything between two sockets
-        :type conn1: socket.socket
-        :type conn2: socket.socket
-        :param callback: callback in connection finish
-        :type callback: Callable
+        deadline = monotonic() + timeout
+        try:
+            while self.peer is None:
+                left = deadline - monotonic()
+                if left <= 0:
+                    return False
+                self._tunnel_sock.settimeout(left)
+                data, addr = self._tunnel_sock.recvfrom(MAX_DATAGRAM)
+                if len(data) < DATAGRAM_HEADER.size or DATAGRAM_HEADER.unpack_from(data)[0] != KEEPALIVE_FLOW:
+                    continue
+                if addr[0] != host:
+                    logging.warning("datagram tunnel keepalive from a stranger {} is dropped".format(addr[0]))
+                    continue
+                self.peer = addr
+        except (OSError, socket.error):
+            return False
+        finally:
+            self._tunnel_sock.settimeout(None)
+        return True
+
+    def start(self, customer_sock):
+        """ type customer_sock: socket.socket - a bound UDP socket the customers send to
         """
-        # change to non-blocking
-        # we use select or epoll to notice when data is ready
-        conn1.setblocking(False)
-        conn2.setblocking(False)
+        self._customer_sock = customer_sock
+        DatagramRelay.start(self)
 
-        # mark as readable+writable
-        self.connections.add(conn1)
-        self.connections.add(conn2)
+    def _sockets(self):
+        return [self._tunnel_sock, self._customer_sock]
 
-        # record sockets pairs
-        self.map[conn1] = conn2
-        self.map[conn2] = conn1
-            
-        if self.selector:
-            self.selector.register(conn1, EVENT_READ_WRITE)
-            self.selector.register(conn2, EVENT_READ_WRITE)
+    def _remove_flow(self, flow):
+        self._by_addr.pop(flow.addr, None)
+        DatagramRelay._remove_flow(self, flow)
 
-        logging.debug("New pair added. Total {} sockets in bridge".format(len(self.connections)))
+    def _find_flow(self, sock, addr):
+        """ A new customer address opens a flow
+        """
+        flow = self._by_addr.get(addr)
+        if flow is None:
+            self._next_id = self._next_id % 0xFFFFFFFF + 1
+            flow = DatagramFlow(self._next_id, addr)
+            self._by_addr[addr] = flow
+            self._add_flow(flow)
+        return flow
+
+    def _send_tunnel(self, data):
+        self._tunnel_sock.sendto(data, self.peer)
+
+    def _from_tunnel(self, flow_id, data, addr):
+        # only the slaver host sends into the tunnel socket, its port may be changed by a NAT
+        if addr[0] != self.peer[0]:
+            return
+        self.peer = addr
+        flow = self._flows.get(flow_id)
+        if flow is not None:
+            self._relay(flow, data, self._customer_sock, flow.addr)
 
 
-    def start_as_daemon(self):
-        t = threading.Thread(target=self.start, name="socketBridge")
-        t.daemon = True
-        t.start()
-        logging.info("SocketBridge daemon started")
-        return t
+class DatagramClientRelay (DatagramRelay):
+    """ The slaver end: a socket connected to the target per flow
+    """
 
-    def start(self):
-        while self.work:
-            try:
-                self._start()
-            except:
-                logging.error("FATAL ERROR! SocketBridge failed {}".format(
-                    traceback.format_exc()
-                ))
+    def __init__(self, tunnel_sock, target, terminate_callback = None, timeout = 60, flow_timeout = UDP_FLOW_TIMEOUT):
+        """ type tunnel_sock: socket.socket - connected to the server tunnel port
+            type target: tuple - (host, port) of the tunnel target
+        """
+        DatagramRelay.__init__(self, tunnel_sock, terminate_callback, timeout, flow_timeout)
+        self.target = socket.getaddrinfo(target[0], target[1], 0, socket.SOCK_DGRAM)[0]
+        self._by_sock = {} # target socket -> DatagramFlow
+        self._keepalive = -DATAGRAM_KEEPALIVE_PERIOD # the first one goes right away
 
+    def _sockets(self):
+        return [self._tunnel_sock] + list(self._by_sock)
 
-    def _start(self): 
-        self._last_success_read = datetime.datetime.now() 
-        while self.work:
-            # Check if timeout reached
-            if (datetime.datetime.now() - self._last_success_read).total_seconds() >= self.timeout_sec:
-                logging.info("bridge timeout reached")
-                self.close() # Close the bridge due a timeout
-                break
+    def _remove_flow(self, flow):
+        self._by_sock.pop(flow.sock, None)
+        DatagramRelay._remove_flow(self, flow)
 
-            if not self.connections:
-                # sleep if there is no connections
-                time.sleep(self.delay)
-                continue
-            # blocks until there is socket(s) ready for .recv
-            # notice: sockets which were closed by remote,
-            #   are also regarded as read-ready by select()
-            if self.selector:
-                events = self.selector.select(self.timeout_sec)
-                socks_rd = tuple(key.fileobj for key, mask in events if mask & EVENT_READ)
-                socks_wr = tuple(key.fileobj for key, mask in events if mask & EVENT_WRITE)
-            else:
-                r, w, e = select.select(self.connections, self.connections, [], self.timeout_sec)
-                socks_rd = tuple(r)
-                socks_wr = tuple(w)
-                # logging.debug('socks_rd: %s, socks_wr:%s', len(socks_rd), len(socks_wr))
+    def _on_tick(self, now):
+        if now - self._keepalive >= DATAGRAM_KEEPALIVE_PERIOD:
+            self._keepalive = now
+            try:
+                self._tunnel_sock.send(DATAGRAM_HEADER.pack(KEEPALIVE_FLOW))
+            except (OSError, socket.error) as e:
+                logging.debug("datagram tunnel keepalive failed: {}".format(e))
+
+    def _find_flow(self, sock, addr):
+        return self._by_sock.get(sock)
+
+    def _send_tunnel(self, data):
+        self._tunnel_sock.send(data)
+
+    def _from_tunnel(self, flow_id, data, addr):
+        flow = self._flows.get(flow_id)
+        if flow is None:
+            # a new customer of the tunnel
+            family, type, proto, _, target_addr = self.target
+            target_sock = socket.socket(family, type, proto)
+            try:
+                target_sock.connect(target_addr)
+            except (OSError, socket.error) as e:
+                try_close(target_sock)
+                logging.debug("unable to open datagram flow {}: {}".format(flow_id, e))
+                return
+            flow = DatagramFlow(flow_id, target_addr, target_sock)
+            self._by_sock[target_sock] = flow
+            self._add_flow(flow)
+        self._relay(flow, data, flow.sock)
+"""
+TLS of the control and data connections. A context is made once per role, so the certificate is not
+reloaded for every connection, and the slaver offers the TLS session of its previous connection to the same
+server, so follow-up connections take an abbreviated handshake instead of a full one. The server shares its
+context between the control and the tunnel ports, so a session of one port is resumed on another.
+On Linux the record encryption can be handed to the kernel (kTLS): OpenSSL moves the keys into the socket after
+the handshake, and the sockets are read and written as before, with no encryption done in the process.
+"""
 
-            if not socks_rd and not socks_wr: # If select timeout reached (for both read and write ready sockets)
-                logging.info("bridge timeout reached")
-                self.close() # Close the bridge due a timeout
 
-            if not socks_rd and not self.send_buff:  # reduce CPU in low traffic if there is no read-ready sockets
-                time.sleep(self.delay)
-                continue
-            
-            # logging.debug('got rd:%s wr:%s', socks_rd, socks_wr) 
-            # ----------------- RECEIVING ----------------
-            for s in socks_rd:  # type: socket.socket
-                
-                # if this socket has non-sent data, stop recving more, to prevent buff blowing up.
-                if self.map[s] in self.send_buff:
-                    # logging.debug('delay recv because another too slow %s', self.map.get(s))
-                    continue
+# seconds a peer has to complete the handshake
+TLS_HANDSHAKE_TIMEOUT = 10
 
-                try:
-                    received = s.recv(RECV_BUFFER_SIZE)
-                    self._last_success_read = datetime.datetime.now() # Reset timeout timer
-                    # logging.debug('recved %s from %s', len(received), s)
-                except Exception as e:
-                    # unable to read, in most cases, it's due to socket close
-                    logging.warning('error reading socket %s, %s closing', repr(e), s)
-                    self._terminate(s)
-                    continue
+# SSL_OP_ENABLE_KTLS of OpenSSL 3, the ssl module has it since python 3.12
+OP_ENABLE_KTLS = getattr(ssl, "OP_ENABLE_KTLS", 1 << 3)
+KTLS_SUPPORTED = sys.platform.startswith("linux") and (hasattr(ssl, "OP_ENABLE_KTLS") or ssl.OPENSSL_VERSION_INFO >= (3, 0))
+# getsockopt() of a kernel TLS socket, from linux/tls.h
+SOL_TLS = 282
+TLS_TX = 1
+TLS_RX = 2
 
-                if not received:
-                    self._terminate(s)
-                    continue
-                else:
-                    self.send_buff[self.map[s]] = received
+_contexts = {}
+_contexts_lock = threading.Lock()
 
-            # ----------------- SENDING ----------------
-            for s in socks_wr:
-                if s not in self.send_buff:
-                    continue
-                data = self.send_buff.pop(s)
-                try:
-                    s.send(data)
-                    # logging.debug('sent %s to %s', len(data), s)
-                except Exception as e:
-                    # unable to send, close connection
-                    logging.warning('error sending socket %s, %s closing', repr(e), s)
-                    print("eror write")
-                    print(s)
-                    self._terminate(s)
-                    continue
-    
 
-    def close (self, from_outside = False):
-        """close the SocketBridge
-        """
-        self.work = False
-        
-        for s in self.connections:
-            try_close(s)  # close the first socket
-            self.send_buff.pop(s, None)
-            if self.selector:
-                try:
-                    self.selector.unregister(s)
-                except:
-                    pass
-        
-        self.map.clear()
+def _enable_ktls(context):
+    """ Ask OpenSSL for the kernel TLS. Without the kernel or the OpenSSL support, or for a cipher the kernel
+        does not have, the connections just stay in the userspace TLS
+    """
+    if KTLS_SUPPORTED:
+        context.options |= OP_ENABLE_KTLS
 
-        # ------ callback --------
-        if not from_outside: # If bridge closed from outside - there is no use in callback
-            if self.callback: 
-                self.callback()
 
-        
-    def _terminate(self, conn, once=False):
-        """terminate a sockets pair (two socket)
-        :type conn: socket.socket
-        :param conn: any one of the sockets pair
-        """
-        logging.debug('terminate %s',conn)
-        try_close(conn)  # close the first socket
+def server_context(certfile, keyfile, ktls = False):
+    """ Returns the shared server context of the certificate. Its session cache and ticket keys
+        are shared by all the connections, which lets the clients resume their sessions
+        type ktls: bool - try the kernel TLS
+        rtype: ssl.SSLContext
+    """
+    with _contexts_lock:
+        context = _contexts.get((certfile, keyfile, ktls))
+        if context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            if ktls:
+                _enable_ktls(context)
+            _contexts[(certfile, keyfile, ktls)] = context
+        return context
+
+
+def client_context(ktls = False):
+    """ Returns the shared client context. As before, the server certificate is not verified
+        type ktls: bool - try the kernel TLS
+        rtype: ssl.SSLContext
+    """
+    with _contexts_lock:
+        context = _contexts.get(("client", ktls))
+        if context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            if ktls:
+                _enable_ktls(context)
+            _contexts[("client", ktls)] = context
+        return context
+
+
+def ktls_offload(sock):
+    """ Returns the directions the kernel encrypts (TLS_TX) and decrypts (TLS_RX) the records of the socket in.
+        OpenSSL 3.0 offloads both for TLS 1.2, and only the sending for TLS 1.3
+        rtype: tuple - (bool, bool)
+    """
+    ret = []
+    for direction in (TLS_TX, TLS_RX):
+        try:
+            sock.getsockopt(SOL_TLS, direction, 64)
+            ret.append(True)
+        except (OSError, socket.error):
+            ret.append(False)
+    return tuple(ret)
 
-        # ------ close and clean the mapped socket, if exist ------
-        _another_conn = self.map.pop(conn, None)
 
-        if conn in self.connections:
-            self.connections.remove(conn)
+class TlsStats(object):
+    """ Handshake counters of a tunnel, added by the threads of its connections
+    """
+    __slots__ = ("handshakes", "resumed", "handshake_time", "offloaded", "_lock")
+
+    def __init__(self):
+        self.handshakes = 0
+        self.resumed = 0 # abbreviated handshakes, the session was reused
+        self.handshake_time = 0.0 # seconds, summed
+        self.offloaded = 0 # connections sent by the kernel TLS
+        self._lock = threading.Lock()
+
+    def add(self, seconds, resumed, offloaded = False):
+        with self._lock:
+            self.handshakes += 1
+            self.resumed += int(bool(resumed))
+            self.handshake_time += seconds
+            self.offloaded += int(bool(offloaded))
+
+    def as_dict(self):
+        with self._lock:
+            return {"tls_handshakes": self.handshakes, "tls_resumed": self.resumed, "tls_offloaded": self.offloaded,
+                    "tls_handshake_ms": round(self.handshake_time * 1000 / self.handshakes, 3) if self.handshakes else 0}
+
+
+class TlsSessionCache ():
+    """ The last TLS session of every server host. With TLS 1.3 the session ticket comes after the handshake,
+        with the first data read, so the session is taken from the latest connection when the next one is made
+    """
 
-        self.send_buff.pop(conn, None)
-        if self.selector:
+    def __init__(self):
+        self._sessions = {} # host -> ssl.SSLSession
+        self._sockets = {} # host -> the latest ssl.SSLSocket
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        """ rtype: ssl.SSLSession or None
+        """
+        with self._lock:
+            sock = self._sockets.get(host)
             try:
-                self.selector.unregister(conn)
-            except:
-                pass
+                session = sock.session if sock is not None else None
+            except (ValueError, OSError):
+                session = None # the connection is closed already
+            if session is not None and (session.has_ticket or session.id):
+                self._sessions[host] = session
+            return self._sessions.get(host)
+
+    def put(self, host, sock):
+        with self._lock:
+            self._sockets[host] = sock
+
+    def forget(self, host):
+        with self._lock:
+            self._sessions.pop(host, None)
+            self._sockets.pop(host, None)
+
+
+# the sessions of the slaver connections
+SESSIONS = TlsSessionCache()
+
+
+def _handshake(wrap, sock, stats, ktls):
+    timeout = sock.gettimeout()
+    sock.settimeout(TLS_HANDSHAKE_TIMEOUT)
+    started = monotonic()
+    tls_sock = wrap()
+    duration = monotonic() - started
+    tls_sock.settimeout(timeout)
+    offloaded = ktls and ktls_offload(tls_sock)[0]
+    if stats is not None:
+        stats.add(duration, tls_sock.session_reused, offloaded)
+    return tls_sock, duration, offloaded
+
+
+def wrap_server(sock, certfile, keyfile, stats = None, ktls = False):
+    """ Make the TLS handshake of an accepted connection
+        type stats: TlsStats - of the tunnel
+        type ktls: bool - try the kernel TLS
+        rtype: ssl.SSLSocket
+    """
+    context = server_context(certfile, keyfile, ktls)
+    tls_sock, _, _ = _handshake(lambda: context.wrap_socket(sock, server_side = True), sock, stats, ktls)
+    return tls_sock
+
+
+def wrap_client(sock, address, stats = None, sessions = SESSIONS, ktls = False):
+    """ Make the TLS handshake of a connection to the server, resuming the session of the previous connection
+        to the same host
+        type sock: socket.socket - connected to the address
+        type ktls: bool - try the kernel TLS
+        rtype: ssl.SSLSocket
+    """
+    context = client_context(ktls)
+    session = sessions.get(address[0])
+    try:
+        tls_sock, duration, offloaded = _handshake(lambda: context.wrap_socket(sock, session = session), sock, stats, ktls)
+    except ssl.SSLError:
+        # a session the server does not know anymore is just not reused, so the error is not about it
+        sessions.forget(address[0])
+        raise
+    sessions.put(address[0], tls_sock)
+    logging.debug("TLS handshake with {}:{} took {:.1f} ms{}{}".format(
+        address[0], address[1], duration * 1000, ", the session is resumed" if tls_sock.session_reused else "",
+        ", records are sent by the kernel" if offloaded else ""))
+    return tls_sock
 
-        # terminate another
-        if not once and _another_conn in self.map:
-            self._terminate(_another_conn, True)
 class AbstractTunnel:
     pass
 
@@ -472,12 +2981,10 @@ class Serial_tunnel_client(AbstractTunnel):
         try:
 
             self._ser = serial.Serial(self._serial_name, self._serial_params, timeout=TUNNEL_IDLE_TIMEOUT)
-            if self._ssl:
-                self._serv_sock = ssl.wrap_socket(socket.socket(), ssl_version=ssl.PROTOCOL_SSLv23)
-            else:
-                self._serv_sock = socket.socket()
-
+            self._serv_sock = socket.socket()
             self._serv_sock.connect((MASTER_HOST, self._server_port))
+            if self._ssl:
+                self._serv_sock = wrap_client(self._serv_sock, (MASTER_HOST, self._server_port), ktls = KTLS_ENABLED)
 
             if sys.platform != 'win32': # Unix
                 while self._work:
@@ -533,9 +3040,16 @@ class TCP_tunnel_client(AbstractTunnel):
         self._tunnel_host = tunnel_host
         self._ssl = ssl and SSL_ENABLED
         self._close_callback = close_callback
-        self._socket_bridge = SocketBridge(self._terminate,TUNNEL_IDLE_TIMEOUT)
+        self._mux = None # type: Multiplexer - the tunnel streams are relayed by it
+        self._parked = set() # idle connections of the pool, waiting on the server for customers
+        self._parked_lock = threading.Lock()
+        self._socket_bridge = self._create_bridge()
         threading.Thread(target=self._run, name="tcp_tunnel", args=[]).start()
 
+    def _create_bridge(self):
+        bridge_class = AsyncioBridge if BRIDGE_ENGINE == "asyncio" else SocketBridge
+        return bridge_class(self._terminate,TUNNEL_IDLE_TIMEOUT)
+
     def _run (self):
         try:
             self._socket_bridge.start_as_daemon() 
@@ -543,12 +3057,7 @@ class TCP_tunnel_client(AbstractTunnel):
             forw_sock = socket.socket()
             forw_sock.connect((self._tunnel_host, self._tunnel_port))
 
-            if self._ssl:
-                serv_sock = ssl.wrap_socket(socket.socket(), ssl_version=ssl.PROTOCOL_SSLv23)
-            else:
-                serv_sock = socket.socket()
-
-            serv_sock.connect((MASTER_HOST, self._server_port))
+            serv_sock = self._connect_server()
             
             self._socket_bridge.add_pair(
                 serv_sock, forw_sock       
@@ -560,16 +3069,22 @@ class TCP_tunnel_client(AbstractTunnel):
             self._work = False
             print (e)
     
-    def connect (self):
+    def connect (self, token = 0):
+        """ Make a connection the server asked for
+            type token: int - the setup token of the connection, sent first for the server to find its customer
+        """
         try:     
             forw_sock = socket.socket()
             forw_sock.connect((self._tunnel_host, self._tunnel_port))
 
-            if self._ssl:
-                serv_sock = ssl.wrap_socket(socket.socket(), ssl_version=ssl.PROTOCOL_SSLv23)
-            else:
-                serv_sock = socket.socket()
-            serv_sock.connect((MASTER_HOST, self._server_port))
+            serv_sock = self._connect_server()
+            if token:
+                try:
+                    serv_sock.sendall(SETUP_TOKEN.pack(token))
+                except:
+                    try_close(serv_sock)
+                    try_close(forw_sock)
+                    raise
 
             self._socket_bridge.add_pair(
                 serv_sock, forw_sock       
@@ -577,9 +3092,102 @@ class TCP_tunnel_client(AbstractTunnel):
         except Exception as e:
             print (e)
 
+    def park (self, token):
+        """ Make an idle connection to the server for the pool of the tunnel. It is connected
+            to the tunnel target, when the server gives it to a customer
+            type token: int - the setup token of the connection
+        """
+        try:
+            serv_sock = self._connect_server()
+        except Exception as e:
+            logging.debug("Unable to park a connection of tunnel {}: {}".format(self._server_port, e))
+            return
+        with self._parked_lock:
+            self._parked.add(serv_sock)
+        try:
+            serv_sock.sendall(SETUP_TOKEN.pack(token))
+            taken = serv_sock.recv(len(PARKED_TAKEN))
+        except:
+            taken = None
+        with self._parked_lock:
+            self._parked.discard(serv_sock)
+        if taken != PARKED_TAKEN or not self._work:
+            # the server dropped the connection, or the tunnel is closed
+            try_close(serv_sock)
+            return
+        if hasattr(socket, "TCP_QUICKACK"):
+            try:
+                # acknowledge it right away: the customer data behind it waits for the acknowledgement (Nagle)
+                serv_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            except:
+                pass
+        forw_sock = socket.socket()
+        try:
+            forw_sock.connect((self._tunnel_host, self._tunnel_port))
+        except Exception as e:
+            # the customer is closed with the connection
+            logging.debug("Unable to connect tunnel {} to its target: {}".format(self._server_port, e))
+            try_close(forw_sock)
+            try_close(serv_sock)
+            return
+        self._socket_bridge.add_pair(
+            serv_sock, forw_sock
+        )
+
+    def _close_parked (self):
+        with self._parked_lock:
+            parked, self._parked = self._parked, set()
+        for serv_sock in parked:
+            try:
+                # wake up the thread waiting on it
+                serv_sock.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+            try_close(serv_sock)
+
+    def _connect_server (self):
+        """ Make a connection to the tunnel communicate port. Over ssl, the connections after the first one
+            resume its TLS session, and skip the full handshake
+            rtype: socket.socket
+        """
+        serv_sock = socket.socket()
+        try:
+            serv_sock.connect((MASTER_HOST, self._server_port))
+            if self._ssl:
+                serv_sock = wrap_client(serv_sock, (MASTER_HOST, self._server_port), ktls = KTLS_ENABLED)
+        except:
+            try_close(serv_sock)
+            raise
+        return serv_sock
+
+    def open_stream (self, mux, stream_id):
+        """ Connect to the tunnel target for a stream the server opened
+            type mux: Multiplexer
+        """
+        self._mux = mux
+        threading.Thread(target=self._connect_stream, name="tcp_tunnel stream", args=[mux, stream_id]).start()
+
+    def _connect_stream (self, mux, stream_id):
+        try:
+            forw_sock = socket.socket()
+            forw_sock.connect((self._tunnel_host, self._tunnel_port))
+            mux.attach(stream_id, forw_sock)
+        except Exception as e:
+            logging.error("Unable to connect a tunnel stream: {}".format(e))
+            mux.close_stream(stream_id)
+
     def _terminate (self):
+        # the multiplexer of a connection lost before a resume is closed, the streams are gone with it
+        mux = self._mux
+        if self._work and mux and mux.work and mux.has_streams(self._server_port):
+            # The bridge has no connections, but the tunnel is still used by its streams
+            logging.debug("Tunnel bridge timeout, the tunnel streams are alive")
+            self._socket_bridge = self._create_bridge()
+            self._socket_bridge.start_as_daemon()
+            return
         logging.debug("Tunnel closed from inside")
         self._work = False
+        self._close_parked()
         self._close_callback(self._server_port)
     
     def close(self):
@@ -587,10 +3195,47 @@ class TCP_tunnel_client(AbstractTunnel):
         """
         logging.debug("Tunnel closed forcibly")
         self._work = False
+        self._close_parked()
         self._socket_bridge.close(True)
 
 
 
+class UDP_tunnel_client(AbstractTunnel):
+    """ Forwards the datagrams of the tunnel customers to the target, and the answers back.
+        Every customer of the server gets its own socket connected to the target
+    """
+
+    def __init__ (self,server_port, tunnel_host, tunnel_port, close_callback, idle_timeout = 0, flow_timeout = 0):
+        """ type idle_timeout: int - seconds, as the server expires the tunnel. 0 - TUNNEL_IDLE_TIMEOUT
+            type flow_timeout: int - seconds, as the server expires the flows. 0 - UDP_FLOW_TIMEOUT
+        """
+        self._server_port = server_port
+        self._close_callback = close_callback
+        self._serv_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._relay = None
+        try:
+            self._serv_sock.connect((MASTER_HOST, server_port))
+            self._relay = DatagramClientRelay(self._serv_sock, (tunnel_host, tunnel_port), self._terminate,
+                                              idle_timeout or TUNNEL_IDLE_TIMEOUT, flow_timeout or UDP_FLOW_TIMEOUT)
+            self._relay.start()
+        except Exception as e:
+            logging.error("Unable to open a UDP tunnel: {}".format(e))
+            try_close(self._serv_sock)
+
+    def _terminate (self):
+        logging.debug("Tunnel closed from inside")
+        try_close(self._serv_sock)
+        self._close_callback(self._server_port)
+
+    def close(self):
+        """ Close the tunnel forcibly from outside
+        """
+        logging.debug("Tunnel closed forcibly")
+        if self._relay:
+            self._relay.close(True)
+        try_close(self._serv_sock)
+
+
 class Slaver ():
 
     def __init__ (self, server_host, server_port, device_name):
@@ -600,6 +3245,11 @@ class Slaver ():
         self.hwId = self.get_hwid()
         self.name = device_name
         self.opened_tunnels = {}
+        self._send_lock = threading.Lock()
+        self._reader = None # type: MessageReader
+        self._mux = None # type: Multiplexer
+        self._alive_period = 5 # seconds, till the server agrees on another one
+        self._resume_token = 0 # given by the server, presented on reconnect to keep the tunnels
         self._connect()
         threading.Thread(target = self._send_alive_ping, args = []).start()
         self._listen_to_server()
@@ -613,32 +3263,43 @@ class Slaver ():
         return get_mac()
 
     def _create_handshake (self):
-        """
-        rtype: bytes
+        """ The slaver capabilities and limits. Servers not negotiating them read the hwId and name only
+        rtype: HandshakeMessage
         """ 
-        return HandshakeMessage(self.get_hwid(),self.name).encode()
+        capabilities = Capability.BATCH | Capability.UDP | Capability.RESUME | Capability.SETUP_TOKEN | Capability.POOL
+        if MUX_ENABLED:
+            capabilities |= Capability.MUX
+        return HandshakeMessage(self.get_hwid(),self.name, capabilities, MAX_FRAME_SIZE, ALIVE_PING_FREQUENCY, MUX_WINDOW,
+                                self._resume_token)
 
     def _listen_to_server (self):
         while True:
             try:
-                data = self.server_socket.recv(256)
-                if data:
-                    self._handle_message(ControlMessage.from_bytes(data))                
+                data = self.server_socket.recv(RECV_BUFFER_SIZE)
+                if not data:
+                    raise Exception("Connection broken")
+                for message in self._reader.feed(data):
+                    self._handle_message(message)
             except Exception as e:
                 logging.error("Error while reading data from command socket: {}".format(e))
                 self.server_socket.close()
                 self._connect()
 
     def _connect(self):
+        # the streams of the previous connection are gone with it
+        if self._mux:
+            self._mux.close()
+            self._mux = None
+        self._reader = MessageReader(MAX_FRAME_SIZE)
         connected = False
         while not connected:
             try:
-                if SSL_ENABLED:
-                    self.server_socket = ssl.wrap_socket(socket.socket(), ssl_version=ssl.PROTOCOL_SSLv23)
-                else:
-                    self.server_socket = socket.socket()
+                self.server_socket = socket.socket()
                 self.server_socket.connect((self.server_host, self.server_port))
-                self.server_socket.sendall(self._create_handshake())
+                if SSL_ENABLED:
+                    # a reconnection resumes the TLS session of the previous connection
+                    self.server_socket = wrap_client(self.server_socket, (self.server_host, self.server_port), ktls = KTLS_ENABLED)
+                self._send(self._create_handshake())
                 connected = True
             except Exception as e:
                 logging.error("Error while connectiong to command socket: {}".format(e))
@@ -646,19 +3307,28 @@ class Slaver ():
                 time.sleep(5)
 
 
+    def _send(self, command):
+        """ Send into the command socket. Tunnels, the multiplexer and the alive ping send from different threads,
+            so a message is never interleaved with another one
+            type command: string or ControlMessage
+        """
+        data = command.encode()
+        with self._send_lock:
+            self.server_socket.sendall(data)
+
     def _send_to_server(self, command):
         """
             type command: string or ControlMessage
         """
         try:
-            self.server_socket.sendall(command.encode())
+            self._send(command)
         except Exception as e:
             logging.error("Error while sending command to command socket: {}".format(e))
             self.server_socket.close()
 
     def _send_alive_ping(self):
         while True:
-            time.sleep(5)
+            time.sleep(self._alive_period)
             self._send_to_server("0\n")
         
     def _handle_message(self,message):
@@ -669,17 +3339,53 @@ class Slaver ():
         if None == message:
             return
 
-        if isinstance(message,TunnelReqMessage):
+        if self._mux and self._mux.feed(message):
+            return
+
+        if isinstance(message, BatchMessage):
+            # A burst of customers: the connections are dialed in parallel
+            for item in message.messages():
+                tunnel = self.opened_tunnels.get(item.tunnel_id)
+                if isinstance(item, ConnectionReqMessage) and isinstance(tunnel, TCP_tunnel_client):
+                    threading.Thread(target = tunnel.connect, name = "tcp_tunnel connect", args = [item.token]).start()
+                elif isinstance(item, ParkReqMessage) and isinstance(tunnel, TCP_tunnel_client):
+                    threading.Thread(target = tunnel.park, name = "tcp_tunnel park", args = [item.token]).start()
+                else:
+                    self._handle_message(item)
+            return
+
+        if isinstance(message, HandshakeMessage):
+            # The server terms. It comes before any other message of the server
+            terms = self._create_handshake().agree(message)
+            self._alive_period = terms.alive_period or self._alive_period
+            # The opened tunnels are kept on reconnect, the server gives them back for the token
+            self._resume_token = message.token if terms.has(Capability.RESUME) else 0
+            if terms.has(Capability.MUX) and not self._mux:
+                self._mux = Multiplexer(self._send, self._on_stream_open, terms.window)
+        elif isinstance(message,TunnelReqMessage):
             server_port = message.communicate_port
             if message.proto == Proto.TCP:
                 self.opened_tunnels[server_port] = TCP_tunnel_client(server_port, message.hostname, message.port, message.ssl, self._on_tunnel_closed)
+            elif message.proto == Proto.UDP:
+                self.opened_tunnels[server_port] = UDP_tunnel_client(server_port, message.hostname, message.port,
+                                                                     self._on_tunnel_closed, message.idle_timeout,
+                                                                     message.flow_timeout)
             else:
                 self.opened_tunnels[server_port] = Serial_tunnel_client(server_port, message.ser_name, message.baudrate, message.ssl, self._on_tunnel_closed)
         elif isinstance(message, ConnectionReqMessage):
             tunnel_id = message.tunnel_id
             if tunnel_id in self.opened_tunnels:
                 logging.debug("Another connection requested for tunnel {}".format(tunnel_id))
-                self.opened_tunnels[tunnel_id].connect()
+                if message.token:
+                    # the server pairs the connection by its token, so it is not waited for
+                    threading.Thread(target = self.opened_tunnels[tunnel_id].connect, name = "tcp_tunnel connect",
+                                     args = [message.token]).start()
+                else:
+                    self.opened_tunnels[tunnel_id].connect()
+        elif isinstance(message, ParkReqMessage):
+            tunnel = self.opened_tunnels.get(message.tunnel_id)
+            if isinstance(tunnel, TCP_tunnel_client):
+                threading.Thread(target = tunnel.park, name = "tcp_tunnel park", args = [message.token]).start()
         elif isinstance(message,TunnelClosedMessage):
             tunnel_id = message.tunnel_id
             if tunnel_id in self.opened_tunnels:
@@ -688,6 +3394,17 @@ class Slaver ():
                 if None != tunnel:
                     tunnel.close()
     
+    def _on_stream_open (self, mux, stream):
+        """ The server opened a stream for a new customer of the tunnel
+            type stream: MuxStream
+        """
+        tunnel = self.opened_tunnels.get(stream.tunnel_id)
+        if isinstance(tunnel, TCP_tunnel_client):
+            logging.debug("Another stream requested for tunnel {}".format(stream.tunnel_id))
+            tunnel.open_stream(mux, stream.id)
+        else:
+            mux.close_stream(stream.id)
+
     def _on_tunnel_closed (self, tunnel_id):
         self.opened_tunnels.pop(tunnel_id, None)
         # Let server know that this tunnel is closed 
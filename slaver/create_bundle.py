@@ -1,24 +1,31 @@
 import os
+import re
 
 output_name = "bundle.py"
 
-source =  open ("slaver.py")
-out = open(output_name, "w")
-    
-content = source.readlines()
-for line in content:
-    if "common.socket" in line:
-        f = open ("../common/socket_bridge.py")
-        out.write(f.read())
-        f.close()
-    elif "common.control_message" in line:
-        f = open ("../common/control_message.py")
-        out.write(f.read())
-        f.close()
-    else:
-        out.write(line)
+# "from ..common.socket_bridge import *" in the slaver, or "from .socket_bridge import *" in common modules.
+# The names imported one by one ("from .socket_bridge import _Name") are in the bundle namespace already
+common_import = re.compile(r"^from \.+(?:common\.)?(\w+) import ")
+inlined = []
 
-source.close()
+def write_module(out, path):
+    """ Copy the module into the bundle, putting common modules in place of their imports (each one once)
+    """
+    source = open(path)
+    content = source.readlines()
+    source.close()
+    for line in content:
+        match = common_import.match(line)
+        if match:
+            name = match.group(1)
+            if name not in inlined:
+                inlined.append(name)
+                write_module(out, "../common/{}.py".format(name))
+        else:
+            out.write(line)
+
+out = open(output_name, "w")
+write_module(out, "slaver.py")
 out.close()
 
 
@@ -35,4 +42,4 @@ for line in content:
             imports.append(line)
     else:
         out.write(line)
-out.close()
\ No newline at end of file
+out.close()
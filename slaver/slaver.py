@@ -12,6 +12,11 @@ MASTER_PORT = 444
 DEVICE_NAME = "Test windows device"
 
 SSL_ENABLED = False
+KTLS_ENABLED = False # hand the TLS record encryption to the kernel (Linux, OpenSSL 3 built with kTLS)
+
+BRIDGE_ENGINE = "selector" # "selector" or "asyncio". SSL pairs use the selector engine anyway
+
+MUX_ENABLED = True # accept the server offer to relay new tunnel connections over the control connection
 #
 
 import socket
@@ -21,10 +26,13 @@ import time
 import os
 import select
 import serial
-import ssl
 from uuid import getnode as get_mac
 from ..common.control_message import *
 from ..common.socket_bridge import *
+from ..common.asyncio_bridge import *
+from ..common.mux import *
+from ..common.datagram_relay import *
+from ..common.tls import *
 
 class AbstractTunnel:
     pass
@@ -74,12 +82,10 @@ class Serial_tunnel_client(AbstractTunnel):
         try:
 
             self._ser = serial.Serial(self._serial_name, self._serial_params, timeout=TUNNEL_IDLE_TIMEOUT)
-            if self._ssl:
-                self._serv_sock = ssl.wrap_socket(socket.socket(), ssl_version=ssl.PROTOCOL_SSLv23)
-            else:
-                self._serv_sock = socket.socket()
-
+            self._serv_sock = socket.socket()
             self._serv_sock.connect((MASTER_HOST, self._server_port))
+            if self._ssl:
+                self._serv_sock = wrap_client(self._serv_sock, (MASTER_HOST, self._server_port), ktls = KTLS_ENABLED)
 
             if sys.platform != 'win32': # Unix
                 while self._work:
@@ -135,9 +141,16 @@ class TCP_tunnel_client(AbstractTunnel):
         self._tunnel_host = tunnel_host
         self._ssl = ssl and SSL_ENABLED
         self._close_callback = close_callback
-        self._socket_bridge = SocketBridge(self._terminate,TUNNEL_IDLE_TIMEOUT)
+        self._mux = None # type: Multiplexer - the tunnel streams are relayed by it
+        self._parked = set() # idle connections of the pool, waiting on the server for customers
+        self._parked_lock = threading.Lock()
+        self._socket_bridge = self._create_bridge()
         threading.Thread(target=self._run, name="tcp_tunnel", args=[]).start()
 
+    def _create_bridge(self):
+        bridge_class = AsyncioBridge if BRIDGE_ENGINE == "asyncio" else SocketBridge
+        return bridge_class(self._terminate,TUNNEL_IDLE_TIMEOUT)
+
     def _run (self):
         try:
             self._socket_bridge.start_as_daemon() 
@@ -145,12 +158,7 @@ class TCP_tunnel_client(AbstractTunnel):
             forw_sock = socket.socket()
             forw_sock.connect((self._tunnel_host, self._tunnel_port))
 
-            if self._ssl:
-                serv_sock = ssl.wrap_socket(socket.socket(), ssl_version=ssl.PROTOCOL_SSLv23)
-            else:
-                serv_sock = socket.socket()
-
-            serv_sock.connect((MASTER_HOST, self._server_port))
+            serv_sock = self._connect_server()
             
             self._socket_bridge.add_pair(
                 serv_sock, forw_sock       
@@ -162,16 +170,22 @@ class TCP_tunnel_client(AbstractTunnel):
             self._work = False
             print (e)
     
-    def connect (self):
+    def connect (self, token = 0):
+        """ Make a connection the server asked for
+            type token: int - the setup token of the connection, sent first for the server to find its customer
+        """
         try:     
             forw_sock = socket.socket()
             forw_sock.connect((self._tunnel_host, self._tunnel_port))
 
-            if self._ssl:
-                serv_sock = ssl.wrap_socket(socket.socket(), ssl_version=ssl.PROTOCOL_SSLv23)
-            else:
-                serv_sock = socket.socket()
-            serv_sock.connect((MASTER_HOST, self._server_port))
+            serv_sock = self._connect_server()
+            if token:
+                try:
+                    serv_sock.sendall(SETUP_TOKEN.pack(token))
+                except:
+                    try_close(serv_sock)
+                    try_close(forw_sock)
+                    raise
 
             self._socket_bridge.add_pair(
                 serv_sock, forw_sock       
@@ -179,9 +193,102 @@ class TCP_tunnel_client(AbstractTunnel):
         except Exception as e:
             print (e)
 
+    def park (self, token):
+        """ Make an idle connection to the server for the pool of the tunnel. It is connected
+            to the tunnel target, when the server gives it to a customer
+            type token: int - the setup token of the connection
+        """
+        try:
+            serv_sock = self._connect_server()
+        except Exception as e:
+            logging.debug("Unable to park a connection of tunnel {}: {}".format(self._server_port, e))
+            return
+        with self._parked_lock:
+            self._parked.add(serv_sock)
+        try:
+            serv_sock.sendall(SETUP_TOKEN.pack(token))
+            taken = serv_sock.recv(len(PARKED_TAKEN))
+        except:
+            taken = None
+        with self._parked_lock:
+            self._parked.discard(serv_sock)
+        if taken != PARKED_TAKEN or not self._work:
+            # the server dropped the connection, or the tunnel is closed
+            try_close(serv_sock)
+            return
+        if hasattr(socket, "TCP_QUICKACK"):
+            try:
+                # acknowledge it right away: the customer data behind it waits for the acknowledgement (Nagle)
+                serv_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            except:
+                pass
+        forw_sock = socket.socket()
+        try:
+            forw_sock.connect((self._tunnel_host, self._tunnel_port))
+        except Exception as e:
+            # the customer is closed with the connection
+            logging.debug("Unable to connect tunnel {} to its target: {}".format(self._server_port, e))
+            try_close(forw_sock)
+            try_close(serv_sock)
+            return
+        self._socket_bridge.add_pair(
+            serv_sock, forw_sock
+        )
+
+    def _close_parked (self):
+        with self._parked_lock:
+            parked, self._parked = self._parked, set()
+        for serv_sock in parked:
+            try:
+                # wake up the thread waiting on it
+                serv_sock.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+            try_close(serv_sock)
+
+    def _connect_server (self):
+        """ Make a connection to the tunnel communicate port. Over ssl, the connections after the first one
+            resume its TLS session, and skip the full handshake
+            rtype: socket.socket
+        """
+        serv_sock = socket.socket()
+        try:
+            serv_sock.connect((MASTER_HOST, self._server_port))
+            if self._ssl:
+                serv_sock = wrap_client(serv_sock, (MASTER_HOST, self._server_port), ktls = KTLS_ENABLED)
+        except:
+            try_close(serv_sock)
+            raise
+        return serv_sock
+
+    def open_stream (self, mux, stream_id):
+        """ Connect to the tunnel target for a stream the server opened
+            type mux: Multiplexer
+        """
+        self._mux = mux
+        threading.Thread(target=self._connect_stream, name="tcp_tunnel stream", args=[mux, stream_id]).start()
+
+    def _connect_stream (self, mux, stream_id):
+        try:
+            forw_sock = socket.socket()
+            forw_sock.connect((self._tunnel_host, self._tunnel_port))
+            mux.attach(stream_id, forw_sock)
+        except Exception as e:
+            logging.error("Unable to connect a tunnel stream: {}".format(e))
+            mux.close_stream(stream_id)
+
     def _terminate (self):
+        # the multiplexer of a connection lost before a resume is closed, the streams are gone with it
+        mux = self._mux
+        if self._work and mux and mux.work and mux.has_streams(self._server_port):
+            # The bridge has no connections, but the tunnel is still used by its streams
+            logging.debug("Tunnel bridge timeout, the tunnel streams are alive")
+            self._socket_bridge = self._create_bridge()
+            self._socket_bridge.start_as_daemon()
+            return
         logging.debug("Tunnel closed from inside")
         self._work = False
+        self._close_parked()
         self._close_callback(self._server_port)
     
     def close(self):
@@ -189,10 +296,47 @@ class TCP_tunnel_client(AbstractTunnel):
         """
         logging.debug("Tunnel closed forcibly")
         self._work = False
+        self._close_parked()
         self._socket_bridge.close(True)
 
 
 
+class UDP_tunnel_client(AbstractTunnel):
+    """ Forwards the datagrams of the tunnel customers to the target, and the answers back.
+        Every customer of the server gets its own socket connected to the target
+    """
+
+    def __init__ (self,server_port, tunnel_host, tunnel_port, close_callback, idle_timeout = 0, flow_timeout = 0):
+        """ type idle_timeout: int - seconds, as the server expires the tunnel. 0 - TUNNEL_IDLE_TIMEOUT
+            type flow_timeout: int - seconds, as the server expires the flows. 0 - UDP_FLOW_TIMEOUT
+        """
+        self._server_port = server_port
+        self._close_callback = close_callback
+        self._serv_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._relay = None
+        try:
+            self._serv_sock.connect((MASTER_HOST, server_port))
+            self._relay = DatagramClientRelay(self._serv_sock, (tunnel_host, tunnel_port), self._terminate,
+                                              idle_timeout or TUNNEL_IDLE_TIMEOUT, flow_timeout or UDP_FLOW_TIMEOUT)
+            self._relay.start()
+        except Exception as e:
+            logging.error("Unable to open a UDP tunnel: {}".format(e))
+            try_close(self._serv_sock)
+
+    def _terminate (self):
+        logging.debug("Tunnel closed from inside")
+        try_close(self._serv_sock)
+        self._close_callback(self._server_port)
+
+    def close(self):
+        """ Close the tunnel forcibly from outside
+        """
+        logging.debug("Tunnel closed forcibly")
+        if self._relay:
+            self._relay.close(True)
+        try_close(self._serv_sock)
+
+
 class Slaver ():
 
     def __init__ (self, server_host, server_port, device_name):
@@ -202,6 +346,11 @@ class Slaver ():
         self.hwId = self.get_hwid()
         self.name = device_name
         self.opened_tunnels = {}
+        self._send_lock = threading.Lock()
+        self._reader = None # type: MessageReader
+        self._mux = None # type: Multiplexer
+        self._alive_period = 5 # seconds, till the server agrees on another one
+        self._resume_token = 0 # given by the server, presented on reconnect to keep the tunnels
         self._connect()
         threading.Thread(target = self._send_alive_ping, args = []).start()
         self._listen_to_server()
@@ -215,32 +364,43 @@ class Slaver ():
         return get_mac()
 
     def _create_handshake (self):
-        """
-        rtype: bytes
+        """ The slaver capabilities and limits. Servers not negotiating them read the hwId and name only
+        rtype: HandshakeMessage
         """ 
-        return HandshakeMessage(self.get_hwid(),self.name).encode()
+        capabilities = Capability.BATCH | Capability.UDP | Capability.RESUME | Capability.SETUP_TOKEN | Capability.POOL
+        if MUX_ENABLED:
+            capabilities |= Capability.MUX
+        return HandshakeMessage(self.get_hwid(),self.name, capabilities, MAX_FRAME_SIZE, ALIVE_PING_FREQUENCY, MUX_WINDOW,
+                                self._resume_token)
 
     def _listen_to_server (self):
         while True:
             try:
-                data = self.server_socket.recv(256)
-                if data:
-                    self._handle_message(ControlMessage.from_bytes(data))                
+                data = self.server_socket.recv(RECV_BUFFER_SIZE)
+                if not data:
+                    raise Exception("Connection broken")
+                for message in self._reader.feed(data):
+                    self._handle_message(message)
             except Exception as e:
                 logging.error("Error while reading data from command socket: {}".format(e))
                 self.server_socket.close()
                 self._connect()
 
     def _connect(self):
+        # the streams of the previous connection are gone with it
+        if self._mux:
+            self._mux.close()
+            self._mux = None
+        self._reader = MessageReader(MAX_FRAME_SIZE)
         connected = False
         while not connected:
             try:
-                if SSL_ENABLED:
-                    self.server_socket = ssl.wrap_socket(socket.socket(), ssl_version=ssl.PROTOCOL_SSLv23)
-                else:
-                    self.server_socket = socket.socket()
+                self.server_socket = socket.socket()
                 self.server_socket.connect((self.server_host, self.server_port))
-                self.server_socket.sendall(self._create_handshake())
+                if SSL_ENABLED:
+                    # a reconnection resumes the TLS session of the previous connection
+                    self.server_socket = wrap_client(self.server_socket, (self.server_host, self.server_port), ktls = KTLS_ENABLED)
+                self._send(self._create_handshake())
                 connected = True
             except Exception as e:
                 logging.error("Error while connectiong to command socket: {}".format(e))
@@ -248,19 +408,28 @@ class Slaver ():
                 time.sleep(5)
 
 
+    def _send(self, command):
+        """ Send into the command socket. Tunnels, the multiplexer and the alive ping send from different threads,
+            so a message is never interleaved with another one
+            type command: string or ControlMessage
+        """
+        data = command.encode()
+        with self._send_lock:
+            self.server_socket.sendall(data)
+
     def _send_to_server(self, command):
         """
             type command: string or ControlMessage
         """
         try:
-            self.server_socket.sendall(command.encode())
+            self._send(command)
         except Exception as e:
             logging.error("Error while sending command to command socket: {}".format(e))
             self.server_socket.close()
 
     def _send_alive_ping(self):
         while True:
-            time.sleep(5)
+            time.sleep(self._alive_period)
             self._send_to_server("0\n")
         
     def _handle_message(self,message):
@@ -271,17 +440,53 @@ class Slaver ():
         if None == message:
             return
 
-        if isinstance(message,TunnelReqMessage):
+        if self._mux and self._mux.feed(message):
+            return
+
+        if isinstance(message, BatchMessage):
+            # A burst of customers: the connections are dialed in parallel
+            for item in message.messages():
+                tunnel = self.opened_tunnels.get(item.tunnel_id)
+                if isinstance(item, ConnectionReqMessage) and isinstance(tunnel, TCP_tunnel_client):
+                    threading.Thread(target = tunnel.connect, name = "tcp_tunnel connect", args = [item.token]).start()
+                elif isinstance(item, ParkReqMessage) and isinstance(tunnel, TCP_tunnel_client):
+                    threading.Thread(target = tunnel.park, name = "tcp_tunnel park", args = [item.token]).start()
+                else:
+                    self._handle_message(item)
+            return
+
+        if isinstance(message, HandshakeMessage):
+            # The server terms. It comes before any other message of the server
+            terms = self._create_handshake().agree(message)
+            self._alive_period = terms.alive_period or self._alive_period
+            # The opened tunnels are kept on reconnect, the server gives them back for the token
+            self._resume_token = message.token if terms.has(Capability.RESUME) else 0
+            if terms.has(Capability.MUX) and not self._mux:
+                self._mux = Multiplexer(self._send, self._on_stream_open, terms.window)
+        elif isinstance(message,TunnelReqMessage):
             server_port = message.communicate_port
             if message.proto == Proto.TCP:
                 self.opened_tunnels[server_port] = TCP_tunnel_client(server_port, message.hostname, message.port, message.ssl, self._on_tunnel_closed)
+            elif message.proto == Proto.UDP:
+                self.opened_tunnels[server_port] = UDP_tunnel_client(server_port, message.hostname, message.port,
+                                                                     self._on_tunnel_closed, message.idle_timeout,
+                                                                     message.flow_timeout)
             else:
                 self.opened_tunnels[server_port] = Serial_tunnel_client(server_port, message.ser_name, message.baudrate, message.ssl, self._on_tunnel_closed)
         elif isinstance(message, ConnectionReqMessage):
             tunnel_id = message.tunnel_id
             if tunnel_id in self.opened_tunnels:
                 logging.debug("Another connection requested for tunnel {}".format(tunnel_id))
-                self.opened_tunnels[tunnel_id].connect()
+                if message.token:
+                    # the server pairs the connection by its token, so it is not waited for
+                    threading.Thread(target = self.opened_tunnels[tunnel_id].connect, name = "tcp_tunnel connect",
+                                     args = [message.token]).start()
+                else:
+                    self.opened_tunnels[tunnel_id].connect()
+        elif isinstance(message, ParkReqMessage):
+            tunnel = self.opened_tunnels.get(message.tunnel_id)
+            if isinstance(tunnel, TCP_tunnel_client):
+                threading.Thread(target = tunnel.park, name = "tcp_tunnel park", args = [message.token]).start()
         elif isinstance(message,TunnelClosedMessage):
             tunnel_id = message.tunnel_id
             if tunnel_id in self.opened_tunnels:
@@ -290,6 +495,17 @@ class Slaver ():
                 if None != tunnel:
                     tunnel.close()
     
+    def _on_stream_open (self, mux, stream):
+        """ The server opened a stream for a new customer of the tunnel
+            type stream: MuxStream
+        """
+        tunnel = self.opened_tunnels.get(stream.tunnel_id)
+        if isinstance(tunnel, TCP_tunnel_client):
+            logging.debug("Another stream requested for tunnel {}".format(stream.tunnel_id))
+            tunnel.open_stream(mux, stream.id)
+        else:
+            mux.close_stream(stream.id)
+
     def _on_tunnel_closed (self, tunnel_id):
         self.opened_tunnels.pop(tunnel_id, None)
         # Let server know that this tunnel is closed 
@@ -252,126 +252,318 @@ class MessageType:
     TUNNEL_REQUEST = 1
     CONNECTION_REQUEST = 2
     TUNNEL_CLOSED = 3
+    STREAM_OPEN = 4
+    STREAM_DATA = 5
+    STREAM_WINDOW_UPDATE = 6
+    STREAM_CLOSE = 7
+    BATCH = 8
+    PARK_REQUEST = 9
 
 class Proto:
     TCP = 0
     SERIAL = 1
+    UDP = 2
+
+class Capability:
+    """ Bits of the handshake capabilities bitmap: what a side supports besides the version 1 messages.
+        A capability is used, if both sides have it
+    """
+    BATCH = 1 # BatchMessage
+    MUX = 2 # tunnel streams over the control connection
+    UDP = 4 # Proto.UDP tunnels
+    RESUME = 8 # a reconnected slaver takes its tunnels back with the resume token
+    SETUP_TOKEN = 16 # connection requests carry a token, the slaver sends it first on the data connection
+    POOL = 32 # ParkReqMessage, the slaver keeps idle data connections parked on the server
+
+
+try:
+    _Struct = struct.Struct
+except AttributeError:
+    class _Struct(object):
+        """ MicroPython has no struct.Struct, the same interface over the module functions
+        """
+        def __init__(self, format):
+            self.format = format
+            self.size = struct.calcsize(format)
+
+        def pack(self, *args):
+            return struct.pack(self.format, *args)
+
+        def unpack_from(self, buffer, offset = 0):
+            return struct.unpack_from(self.format, buffer, offset)
+
+
+# protocol versions, as they are put in the message header
+VERSION_1 = 10 # message = header (version, type) + payload. The payload size is known from its fields only
+VERSION_2 = 20 # message = header (version, type, payload length) + payload
+# later versions keep the version 2 header, and only append fields to the payloads,
+# so the messages of a newer peer are still split and decoded as far as the fields are known
+
+# the biggest frame payload accepted, a bigger length means the stream is broken
+MAX_FRAME_SIZE = 2 ** 20
+
+# the formats are compiled once
+_HEADER = _Struct("<BB")
+_FRAME_HEADER = _Struct("<BBI")
+_BYTE = _Struct("<B")
+# the setup token of a requested data connection (uint_32), the slaver sends it first on the connection
+SETUP_TOKEN = _Struct("<I")
+# the server sends it on a parked data connection, when the connection is given to a customer
+PARKED_TAKEN = b"\x01"
 
 
-class ControlMessage ():
+def _read_string(buffer, start, length):
+    return bytes(buffer[start:start + length]).decode()
+
+
+class ControlMessage (object):
     """
         A base class of control messages to communicate between slaves and master.
-        message = header (version: uint_8, message type: uint_8) + payload
+        version 2 frame = header (version: uint_8, message type: uint_8, payload length: uint_32) + payload
+        version 1 message = header (version: uint_8, message type: uint_8) + payload
+        A message is decoded in the version it came, and encoded in the version the peer speaks
     """
+    __slots__ = ("frame_version",)
     #static fields
     header_format = "<BB"
-    version = 1.0
-    HEADER_SIZE = 2
+    frame_header_format = "<BBI"
+    version = 2.0
+    HEADER_SIZE = _HEADER.size
+    FRAME_HEADER_SIZE = _FRAME_HEADER.size
+
+    def __init__(self):
+        self.frame_version = None # the version a decoded message came in
+
     @classmethod
     def from_bytes (cls,payload):
-        (version,message_type)  = struct.unpack(cls.get_header_format(),payload[:cls.HEADER_SIZE])
-        #if version != cls.get_version():
-            #logging.error("message protocol versions is not match: {} and {}".format(float(version)/10, cls.version))
-        if message_type == MessageType.HANDSHAKE:
-            return HandshakeMessage.from_bytes(payload[cls.HEADER_SIZE:])
-        elif message_type == MessageType.TUNNEL_REQUEST:
-            return TunnelReqMessage.from_bytes(payload[cls.HEADER_SIZE:])
-        elif message_type == MessageType.CONNECTION_REQUEST:
-            return ConnectionReqMessage.from_bytes(payload[cls.HEADER_SIZE:])
-        elif message_type == MessageType.TUNNEL_CLOSED:
-            return TunnelClosedMessage.from_bytes(payload[cls.HEADER_SIZE:])
+        """ Decode a message
+            type payload: bytes - exactly one message
+            rtype: ControlMessage or None, if it is broken or of an unknown type
+        """
+        return ControlMessage.decode(payload, 0, len(payload))
+
+    @staticmethod
+    def decode(buffer, offset, end):
+        """ Decode the message at buffer[offset:end] without copying it.
+            end - the end of the frame, or of the buffer for a version 1 message
+            type buffer: memoryview or bytes
+            rtype: ControlMessage or None
+        """
+        try:
+            (version,message_type)  = _HEADER.unpack_from(buffer, offset)
+            message_class = MESSAGE_CLASSES.get(message_type)
+            if message_class is None:
+                return None
+            start = offset + (_FRAME_HEADER.size if version >= VERSION_2 else _HEADER.size)
+            message = message_class.decode_payload(buffer, start, end)
+        except Exception:
+            return None
+        if message is not None:
+            message.frame_version = version
+        return message
+
+    @staticmethod
+    def message_size(buffer, offset = 0, end = None, max_frame_size = MAX_FRAME_SIZE):
+        """ Returns the size of the message at buffer[offset:end], or None if there is too little data to tell.
+            A version 1 message has no length field, so it is worked out from the message type and its fields
+            rtype: int
+        """
+        end = len(buffer) if end is None else end
+        if end - offset < _HEADER.size:
+            return None
+        (version, message_type) = _HEADER.unpack_from(buffer, offset)
+        if version >= VERSION_2:
+            if end - offset < _FRAME_HEADER.size:
+                return None
+            length = _FRAME_HEADER.unpack_from(buffer, offset)[2]
+            if length > max_frame_size:
+                raise Exception("Frame is too long: {}".format(length))
+            return _FRAME_HEADER.size + length
+        if version != VERSION_1:
+            raise Exception("Unknown protocol version {}".format(version))
+        message_class = MESSAGE_CLASSES.get(message_type)
+        if message_class is None:
+            raise Exception("Unknown message type {}".format(message_type))
+        size = message_class.payload_size(buffer, offset + _HEADER.size, end)
+        return None if size is None else _HEADER.size + size
 
-        return None
     @staticmethod
     def get_header_format():
         return ControlMessage.header_format
-    
+
     @staticmethod
     def get_version():
         return int(ControlMessage.version*10)
 
     @classmethod
-    def _add_header(cls,message_type, payload):
-        return struct.pack(cls.get_header_format(),cls.get_version(),message_type) + payload
+    def _add_header(cls,message_type, payload, version = None):
+        """ version - the peer protocol version, the current one by default
+        """
+        version = version or cls.get_version()
+        if version == VERSION_1:
+            return _HEADER.pack(version,message_type) + payload
+        return _FRAME_HEADER.pack(version,message_type,len(payload)) + payload
 
 class HandshakeMessage(ControlMessage):
-    def __init__(self, hwId, name):
+    """ The slaver introduces itself with it. A slaver sending the capabilities gets the server handshake back,
+        and both sides use what they agree on: see agree()
+    hwId (uint_64), len_of name (uint_8), name (n*s)
+        version 2 frames, optional: capabilities (uint_32), max_frame_size (uint_32), alive_period (uint_16), window (uint_32)
+            then optional: resume token (uint_64)
+    """
+    __slots__ = ("hwId", "name", "capabilities", "max_frame_size", "alive_period", "window", "token")
+    message_type = MessageType.HANDSHAKE
+    _struct = _Struct("<QB")
+    _limits_struct = _Struct("<IIHI")
+    _token_struct = _Struct("<Q")
+
+    def __init__(self, hwId, name, capabilities = None, max_frame_size = MAX_FRAME_SIZE, alive_period = 0, window = 0,
+                 token = 0):
+        """ type capabilities: int - Capability bits, None - the sender does not negotiate (an old slaver)
+            type max_frame_size: int - the biggest frame payload the sender accepts
+            type alive_period: int - seconds between alive pings, 0 - no preference
+            type window: int - the stream window of the multiplexing, 0 - no preference
+            type token: int - the server gives it to the slaver, the slaver presents it to resume the session. 0 - none
+        """
+        ControlMessage.__init__(self)
         self.hwId = hwId
         if (len(name) > 255):
             raise Exception ("Device name is too long")
         self.name = name
+        self.capabilities = capabilities
+        self.max_frame_size = max_frame_size
+        self.alive_period = alive_period
+        self.window = window
+        self.token = token
+
+    def has(self, capability):
+        """ rtype: bool
+        """
+        return bool((self.capabilities or 0) & capability)
+
+    def agree(self, other):
+        """ Returns the terms both sides support: the common capabilities, and the smallest limits
+            type other: HandshakeMessage - the handshake of the other side
+            rtype: HandshakeMessage
+        """
+        def smallest(a, b):
+            return min(a, b) if a and b else a or b
+        return HandshakeMessage(other.hwId, other.name, (self.capabilities or 0) & (other.capabilities or 0),
+                                min(self.max_frame_size, other.max_frame_size),
+                                smallest(self.alive_period, other.alive_period), smallest(self.window, other.window))
 
     @classmethod
-    def from_bytes(cls, payload):
-        try:
-            (hwid,name_len) = struct.unpack("<QB",payload[0:9])
-            return (cls(hwid,payload[-name_len:].decode()))
-        except:
+    def decode_payload(cls, buffer, start, end):
+        (hwid,name_len) = cls._struct.unpack_from(buffer, start)
+        start += cls._struct.size
+        message = cls(hwid, _read_string(buffer, start, name_len))
+        start += name_len
+        # old slavers send no capabilities
+        if end - start >= cls._limits_struct.size:
+            (message.capabilities, message.max_frame_size, message.alive_period,
+                message.window) = cls._limits_struct.unpack_from(buffer, start)
+            start += cls._limits_struct.size
+            if end - start >= cls._token_struct.size:
+                message.token = cls._token_struct.unpack_from(buffer, start)[0]
+        return message
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        if end - start < cls._struct.size:
             return None
+        return cls._struct.size + _BYTE.unpack_from(buffer, start + 8)[0]
+
+    def encode (self, version = None):
+        name = self.name.encode()
+        payload = self._struct.pack(self.hwId, len(name)) + name
+        if self.capabilities is not None and (version or self.get_version()) != VERSION_1:
+            # a version 1 message has no length, so nothing may follow the name
+            payload += self._limits_struct.pack(self.capabilities, self.max_frame_size, self.alive_period, self.window)
+            payload += self._token_struct.pack(self.token)
+        return self._add_header(MessageType.HANDSHAKE, payload, version)
+
+
+class _TunnelMessage(ControlMessage):
+    """ A message about a tunnel. The messages of different types are not subclasses of each other,
+        so an isinstance() check does not take one type for another
+    tunnel_id (uint_16)
+    """
+    __slots__ = ("tunnel_id", "token")
+    _struct = _Struct("<H")
 
-    def encode (self):
-        payload = struct.pack(self._get_format(),self.hwId,len(self.name), self.name.encode())
-        return self._add_header(MessageType.HANDSHAKE, payload)
-    
-    def _get_format(self):
-        """
-        hwId (uint_64), len_of name (uint_8), name (n*s)
+    def __init__(self, tunnel_id, token = 0):
+        """ type token: int - sent first on the requested connection, so the server knows its customer. 0 - no token
         """
-        return "<QB{}s".format(len(self.name)) 
-
-
-class ConnectionReqMessage(ControlMessage):
-    def __init__(self, tunnel_id):
+        ControlMessage.__init__(self)
         self.tunnel_id = tunnel_id
+        self.token = token
 
     @classmethod
-    def from_bytes(cls, payload):
-        try:
-            (tunnel_id,) = struct.unpack("<H",payload)
-            return (cls(tunnel_id))
-        except:
-            return None
+    def decode_payload(cls, buffer, start, end):
+        message = cls(*cls._struct.unpack_from(buffer, start))
+        start += cls._struct.size
+        if end - start >= SETUP_TOKEN.size:
+            message.token = SETUP_TOKEN.unpack_from(buffer, start)[0]
+        return message
 
-    def encode (self):
-        payload = struct.pack(self._get_format(),self.tunnel_id)
-        return self._add_header(MessageType.CONNECTION_REQUEST, payload)
-    
-    def _get_format(self):
-        """
-        tunnel_id (uint_16)
-        """
-        return "<H"
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        return cls._struct.size
+
+    def encode (self, version = None):
+        payload = self._struct.pack(self.tunnel_id)
+        if self.token:
+            payload += SETUP_TOKEN.pack(self.token)
+        return self._add_header(self.message_type, payload, version)
 
-class TunnelClosedMessage(ControlMessage):
-    """ A tunnel closed callback message. 
+class ConnectionReqMessage(_TunnelMessage):
     """
-    def __init__(self, tunnel_id):
-        self.tunnel_id = tunnel_id
+    tunnel_id (uint_16)
+        -> setup token (uint_32) - in version 2 frames to slavers agreed on the Capability.SETUP_TOKEN
+    """
+    __slots__ = ()
+    message_type = MessageType.CONNECTION_REQUEST
 
-    @classmethod
-    def from_bytes(cls, payload):
-        try:
-            (tunnel_id,) = struct.unpack("<H",payload)
-            return (cls(tunnel_id))
-        except:
-            return None
+class TunnelClosedMessage(_TunnelMessage):
+    """ A tunnel closed callback message.
+    tunnel_id (uint_16)
+    """
+    __slots__ = ()
+    message_type = MessageType.TUNNEL_CLOSED
 
-    def encode (self):
-        payload = struct.pack(self._get_format(),self.tunnel_id)
-        return self._add_header(MessageType.TUNNEL_CLOSED, payload)
-    
-    def _get_format(self):
-        """
-        tunnel_id (uint_16)
-        """
-        return "<H"
+class ParkReqMessage(_TunnelMessage):
+    """ A connection request for the pool of the tunnel: the slaver connects to the server and sends the token,
+        then waits for PARKED_TAKEN to connect to the tunnel target. It is sent to slavers agreed on the Capability.POOL
+    tunnel_id (uint_16), setup token (uint_32)
+    """
+    __slots__ = ()
+    message_type = MessageType.PARK_REQUEST
 
 class TunnelReqMessage(ControlMessage):
-    """ A new tunnel request message. 
+    """ A new tunnel request message.
+    communicate_port (uint_16), proto (uint_8), ssl(uint_8)
+        -> port (uint_16), len_of hostname (uint_8), hostname (n*s) - TCP and UDP
+            then for UDP, optional: idle_timeout (uint_32), flow_timeout (uint_32)
+        or
+        -> baudrate (uint_32), len_of ser_name (uint_8), ser_name (n*s)
     """
-    def __init__(self, communicate_port, ssl = False, hostname = None, port = None, ser_name = None, baudrate = None):
+    __slots__ = ("proto", "hostname", "port", "ser_name", "baudrate", "communicate_port", "ssl",
+                 "idle_timeout", "flow_timeout")
+    message_type = MessageType.TUNNEL_REQUEST
+    _struct = _Struct("<HBB")
+    _tcp_struct = _Struct("<HB")
+    _serial_struct = _Struct("<IB")
+    _udp_struct = _Struct("<II")
+
+    def __init__(self, communicate_port, ssl = False, hostname = None, port = None, ser_name = None, baudrate = None,
+                 udp = False, idle_timeout = 0, flow_timeout = 0):
+        """ udp - forward the datagrams to the host and port, instead of the connections
+            type idle_timeout: int - seconds a UDP tunnel lives without datagrams, 0 - the slaver default
+            type flow_timeout: int - seconds a flow of a UDP tunnel lives without datagrams, 0 - the slaver default
+        """
+        ControlMessage.__init__(self)
         if hostname and port:
-            self.proto = Proto.TCP
+            self.proto = Proto.UDP if udp else Proto.TCP
             self.hostname = hostname
             self.port = port
         elif ser_name and baudrate:
@@ -382,46 +574,314 @@ class TunnelReqMessage(ControlMessage):
             raise Exception("Wrong parameters given")
         self.communicate_port = communicate_port
         self.ssl = ssl
+        self.idle_timeout = idle_timeout
+        self.flow_timeout = flow_timeout
 
     @classmethod
-    def from_bytes(cls, payload):
-        try:
-            (communicate_port,proto, ssl) = struct.unpack("<HBB",payload[0:4])
-            if proto == Proto.TCP:
-                (port, host_len ) = struct.unpack("<HB",payload[4:7])
-                return cls(communicate_port = communicate_port, ssl = ssl, hostname = payload[-host_len:].decode(),port = port)
-            elif proto == Proto.SERIAL:
-                (baudrate, ser_name_len ) = struct.unpack("<IB",payload[4:9])
-                return cls(communicate_port = communicate_port, ssl = ssl, ser_name = payload[-ser_name_len:].decode(), baudrate= baudrate)
+    def decode_payload(cls, buffer, start, end):
+        (communicate_port,proto, ssl) = cls._struct.unpack_from(buffer, start)
+        start += cls._struct.size
+        if proto in (Proto.TCP, Proto.UDP):
+            (port, host_len ) = cls._tcp_struct.unpack_from(buffer, start)
+            start += cls._tcp_struct.size
+            hostname = _read_string(buffer, start, host_len)
+            message = cls(communicate_port = communicate_port, ssl = ssl, hostname = hostname, port = port,
+                          udp = proto == Proto.UDP)
+            start += host_len
+            # UDP tunnels are version 2 only, so the end is the frame end
+            if proto == Proto.UDP and end - start >= cls._udp_struct.size:
+                (message.idle_timeout, message.flow_timeout) = cls._udp_struct.unpack_from(buffer, start)
+            return message
+        elif proto == Proto.SERIAL:
+            (baudrate, ser_name_len ) = cls._serial_struct.unpack_from(buffer, start)
+            ser_name = _read_string(buffer, start + cls._serial_struct.size, ser_name_len)
+            return cls(communicate_port = communicate_port, ssl = ssl, ser_name = ser_name, baudrate= baudrate)
+        return None
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        if end - start < cls._struct.size:
             return None
-        except Exception as e:
-            print(e)
+        proto = _BYTE.unpack_from(buffer, start + 2)[0]
+        # the name length follows the port (uint_16) or the baudrate (uint_32)
+        len_offset = 8 if proto == Proto.SERIAL else 6
+        if end - start <= len_offset:
             return None
-             
-    def encode (self):
-        payload = None
-        if self.proto == Proto.TCP:
-            payload =  struct.pack(self._get_format(), self.communicate_port, 
-            self.proto, self.ssl, self.port, len(self.hostname), self.hostname.encode() )
+        return len_offset + 1 + _BYTE.unpack_from(buffer, start + len_offset)[0]
+
+    def encode (self, version = None):
+        header = self._struct.pack(self.communicate_port, self.proto, self.ssl)
+        if self.proto != Proto.SERIAL:
+            name = self.hostname.encode()
+            payload = header + self._tcp_struct.pack(self.port, len(name)) + name
+            if self.proto == Proto.UDP and (version or self.get_version()) != VERSION_1:
+                payload += self._udp_struct.pack(self.idle_timeout, self.flow_timeout)
         else:
-            payload =  struct.pack(self._get_format(), self.communicate_port, 
-            self.proto, self.ssl, self.baudrate, len(self.ser_name), self.ser_name.encode())
-        return self._add_header(MessageType.TUNNEL_REQUEST, payload)
+            name = self.ser_name.encode()
+            payload = header + self._serial_struct.pack(self.baudrate, len(name)) + name
+        return self._add_header(MessageType.TUNNEL_REQUEST, payload, version)
+
 
-    def _get_format(self):
+class StreamOpenMessage(ControlMessage):
+    """ Open a stream of the tunnel multiplexed over the control connection.
+        window - bytes the sender is ready to receive on the stream
+    stream_id (uint_32), tunnel_id (uint_16), priority (uint_8), window (uint_32)
+    """
+    __slots__ = ("stream_id", "tunnel_id", "priority", "window")
+    message_type = MessageType.STREAM_OPEN
+    _struct = _Struct("<IHBI")
+
+    def __init__(self, stream_id, tunnel_id, priority = 0, window = 0):
+        ControlMessage.__init__(self)
+        self.stream_id = stream_id
+        self.tunnel_id = tunnel_id
+        self.priority = priority
+        self.window = window
+
+    @classmethod
+    def decode_payload(cls, buffer, start, end):
+        return cls(*cls._struct.unpack_from(buffer, start))
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        return cls._struct.size
+
+    def encode (self, version = None):
+        payload = self._struct.pack(self.stream_id, self.tunnel_id, self.priority, self.window)
+        return self._add_header(MessageType.STREAM_OPEN, payload, version)
+
+
+class StreamDataMessage(ControlMessage):
+    """ Data of a multiplexed stream
+    stream_id (uint_32), len_of data (uint_16), data (n*s)
+    """
+    __slots__ = ("stream_id", "data")
+    message_type = MessageType.STREAM_DATA
+    _struct = _Struct("<IH")
+
+    def __init__(self, stream_id, data):
+        ControlMessage.__init__(self)
+        if len(data) > 0xFFFF:
+            raise Exception("Stream data is too long")
+        self.stream_id = stream_id
+        self.data = data
+
+    @classmethod
+    def decode_payload(cls, buffer, start, end):
+        (stream_id, length) = cls._struct.unpack_from(buffer, start)
+        start += cls._struct.size
+        if end - start < length:
+            return None
+        # the only copy of the data, the buffer is reused by the reader
+        return cls(stream_id, bytes(buffer[start:start + length]))
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        if end - start < cls._struct.size:
+            return None
+        return cls._struct.size + cls._struct.unpack_from(buffer, start)[1]
+
+    def encode (self, version = None):
+        return self._add_header(MessageType.STREAM_DATA,
+                                self._struct.pack(self.stream_id, len(self.data)) + bytes(self.data), version)
+
+
+class StreamWindowUpdateMessage(ControlMessage):
+    """ The receiver of a stream has delivered increment bytes, so the sender may send that much more.
+        The first update of a stream opened by the other side acknowledges it
+    stream_id (uint_32), increment (uint_32)
+    """
+    __slots__ = ("stream_id", "increment")
+    message_type = MessageType.STREAM_WINDOW_UPDATE
+    _struct = _Struct("<II")
+
+    def __init__(self, stream_id, increment):
+        ControlMessage.__init__(self)
+        self.stream_id = stream_id
+        self.increment = increment
+
+    @classmethod
+    def decode_payload(cls, buffer, start, end):
+        return cls(*cls._struct.unpack_from(buffer, start))
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        return cls._struct.size
+
+    def encode (self, version = None):
+        return self._add_header(MessageType.STREAM_WINDOW_UPDATE,
+                                self._struct.pack(self.stream_id, self.increment), version)
+
+
+class StreamCloseMessage(ControlMessage):
+    """ The sender has closed the stream. The receiver delivers what it already got and closes the stream too
+    stream_id (uint_32)
+    """
+    __slots__ = ("stream_id",)
+    message_type = MessageType.STREAM_CLOSE
+    _struct = _Struct("<I")
+
+    def __init__(self, stream_id):
+        ControlMessage.__init__(self)
+        self.stream_id = stream_id
+
+    @classmethod
+    def decode_payload(cls, buffer, start, end):
+        return cls(*cls._struct.unpack_from(buffer, start))
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        return cls._struct.size
+
+    def encode (self, version = None):
+        return self._add_header(MessageType.STREAM_CLOSE, self._struct.pack(self.stream_id), version)
+
+
+class BatchMessage(ControlMessage):
+    """ Several connection requests or tunnel closed messages in one frame, for a burst of customers
+        or of closed tunnels. It is sent to slavers agreed on the Capability.BATCH only
+    message type of the items (uint_8), count (uint_16), tunnel_id (count*uint_16)
+        -> setup token (count*uint_32) - connection requests to slavers agreed on the Capability.SETUP_TOKEN
+    """
+    __slots__ = ("item_type", "tunnel_ids", "tokens")
+    message_type = MessageType.BATCH
+    _struct = _Struct("<BH")
+    MAX_ITEMS = 0xFFFF
+
+    def __init__(self, item_type, tunnel_ids, tokens = None):
+        ControlMessage.__init__(self)
+        if item_type not in BATCH_ITEMS:
+            raise Exception("Messages of type {} are not batched".format(item_type))
+        if len(tunnel_ids) > self.MAX_ITEMS:
+            raise Exception("Too many messages in a batch")
+        if tokens and len(tokens) != len(tunnel_ids):
+            raise Exception("A token per message is needed")
+        self.item_type = item_type
+        self.tunnel_ids = tunnel_ids
+        self.tokens = tokens
+
+    def messages(self):
+        """ rtype: list - the batched messages
         """
-        communicate_port (uint_16), proto (uint_8), ssl(uint_8)
-            -> port (uint_16), len_of hostname (uint_8), hostname (n*s)
-            or
-            -> baudrate (uint_32), len_of ser_name (uint_8), ser_name (n*s)
+        item_class = BATCH_ITEMS[self.item_type]
+        if self.tokens:
+            return [item_class(tunnel_id, token) for tunnel_id, token in zip(self.tunnel_ids, self.tokens)]
+        return [item_class(tunnel_id) for tunnel_id in self.tunnel_ids]
+
+    @classmethod
+    def decode_payload(cls, buffer, start, end):
+        (item_type, count) = cls._struct.unpack_from(buffer, start)
+        start += cls._struct.size
+        if end - start < 2 * count:
+            return None
+        message = cls(item_type, list(struct.unpack_from("<{}H".format(count), buffer, start)))
+        start += 2 * count
+        if count and end - start >= SETUP_TOKEN.size * count:
+            message.tokens = list(struct.unpack_from("<{}I".format(count), buffer, start))
+        return message
+
+    @classmethod
+    def payload_size(cls, buffer, start, end):
+        if end - start < cls._struct.size:
+            return None
+        return cls._struct.size + 2 * cls._struct.unpack_from(buffer, start)[1]
+
+    def encode (self, version = None):
+        count = len(self.tunnel_ids)
+        payload = self._struct.pack(self.item_type, count) + struct.pack("<{}H".format(count), *self.tunnel_ids)
+        if self.tokens:
+            payload += struct.pack("<{}I".format(count), *self.tokens)
+        return self._add_header(MessageType.BATCH, payload, version)
+
+    @classmethod
+    def coalesce(cls, messages, max_frame_size = MAX_FRAME_SIZE):
+        """ Put the runs of batchable messages into batches, keeping the order of the messages
+            type messages: list of ControlMessage
+            type max_frame_size: int - the biggest frame the other side accepts
+            rtype: list of ControlMessage
         """
-        if self.proto == Proto.TCP:
-            return "<HBBHB{}s".format(len(self.hostname)) 
-        else:
-            return "<HBBIB{}s".format(len(self.ser_name))
+        ret = []
+        run = []
+        for message in messages + [None]:
+            # the messages with tokens and without them are not mixed in a batch
+            if run and (type(message) is not type(run[0]) or bool(message.token) != bool(run[0].token) or
+                        len(run) == min(cls.MAX_ITEMS, (max_frame_size - cls._struct.size) // (6 if run[0].token else 2))):
+                if len(run) > 1:
+                    tokens = [m.token for m in run] if run[0].token else None
+                    ret.append(cls(run[0].message_type, [m.tunnel_id for m in run], tokens))
+                else:
+                    ret.extend(run)
+                run = []
+            if type(message) in BATCH_ITEMS.values():
+                run.append(message)
+            elif message is not None:
+                ret.append(message)
+        return ret
+
+
+# message type -> class of the messages a BatchMessage carries
+BATCH_ITEMS = dict((c.message_type, c) for c in (ConnectionReqMessage, TunnelClosedMessage, ParkReqMessage))
+
+STREAM_MESSAGES = dict((c.message_type, c) for c in (
+    StreamOpenMessage, StreamDataMessage, StreamWindowUpdateMessage, StreamCloseMessage))
 
+# the message type -> class dispatch table of the decoder
+MESSAGE_CLASSES = dict((c.message_type, c) for c in (
+    HandshakeMessage, TunnelReqMessage, ConnectionReqMessage, TunnelClosedMessage, BatchMessage, ParkReqMessage))
+MESSAGE_CLASSES.update(STREAM_MESSAGES)
+
+# the slaver alive ping, sent as is
+ALIVE_PING = b"0\n"
+
+
+class MessageReader ():
+    """ An incremental decoder of a control connection. A message may come in several reads,
+        and one read may hold several messages. Partial ones are buffered till they are complete.
+        Version 2 frames are split by their length, version 1 messages by their fields
+    """
 
+    def __init__(self, max_frame_size = MAX_FRAME_SIZE):
+        """ max_frame_size - the biggest frame this side accepts, as told to the other side in the handshake
+        """
+        self._buffer = bytearray() # the start of a partial message, it is grown in place by the next reads
+        self.max_frame_size = max_frame_size
 
+    def feed(self, data):
+        """ Returns the messages completed by the data. Alive pings are skipped
+            rtype: list
+        """
+        if self._buffer:
+            self._buffer += data
+            buff = self._buffer
+        else:
+            buff = data # nothing is buffered, the messages are decoded from the data as is
+        end = len(buff)
+        messages = []
+        pos = 0
+        # the view is released before the buffer is resized, the messages copy what they keep
+        with memoryview(buff) as view:
+            while pos < end:
+                if buff.startswith(ALIVE_PING, pos):
+                    pos += len(ALIVE_PING)
+                    continue
+                try:
+                    size = ControlMessage.message_size(view, pos, end, self.max_frame_size)
+                except Exception as e:
+                    # there is no way to find where the next message starts
+                    logging.error("Control message decode error: {}. {} bytes dropped".format(e, end - pos))
+                    pos = end
+                    break
+                if size is None or end - pos < size:
+                    break
+                message = ControlMessage.decode(view, pos, pos + size)
+                if message is not None:
+                    messages.append(message)
+                pos += size
+            if buff is not self._buffer and pos < end:
+                self._buffer += view[pos:]
+        if buff is self._buffer:
+            del self._buffer[:pos]
+        return messages
 
 class AbstractTunnel:
     pass
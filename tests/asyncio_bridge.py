@@ -0,0 +1,135 @@
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+from ..common.asyncio_bridge import *
+
+def bridged(bridge):
+    """ Two socket pairs linked by the bridge: what is sent into the first socket comes out of the second one
+        rtype: tuple - (socket.socket, socket.socket)
+    """
+    a1, b1 = socket.socketpair()
+    a2, b2 = socket.socketpair()
+    bridge.add_pair(b1, b2)
+    a1.settimeout(5)
+    a2.settimeout(5)
+    return a1, a2
+
+def read_all(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def make_certificate(directory):
+    """ A self-signed certificate for the SSL pairs
+        rtype: tuple - (certfile, keyfile)
+    """
+    certfile, keyfile = os.path.join(directory, "test.crt"), os.path.join(directory, "test.key")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                           "-subj", "/CN=localhost", "-keyout", keyfile, "-out", certfile],
+                          stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    return certfile, keyfile
+
+def ssl_pair(certfile, keyfile):
+    """ A connected pair of SSL sockets, the handshake is made
+        rtype: tuple - (server side, client side)
+    """
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(certfile, keyfile)
+    client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+    s, c = socket.socketpair()
+    s.settimeout(5)
+    c.settimeout(5)
+    result = {}
+    thread = threading.Thread(target = lambda: result.update(client = client_context.wrap_socket(c)))
+    thread.start()
+    server = server_context.wrap_socket(s, server_side = True)
+    thread.join()
+    return server, result["client"]
+
+if __name__ == "__main__":
+    reactor = AsyncioReactor.instance()
+
+    # the data is relayed both ways
+    bridge = AsyncioBridge(timeout = 5, reactor = reactor)
+    bridge.start_as_daemon()
+    a, b = bridged(bridge)
+    a.sendall(b"ping")
+    assert read_all(b, 4) == b"ping", "relay error"
+    b.sendall(b"pong")
+    assert read_all(a, 4) == b"pong", "relay error"
+
+    # a half-closed socket gets its data delivered before the pair is closed
+    payload = os.urandom(2 ** 20)
+    threading.Thread(target = lambda: (a.sendall(payload), a.shutdown(socket.SHUT_WR))).start()
+    assert read_all(b, len(payload) + 1) == payload, "half-close data lost"
+    assert b.recv(1) == b"", "half-close is not passed to the pair"
+    deadline = time.time() + 5
+    while reactor.run_in_loop(lambda: len(bridge.pairs)) and time.time() < deadline:
+        time.sleep(0.01)
+    assert reactor.run_in_loop(lambda: len(bridge.pairs)) == 0, "half-closed pair is not closed"
+    stats = bridge.get_stats()
+    assert stats["bytes_in"] == stats["bytes_out"] == len(payload) + 8, "relay stats error"
+
+    # a pair idle for the timeout is closed, and then its empty bridge fires the callback
+    closed = threading.Event()
+    idle = AsyncioBridge(closed.set, timeout = 0.5, reactor = reactor)
+    idle.start_as_daemon()
+    a, b = bridged(idle)
+    a.sendall(b"ping")
+    assert read_all(b, 4) == b"ping", "relay error"
+    started = time.time()
+    assert b.recv(1) == b"", "idle pair is not closed"
+    assert closed.wait(5) and time.time() - started < 4, "idle bridge timeout error"
+
+    # the callback is fired by a bridge closed from inside only, and the pairs are closed either way
+    fired = []
+    bridge = AsyncioBridge(lambda: fired.append(1), timeout = 5, reactor = reactor)
+    bridge.start_as_daemon()
+    a, b = bridged(bridge)
+    a.sendall(b"ping")
+    assert read_all(b, 4) == b"ping", "relay error"
+    bridge.close(True)
+    assert b.recv(1) == b"" and not fired, "bridge close from outside error"
+    bridge = AsyncioBridge(lambda: fired.append(1), timeout = 5, reactor = reactor)
+    bridge.start_as_daemon()
+    a, b = bridged(bridge)
+    bridge.close()
+    assert b.recv(1) == b"" and fired == [1], "bridge close callback error"
+
+    # asyncio refuses SSL sockets, so an SSL pair is relayed by the selector engine, the plain ones are not
+    directory = tempfile.mkdtemp()
+    try:
+        certfile, keyfile = make_certificate(directory)
+        ssl_server, ssl_client = ssl_pair(certfile, keyfile)
+    finally:
+        shutil.rmtree(directory)
+    bridge = AsyncioBridge(timeout = 5, reactor = reactor)
+    bridge.start_as_daemon()
+    a, b = bridged(bridge)
+    assert bridge._local is None, "plain pair is relayed by the selector engine"
+    plain, other = socket.socketpair()
+    plain.settimeout(5)
+    bridge.add_pair(ssl_server, other)
+    assert isinstance(bridge._local, SocketBridge), "SSL pair is not relayed by the selector engine"
+    ssl_client.sendall(b"secret")
+    assert read_all(plain, 6) == b"secret", "SSL pair relay error"
+    plain.sendall(b"answer")
+    assert read_all(ssl_client, 6) == b"answer", "SSL pair relay error"
+    a.sendall(b"ping")
+    assert read_all(b, 4) == b"ping", "plain pair relay error"
+    stats = bridge.get_stats()
+    assert stats["bytes_in"] == 16 and stats["pairs"] == 2, "SSL and plain pairs stats error"
+    bridge.close(True)
+    assert plain.recv(1) == b"" and b.recv(1) == b"", "bridge close error"
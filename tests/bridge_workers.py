@@ -0,0 +1,74 @@
+import os
+import signal
+import socket
+import time
+
+from ..common.bridge_workers import *
+
+def bridged(bridge):
+    """ Two socket pairs linked by the bridge: what is sent into the first socket comes out of the second one
+        rtype: tuple - (socket.socket, socket.socket)
+    """
+    a1, b1 = socket.socketpair()
+    a2, b2 = socket.socketpair()
+    bridge.add_pair(b1, b2)
+    a1.settimeout(5)
+    a2.settimeout(5)
+    return a1, a2
+
+def read_all(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def wait_for(fn, timeout = 5):
+    deadline = time.time() + timeout
+    while not fn():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def check_relay(bridge):
+    a, b = bridged(bridge)
+    a.sendall(b"ping")
+    assert read_all(b, 4) == b"ping", "relay error"
+    b.sendall(b"pong")
+    assert read_all(a, 4) == b"pong", "relay error"
+    return a, b
+
+if __name__ == "__main__":
+    assert BridgeWorkerPool.is_supported(), "bridge workers are not supported"
+    pool = BridgeWorkerPool(2)
+
+    # the pair is handed over to a worker process, this process keeps no descriptors of it
+    bridge = pool.create_bridge(timeout = 30)
+    bridge.start_as_daemon()
+    a, b = check_relay(bridge)
+    first = bridge._worker
+    assert first is not None and bridge._local is None, "pair is not handed over to a worker"
+    assert bridge.get_stats()["bytes_in"] == 8, "worker bridge stats error"
+    assert wait_for(lambda: first.load == 1), "worker load report error"
+
+    # a killed worker takes its pairs with it, the bridge moves to the worker left and keeps relaying
+    os.kill(first.process.pid, signal.SIGKILL)
+    assert b.recv(1) == b"", "pair of the killed worker is not closed"
+    assert wait_for(lambda: len(pool.get_stats()) == 1), "killed worker is not forgotten"
+    assert wait_for(lambda: bridge._worker not in (None, first)), "bridge is not moved to the worker left"
+    check_relay(bridge)
+    other = pool.create_bridge(timeout = 30)
+    other.start_as_daemon()
+    check_relay(other)
+    assert other._worker is bridge._worker, "new bridge worker error"
+
+    # with no worker left, the pairs are relayed in this process
+    os.kill(bridge._worker.process.pid, signal.SIGKILL)
+    assert wait_for(lambda: not pool.get_stats()), "killed worker is not forgotten"
+    assert wait_for(lambda: bridge._worker is None and bridge._local is not None), "bridge is not moved to this process"
+    check_relay(bridge)
+    bridge.close(True)
+    other.close(True)
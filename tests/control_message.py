@@ -1,4 +1,5 @@
 from ..common.control_message import *
+from ..common.control_message import _TunnelMessage
 
 if __name__ == "__main__":
     ser_name = "com21"
@@ -34,3 +35,139 @@ if __name__ == "__main__":
     data = ConnectionReqMessage(tunnel_id).encode()
     ms = ControlMessage.from_bytes(data)
     assert ms.tunnel_id == tunnel_id, "connection request message error"
+
+    data = StreamOpenMessage(7, tunnel_id, 3, 65536).encode()
+    ms = ControlMessage.from_bytes(data)
+    assert (ms.stream_id, ms.tunnel_id, ms.priority, ms.window) == (7, tunnel_id, 3, 65536), "stream open message error"
+
+    data = StreamDataMessage(7, b"payload").encode()
+    ms = ControlMessage.from_bytes(data)
+    assert ms.stream_id == 7 and ms.data == b"payload", "stream data message error"
+
+    data = StreamWindowUpdateMessage(7, 4096).encode()
+    ms = ControlMessage.from_bytes(data)
+    assert ms.stream_id == 7 and ms.increment == 4096, "stream window update message error"
+
+    data = StreamCloseMessage(7).encode()
+    ms = ControlMessage.from_bytes(data)
+    assert ms.stream_id == 7, "stream close message error"
+
+    # several messages in one read, a message split between reads, and alive pings in between
+    data = (HandshakeMessage(hwid, name).encode() + ALIVE_PING + ConnectionReqMessage(tunnel_id).encode() +
+            StreamDataMessage(7, b"payload").encode() + TunnelReqMessage(communicate_port=com_port, hostname=hostname, port= port).encode())
+    reader = MessageReader()
+    messages = reader.feed(data[:5]) + reader.feed(data[5:-3]) + reader.feed(data[-3:])
+    assert [type(m) for m in messages] == [HandshakeMessage, ConnectionReqMessage, StreamDataMessage, TunnelReqMessage], "message reader error"
+    assert messages[0].name == name and messages[2].data == b"payload" and messages[3].hostname == hostname, "message reader error"
+
+    # version 2 frames carry the payload length, version 1 messages are still decoded for old peers
+    data = ConnectionReqMessage(tunnel_id).encode()
+    assert len(data) == ControlMessage.FRAME_HEADER_SIZE + 2, "version 2 frame error"
+    assert ControlMessage.from_bytes(data).frame_version == VERSION_2, "version 2 frame error"
+    data = HandshakeMessage(hwid, name).encode(VERSION_1)
+    ms = ControlMessage.from_bytes(data)
+    assert ms.frame_version == VERSION_1 and ms.hwId == hwid and ms.name == name, "version 1 message error"
+
+    data = TunnelClosedMessage(tunnel_id).encode(VERSION_1) + StreamDataMessage(7, b"payload").encode() + \
+        TunnelReqMessage(communicate_port=com_port, ser_name=ser_name, baudrate= baudrate).encode(VERSION_1)
+    reader = MessageReader()
+    messages = []
+    for i in range(len(data)):
+        messages += reader.feed(data[i:i + 1])
+    assert [m.frame_version for m in messages] == [VERSION_1, VERSION_2, VERSION_1], "message reader versions error"
+    assert messages[2].ser_name == ser_name, "message reader versions error"
+
+    # a big frame comes in small reads: the partial frame is grown in place, and only the rest of the read is kept
+    payload = b"x" * 60000
+    data = StreamDataMessage(7, payload).encode() + ConnectionReqMessage(tunnel_id).encode()
+    reader = MessageReader()
+    messages = []
+    for i in range(0, len(data) - 3, 100):
+        messages += reader.feed(data[i:min(i + 100, len(data) - 3)])
+    assert len(messages) == 1 and messages[0].data == payload, "message reader big frame error"
+    assert len(reader._buffer) == len(ConnectionReqMessage(tunnel_id).encode()) - 3, "message reader rest error"
+    messages = reader.feed(data[-3:])
+    assert len(messages) == 1 and messages[0].tunnel_id == tunnel_id and not reader._buffer, "message reader rest error"
+
+    # a burst of connection requests goes in one batch, the order of the other messages is kept
+
+    messages = BatchMessage.coalesce([ConnectionReqMessage(1), ConnectionReqMessage(2), ConnectionReqMessage(3),
+        TunnelClosedMessage(4), StreamCloseMessage(7), ConnectionReqMessage(5)])
+    assert [type(m) for m in messages] == [BatchMessage, TunnelClosedMessage, StreamCloseMessage, ConnectionReqMessage], \
+        "batch coalesce error"
+    ms = ControlMessage.from_bytes(messages[0].encode())
+    assert ms.item_type == MessageType.CONNECTION_REQUEST and ms.tunnel_ids == [1, 2, 3], "batch message error"
+    assert [(type(m), m.tunnel_id) for m in ms.messages()] == [(ConnectionReqMessage, 1), (ConnectionReqMessage, 2),
+        (ConnectionReqMessage, 3)], "batch message error"
+    data = messages[0].encode(VERSION_1) + BatchMessage(MessageType.TUNNEL_CLOSED, [8, 9]).encode()
+    messages = MessageReader().feed(data)
+    assert [m.tunnel_ids for m in messages] == [[1, 2, 3], [8, 9]], "batch message reader error"
+    assert messages[1].messages()[0].__class__ == TunnelClosedMessage, "batch message reader error"
+
+    # the capabilities and limits of a handshake, and the terms both sides agree on
+    slaver = HandshakeMessage(hwid, name, Capability.BATCH | Capability.MUX, 2 ** 16, 60, 0)
+    ms = ControlMessage.from_bytes(slaver.encode())
+    assert (ms.name, ms.capabilities, ms.max_frame_size, ms.alive_period, ms.window) == \
+        (name, Capability.BATCH | Capability.MUX, 2 ** 16, 60, 0), "handshake capabilities error"
+    assert ControlMessage.from_bytes(slaver.encode(VERSION_1)).capabilities is None, "version 1 handshake error"
+    assert ControlMessage.from_bytes(HandshakeMessage(hwid, name).encode()).capabilities is None, "old handshake error"
+    terms = HandshakeMessage(0, "server", Capability.BATCH, MAX_FRAME_SIZE, 5, 4096).agree(ms)
+    assert terms.has(Capability.BATCH) and not terms.has(Capability.MUX), "handshake agree error"
+    assert (terms.max_frame_size, terms.alive_period, terms.window) == (2 ** 16, 5, 4096), "handshake agree error"
+
+    # a newer peer appends fields, they are skipped
+    data = bytearray(slaver.encode())
+    data[0] = VERSION_2 + 1
+    data[2] += 3
+    ms = MessageReader().feed(bytes(data) + b"new" + ConnectionReqMessage(tunnel_id).encode())
+    assert ms[0].name == name and ms[0].window == 0 and ms[1].tunnel_id == tunnel_id, "newer version error"
+
+    # the batches fit into the frames the other side accepts
+    messages = BatchMessage.coalesce([ConnectionReqMessage(n) for n in range(10)], BatchMessage._struct.size + 2 * 4)
+    assert [len(m.tunnel_ids) for m in messages] == [4, 4, 2], "batch frame size error"
+    data = messages[0].encode()
+    assert len(MessageReader(len(data) - ControlMessage.FRAME_HEADER_SIZE - 1).feed(data)) == 0, "reader frame size error"
+
+    # udp tunnels are requested like tcp ones
+    data = TunnelReqMessage(communicate_port=com_port, hostname=hostname, port= 161, udp = True).encode()
+    ms = MessageReader().feed(data)[0]
+    assert ms.proto == Proto.UDP and ms.hostname == hostname and ms.port == 161, "udp tunnel request message error"
+    assert (ms.idle_timeout, ms.flow_timeout) == (0, 0), "udp tunnel request timeouts error"
+    data = TunnelReqMessage(communicate_port=com_port, hostname=hostname, port= 161, udp = True,
+                            idle_timeout = 300, flow_timeout = 30).encode()
+    ms = MessageReader().feed(data)[0]
+    assert (ms.idle_timeout, ms.flow_timeout) == (300, 30), "udp tunnel request timeouts error"
+    # a server sending no timeouts
+    data = bytearray(data[:-TunnelReqMessage._udp_struct.size])
+    data[2] -= TunnelReqMessage._udp_struct.size
+    ms = MessageReader().feed(bytes(data))[0]
+    assert ms.port == 161 and (ms.idle_timeout, ms.flow_timeout) == (0, 0), "udp tunnel request timeouts error"
+
+    # the resume token follows the limits
+    ms = ControlMessage.from_bytes(HandshakeMessage(hwid, name, Capability.RESUME, token = 2 ** 63 + 5).encode())
+    assert ms.has(Capability.RESUME) and ms.token == 2 ** 63 + 5, "handshake token error"
+
+    # the connection requests carry the setup tokens, batched ones too
+    ms = ControlMessage.from_bytes(ConnectionReqMessage(tunnel_id, 2 ** 32 - 1).encode())
+    assert ms.tunnel_id == tunnel_id and ms.token == 2 ** 32 - 1, "connection request token error"
+    assert ControlMessage.from_bytes(ConnectionReqMessage(tunnel_id).encode()).token == 0, "connection request token error"
+    messages = BatchMessage.coalesce([ConnectionReqMessage(1, 11), ConnectionReqMessage(1, 12), ConnectionReqMessage(2),
+        ConnectionReqMessage(3)])
+    assert [m.tokens for m in messages] == [[11, 12], None], "batch tokens error"
+    ms = MessageReader().feed(b"".join([m.encode() for m in messages]))
+    assert [(m.tunnel_id, m.token) for m in ms[0].messages() + ms[1].messages()] == [(1, 11), (1, 12), (2, 0), (3, 0)], \
+        "batch tokens error"
+
+    # the requests of the pool connections are batched apart from the customer ones
+    messages = BatchMessage.coalesce([ConnectionReqMessage(1, 11), ParkReqMessage(1, 12), ParkReqMessage(1, 13)])
+    ms = MessageReader().feed(b"".join([m.encode() for m in messages]))
+    assert [type(m) for m in ms] == [ConnectionReqMessage, BatchMessage], "park request batch error"
+    assert [(type(m), m.token) for m in ms[1].messages()] == [(ParkReqMessage, 12), (ParkReqMessage, 13)], \
+        "park request batch error"
+
+    # the slavers tell the messages about tunnels apart by isinstance(), so none of them is taken for another
+    for cls in _TunnelMessage.__subclasses__():
+        ms = ControlMessage.from_bytes(cls(tunnel_id).encode())
+        assert type(ms) is cls and ms.tunnel_id == tunnel_id, "tunnel message type error"
+        others = [other for other in _TunnelMessage.__subclasses__() if other is not cls]
+        assert not any(isinstance(ms, other) for other in others), "tunnel message type error"
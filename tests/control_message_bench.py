@@ -0,0 +1,66 @@
+"""
+The control message decoder speed, compared with the decoder of a git revision. It prints the numbers only,
+timings depend on the machine and its load, so nothing is asserted on them.
+    python -m package.tests.control_message_bench [revision, HEAD by default]
+"""
+import os
+import subprocess
+import sys
+import timeit
+import types
+
+from ..common.control_message import *
+
+def load_revision(revision):
+    """ The control_message module as it is in the git revision
+        rtype: module or None, if there is no git or no such revision
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        source = subprocess.check_output(["git", "show", "{}:common/control_message.py".format(revision)],
+                                         cwd = root, stderr = subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    module = types.ModuleType("control_message_{}".format(revision))
+    exec(compile(source, "{}:common/control_message.py".format(revision), "exec"), module.__dict__)
+    return module
+
+def per_message(fn, count, number):
+    """ The best of several runs, in microseconds per message
+    """
+    return min(timeit.repeat(fn, number = number, repeat = 5)) / number / count * 1e6
+
+if __name__ == "__main__":
+    revision = sys.argv[1] if len(sys.argv) > 1 else "HEAD"
+    # a handshake, and the hot path of a multiplexed connection
+    frames = [HandshakeMessage(123456789, "device name").encode(), ConnectionReqMessage(3000).encode(), StreamDataMessage(5, b"x" * 1024).encode(),
+              StreamWindowUpdateMessage(5, 4096).encode()]
+    stream = b"".join(frames) * 100
+
+    old = load_revision(revision)
+    if old is None:
+        print("no revision {} to compare with".format(revision))
+    else:
+        try:
+            decoded = [old.ControlMessage.from_bytes(frame) for frame in frames]
+        except Exception:
+            decoded = [None]
+        if None in decoded:
+            print("the decoder of {} does not take these frames".format(revision))
+            old = None
+
+    number = 20000
+    new_time = per_message(lambda: [ControlMessage.from_bytes(frame) for frame in frames], len(frames), number)
+    if old:
+        old_time = per_message(lambda: [old.ControlMessage.from_bytes(frame) for frame in frames], len(frames), number)
+        print("decode  {:.2f} us/msg, {} {:.2f} us/msg".format(new_time, revision, old_time))
+    else:
+        print("decode  {:.2f} us/msg".format(new_time))
+
+    number = 100
+    new_time = per_message(lambda: MessageReader().feed(stream), len(frames) * 100, number)
+    if old and hasattr(old, "MessageReader"):
+        old_time = per_message(lambda: old.MessageReader().feed(stream), len(frames) * 100, number)
+        print("reader  {:.2f} us/msg, {} {:.2f} us/msg".format(new_time, revision, old_time))
+    else:
+        print("reader  {:.2f} us/msg".format(new_time))
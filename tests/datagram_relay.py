@@ -0,0 +1,73 @@
+import socket
+import threading
+import time
+
+from ..common.datagram_relay import *
+
+def udp_socket(timeout = 5):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(timeout)
+    return sock
+
+def wait_for(fn, timeout = 5):
+    deadline = time.time() + timeout
+    while not fn():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+if __name__ == "__main__":
+    # the server and the slaver ends of a tunnel, the target just answers
+    server_tunnel, customer_port, target = udp_socket(), udp_socket(), udp_socket()
+    slaver_tunnel = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    slaver_tunnel.connect(server_tunnel.getsockname())
+    server = DatagramServerRelay(server_tunnel, timeout = 30, flow_timeout = 1)
+    slaver = DatagramClientRelay(slaver_tunnel, target.getsockname(), timeout = 30, flow_timeout = 1)
+    # a keepalive from another host than the slaver one does not take the tunnel
+    stranger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stranger.bind(("127.0.0.2", 0))
+    stranger.sendto(DATAGRAM_HEADER.pack(KEEPALIVE_FLOW), server_tunnel.getsockname())
+    assert not server.wait_peer("127.0.0.1", 0.5) and server.peer is None, "stranger keepalive is taken"
+    slaver.start()
+    assert server.wait_peer("127.0.0.1", 5), "slaver keepalive error"
+    assert server.peer == slaver_tunnel.getsockname(), "slaver address error"
+    server.start(customer_port)
+
+    # a flow per customer address, and the answers find their customer
+    first, second = udp_socket(), udp_socket()
+    first.sendto(b"hello", customer_port.getsockname())
+    data, first_flow = target.recvfrom(MAX_DATAGRAM)
+    assert data == b"hello", "datagram relay error"
+    second.sendto(b"hi", customer_port.getsockname())
+    data, second_flow = target.recvfrom(MAX_DATAGRAM)
+    assert data == b"hi" and second_flow != first_flow, "a flow per customer error"
+    target.sendto(b"to second", second_flow)
+    target.sendto(b"to first", first_flow)
+    assert first.recvfrom(MAX_DATAGRAM)[0] == b"to first", "datagram reply error"
+    assert second.recvfrom(MAX_DATAGRAM)[0] == b"to second", "datagram reply error"
+    first.sendto(b"again", customer_port.getsockname())
+    assert target.recvfrom(MAX_DATAGRAM) == (b"again", first_flow), "flow reuse error"
+    stats = server.get_stats()
+    assert stats["flows"] == 2 and stats["bytes_in"] == 12 and stats["bytes_out"] == 17, "server flows stats error"
+    assert slaver.get_stats()["flows"] == 2, "slaver flows stats error"
+
+    # idle flows are expired on both ends, and a customer coming back gets a new flow
+    assert wait_for(lambda: not server.get_stats()["flows"] and not slaver.get_stats()["flows"]), "flow expiry error"
+    assert server.get_stats()["flows_total"] == 2, "expired flows stats error"
+    first.sendto(b"back", customer_port.getsockname())
+    data, flow = target.recvfrom(MAX_DATAGRAM)
+    assert data == b"back" and flow != first_flow, "expired flow is reused"
+    target.sendto(b"welcome", flow)
+    assert first.recvfrom(MAX_DATAGRAM)[0] == b"welcome", "new flow reply error"
+    server.close(True)
+    slaver.close(True)
+
+    # a relay idle for its timeout closes itself
+    closed = threading.Event()
+    tunnel = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tunnel.connect(server_tunnel.getsockname())
+    idle = DatagramClientRelay(tunnel, target.getsockname(), closed.set, timeout = 1)
+    idle.start()
+    assert closed.wait(5) and not idle.work, "datagram relay timeout error"
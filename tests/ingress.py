@@ -0,0 +1,86 @@
+import socket
+import ssl
+import time
+
+from ..common.ingress import *
+
+if __name__ == "__main__":
+    # the preamble and the CONNECT request are taken off the connection
+    data = b"TUNNEL Web3017\npayload"
+    assert parse_route(data) == (ROUTE_PREAMBLE, "web3017", len(data) - len(b"payload")), "preamble route error"
+    data = b"CONNECT 3017.tunnels.example.com:443 HTTP/1.1\r\nHost: 3017.tunnels.example.com:443\r\n\r\n"
+    assert parse_route(data + b"payload") == (ROUTE_CONNECT, "3017", len(data)), "connect route error"
+
+    # a route header split between reads waits for the rest
+    assert parse_route(b"CONN") is None and parse_route(b"TUNNEL 30") is None, "partial route error"
+    assert parse_route(data[:-2]) is None, "partial route error"
+    for bad in (b"GET / HTTP/1.1\r\n\r\n", b"TUNNEL \n", b"CONNECT host\r\n\r\n"):
+        try:
+            parse_route(bad)
+            assert False, "bad route header error"
+        except ValueError:
+            pass
+
+    # the server name of a client hello, it goes to the target as is
+    outgoing = ssl.MemoryBIO()
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    tls = context.wrap_bio(ssl.MemoryBIO(), outgoing, server_hostname = "db7.tunnels.example.com")
+    try:
+        tls.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    hello = outgoing.read()
+    assert parse_route(hello) == (ROUTE_SNI, "db7", 0), "sni route error"
+    assert parse_route(hello[:20]) is None, "partial client hello error"
+
+    # a routed customer is handed to its tunnel with the route header taken off, and the CONNECT request answered
+    class Tunnel(object):
+        def __init__(self):
+            self.customers = []
+        def add_customer(self, conn):
+            self.customers.append(conn)
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    ingress = IngressServer(port, "127.0.0.1")
+    tunnel = Tunnel()
+    assert ingress.add_route("3017", tunnel) and not ingress.add_route("3017", Tunnel()), "route taken error"
+    ingress.start()
+    customer = socket.create_connection(("127.0.0.1", port))
+    customer.settimeout(5)
+    customer.sendall(data + b"payload")
+    assert customer.recv(len(CONNECT_ESTABLISHED)) == CONNECT_ESTABLISHED, "connect reply error"
+    deadline = time.time() + 5
+    while not tunnel.customers and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(tunnel.customers) == 1, "routed customer error"
+    conn = tunnel.customers[0]
+    conn.settimeout(5)
+    assert conn.recv(100) == b"payload", "route header is not taken off"
+    assert ingress.get_stats()["routed"] == 1, "ingress stats error"
+
+    # a port that can not be bound is an error of start(), not of the ingress thread
+    try:
+        IngressServer(port, "127.0.0.1").start()
+        assert False, "busy ingress port is started"
+    except (OSError, socket.error):
+        pass
+
+    # a tunnel failing to take its customer does not stop the routing of the others
+    class BrokenTunnel(object):
+        def add_customer(self, conn):
+            raise RuntimeError("broken tunnel")
+    ingress.add_route("broken", BrokenTunnel())
+    broken = socket.create_connection(("127.0.0.1", port))
+    broken.settimeout(5)
+    broken.sendall(b"TUNNEL broken\n")
+    assert broken.recv(1) == b"", "failed customer is not closed"
+    customer = socket.create_connection(("127.0.0.1", port))
+    customer.sendall(b"TUNNEL 3017\nagain")
+    deadline = time.time() + 5
+    while len(tunnel.customers) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(tunnel.customers) == 2, "ingress routing is stopped by a failed tunnel"
+    tunnel.customers[1].settimeout(5)
+    assert tunnel.customers[1].recv(100) == b"again", "routed customer error"
@@ -0,0 +1,132 @@
+import socket
+import threading
+import time
+
+from ..common.mux import *
+
+class Link(object):
+    """ One direction of a control connection: the messages are encoded, and fed decoded to the other multiplexer.
+        A closed gate makes the connection slow, the writer is blocked till it is opened
+    """
+    def __init__(self):
+        self.reader = MessageReader()
+        self.mux = None # type: Multiplexer
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def send(self, message):
+        self.gate.wait()
+        for decoded in self.reader.feed(message.encode()):
+            assert self.mux.feed(decoded), "not a stream message"
+
+def read_all(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def wait_for(fn, timeout = 5):
+    deadline = time.time() + timeout
+    while not fn():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+if __name__ == "__main__":
+    window = 2 ** 15
+    targets = []
+    def on_open(mux, stream):
+        # the slaver connects the stream to the tunnel target
+        target, sock = socket.socketpair()
+        target.settimeout(5)
+        targets.append(target)
+        mux.attach(stream.id, sock)
+
+    to_slaver, to_server = Link(), Link()
+    server = Multiplexer(to_slaver.send, window = window)
+    slaver = Multiplexer(to_server.send, on_open, window)
+    to_slaver.mux, to_server.mux = slaver, server
+
+    # a stream is opened for a customer, and relayed both ways
+    customer, sock = socket.socketpair()
+    customer.settimeout(5)
+    server.open_stream(7, sock)
+    customer.sendall(b"ping")
+    assert wait_for(lambda: targets), "stream open error"
+    target = targets[0]
+    assert read_all(target, 4) == b"ping", "stream relay error"
+    target.sendall(b"pong")
+    assert read_all(customer, 4) == b"pong", "stream relay error"
+    assert server.has_streams(7) and slaver.has_streams(7) and not server.has_streams(8), "stream count error"
+
+    # the customer side sends no more than the slaver side has granted
+    payload = os.urandom(2 ** 22)
+    threading.Thread(target = customer.sendall, args = [payload]).start()
+    def settled():
+        before = server.get_stats(7)["bytes_in"]
+        time.sleep(0.2)
+        return server.get_stats(7)["bytes_in"] == before
+    assert wait_for(settled), "stream credit is not exhausted"
+    in_flight = server.get_stats(7)["bytes_in"] - slaver.get_stats(7)["bytes_out"]
+    assert 0 <= in_flight <= window, "stream window exceeded: {}".format(in_flight)
+    assert server.get_stats(7)["bytes_in"] < len(payload), "stream is not paused"
+    assert read_all(target, len(payload)) == payload, "stream window data error"
+
+    # a slow control connection to the slaver does not stall the other direction
+    to_slaver.gate.clear()
+    customer.sendall(b"stalled")
+    time.sleep(0.1)
+    target.sendall(b"still going")
+    assert read_all(customer, 11) == b"still going", "a slow control connection stalls the streams"
+    to_slaver.gate.set()
+    assert read_all(target, 7) == b"stalled", "stream data lost"
+
+    # closing the customer closes the target, and the stream is forgotten on both sides
+    customer.close()
+    assert target.recv(1) == b"", "stream close error"
+    assert wait_for(lambda: not server.has_streams(7) and not slaver.has_streams(7)), "closed stream is kept"
+
+    # and the other way round
+    customer, sock = socket.socketpair()
+    customer.settimeout(5)
+    server.open_stream(7, sock)
+    assert wait_for(lambda: len(targets) == 2), "stream open error"
+    targets[1].sendall(b"bye")
+    targets[1].close()
+    assert read_all(customer, 4) == b"bye", "stream close from the target error"
+    assert wait_for(lambda: not server.has_streams(7) and not slaver.has_streams(7)), "closed stream is kept"
+
+    server.close()
+    slaver.close()
+
+    # the other side is checked: a stream opened again is rejected and kept, and data over the window closes it
+    sent = []
+    def on_open_full(mux, stream):
+        # the target takes nothing, so the data is not written and no credit is granted back
+        target, sock = socket.socketpair()
+        sock.setblocking(False)
+        try:
+            while True:
+                sock.send(b"x" * 65536)
+        except (BlockingIOError, socket.error):
+            pass
+        targets.append(target)
+        mux.attach(stream.id, sock)
+    strict = Multiplexer(sent.append, on_open_full, window)
+    strict.feed(StreamOpenMessage(1, 7, 0, window))
+    assert wait_for(lambda: strict.has_streams(7)), "stream open error"
+    strict.feed(StreamOpenMessage(1, 8, 0, window))
+    assert wait_for(lambda: any(isinstance(m, StreamCloseMessage) for m in sent)), "opened again stream is not rejected"
+    assert strict.has_streams(7) and not strict.has_streams(8) and len(targets) == 3, "opened again stream error"
+    chunk = b"x" * 1024
+    for i in range(window // len(chunk)):
+        strict.feed(StreamDataMessage(1, chunk))
+    assert strict.has_streams(7), "stream is closed within its window"
+    strict.feed(StreamDataMessage(1, b"x"))
+    assert wait_for(lambda: not strict.has_streams(7)), "stream over its window is not closed"
+    assert sum(isinstance(m, StreamCloseMessage) for m in sent) == 2, "stream over its window close error"
+    strict.close()
@@ -0,0 +1,68 @@
+import socket
+import time
+
+from ..common.port_pool import *
+
+def free_range(size):
+    """ The first port of a range no socket holds now, so the test does not take the ports of other programs
+        rtype: int
+    """
+    for first in range(47000, 60000, size):
+        sockets = []
+        try:
+            for port in range(first, first + size):
+                for kind in (socket.SOCK_STREAM, socket.SOCK_DGRAM):
+                    sock = socket.socket(socket.AF_INET, kind)
+                    sockets.append(sock)
+                    sock.bind(("0.0.0.0", port))
+            return first
+        except socket.error:
+            pass
+        finally:
+            for sock in sockets:
+                sock.close()
+    raise Exception("no free port range")
+
+if __name__ == "__main__":
+    first = free_range(20)
+    # a port of the range taken by another program is set aside, and not tried again by the next allocation
+    # (for both kinds of sockets, the stream and datagram ports are bound separately)
+    other = socket.socket()
+    other.bind(("0.0.0.0", first + 2))
+    other.listen(1)
+    other_datagram = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    other_datagram.bind(("0.0.0.0", first + 2))
+
+    pool = PortPool(first, first + 4)
+    ports = []
+    for kind in (socket.SOCK_STREAM, socket.SOCK_DGRAM, socket.SOCK_STREAM):
+        sock, port = pool.allocate(kind)
+        assert sock is not None and first <= port < first + 4 and port != first + 2, "port allocation error"
+        assert sock.getsockname()[1] == port and sock.type == kind, "port allocation error"
+        ports.append((sock, port))
+    assert len(set(port for _, port in ports)) == 3, "port allocated twice"
+    assert pool.allocate() == (None, None), "port range exhaustion error"
+    stats = pool.get_stats()
+    assert (stats["ports_used"], stats["ports_busy"], stats["ports_free"]) == (3, 1, 0), "port stats error"
+    assert (stats["ports_exhausted"], stats["ports_found_busy"], stats["ports_utilisation"]) == (1, 1, 1.0), "port stats error"
+
+    # a released port goes back to the range, and its socket is closed. The second release does nothing
+    sock, port = ports[0]
+    pool.release(sock)
+    pool.release(sock)
+    assert sock.fileno() == -1 and pool.get_stats()["ports_used"] == 2, "port release error"
+    assert pool.allocate()[1] == port, "port release error"
+    other.close()
+    other_datagram.close()
+
+    # the sockets bound ahead are handed out first
+    pool = PortPool(first + 10, first + 20, prebound = 2)
+    pool.start()
+    for _ in range(100):
+        if pool.get_stats()["ports_prebound"] == 2:
+            break
+        time.sleep(0.01)
+    assert pool.get_stats()["ports_prebound"] == 2, "prebound ports error"
+    sock, port = pool.allocate()
+    assert sock.getsockname()[1] == port and pool.get_stats()["ports_used"] == 1, "prebound ports error"
+    sock.listen(1)
@@ -0,0 +1,110 @@
+import os
+import socket
+import threading
+import time
+import traceback
+
+from ..common.control_message import *
+from ..common.mux import *
+from ..slaver import slaver
+
+def listener():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(5)
+    sock.settimeout(5)
+    return sock
+
+def read_messages(conn, reader, count = 1):
+    """ Read the messages the slaver sends into the control connection, alive pings are skipped
+        rtype: list
+    """
+    messages = []
+    while len(messages) < count:
+        data = conn.recv(65536)
+        if not data:
+            break
+        messages += reader.feed(data)
+    return messages
+
+def read_all(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def server_handshake(token):
+    capabilities = Capability.BATCH | Capability.UDP | Capability.RESUME | Capability.SETUP_TOKEN | Capability.MUX
+    return HandshakeMessage(0, "server", capabilities, MAX_FRAME_SIZE, 60, MUX_WINDOW, token)
+
+def check_resume():
+    """ A fake server gives the slaver a session, loses the control connection, and resumes the session
+    """
+    slaver.MASTER_HOST = "127.0.0.1"
+    slaver.TUNNEL_IDLE_TIMEOUT = 1
+    control, tunnel, target = listener(), listener(), listener()
+    tunnel_port = tunnel.getsockname()[1]
+
+    # the slaver connects, and its session is given a resume token
+    device = slaver.Slaver.__new__(slaver.Slaver)
+    threading.Thread(target = device.__init__, args = ["127.0.0.1", control.getsockname()[1], "test device"]).start()
+    conn, _ = control.accept()
+    reader = MessageReader(MAX_FRAME_SIZE)
+    hs = read_messages(conn, reader)[0]
+    assert isinstance(hs, HandshakeMessage) and hs.has(Capability.RESUME) and not hs.token, "first handshake error"
+    conn.sendall(server_handshake(1234).encode())
+    conn.sendall(TunnelReqMessage(tunnel_port, hostname = "127.0.0.1", port = target.getsockname()[1]).encode())
+    # the tunnel connects to its target and to the tunnel port
+    tunnel_conn, _ = tunnel.accept()
+    target.accept()
+
+    # a customer of the tunnel is relayed by a stream, the tunnel outlives its idle bridge while the stream is open
+    server_mux = Multiplexer(lambda message: conn.sendall(message.encode()))
+    def feed():
+        try:
+            while True:
+                for message in read_messages(conn, reader):
+                    server_mux.feed(message)
+        except Exception:
+            pass # the control connection is broken
+    threading.Thread(target = feed).start()
+    customer, sock = socket.socketpair()
+    server_mux.open_stream(tunnel_port, sock)
+    stream_target, _ = target.accept()
+    customer.sendall(b"ping")
+    stream_target.settimeout(5)
+    assert read_all(stream_target, 4) == b"ping", "stream relay error"
+    assert tunnel_conn.recv(1) == b"", "idle tunnel pair is not closed"
+    time.sleep(slaver.TUNNEL_IDLE_TIMEOUT * 2)
+    assert tunnel_port in device.opened_tunnels, "tunnel with a stream is closed"
+
+    # the control connection is lost, and the slaver reconnects within the grace period presenting the token
+    server_mux.close()
+    conn.shutdown(socket.SHUT_RDWR)
+    conn.close()
+    conn, _ = control.accept()
+    reader = MessageReader(MAX_FRAME_SIZE)
+    hs = read_messages(conn, reader)[0]
+    assert isinstance(hs, HandshakeMessage) and hs.token == 1234, "resume token is not presented"
+    assert tunnel_port in device.opened_tunnels, "tunnel is not kept for the resume"
+    conn.sendall(server_handshake(5678).encode())
+
+    # the streams are gone with the old multiplexer, so the idle tunnel is closed at once on its next bridge timeout
+    resumed = time.time()
+    conn.settimeout(slaver.TUNNEL_IDLE_TIMEOUT + 3)
+    closed = read_messages(conn, reader)[0]
+    assert isinstance(closed, TunnelClosedMessage) and closed.tunnel_id == tunnel_port, "resumed tunnel close error"
+    assert time.time() - resumed < slaver.TUNNEL_IDLE_TIMEOUT + 2, "resumed tunnel close is delayed"
+    assert tunnel_port not in device.opened_tunnels, "closed tunnel is kept"
+
+if __name__ == "__main__":
+    # the slaver threads are not daemons, so the process is ended either way
+    try:
+        check_resume()
+    except Exception:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
@@ -0,0 +1,223 @@
+import socket
+import threading
+import time
+
+from ..common.socket_bridge import *
+
+def bridged(bridge):
+    """ Two socket pairs linked by the bridge: what is sent into the first socket comes out of the second one
+        rtype: tuple - (socket.socket, socket.socket)
+    """
+    a1, b1 = socket.socketpair()
+    a2, b2 = socket.socketpair()
+    bridge.add_pair(b1, b2)
+    a1.settimeout(5)
+    a2.settimeout(5)
+    return a1, a2
+
+def read_all(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def wait_for(reactor, fn, timeout = 5):
+    """ Poll the state of the reactor till the function is true
+    """
+    deadline = time.time() + timeout
+    while not reactor.run_in_loop(fn):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+class TrickleSocket(object):
+    """ Accepts a few bytes per send, as a socket with a full send buffer
+    """
+    def __init__(self, accepted):
+        self.accepted = accepted
+        self.data = b""
+
+    def send(self, data):
+        if not self.accepted:
+            raise BlockingIOError()
+        sent = bytes(data[:self.accepted])
+        self.data += sent
+        return len(sent)
+
+if __name__ == "__main__":
+    reactor = BridgeReactor()
+    reactor.start_as_daemon()
+
+    # the data is relayed both ways
+    bridge = SocketBridge(timeout = 5, reactor = reactor, zero_copy = False)
+    a, b = bridged(bridge)
+    a.sendall(b"ping")
+    assert read_all(b, 4) == b"ping", "relay error"
+    b.sendall(b"pong")
+    assert read_all(a, 4) == b"pong", "relay error"
+
+    # a half-closed socket gets its data delivered before the pair is closed
+    payload = os.urandom(2 ** 20)
+    a.sendall(payload[:2 ** 19])
+    threading.Thread(target = lambda: (a.sendall(payload[2 ** 19:]), a.shutdown(socket.SHUT_WR))).start()
+    assert read_all(b, len(payload) + 1) == payload, "half-close data lost"
+    assert b.recv(1) == b"", "half-close is not passed to the pair"
+    assert reactor.run_in_loop(lambda: len(bridge.pairs)) == 0, "half-closed pair is not closed"
+    assert bridge.get_stats()["bytes_in"] == len(payload) + 8, "relay stats error"
+
+    # a partial send keeps the rest of the chunk, and the next send continues from it
+    pool = BufferPool(slab_size = 2 ** 12)
+    buff = SendBuffer(pool)
+    x, y = socket.socketpair()
+    x.sendall(payload[:10000])
+    y.setblocking(False)
+    while buff.size < 10000:
+        buff.fill_from(y)
+    sink = TrickleSocket(3)
+    stats = TrafficStats()
+    assert buff.send_to(sink, stats) == 3 and buff.size == 10000 - 3, "partial send error"
+    time.sleep(0.01)
+    sink.accepted = 5000
+    while buff.size:
+        buff.send_to(sink, stats)
+    assert sink.data == payload[:10000] and stats.bytes_out == 10000, "partial send data error"
+    # every chunk has waited for 10 ms (2 ** 13 microseconds and more) since it was received
+    assert sum(stats.latency[14:]) == 3 and sum(stats.latency) == 3, "chunk latency error"
+    assert pool.stats()["in_use"] == 0, "sent slabs are not returned to the pool"
+    sink.accepted = 0
+    y.setblocking(True)
+    x.sendall(b"blocked")
+    buff.fill_from(y)
+    assert buff.send_to(sink, stats) == 0 and buff.size == 7, "blocked send error"
+    # the slabs are reused, a new one is allocated only when the pool has no free one
+    assert pool.stats()["misses"] == 3 and pool.stats()["allocated"] == 3, "buffer pool misses error"
+    buff.clear()
+
+    # the reader is paused while its peer has too much data not sent, and resumed when it is drained
+    high, low = 2 ** 16, 2 ** 14
+    bridge = SocketBridge(timeout = 5, reactor = reactor, zero_copy = False, high_watermark = high, low_watermark = low)
+    a, b = bridged(bridge)
+    pair = reactor.run_in_loop(lambda: next(iter(bridge.pairs)))
+    a.setblocking(False)
+    sent = 0
+    # the sender is blocked for a moment while the reactor catches up, till it is paused for good
+    while not reactor.run_in_loop(lambda: pair.ep1.paused) and sent < len(payload):
+        try:
+            sent += a.send(payload[sent:sent + 2 ** 16])
+        except BlockingIOError:
+            time.sleep(0.01)
+    assert reactor.run_in_loop(lambda: pair.ep1.paused), "watermark pause error"
+    assert high <= reactor.run_in_loop(lambda: pair.ep2.buff.size) < high + 2 ** 16, "watermark buffered size error"
+    # the reader is resumed as the peer drains, so the sender is not blocked for good
+    a.setblocking(True)
+    a.settimeout(5)
+    threading.Thread(target = a.sendall, args = [payload[sent:]]).start()
+    received = read_all(b, len(payload))
+    assert received == payload, "paused relay data error"
+    assert not reactor.run_in_loop(lambda: pair.ep1.paused), "watermark resume error"
+
+    # the bridges share the reactor thread, a pair idle for the timeout is closed, and then its empty bridge
+    closed = threading.Event()
+    idle = SocketBridge(closed.set, timeout = 0.5, reactor = reactor, zero_copy = False)
+    busy_closed = threading.Event()
+    busy = SocketBridge(busy_closed.set, timeout = 5, reactor = reactor, zero_copy = False)
+    assert idle.start_as_daemon() is busy.start_as_daemon() is reactor._thread, "reactor thread is not shared"
+    a, b = bridged(idle)
+    c, d = bridged(busy)
+    assert wait_for(reactor, lambda: len(reactor.endpoints) == 4), "shared reactor sockets error"
+    assert reactor.get_stats()["sockets"] == 4, "reactor stats error"
+    started = time.time()
+    assert b.recv(1) == b"", "idle pair is not closed"
+    assert not closed.is_set(), "bridge closed with a pair"
+    assert closed.wait(5) and time.time() - started < 4, "idle bridge timeout error"
+    c.sendall(b"ping")
+    assert read_all(d, 4) == b"ping", "the other bridge relay error"
+
+    # the callback is fired by a bridge closed from inside only, and the pairs are closed either way
+    fired = []
+    bridge = SocketBridge(lambda: fired.append(1), timeout = 5, reactor = reactor, zero_copy = False)
+    a, b = bridged(bridge)
+    bridge.close(True)
+    assert b.recv(1) == b"" and not fired, "bridge close from outside error"
+    busy.close()
+    assert busy_closed.is_set() and d.recv(1) == b"", "bridge close error"
+
+    # plain stream sockets are spliced, and the relay is the same
+    bridge = SocketBridge(timeout = 5, reactor = reactor)
+    a, b = bridged(bridge)
+    pair = reactor.run_in_loop(lambda: next(iter(bridge.pairs)))
+    buffer_class = PipeBuffer if SPLICE_ENABLED else SendBuffer
+    assert type(pair.ep1.buff) is type(pair.ep2.buff) is buffer_class, "splice buffer error"
+    threading.Thread(target = lambda: (a.sendall(payload), a.shutdown(socket.SHUT_WR))).start()
+    assert read_all(b, len(payload) + 1) == payload and b.recv(1) == b"", "splice relay error"
+    assert bridge.get_stats()["bytes_out"] == len(payload), "splice stats error"
+
+    # the sockets splice can not take (SSL ones are socket.socket subclasses) fall back to the userspace copy
+    class WrappedSocket(socket.socket):
+        pass
+    wrapped = WrappedSocket()
+    datagram = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    plain = socket.socket()
+    assert PipeBuffer.supports(plain) == SPLICE_ENABLED, "splice support error"
+    assert not PipeBuffer.supports(wrapped) and not PipeBuffer.supports(datagram), "splice fallback error"
+    assert type(reactor._create_buffer(bridge, wrapped, plain)) is SendBuffer, "splice fallback error"
+    assert type(reactor._create_buffer(bridge, plain, wrapped)) is SendBuffer, "splice fallback error"
+    bridge.zero_copy = False
+    assert type(reactor._create_buffer(bridge, plain, plain)) is SendBuffer, "zero copy off error"
+    for sock in (wrapped, datagram, plain):
+        sock.close()
+
+    # the profiles tune the TCP sockets: small writes go out at once, or the kernel buffers are big
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(5)
+    interactive = socket.create_connection(listener.getsockname())
+    bulk = socket.create_connection(listener.getsockname())
+    default_sndbuf = bulk.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    default_rcvbuf = bulk.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    tune_socket(interactive, get_profile("interactive"))
+    tune_socket(bulk, get_profile("bulk"))
+    assert interactive.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), "interactive profile nodelay error"
+    assert interactive.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE), "interactive profile keepalive error"
+    assert not bulk.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), "bulk profile nodelay error"
+    assert bulk.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) > default_sndbuf, "bulk profile send buffer error"
+    assert bulk.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) > default_rcvbuf, "bulk profile receive buffer error"
+    assert get_profile(None) is None and get_profile("unknown") is None, "unknown profile error"
+    # the OS measures the round trip time of a TCP connection only
+    interactive.sendall(b"ping")
+    rtt = tcp_rtt(interactive)
+    assert rtt is not None and 0 < rtt < 1, "TCP round trip time error: {}".format(rtt)
+    x, y = socket.socketpair()
+    assert tcp_rtt(x) is None, "unix socket round trip time error"
+    for sock in (interactive, bulk, listener, x, y):
+        sock.close()
+
+    # an adaptive pair reads the bandwidth-delay product, within its bounds and the high watermark
+    class Stub(object):
+        pass
+    def adapted_size(throughput, high_watermark = HIGH_WATERMARK):
+        """ The read size of a pair which relayed throughput bytes per second for ADAPT_PERIOD.
+            Its unix sockets have no round trip time, so ASSUMED_RTT is taken
+            rtype: int
+        """
+        adapting = BridgeReactor()
+        adapting.now = 100.0 + ADAPT_PERIOD
+        pair, bridge = Stub(), Stub()
+        bridge.high_watermark = high_watermark
+        pair.ep1, pair.ep2 = Stub(), Stub()
+        pair.ep1.sock, pair.ep2.sock = socket.socketpair()
+        pair.bytes_in, pair.sampled, pair.sampled_bytes = int(throughput * ADAPT_PERIOD), 100.0, 0
+        adapting._adapt_read_size(pair, bridge)
+        pair.ep1.sock.close()
+        pair.ep2.sock.close()
+        assert pair.ep1.read_size == pair.ep2.read_size, "adaptive read size differs in a pair"
+        assert pair.sampled == adapting.now and pair.sampled_bytes == pair.bytes_in, "adaptive sample error"
+        return pair.ep1.read_size
+    assert adapted_size(10 ** 7) == int(10 ** 7 * ASSUMED_RTT), "adaptive read size error"
+    assert adapted_size(10) == ADAPTIVE_MIN_READ, "adaptive read size lower bound error"
+    assert adapted_size(10 ** 10, 2 ** 30) == ADAPTIVE_MAX_READ, "adaptive read size upper bound error"
+    assert adapted_size(10 ** 10, 2 ** 16) == 2 ** 16, "adaptive read size watermark error"
@@ -0,0 +1,31 @@
+from ..common.timer_wheel import *
+
+class Timer(object):
+    def __init__(self, name):
+        self.name = name
+        self.deadline = None
+        self.wheel_slot = None
+
+if __name__ == "__main__":
+    wheel = TimerWheel(tick = 1.0, slots_count = 8)
+    now = wheel.current * wheel.tick
+    soon, later, far = Timer("soon"), Timer("later"), Timer("far")
+    wheel.schedule(soon, now + 1.5)
+    wheel.schedule(later, now + 3)
+    wheel.schedule(far, now + 20) # more than a wheel revolution ahead
+    assert wheel.count == 3, "timer wheel schedule error"
+
+    assert wheel.advance(now + 1) == [], "timer wheel expired too early"
+    assert wheel.advance(now + 2) == [soon], "timer wheel expire error"
+
+    wheel.schedule(later, now + 5) # moved
+    assert wheel.advance(now + 4) == [], "timer wheel reschedule error"
+    assert wheel.advance(now + 5) == [later], "timer wheel reschedule error"
+
+    assert wheel.advance(now + 12) == [], "timer wheel revolution error"
+    assert wheel.advance(now + 25) == [far], "timer wheel revolution error"
+    assert wheel.count == 0 and wheel.next_tick() is None, "timer wheel count error"
+
+    wheel.schedule(soon, now + 30)
+    wheel.cancel(soon)
+    assert wheel.advance(now + 40) == [] and wheel.count == 0, "timer wheel cancel error"
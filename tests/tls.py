@@ -0,0 +1,128 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+
+from ..common import tls
+from ..common.tls import *
+
+def make_certificate(directory):
+    """ A self-signed certificate of the server
+        rtype: tuple - (certfile, keyfile)
+    """
+    certfile, keyfile = os.path.join(directory, "test.crt"), os.path.join(directory, "test.key")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                           "-subj", "/CN=localhost", "-keyout", keyfile, "-out", certfile],
+                          stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    return certfile, keyfile
+
+def serve(listener, certfile, keyfile, stats, count):
+    """ Accept the connections with the TLS handshake, and greet each one, so the client gets its session ticket
+    """
+    for i in range(count):
+        conn, _ = listener.accept()
+        tls_conn = wrap_server(conn, certfile, keyfile, stats)
+        tls_conn.sendall(b"hello")
+        tls_conn.recv(1)
+        tls_conn.close()
+
+def connect(address, stats, sessions):
+    """ rtype: ssl.SSLSocket - the greeting is read
+    """
+    sock = socket.create_connection(address, 5)
+    tls_sock = wrap_client(sock, address, stats, sessions)
+    assert tls_sock.recv(5) == b"hello", "TLS relay error"
+    return tls_sock
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    try:
+        certfile, keyfile = make_certificate(directory)
+
+        # a context is made once per role, and the certificate is not reloaded
+        assert server_context(certfile, keyfile) is server_context(certfile, keyfile), "server context is not reused"
+        assert server_context(certfile, keyfile, True) is not server_context(certfile, keyfile), "kTLS context error"
+        assert client_context() is client_context() and client_context(True) is not client_context(), "client context error"
+
+        # the counters are added by the threads of the connections
+        stats = TlsStats()
+        threads = [threading.Thread(target = lambda: [stats.add(0.001, i % 2) for i in range(10000)]) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert stats.handshakes == 40000 and stats.resumed == 20000, "stats counters are lost"
+        assert stats.as_dict()["tls_handshake_ms"] == 1, "stats handshake time error"
+
+        # the cache has no session of an unknown host
+        sessions = TlsSessionCache()
+        assert sessions.get("127.0.0.1") is None, "unknown host session error"
+
+        # the second connection to the same host resumes the session of the first one
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        listener.settimeout(5)
+        address = listener.getsockname()
+        server_stats, client_stats = TlsStats(), TlsStats()
+        thread = threading.Thread(target = serve, args = [listener, certfile, keyfile, server_stats, 3])
+        thread.start()
+        first = connect(address, client_stats, sessions)
+        assert not first.session_reused, "first connection session error"
+        assert sessions.get(address[0]) is not None, "session is not cached"
+        first.close()
+        second = connect(address, client_stats, sessions)
+        assert second.session_reused, "session is not resumed"
+        second.close()
+        sessions.forget(address[0])
+        assert sessions.get(address[0]) is None, "forgotten session error"
+        third = connect(address, client_stats, sessions)
+        assert not third.session_reused, "forgotten session is resumed"
+        third.close()
+        thread.join(5)
+        assert client_stats.handshakes == 3 and client_stats.resumed == 1, "client resumed counter error"
+        assert server_stats.handshakes == 3 and server_stats.resumed == 1, "server resumed counter error"
+
+        # with the kernel TLS asked for, the connection works either way, and is counted offloaded only if it is
+        plain = socket.socket()
+        assert ktls_offload(plain) == (False, False), "plain socket offload error"
+        plain.close()
+        def check_ktls(certfile, keyfile):
+            """ rtype: tuple - (TlsStats of the server, the kernel sends the records of the server side)
+            """
+            server_stats = TlsStats()
+            conns = []
+            def accept():
+                conn, _ = listener.accept()
+                conns.append(wrap_server(conn, certfile, keyfile, server_stats, True))
+            thread = threading.Thread(target = accept)
+            thread.start()
+            client = wrap_client(socket.create_connection(address, 5), address, TlsStats(), TlsSessionCache(), True)
+            thread.join(5)
+            conn = conns[0]
+            conn.sendall(b"hello")
+            assert client.recv(5) == b"hello", "kTLS relay error"
+            client.sendall(b"hi")
+            assert conn.recv(2) == b"hi", "kTLS relay error"
+            offloaded = ktls_offload(conn)[0]
+            client.close()
+            conn.close()
+            return server_stats, offloaded
+        server_stats, offloaded = check_ktls(certfile, keyfile)
+        assert server_stats.handshakes == 1 and server_stats.offloaded == int(offloaded), "kTLS offloaded counter error"
+        # a platform without the kernel TLS does not ask OpenSSL for it, and nothing is offloaded
+        supported = tls.KTLS_SUPPORTED
+        tls.KTLS_SUPPORTED = False
+        try:
+            other_certfile = os.path.join(directory, "other.crt")
+            shutil.copy(certfile, other_certfile)
+            assert not server_context(other_certfile, keyfile, True).options & OP_ENABLE_KTLS, "unsupported kTLS is asked for"
+            server_stats, offloaded = check_ktls(other_certfile, keyfile)
+            assert not offloaded and server_stats.offloaded == 0, "unsupported kTLS offloaded counter error"
+        finally:
+            tls.KTLS_SUPPORTED = supported
+        listener.close()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,23 @@
+from ..common.socket_bridge import *
+
+if __name__ == "__main__":
+    bucket = TokenBucket(rate = 1000, burst = 500)
+    now = bucket.updated
+    assert bucket.available(now) == 500, "token bucket burst error"
+
+    bucket.consume(500)
+    assert bucket.available(now) == 0, "token bucket consume error"
+    assert abs(bucket.delay(100, now) - 0.1) < 1e-9, "token bucket delay error"
+    assert abs(bucket.available(now + 0.2) - 200) < 1e-6, "token bucket refill error"
+    assert bucket.available(now + 10) == 500, "token bucket refill above the burst"
+
+    # readers throttled by a bucket are resumed together
+    first = bucket.resume_at(now + 10)
+    assert first >= now + 10 + THROTTLE_MIN_DELAY, "token bucket resume error"
+    assert bucket.resume_at(now + 10.001) == first, "token bucket resume round error"
+
+    # the bridges of a device share one bucket, and the last limit wins
+    a = device_bucket(1, 1000)
+    b = device_bucket(1, 2000)
+    assert a is b and a.rate == 2000, "device bucket error"
+    assert device_bucket(2, 1000) is not a, "device bucket error"
@@ -0,0 +1,112 @@
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from .port_pool import free_range
+
+# the server imports the shared modules as "common", the way app.py runs it,
+# and makes its database file in the current directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp())
+from remote_server import *
+
+class FakeSlaver(object):
+    """ The session of an old slaver: the control messages are recorded, the test makes its connections
+    """
+    def __init__(self, hwId):
+        self.hwId = hwId
+        self.status = ONLINE
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def has_capability(self, capability):
+        return False
+
+    def get_mux(self):
+        return None
+
+def connect_slaver(tunnel_id, timeout = 5):
+    """ Connect to the communicate port of the tunnel, the moment it is listening
+        rtype: socket.socket
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return socket.create_connection(("127.0.0.1", tunnel_id))
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.01)
+
+def wait_for(fn, timeout = 5):
+    deadline = time.time() + timeout
+    while not fn():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def check_status_wait():
+    """ The open and status requests are answered the moment the tunnel is ready or fails, not at the end of their wait
+    """
+    # a tunnel over ssl has the slaver connection and its TLS handshake to wait for
+    assert TUNNEL_OPEN_TIMEOUT > SLAVER_CONNECT_TIMEOUT + TLS_HANDSHAKE_TIMEOUT, "tunnel open timeout error"
+    assert MAX_STATUS_WAIT >= TUNNEL_OPEN_TIMEOUT, "status wait limit error"
+    assert parse_wait("2.5") == 2.5 and parse_wait(0) == 0 and parse_wait("1e9") == MAX_STATUS_WAIT, "wait parse error"
+    for bad in ("soon", "-1", "nan", None, []):
+        try:
+            parse_wait(bad)
+            assert False, "bad wait error"
+        except ValueError:
+            pass
+
+    first = free_range(20)
+    server = RemoteServer.__new__(RemoteServer)
+    server._slavers = {1: FakeSlaver(1)}
+    server._opened_tunnels = {}
+    server._ports = PortPool(first, first + 20)
+    server._bridge_factory = SocketBridge
+    server._ingress = None
+    options = {"id": 1, "proto": "tcp", "host": "127.0.0.1", "port": 1, "ssl": False}
+
+    # the open request waits for the slaver connection, and is woken by it
+    replies = []
+    threading.Thread(target = lambda: replies.append(json.loads(server.open_tunnel(dict(options, wait = 20))))).start()
+    assert wait_for(lambda: server._opened_tunnels), "tunnel is not listed while it is opened"
+    tunnel_id = list(server._opened_tunnels)[0]
+    assert json.loads(server.get_tunnel_status(tunnel_id, 0)) == {"status": "opening", "id": tunnel_id}, "opening status error"
+    started = time.time()
+    slaver_conn = connect_slaver(tunnel_id)
+    assert wait_for(lambda: replies) and time.time() - started < 2, "open request is not woken"
+    tunnel = server._opened_tunnels[tunnel_id]
+    assert replies[0] == {"status": "ok", "port": tunnel.get_customer_port(), "id": tunnel_id}, "open reply error"
+    assert json.loads(server.get_tunnel_status(tunnel_id, 5))["status"] == "ok", "ready status error"
+    slaver_conn.close()
+
+    # a status request is woken by the tunnel failure
+    replies = []
+    opening = json.loads(server.open_tunnel(dict(options, port = 2, wait = 0)))
+    assert opening["status"] == "opening", "opening reply error"
+    threading.Thread(target = lambda: replies.append(json.loads(server.get_tunnel_status(opening["id"], 20)))).start()
+    time.sleep(0.2)
+    started = time.time()
+    server._opened_tunnels[opening["id"]].close()
+    assert wait_for(lambda: replies) and time.time() - started < 2, "status request is not woken"
+    assert replies[0] == {"status": "error"}, "failed tunnel status error"
+    tunnel.close()
+
+if __name__ == "__main__":
+    # the tunnel threads are not daemons, so the process is ended either way
+    try:
+        check_status_wait()
+    except Exception:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)